@@ -24,7 +24,7 @@ __all__ = ["A", "ASCII", "B", "BESTMATCH", "D", "DEBUG", "E", "ENHANCEMATCH",
   "F", "FULLCASE", "I", "IGNORECASE", "L", "LOCALE", "M", "MULTILINE", "P",
   "POSIX", "R", "REVERSE", "S", "DOTALL", "T", "TEMPLATE", "U", "UNICODE",
   "V0", "VERSION0", "V1", "VERSION1", "W", "WORD", "X", "VERBOSE", "error",
-  "Scanner"]
+  "Scanner", "TimeoutError", "MemoryLimitError"]
 
 # The regex exception.
 class error(Exception):
@@ -45,6 +45,20 @@ class error(Exception):
 
         Exception.__init__(self, message)
 
+# The exception for when matching runs out of time or steps. pos is the
+# position in the string which matching had reached.
+class TimeoutError(error):
+    def __init__(self, message, pos=None):
+        if pos is not None:
+            message = "{} at position {}".format(message, pos)
+
+        error.__init__(self, message)
+        self.pos = pos
+
+# The exception for when matching needs more memory than it's allowed.
+class MemoryLimitError(error):
+    pass
+
 # The exception for when a positional flag has been turned on in the old
 # behaviour.
 class _UnscopedFlagSet(Exception):
@@ -58,6 +72,10 @@ class ParseError(Exception):
 class _FirstSetError(Exception):
     pass
 
+# The exception for when a pattern can't be run by the lazy DFA.
+class _DFAError(Exception):
+    pass
+
 # Flags.
 A = ASCII = 0x80          # Assume ASCII locale.
 B = BESTMATCH = 0x1000    # Best fuzzy match.
@@ -225,55 +243,18 @@ OP = Namespace()
 for i, op in enumerate(OPCODES.split()):
     setattr(OP, op, i)
 
-def _shrink_cache(cache_dict, args_dict, locale_sensitive, max_length, divisor=5):
-    """Make room in the given cache.
+# The zero-width assertions which the lazy DFA can test.
+DFA_ASSERTIONS = frozenset([OP.BOUNDARY, OP.DEFAULT_BOUNDARY,
+  OP.DEFAULT_END_OF_WORD, OP.DEFAULT_START_OF_WORD, OP.END_OF_LINE,
+  OP.END_OF_LINE_U, OP.END_OF_STRING, OP.END_OF_STRING_LINE,
+  OP.END_OF_STRING_LINE_U, OP.END_OF_WORD, OP.START_OF_LINE,
+  OP.START_OF_LINE_U, OP.START_OF_STRING, OP.START_OF_WORD])
 
-    Args:
-        cache_dict: The cache dictionary to modify.
-        args_dict: The dictionary of named list args used by patterns.
-        max_length: Maximum # of entries in cache_dict before it is shrunk.
-        divisor: Cache will shrink to max_length - 1/divisor*max_length items.
-    """
-    # Toss out a fraction of the entries at random to make room for new ones.
-    # A random algorithm was chosen as opposed to simply cache_dict.popitem()
-    # as popitem could penalize the same regular expression repeatedly based
-    # on its internal hash value.  Being random should spread the cache miss
-    # love around.
-    cache_keys = tuple(cache_dict.keys())
-    overage = len(cache_keys) - max_length
-    if overage < 0:
-        # Cache is already within limits.  Normally this should not happen
-        # but it could due to multithreading.
-        return
-
-    number_to_toss = max_length // divisor + overage
-
-    # The import is done here to avoid a circular dependency.
-    import random
-    if not hasattr(random, 'sample'):
-        # Do nothing while resolving the circular dependency:
-        #  re->random->warnings->tokenize->string->re
-        return
-
-    for doomed_key in random.sample(cache_keys, number_to_toss):
-        try:
-            del cache_dict[doomed_key]
-        except KeyError:
-            # Ignore problems if the cache changed from another thread.
-            pass
-
-    # Rebuild the arguments and locale-sensitivity dictionaries.
-    args_dict.clear()
-    sensitivity_dict = {}
-    for pattern, pattern_type, flags, args, default_version, locale in tuple(cache_dict):
-        args_dict[pattern, pattern_type, flags, default_version, locale] = args
-        try:
-            sensitivity_dict[pattern_type, pattern] = locale_sensitive[pattern_type, pattern]
-        except KeyError:
-            pass
+# The maximum number of instructions in a program for the lazy DFA.
+MAX_DFA_SIZE = 1000
 
-    locale_sensitive.clear()
-    locale_sensitive.update(sensitivity_dict)
+# The maximum nesting of the branches when merging literals into a trie.
+MAX_TRIE_DEPTH = 32
 
 def _fold_case(info, string):
     "Folds the case of a string."
@@ -302,7 +283,7 @@ def _compile_firstset(info, fs):
             if isinstance(i, Character):
                 if is_cased(info, i.value):
                     return []
-            elif isinstance(i, SetBase):
+            elif isinstance(i, (Property, SetBase)):
                 return []
 
         members.add(i.with_flags(case_flags=NOCASE))
@@ -1810,6 +1791,19 @@ class RegexBase:
     def get_required_string(self, reverse):
         return self.max_width(), None
 
+    def get_required_alternatives(self, reverse):
+        return self.max_width(), None
+
+    def get_required_sequence(self, reverse):
+        ofs, req = self.get_required_string(reverse)
+        if req:
+            return [req]
+
+        return []
+
+    def _compile_dfa(self, program, reverse, next):
+        raise _DFAError()
+
 # Base class for zero-width nodes.
 class ZeroWidthBase(RegexBase):
     def __init__(self, positive=True):
@@ -1831,6 +1825,13 @@ class ZeroWidthBase(RegexBase):
             flags |= REVERSE_OP
         return [(self._opcode, flags)]
 
+    def _compile_dfa(self, program, reverse, next):
+        code = self._compile(False, False)
+        if code[0][0] not in DFA_ASSERTIONS:
+            raise _DFAError()
+
+        return program.add_test(code, next)
+
     def _dump(self, indent, reverse):
         print("{}{} {}".format(INDENT * indent, self._op_name,
           POS_TEXT[self.positive]))
@@ -1851,6 +1852,9 @@ class Any(RegexBase):
             flags |= FUZZY_OP
         return [(self._opcode[reverse], flags)]
 
+    def _compile_dfa(self, program, reverse, next):
+        return program.add_test(self._compile(False, False), next)
+
     def _dump(self, indent, reverse):
         print("{}{}".format(INDENT * indent, self._op_name))
 
@@ -1921,6 +1925,12 @@ class Atomic(RegexBase):
     def get_required_string(self, reverse):
         return self.subpattern.get_required_string(reverse)
 
+    def get_required_alternatives(self, reverse):
+        return self.subpattern.get_required_alternatives(reverse)
+
+    def get_required_sequence(self, reverse):
+        return self.subpattern.get_required_sequence(reverse)
+
 class Boundary(ZeroWidthBase):
     _opcode = OP.BOUNDARY
     _op_name = "BOUNDARY"
@@ -1929,8 +1939,15 @@ class Branch(RegexBase):
     def __init__(self, branches):
         RegexBase.__init__(self)
         self.branches = branches
+        self.reverse = None
+        self.fuzzy = False
 
     def fix_groups(self, pattern, reverse, fuzzy):
+        # Literals can be merged only if the direction in which the branches
+        # will be matched is known.
+        self.reverse = reverse
+        self.fuzzy = fuzzy
+
         for b in self.branches:
             b.fix_groups(pattern, reverse, fuzzy)
 
@@ -1938,6 +1955,14 @@ class Branch(RegexBase):
         # Flatten branches within branches.
         branches = Branch._flatten_branches(info, self.branches)
 
+        # Merge literals with common prefixes, or common suffixes if matching
+        # in reverse. A group which is called might be matched in either
+        # direction.
+        if (self.reverse is not None and not self.fuzzy and not
+          info.group_calls):
+            branches = Branch._merge_common_prefixes(info, branches,
+              self.reverse)
+
         # Move any common prefix or suffix out of the branches.
         prefix, branches = Branch._split_common_prefix(info, branches)
 
@@ -1975,6 +2000,17 @@ class Branch(RegexBase):
 
         return fs or set([None])
 
+    def _compile_dfa(self, program, reverse, next):
+        entries = [b._compile_dfa(program, reverse, next) for b in
+          self.branches]
+
+        # Each branch is tried before the ones which follow it.
+        entry = entries.pop()
+        while entries:
+            entry = program.add([(OP.BRANCH, entries.pop(), entry)])
+
+        return entry
+
     def _compile(self, reverse, fuzzy):
         code = [(OP.BRANCH, )]
         for b in self.branches:
@@ -2141,35 +2177,194 @@ class Branch(RegexBase):
         return True
 
     @staticmethod
-    def _merge_common_prefixes(info, branches):
-        # Branches with the same case-sensitive character prefix can be grouped
-        # together if they are separated only by other branches with a
-        # character prefix.
-        prefixed = defaultdict(list)
-        order = {}
+    def _merge_common_prefixes(info, branches, reverse):
+        # Branches which are case-sensitive literals are merged into a trie so
+        # that those with a common prefix share it. When matching in reverse
+        # the literals are matched from their ends, so the trie is built from
+        # their reversed codepoints instead and they share common suffixes.
+        #
+        # A literal can share the prefix of an earlier one only if every
+        # literal between them which also reached that point in the trie
+        # continued with a different codepoint. At most one of those can
+        # match at any position, so their order doesn't matter. A literal
+        # which ends there, or a branch which isn't a literal, can match as
+        # well, so the order matters and it prevents the sharing.
         new_branches = []
+        literals = []
         for b in branches:
-            if Branch._is_simple_character(b):
-                # Branch starts with a simple character.
-                prefixed[b.value].append([b])
-                order.setdefault(b.value, len(order))
-            elif (isinstance(b, Sequence) and b.items and
-              Branch._is_simple_character(b.items[0])):
-                # Branch starts with a simple character.
-                prefixed[b.items[0].value].append(b.items)
-                order.setdefault(b.items[0].value, len(order))
+            characters = Branch._literal_characters(b)
+            if characters is None:
+                Branch._flush_literals(info, literals, reverse, new_branches)
+                new_branches.append(b)
             else:
-                Branch._flush_char_prefix(info, prefixed, order, new_branches)
+                if reverse:
+                    characters = characters[ : : -1]
 
-                new_branches.append(b)
+                literals.append(characters)
 
-        Branch._flush_char_prefix(info, prefixed, order, new_branches)
+        Branch._flush_literals(info, literals, reverse, new_branches)
 
         return new_branches
 
+    @staticmethod
+    def _literal_characters(b):
+        # Gets the codepoints of a branch which is a case-sensitive literal as
+        # a tuple, or None if it isn't one.
+        if isinstance(b, String):
+            if b.case_flags & IGNORECASE:
+                return None
+
+            return b.characters
+
+        if isinstance(b, Sequence):
+            items = b.items
+        else:
+            items = [b]
+
+        characters = []
+        for i in items:
+            if Branch._is_simple_character(i):
+                characters.append(i.value)
+            elif isinstance(i, String) and not i.case_flags & IGNORECASE:
+                characters.extend(i.characters)
+            else:
+                return None
+
+        return tuple(characters)
+
+    @staticmethod
+    def _flush_literals(info, literals, reverse, new_branches):
+        # Flush the literals as a trie. The trie is built and then unpacked
+        # without recursion, so that long literals don't hit the recursion
+        # limit. A node of the trie holds the codepoints which its literals
+        # share, so only a branching point needs a node, and each codepoint of
+        # each literal is visited once at each of its branching points. The
+        # branches are nested at each node, and the later passes recurse into
+        # them, so below a certain depth the literals are left unmerged.
+        if not literals:
+            return
+
+        root = Branch._split_literals(literals, 0)
+        nodes = []
+        stack = [(root, 0)]
+        while stack:
+            node, level = stack.pop()
+            nodes.append(node)
+            entries = node[3]
+            for i, e in enumerate(entries):
+                if e is None:
+                    pass
+                elif len(e) == 1:
+                    # Nothing shares the rest of this literal.
+                    entries[i] = Branch._make_literal(e[0][node[2] : ],
+                      reverse)
+                elif level + 1 >= MAX_TRIE_DEPTH:
+                    entries[i] = [e[0], node[2], node[2],
+                      [Branch._make_literal(l[node[2] : ], reverse) for l in
+                      e]]
+                    nodes.append(entries[i])
+                else:
+                    entries[i] = Branch._split_literals(e, node[2])
+                    stack.append((entries[i], level + 1))
+
+        # Every node comes after its parent, so unpacking the nodes in reverse
+        # order unpacks the children first.
+        unpacked = {}
+        for node in reversed(nodes):
+            unpacked[id(node)] = Branch._unpack_literals(info, node, unpacked,
+              reverse)
+
+        merged = unpacked[id(root)]
+        if isinstance(merged, Branch):
+            new_branches.extend(merged.branches)
+        else:
+            new_branches.append(merged)
+
+        del literals[:]
+
+    @staticmethod
+    def _split_literals(literals, depth):
+        # Builds a node of the trie from literals which share their first
+        # 'depth' codepoints. The node is the literals' first codepoint, its
+        # depth, the depth to which they all match, and its entries in order.
+        # An entry is either a list of the literals which continue with the
+        # same codepoint or None where a literal ends.
+        first = literals[0]
+        shortest = min(len(l) for l in literals)
+        end = depth
+        while end < shortest and all(l[end] == first[end] for l in literals):
+            end += 1
+
+        entries = []
+        children = {}
+        for l in literals:
+            if len(l) == end:
+                if not entries or entries[-1] is not None:
+                    entries.append(None)
+
+                # A literal which continues past here can no longer share the
+                # children before this point.
+                children = {}
+            else:
+                child = children.get(l[end])
+                if child is None:
+                    child = children[l[end]] = []
+                    entries.append(child)
+
+                child.append(l)
+
+        return [first, depth, end, entries]
+
+    @staticmethod
+    def _unpack_literals(info, node, unpacked, reverse):
+        # Unpacks a node of the trie whose children have been unpacked.
+        first, depth, end, entries = node
+        if entries == [None]:
+            items = []
+        else:
+            alternatives = []
+            for e in entries:
+                if e is None:
+                    alternatives.append(Sequence())
+                elif isinstance(e, list):
+                    alternatives.append(unpacked.pop(id(e)))
+                else:
+                    alternatives.append(e)
+
+            alternatives = Branch._reduce_to_set(info, alternatives)
+            if len(alternatives) > 1:
+                items = [Branch(alternatives)]
+            else:
+                items = alternatives
+
+        if end > depth:
+            prefix = Branch._make_literal(first[depth : end], reverse)
+            if reverse:
+                items.append(prefix)
+            else:
+                items.insert(0, prefix)
+
+        return make_sequence(items)
+
+    @staticmethod
+    def _make_literal(characters, reverse):
+        # Makes a literal from codepoints taken from the trie. A single
+        # codepoint is left as a character so that it can be reduced to a set.
+        if reverse:
+            characters = characters[ : : -1]
+
+        if not characters:
+            return Sequence()
+
+        if len(characters) == 1:
+            return Character(characters[0])
+
+        return Literal(characters)
+
     @staticmethod
     def _is_simple_character(c):
-        return isinstance(c, Character) and c.positive and not c.case_flags
+        return (isinstance(c, Character) and c.positive and not c.zerowidth
+          and not c.case_flags & IGNORECASE)
 
     @staticmethod
     def _reduce_to_set(info, branches):
@@ -2198,32 +2393,6 @@ class Branch(RegexBase):
 
         return new_branches
 
-    @staticmethod
-    def _flush_char_prefix(info, prefixed, order, new_branches):
-        # Flush the prefixed branches.
-        if not prefixed:
-            return
-
-        for value, branches in sorted(prefixed.items(), key=lambda pair:
-          order[pair[0]]):
-            if len(branches) == 1:
-                new_branches.append(make_sequence(branches[0]))
-            else:
-                subbranches = []
-                optional = False
-                for b in branches:
-                    if len(b) > 1:
-                        subbranches.append(make_sequence(b[1 : ]))
-                    elif not optional:
-                        subbranches.append(Sequence())
-                        optional = True
-
-                sequence = Sequence([Character(value), Branch(subbranches)])
-                new_branches.append(sequence.optimise(info))
-
-        prefixed.clear()
-        order.clear()
-
     @staticmethod
     def _flush_set_members(info, items, case_flags, new_branches):
         # Flush the set members.
@@ -2279,6 +2448,20 @@ class Branch(RegexBase):
     def max_width(self):
         return max(b.max_width() for b in self.branches)
 
+    def get_required_alternatives(self, reverse):
+        # Every branch must have a required string at a known offset.
+        offset = 0
+        alternatives = []
+        for b in self.branches:
+            ofs, req = b.get_required_string(reverse)
+            if not req or ofs >= UNLIMITED:
+                return self.max_width(), None
+
+            offset = max(offset, ofs)
+            alternatives.append(req)
+
+        return offset, alternatives
+
 class CallGroup(RegexBase):
     def __init__(self, info, group, position):
         RegexBase.__init__(self)
@@ -2308,7 +2491,7 @@ class CallGroup(RegexBase):
         self._key = self.__class__, self.group
 
     def remove_captures(self):
-        raise error("group reference not allowed", pattern, self.position)
+        raise error("group reference not allowed", None, self.position)
 
     def _compile(self, reverse, fuzzy):
         return [(OP.GROUP_CALL, self.call_ref)]
@@ -2377,6 +2560,12 @@ class Character(RegexBase):
 
         return code.compile(reverse, fuzzy)
 
+    def _compile_dfa(self, program, reverse, next):
+        if self.zerowidth or len(self.folded) > 1:
+            raise _DFAError()
+
+        return program.add_test(self._compile(False, False), next)
+
     def _dump(self, indent, reverse):
         display = ascii(chr(self.value)).lstrip("bu")
         print("{}CHARACTER {} {}{}".format(INDENT * indent,
@@ -2437,8 +2626,7 @@ class Conditional(RegexBase):
         return self
 
     def remove_captures(self):
-        self.yes_item = self.yes_item.remove_captures()
-        self.no_item = self.no_item.remove_captures()
+        raise error("group reference not allowed", None, self.position)
 
     def is_atomic(self):
         return self.yes_item.is_atomic() and self.no_item.is_atomic()
@@ -2721,6 +2909,38 @@ class GreedyRepeat(RegexBase):
 
         return ([tuple(repeat)] + subpattern + [(OP.END, )])
 
+    def _compile_dfa(self, program, reverse, next):
+        program.has_repeat = True
+
+        if self.max_count is None:
+            # The branch of the loop is filled in once the body is compiled.
+            loop = program.add(None)
+            body = self._compile_dfa_body(program, reverse, loop)
+            program.instructions[loop] = self._dfa_choice(body, next)
+            next = loop
+        else:
+            for i in range(self.max_count - self.min_count):
+                body = self._compile_dfa_body(program, reverse, next)
+                next = program.add(self._dfa_choice(body, next))
+
+        for i in range(self.min_count):
+            next = self._compile_dfa_body(program, reverse, next)
+
+        return next
+
+    def _compile_dfa_body(self, program, reverse, next):
+        body = self.subpattern._compile_dfa(program, reverse, next)
+
+        # The matching engine treats an iteration which matches an empty
+        # string specially, so the DFA would disagree with it.
+        if program.is_nullable(body, next):
+            raise _DFAError()
+
+        return body
+
+    def _dfa_choice(self, body, next):
+        return [(OP.BRANCH, body, next)]
+
     def _dump(self, indent, reverse):
         if self.max_count is None:
             limit = "INF"
@@ -2758,6 +2978,23 @@ class GreedyRepeat(RegexBase):
         w = self.subpattern.max_width() * max_count
         return min(w, UNLIMITED), None
 
+    def get_required_alternatives(self, reverse):
+        max_count = UNLIMITED if self.max_count is None else self.max_count
+        if self.min_count > 0:
+            ofs, alternatives = self.subpattern.get_required_alternatives(
+              reverse)
+            if alternatives:
+                return ofs, alternatives
+
+        w = self.subpattern.max_width() * max_count
+        return min(w, UNLIMITED), None
+
+    def get_required_sequence(self, reverse):
+        if self.min_count == 0:
+            return []
+
+        return self.subpattern.get_required_sequence(reverse)
+
 class Group(RegexBase):
     def __init__(self, info, group, subpattern):
         RegexBase.__init__(self)
@@ -2819,6 +3056,9 @@ class Group(RegexBase):
 
         return code
 
+    def _compile_dfa(self, program, reverse, next):
+        return self.subpattern._compile_dfa(program, reverse, next)
+
     def _dump(self, indent, reverse):
         group = self.group
         if group < 0:
@@ -2836,6 +3076,12 @@ class Group(RegexBase):
     def get_required_string(self, reverse):
         return self.subpattern.get_required_string(reverse)
 
+    def get_required_alternatives(self, reverse):
+        return self.subpattern.get_required_alternatives(reverse)
+
+    def get_required_sequence(self, reverse):
+        return self.subpattern.get_required_sequence(reverse)
+
 class Keep(ZeroWidthBase):
     _opcode = OP.KEEP
     _op_name = "KEEP"
@@ -2844,6 +3090,9 @@ class LazyRepeat(GreedyRepeat):
     _opcode = OP.LAZY_REPEAT
     _op_name = "LAZY_REPEAT"
 
+    def _dfa_choice(self, body, next):
+        return [(OP.BRANCH, next, body)]
+
 class LookAround(RegexBase):
     _dir_text = {False: "AHEAD", True: "BEHIND"}
 
@@ -2868,7 +3117,8 @@ class LookAround(RegexBase):
         return self
 
     def remove_captures(self):
-        return self.subpattern.remove_captures()
+        self.subpattern = self.subpattern.remove_captures()
+        return self
 
     def is_atomic(self):
         return self.subpattern.is_atomic()
@@ -2945,6 +3195,12 @@ class Property(RegexBase):
             flags |= FUZZY_OP
         return [(self._opcode[self.case_flags, reverse], flags, self.value)]
 
+    def _compile_dfa(self, program, reverse, next):
+        if self.zerowidth:
+            raise _DFAError()
+
+        return program.add_test(self._compile(False, False), next)
+
     def _dump(self, indent, reverse):
         prop = PROPERTY_NAMES[self.value >> 16]
         name, value = prop[0], prop[1][self.value & 0xFFFF]
@@ -3027,6 +3283,12 @@ class Range(RegexBase):
         return [(self._opcode[self.case_flags, reverse], flags, self.lower,
           self.upper)]
 
+    def _compile_dfa(self, program, reverse, next):
+        if self.zerowidth:
+            raise _DFAError()
+
+        return program.add_test(self._compile(False, False), next)
+
     def _dump(self, indent, reverse):
         display_lower = ascii(chr(self.lower)).lstrip("bu")
         display_upper = ascii(chr(self.upper)).lstrip("bu")
@@ -3071,7 +3333,7 @@ class RefGroup(RegexBase):
         self._key = self.__class__, self.group, self.case_flags
 
     def remove_captures(self):
-        raise error("group reference not allowed", pattern, self.position)
+        raise error("group reference not allowed", None, self.position)
 
     def _compile(self, reverse, fuzzy):
         flags = 0
@@ -3192,6 +3454,17 @@ class Sequence(RegexBase):
 
         return code
 
+    def _compile_dfa(self, program, reverse, next):
+        # The program is built from the end backwards.
+        seq = self.items
+        if not reverse:
+            seq = seq[::-1]
+
+        for s in seq:
+            next = s._compile_dfa(program, reverse, next)
+
+        return next
+
     def _dump(self, indent, reverse):
         for s in self.items:
             s.dump(indent, reverse)
@@ -3237,6 +3510,41 @@ class Sequence(RegexBase):
 
         return offset, None
 
+    def get_required_alternatives(self, reverse):
+        seq = self.items
+        if reverse:
+            seq = seq[::-1]
+
+        offset = 0
+
+        for s in seq:
+            ofs, req = s.get_required_string(reverse)
+            if req:
+                # A required string comes first.
+                return offset + ofs, None
+
+            ofs, alternatives = s.get_required_alternatives(reverse)
+            if alternatives:
+                return offset + ofs, alternatives
+
+            offset += ofs
+
+        return offset, None
+
+    def get_required_sequence(self, reverse):
+        seq = self.items
+        if reverse:
+            seq = seq[::-1]
+
+        required = []
+
+        for s in seq:
+            ofs, req = s.get_required_string(reverse)
+            if req:
+                required.append(req)
+
+        return required
+
 class SetBase(RegexBase):
     def __init__(self, info, items, positive=True, case_flags=NOCASE,
       zerowidth=False):
@@ -3278,6 +3586,12 @@ class SetBase(RegexBase):
 
         return code
 
+    def _compile_dfa(self, program, reverse, next):
+        if self.zerowidth:
+            raise _DFAError()
+
+        return program.add_test(self._compile(False, False), next)
+
     def _dump(self, indent, reverse):
         print("{}{} {}{}".format(INDENT * indent, self._op_name,
           POS_TEXT[self.positive], CASE_TEXT[self.case_flags]))
@@ -3558,6 +3872,22 @@ class String(RegexBase):
         return [(self._opcode[self.case_flags, reverse], flags,
           len(self.folded_characters)) + self.folded_characters]
 
+    def _compile_dfa(self, program, reverse, next):
+        if (self.case_flags & FULLIGNORECASE) == FULLIGNORECASE:
+            # A character can match more than one in the text.
+            raise _DFAError()
+
+        # The program is built from the end backwards.
+        characters = self.characters
+        if not reverse:
+            characters = characters[::-1]
+
+        for c in characters:
+            next = Character(c, case_flags=self.case_flags)._compile_dfa(
+              program, reverse, next)
+
+        return next
+
     def _dump(self, indent, reverse):
         display = ascii("".join(chr(c) for c in self.characters)).lstrip("bu")
         print("{}STRING {}{}".format(INDENT * indent, display,
@@ -3606,29 +3936,11 @@ class StringSet(RegexBase):
         encoding = self.info.flags & _ALL_ENCODINGS
         fold_flags = encoding | case_flags
 
-        if fuzzy:
-            choices = [self._folded(fold_flags, i) for i in items]
-
-            # Sort from longest to shortest.
-            choices.sort(key=lambda s: (-len(s), s))
-
-            branches = []
-            for string in choices:
-                branches.append(Sequence([Character(c, case_flags=case_flags)
-                  for c in string]))
-
-            if len(branches) > 1:
-                branch = Branch(branches)
-            else:
-                branch = branches[0]
-            branch = branch.optimise(self.info).pack_characters(self.info)
-
-            return branch.compile(reverse, fuzzy)
-        else:
-            min_len = min(len(i) for i in items)
-            max_len = max(len(self._folded(fold_flags, i)) for i in items)
-            return [(self._opcode[case_flags, reverse], index, min_len,
-              max_len)]
+        # Within a fuzzy section the engine walks the trie of the members with
+        # an error budget instead of trying each member in turn.
+        min_len = min(len(i) for i in items)
+        max_len = max(len(self._folded(fold_flags, i)) for i in items)
+        return [(self._opcode[case_flags, reverse], index, min_len, max_len)]
 
     def _dump(self, indent, reverse):
         print("{}STRING_SET {}{}".format(INDENT * indent, self.name,
@@ -4018,6 +4330,120 @@ def _get_required_string(parsed, flags):
 
     return req_offset, req_chars, req_flags
 
+def _get_required_literals(parsed, flags):
+    """Gets the alternative strings, one of which is required, and the strings
+    which must follow the required string, of a parsed pattern."""
+    reverse = bool(flags & REVERSE)
+    if reverse:
+        # They're used only when searching forwards.
+        return 0, (), ()
+
+    req_offset, required = parsed.get_required_string(reverse)
+
+    # The strings which must follow the required string.
+    following = []
+    if required:
+        sequence = parsed.get_required_sequence(reverse)
+        if sequence and sequence[0] is required:
+            following = sequence[1 : ]
+
+    # The alternatives are needed only if the required string doesn't say where
+    # to start matching.
+    alt_offset, alternatives = 0, None
+    if not required or req_offset >= UNLIMITED:
+        alt_offset, alternatives = parsed.get_required_alternatives(reverse)
+        if alt_offset >= UNLIMITED:
+            alt_offset = -1
+
+    alternatives = tuple(_get_literal_info(req, flags) for req in
+      alternatives or ())
+    following = tuple(_get_literal_info(req, flags) for req in following)
+
+    return alt_offset, alternatives, following
+
+def _get_literal_info(req, flags):
+    "Gets the flags and characters of a required literal."
+    req_flags = req.case_flags
+    if not (flags & UNICODE):
+        req_flags &= ~UNICODE
+
+    return req_flags, req.folded_characters
+
+class DFAProgram:
+    """A program for the lazy DFA. It's built from the end backwards, so each
+    instruction is given the index of the instruction which follows it."""
+
+    def __init__(self):
+        # Instruction 0 is where a match ends.
+        self.instructions = [[(OP.SUCCESS, )]]
+        self.has_repeat = False
+
+    def add(self, code):
+        if len(self.instructions) >= MAX_DFA_SIZE:
+            raise _DFAError()
+
+        self.instructions.append(code)
+
+        return len(self.instructions) - 1
+
+    def add_test(self, code, next):
+        return self.add(code + [(OP.NEXT, next)])
+
+    def is_nullable(self, entry, exit):
+        "Checks whether the exit can be reached without matching a character."
+        pending, seen = [entry], set()
+        while pending:
+            index = pending.pop()
+            if index == exit:
+                return True
+
+            if index in seen:
+                continue
+
+            seen.add(index)
+            code = self.instructions[index]
+            if code[0][0] == OP.BRANCH:
+                pending.extend(code[0][1 : ])
+            elif code[0][0] in DFA_ASSERTIONS:
+                pending.append(code[-1][1])
+
+        return False
+
+    def get_code(self, entry):
+        code = [entry, len(self.instructions)]
+        for c in self.instructions:
+            code.extend(_flatten_code(c))
+
+        return code
+
+def _get_dfa_code(parsed, flags):
+    """Gets the code of the programs with which the lazy DFA finds the span of
+    a match, or None if the pattern isn't suitable."""
+    if flags & (BESTMATCH | ENHANCEMATCH | POSIX | REVERSE):
+        return None
+
+    try:
+        forward = DFAProgram()
+        entry = parsed._compile_dfa(forward, False, 0)
+
+        # A search tries the pattern at each position in turn, like a lazy
+        # repeat of any character before the pattern.
+        search = forward.add(None)
+        skip = forward.add_test(AnyAll()._compile(False, False), search)
+        forward.instructions[search] = [(OP.BRANCH, entry, skip)]
+
+        # The backward program finds where the match starts.
+        backward = DFAProgram()
+        back_entry = parsed._compile_dfa(backward, True, 0)
+    except _DFAError:
+        return None
+
+    # A pattern without a repeat is matched in linear time anyway.
+    if not forward.has_repeat:
+        return None
+
+    return forward.get_code(search), backward.get_code(back_entry)
+
 class Scanner:
     def __init__(self, lexicon, flags=0):
         self.lexicon = lexicon
@@ -4087,8 +4513,8 @@ class Scanner:
         # LOCALE _don't_ affect the code generation but _are_ needed by the
         # PatternObject.
         self.scanner = _regex.compile(None, (flags & GLOBAL_FLAGS) | version,
-          code, {}, {}, {}, [], req_offset, req_chars, req_flags,
-          len(patterns))
+          code, {}, {}, {}, [], req_offset, req_chars, req_flags, (0, (), ()),
+          None, len(patterns))
 
     def scan(self, string):
         result = []
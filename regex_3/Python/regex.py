@@ -184,8 +184,25 @@ This module exports the following functions:
     splititer  Return an iterator yielding the parts of a split string.
     findall    Find all occurrences of a pattern in a string.
     finditer   Return an iterator yielding a match object for each match.
+    finditer_stream
+               Return an iterator yielding a match object for each match in a
+               file-like object or an iterable of chunks.
+    asearch    Same as search, but return an awaitable for use with asyncio.
+    afinditer  Same as finditer, but return an asynchronous iterator.
+    asub       Same as sub, but return an awaitable for use with asyncio.
     compile    Compile a pattern into a Pattern object.
+    compile_many
+               Compile a sequence of patterns into Pattern objects.
     purge      Clear the regular expression cache.
+    cache_info Return the hits, misses, evictions and size of the regular
+               expression cache.
+    set_cache_size
+               Set the maximum number of patterns in the cache.
+    set_disk_cache
+               Set the directory in which compiled patterns are cached across
+               processes.
+    set_max_memory
+               Set the default maximum memory for matching.
     escape     Backslash all non-alphanumerics or special characters in a
                string.
 
@@ -194,6 +211,27 @@ released during matching, allowing other Python threads to run concurrently. If
 the string changes during matching, the behaviour is undefined. This parameter
 is not needed when working on the builtin (immutable) string classes.
 
+The findall, finditer, sub, subn and split functions also support a workers
+parameter: if provided, the string is divided into that many parts which are
+searched by threads in parallel, with the GIL released, and the results are
+joined to give the same result as searching the whole string. Reverse,
+BESTMATCH and ENHANCEMATCH patterns, and patterns which contain \G, are
+searched without threads. The string mustn't change during matching, and the
+limits apply to the search for each match, as they do for finditer.
+
+The findall, finditer and split functions also support a spans_only parameter:
+if True, the (start, end) spans of the matches, groups and parts are returned
+instead of copies of the text, with (-1, -1) for a group which didn't
+participate. For bytes-like strings, the group_view method of a match object
+returns a memoryview of a group which shares the buffer of the string.
+
+Most of the functions also support timeout and max_steps parameters: if
+matching takes longer than timeout seconds or more than max_steps steps of the
+matching engine, TimeoutError is raised. Similarly, if matching needs more than
+max_memory bytes for backtracking and captures, MemoryLimitError is raised. The
+limits apply to the whole call, or to each item for the iterators returned by
+finditer and splititer.
+
 Some of the functions in this module take flags as optional parameters. Most of
 these flags can also be set within an RE:
     A   a   ASCII         Make \w, \W, \b, \B, \d, and \D match the
@@ -226,18 +264,25 @@ these flags can also be set within an RE:
                           breaks.
     X   x   VERBOSE       Ignore whitespace and comments for nicer looking REs.
 
-This module also defines an exception 'error'.
+This module also defines the exceptions 'error', 'TimeoutError' and
+'MemoryLimitError', the PatternSet class, which searches for a set of patterns
+in a single pass over a string, and the IncrementalMatcher class, which
+searches text which is fed to it piece by piece.
 
 """
 
 # Public symbols.
-__all__ = ["compile", "escape", "findall", "finditer", "fullmatch", "match",
+__all__ = ["compile", "compile_many", "escape", "findall", "finditer",
+  "finditer_stream", "asearch", "afinditer", "asub", "fullmatch", "match",
   "purge", "search", "split", "splititer", "sub", "subf", "subfn", "subn",
-  "template", "Scanner", "A", "ASCII", "B", "BESTMATCH", "D", "DEBUG", "E",
-  "ENHANCEMATCH", "S", "DOTALL", "F", "FULLCASE", "I", "IGNORECASE", "L",
-  "LOCALE", "M", "MULTILINE", "P", "POSIX", "R", "REVERSE", "T", "TEMPLATE",
-  "U", "UNICODE", "V0", "VERSION0", "V1", "VERSION1", "X", "VERBOSE", "W",
-  "WORD", "error", "Regex"]
+  "template", "cache_info", "set_cache_size", "set_disk_cache",
+  "set_max_memory", "PatternSet", "IncrementalMatcher",
+  "Scanner", "A", "ASCII", "B",
+  "BESTMATCH", "D", "DEBUG", "E", "ENHANCEMATCH", "S", "DOTALL", "F",
+  "FULLCASE", "I", "IGNORECASE", "L", "LOCALE", "M", "MULTILINE", "P", "POSIX",
+  "R", "REVERSE", "T", "TEMPLATE", "U", "UNICODE", "V0", "VERSION0", "V1",
+  "VERSION1", "X", "VERBOSE", "W", "WORD", "error", "Regex", "TimeoutError",
+  "MemoryLimitError"]
 
 __version__ = "2.4.83"
 
@@ -245,60 +290,78 @@ __version__ = "2.4.83"
 # Public interface.
 
 def match(pattern, string, flags=0, pos=None, endpos=None, partial=False,
-  concurrent=None, **kwargs):
+  concurrent=None, timeout=None, max_steps=None, max_memory=None, **kwargs):
     """Try to apply the pattern at the start of the string, returning a match
     object, or None if no match was found."""
     return _compile(pattern, flags, kwargs).match(string, pos, endpos,
-      concurrent, partial)
+      concurrent, partial, timeout, max_steps, max_memory)
 
 def fullmatch(pattern, string, flags=0, pos=None, endpos=None, partial=False,
-  concurrent=None, **kwargs):
+  concurrent=None, timeout=None, max_steps=None, max_memory=None, **kwargs):
     """Try to apply the pattern against all of the string, returning a match
     object, or None if no match was found."""
     return _compile(pattern, flags, kwargs).fullmatch(string, pos, endpos,
-      concurrent, partial)
+      concurrent, partial, timeout, max_steps, max_memory)
 
 def search(pattern, string, flags=0, pos=None, endpos=None, partial=False,
-  concurrent=None, **kwargs):
+  concurrent=None, timeout=None, max_steps=None, max_memory=None, **kwargs):
     """Search through string looking for a match to the pattern, returning a
     match object, or None if no match was found."""
     return _compile(pattern, flags, kwargs).search(string, pos, endpos,
-      concurrent, partial)
+      concurrent, partial, timeout, max_steps, max_memory)
 
 def sub(pattern, repl, string, count=0, flags=0, pos=None, endpos=None,
-  concurrent=None, **kwargs):
+  concurrent=None, timeout=None, max_steps=None, max_memory=None, workers=None,
+  **kwargs):
     """Return the string obtained by replacing the leftmost (or rightmost with a
     reverse pattern) non-overlapping occurrences of the pattern in string by the
     replacement repl. repl can be either a string or a callable; if a string,
     backslash escapes in it are processed; if a callable, it's passed the match
-    object and must return a replacement string to be used."""
-    return _compile(pattern, flags, kwargs).sub(repl, string, count, pos,
-      endpos, concurrent)
+    object and must return a replacement string to be used. If workers is
+    provided, the string is searched in parts by that many threads."""
+    pat = _compile(pattern, flags, kwargs)
+    if workers:
+        result = _sharded_subn(pat, repl, string, count, pos, endpos, (timeout,
+          max_steps, max_memory), workers)
+        if result is not None:
+            return result[0]
+
+    return pat.sub(repl, string, count, pos, endpos, concurrent, timeout,
+      max_steps, max_memory)
 
 def subf(pattern, format, string, count=0, flags=0, pos=None, endpos=None,
-  concurrent=None, **kwargs):
+  concurrent=None, timeout=None, max_steps=None, max_memory=None, **kwargs):
     """Return the string obtained by replacing the leftmost (or rightmost with a
     reverse pattern) non-overlapping occurrences of the pattern in string by the
     replacement format. format can be either a string or a callable; if a string,
     it's treated as a format string; if a callable, it's passed the match object
     and must return a replacement string to be used."""
     return _compile(pattern, flags, kwargs).subf(format, string, count, pos,
-      endpos, concurrent)
+      endpos, concurrent, timeout, max_steps, max_memory)
 
 def subn(pattern, repl, string, count=0, flags=0, pos=None, endpos=None,
-  concurrent=None, **kwargs):
+  concurrent=None, timeout=None, max_steps=None, max_memory=None, workers=None,
+  **kwargs):
     """Return a 2-tuple containing (new_string, number). new_string is the string
     obtained by replacing the leftmost (or rightmost with a reverse pattern)
     non-overlapping occurrences of the pattern in the source string by the
     replacement repl. number is the number of substitutions that were made. repl
     can be either a string or a callable; if a string, backslash escapes in it
     are processed; if a callable, it's passed the match object and must return a
-    replacement string to be used."""
-    return _compile(pattern, flags, kwargs).subn(repl, string, count, pos,
-      endpos, concurrent)
+    replacement string to be used. If workers is provided, the string is
+    searched in parts by that many threads."""
+    pat = _compile(pattern, flags, kwargs)
+    if workers:
+        result = _sharded_subn(pat, repl, string, count, pos, endpos, (timeout,
+          max_steps, max_memory), workers)
+        if result is not None:
+            return result
+
+    return pat.subn(repl, string, count, pos, endpos, concurrent, timeout,
+      max_steps, max_memory)
 
 def subfn(pattern, format, string, count=0, flags=0, pos=None, endpos=None,
-  concurrent=None, **kwargs):
+  concurrent=None, timeout=None, max_steps=None, max_memory=None, **kwargs):
     """Return a 2-tuple containing (new_string, number). new_string is the string
     obtained by replacing the leftmost (or rightmost with a reverse pattern)
     non-overlapping occurrences of the pattern in the source string by the
@@ -307,47 +370,169 @@ def subfn(pattern, format, string, count=0, flags=0, pos=None, endpos=None,
     string; if a callable, it's passed the match object and must return a
     replacement string to be used."""
     return _compile(pattern, flags, kwargs).subfn(format, string, count, pos,
-      endpos, concurrent)
+      endpos, concurrent, timeout, max_steps, max_memory)
 
-def split(pattern, string, maxsplit=0, flags=0, concurrent=None, **kwargs):
+def split(pattern, string, maxsplit=0, flags=0, concurrent=None,
+  timeout=None, max_steps=None, max_memory=None, workers=None,
+  spans_only=False, **kwargs):
     """Split the source string by the occurrences of the pattern, returning a
     list containing the resulting substrings.  If capturing parentheses are used
     in pattern, then the text of all groups in the pattern are also returned as
     part of the resulting list.  If maxsplit is nonzero, at most maxsplit splits
     occur, and the remainder of the string is returned as the final element of
-    the list."""
-    return _compile(pattern, flags, kwargs).split(string, maxsplit, concurrent)
-
-def splititer(pattern, string, maxsplit=0, flags=0, concurrent=None, **kwargs):
+    the list. If workers is provided, the string is searched in parts by that
+    many threads. If spans_only is True, the spans are returned instead of the
+    substrings."""
+    pat = _compile(pattern, flags, kwargs)
+    if workers:
+        result = _sharded_split(pat, string, maxsplit, (timeout, max_steps,
+          max_memory), workers, spans_only)
+        if result is not None:
+            return result
+
+    return pat.split(string, maxsplit, concurrent, timeout, max_steps,
+      max_memory, spans_only)
+
+def splititer(pattern, string, maxsplit=0, flags=0, concurrent=None,
+  timeout=None, max_steps=None, max_memory=None, **kwargs):
     "Return an iterator yielding the parts of a split string."
     return _compile(pattern, flags, kwargs).splititer(string, maxsplit,
-      concurrent)
+      concurrent, timeout, max_steps, max_memory)
 
 def findall(pattern, string, flags=0, pos=None, endpos=None, overlapped=False,
-  concurrent=None, **kwargs):
+  concurrent=None, timeout=None, max_steps=None, max_memory=None, workers=None,
+  spans_only=False, **kwargs):
     """Return a list of all matches in the string. The matches may be overlapped
     if overlapped is True. If one or more groups are present in the pattern,
     return a list of groups; this will be a list of tuples if the pattern has
-    more than one group. Empty matches are included in the result."""
-    return _compile(pattern, flags, kwargs).findall(string, pos, endpos,
-      overlapped, concurrent)
+    more than one group. Empty matches are included in the result. If workers
+    is provided, the string is searched in parts by that many threads. If
+    spans_only is True, the spans are returned instead of the substrings."""
+    pat = _compile(pattern, flags, kwargs)
+    if workers:
+        matches = _sharded_matches(pat, string, pos, endpos, overlapped,
+          _FINDALL_RULE, (timeout, max_steps, max_memory), workers)
+        if matches is not None:
+            return [_findall_item(pat, m, spans_only) for m in matches]
+
+    return pat.findall(string, pos, endpos, overlapped, concurrent, timeout,
+      max_steps, max_memory, spans_only)
 
 def finditer(pattern, string, flags=0, pos=None, endpos=None, overlapped=False,
-  partial=False, concurrent=None, **kwargs):
+  partial=False, concurrent=None, timeout=None, max_steps=None,
+  max_memory=None, workers=None, spans_only=False, **kwargs):
     """Return an iterator over all matches in the string. The matches may be
     overlapped if overlapped is True. For each match, the iterator returns a
-    match object. Empty matches are included in the result."""
-    return _compile(pattern, flags, kwargs).finditer(string, pos, endpos,
-      overlapped, concurrent, partial)
+    match object, or its span if spans_only is True. Empty matches are included
+    in the result. If workers is provided, the string is searched in parts by
+    that many threads before the iterator is returned."""
+    pat = _compile(pattern, flags, kwargs)
+    if workers and not partial:
+        matches = _sharded_matches(pat, string, pos, endpos, overlapped,
+          _FINDALL_RULE, (timeout, max_steps, max_memory), workers)
+        if matches is not None:
+            if spans_only:
+                return iter([m.span() for m in matches])
+
+            return iter(matches)
+
+    return pat.finditer(string, pos, endpos, overlapped, concurrent, partial,
+      timeout, max_steps, max_memory, spans_only)
+
+def finditer_stream(pattern, source, flags=0, chunk_size=0x10000,
+  concurrent=None, timeout=None, max_steps=None, max_memory=None, **kwargs):
+    """Return an iterator over all matches in a stream, which is either a
+    file-like object, which is read chunk_size characters at a time, or an
+    iterable of chunks. For each match, the iterator returns a match object
+    whose positions are offsets from the start of the stream."""
+    return _compile(pattern, flags, kwargs).finditer_stream(source,
+      chunk_size, concurrent, timeout, max_steps, max_memory)
+
+def asearch(pattern, string, flags=0, pos=None, endpos=None, timeout=None,
+  max_steps=None, max_memory=None, **kwargs):
+    """Return an awaitable which searches through string on a thread pool,
+    giving a match object, or None if no match was found. If the awaiting task
+    is cancelled, the search is stopped."""
+    return _compile(pattern, flags, kwargs).asearch(string, pos, endpos,
+      timeout=timeout, max_steps=max_steps, max_memory=max_memory)
+
+def afinditer(pattern, string, flags=0, pos=None, endpos=None,
+  overlapped=False, timeout=None, max_steps=None, max_memory=None, **kwargs):
+    """Return an asynchronous iterator over all matches in the string, which
+    searches on a thread pool."""
+    return _compile(pattern, flags, kwargs).afinditer(string, pos, endpos,
+      overlapped, timeout=timeout, max_steps=max_steps, max_memory=max_memory)
+
+def asub(pattern, repl, string, count=0, flags=0, pos=None, endpos=None,
+  timeout=None, max_steps=None, max_memory=None, **kwargs):
+    """Return an awaitable which makes the replacements that sub would make on
+    a thread pool. If the awaiting task is cancelled, the matching is
+    stopped."""
+    return _compile(pattern, flags, kwargs).asub(repl, string, count, pos=pos,
+      endpos=endpos, timeout=timeout, max_steps=max_steps,
+      max_memory=max_memory)
 
 def compile(pattern, flags=0, **kwargs):
     "Compile a regular expression pattern, returning a pattern object."
     return _compile(pattern, flags, kwargs)
 
+def compile_many(patterns, flags=0, processes=None, **kwargs):
+    """Compile a sequence of regular expression patterns with the same flags
+    and named lists, returning a list of pattern objects. If a pattern can't be
+    compiled, the exception is returned in its place instead. If processes is
+    provided, the patterns which aren't in the cache are compiled using a pool
+    of that many worker processes."""
+    return _compile_many(patterns, flags, kwargs, processes)
+
 def purge():
     "Clear the regular expression cache"
-    _cache.clear()
-    _locale_sensitive.clear()
+    with _cache_lock:
+        _cache.clear()
+        _named_args.clear()
+        _locale_sensitive.clear()
+        _cache_refs.clear()
+        _cache_stats[:] = [0, 0, 0]
+
+def cache_info():
+    """Return a named tuple (hits, misses, evictions, maxsize, currsize)
+    describing the state of the regular expression cache."""
+    with _cache_lock:
+        hits, misses, evictions = _cache_stats
+        return _CacheInfo(hits, misses, evictions, _MAXCACHE, len(_cache))
+
+def set_cache_size(size):
+    """Set the maximum number of compiled patterns held in the regular
+    expression cache. The least recently used patterns are discarded if the
+    cache is currently larger than that."""
+    global _MAXCACHE
+
+    size = int(size)
+    if size < 0:
+        raise ValueError("cache size cannot be negative")
+
+    with _cache_lock:
+        _MAXCACHE = size
+        _evict_from_cache(size)
+
+def set_max_memory(size):
+    """Set the default maximum number of bytes which matching may allocate for
+    backtracking and captures, or None for no limit. It's used when a call
+    doesn't pass max_memory."""
+    _regex.set_max_memory(size)
+
+def set_disk_cache(directory):
+    """Set the directory in which compiled patterns are cached so that they
+    don't need to be compiled again by a later process, or None to stop
+    caching them on disk. The cached patterns are discarded automatically if
+    the regex module changes."""
+    global _disk_cache_dir
+
+    if directory is not None:
+        directory = _os.path.abspath(directory)
+        if not _os.path.isdir(directory):
+            _os.makedirs(directory)
+
+    _disk_cache_dir = directory
 
 def template(pattern, flags=0):
     "Compile a template pattern, returning a pattern object."
@@ -400,20 +585,220 @@ def escape(pattern, special_only=False):
 
         return bytes(s)
 
+class PatternSet(object):
+    """A set of regular expression patterns which are searched for together
+    in a single pass over the string. It reports every pattern which matches
+    at each position, not just the first."""
+
+    def __init__(self, patterns, flags=0, **kwargs):
+        self.patterns = [_compile(pattern, flags, kwargs) for pattern in
+          patterns]
+        self.flags = flags
+        self._combined, self._merged, self._unmerged = _compile_pattern_set(
+          self.patterns, kwargs)
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def findall(self, string, pos=None, endpos=None, concurrent=None):
+        """Return a list of (index, start, end) for each pattern which matches
+        at each position in the string, ordered by position and then by the
+        index of the pattern."""
+        results = []
+        append = results.append
+
+        if self._combined is not None:
+            merged = self._merged
+            for m in self._combined.finditer(string, pos, endpos,
+              overlapped=True, concurrent=concurrent):
+                # The group of each pattern which matched here has captured
+                # its match.
+                for group, span in enumerate(m.regs[1 : ]):
+                    if span[0] >= 0:
+                        append((merged[group], span[0], span[1]))
+
+        if self._unmerged:
+            for index in self._unmerged:
+                for m in self.patterns[index].finditer(string, pos, endpos,
+                  overlapped=True, concurrent=concurrent):
+                    append((index, m.start(), m.end()))
+
+            results.sort(key=lambda r: (r[1], r[0]))
+
+        return results
+
+    def finditer(self, string, pos=None, endpos=None, concurrent=None,
+      captures=False):
+        """Return an iterator over (index, start, end) for each pattern which
+        matches at each position in the string. If captures is true, the items
+        are (index, match) instead, where match is the pattern's match
+        object."""
+        for index, start, end in self.findall(string, pos, endpos,
+          concurrent):
+            if captures:
+                pattern = self.patterns[index]
+                if pattern.flags & REVERSE:
+                    m = pattern.match(string, pos, end, concurrent)
+                else:
+                    m = pattern.match(string, start, endpos, concurrent)
+
+                yield index, m
+            else:
+                yield index, start, end
+
+    def search(self, string, pos=None, endpos=None, concurrent=None):
+        """Return a sorted list of the indexes of the patterns which match
+        anywhere in the string."""
+        return sorted(set(r[0] for r in self.findall(string, pos, endpos,
+          concurrent)))
+
+class IncrementalMatcher(object):
+    """Searches for a pattern in text which is fed to it piece by piece, such
+    as data arriving from a network connection. The matches have their offsets
+    in all of the text fed so far, and their string is None.
+
+    A match which might continue into text which hasn't been fed yet is
+    searched for again when more is fed, but the search doesn't go back over
+    the text before it, and only up to history characters before the current
+    position are kept for lookbehinds and word boundaries."""
+
+    def __init__(self, pattern, flags=0, history=0x10000, concurrent=None,
+      timeout=None, max_steps=None, max_memory=None, **kwargs):
+        self.pattern = _compile(pattern, flags, kwargs)
+
+        # The best match can't be known until all of the text has been fed.
+        if self.pattern.flags & (REVERSE | BESTMATCH | ENHANCEMATCH):
+            raise ValueError("can't search incrementally with a reverse, "
+              "BESTMATCH or ENHANCEMATCH pattern")
+
+        if history < 0:
+            raise ValueError("history can't be negative")
+
+        self.history = history
+        self._args = (concurrent, timeout, max_steps, max_memory)
+
+        # Where \G matches depends on where the search started, so the search
+        # must resume where the previous match ended, and a match which
+        # reaches the end of the text so far can change only if the pattern
+        # looks at the text which follows it.
+        source = self.pattern.pattern
+        if isinstance(source, bytes):
+            source = source.decode("latin-1")
+
+        self._anchored = "\\G" in source
+        self._looks_ahead = any(token in source for token in
+          _LOOKAHEAD_TOKENS)
+
+        # The buffer holds the text from offset onwards, and the search
+        # continues from pos within it. An empty match at the offset empty_at
+        # has already been returned.
+        self._buffer = None
+        self._offset = 0
+        self._pos = 0
+        self._empty_at = None
+        self._finished = False
+
+    def feed(self, data):
+        """Add some text and return a list of the matches which are now
+        complete."""
+        if self._finished:
+            raise ValueError("can't feed a finished matcher")
+
+        if not data:
+            return []
+
+        if not isinstance(data, (str, bytes)):
+            data = bytes(data)
+
+        if self._buffer is None:
+            # The pattern will check that the text is the right type.
+            self._buffer = data
+        else:
+            self._buffer += data
+
+        return self._search(False)
+
+    def finish(self):
+        """Signal that all of the text has been fed and return a list of the
+        remaining matches."""
+        if self._finished:
+            return []
+
+        self._finished = True
+        if self._buffer is None:
+            self._buffer = self.pattern.pattern[ : 0]
+
+        return self._search(True)
+
+    def _search(self, at_end):
+        "Searches the buffer for the matches which are complete."
+        concurrent, timeout, max_steps, max_memory = self._args
+        buffer = self._buffer
+        offset = self._offset
+        pos = self._pos
+        matches = []
+
+        # Before the end of the text, a match which is partial, or which
+        # reaches the end of the buffer and depends on what follows, might be
+        # different once there's more text, so the search stops there and
+        # resumes when there is.
+        resume = len(buffer)
+        for m in self.pattern.finditer(buffer, pos, None, False, concurrent,
+          not at_end, timeout, max_steps, max_memory):
+            start, end = m.span()
+            if not at_end and (m.partial or (self._looks_ahead and end ==
+              len(buffer))):
+                resume = start
+                break
+
+            if start == end:
+                if offset + start == self._empty_at:
+                    continue
+
+                self._empty_at = offset + start
+
+            pos = end
+            _regex.offset_match(m, offset)
+            matches.append(m)
+
+        if self._anchored:
+            resume = min(resume, pos)
+
+        # Discard the text which is no longer needed.
+        discard = resume - self.history
+        if discard > 0:
+            self._buffer = buffer[discard : ]
+            self._offset = offset + discard
+            resume -= discard
+
+        self._pos = resume
+
+        return matches
+
 # --------------------------------------------------------------------
 # Internals.
 
 import _regex_core
 import _regex
-from threading import RLock as _RLock
+import hashlib as _hashlib
+import marshal as _marshal
+import os as _os
+import sys as _sys
+import weakref as _weakref
+from collections import (OrderedDict as _OrderedDict, deque as _deque,
+  namedtuple as _namedtuple)
+from itertools import islice as _islice
+from threading import RLock as _RLock, Thread as _Thread
+from _thread import get_ident as _get_ident
 from locale import getlocale as _getlocale
 from _regex_core import *
-from _regex_core import (_ALL_VERSIONS, _ALL_ENCODINGS, _FirstSetError,
-  _UnscopedFlagSet, _check_group_features, _compile_firstset,
-  _compile_replacement, _flatten_code, _fold_case, _get_required_string,
-  _parse_pattern, _shrink_cache)
+from _regex_core import (GLOBAL_FLAGS, _ALL_VERSIONS, _ALL_ENCODINGS,
+  _FirstSetError, _UnscopedFlagSet, _check_group_features, _compile_firstset,
+  _compile_replacement, _flatten_code, _fold_case, _get_dfa_code,
+  _get_required_literals, _get_required_string, _parse_pattern)
 from _regex_core import (ALNUM as _ALNUM, Info as _Info, OP as _OP, Source as
-  _Source, Fuzzy as _Fuzzy)
+  _Source, Fuzzy as _Fuzzy, Branch as _Branch, Group as _Group, LookAround as
+  _LookAround, Sequence as _Sequence)
 
 # Version 0 is the old behaviour, compatible with the original 're' module.
 # Version 1 is the new behaviour, which differs slightly.
@@ -425,55 +810,138 @@ _METACHARS = frozenset("()[]{}?*+|^$\\.")
 _regex_core.DEFAULT_VERSION = DEFAULT_VERSION
 
 # Caches for the patterns and replacements.
-_cache = {}
+#
+# The pattern cache is kept in least-recently-used order, the oldest entry
+# first.
+_cache = _OrderedDict()
 _cache_lock = _RLock()
 _named_args = {}
 _replacement_cache = {}
 _locale_sensitive = {}
 
+# How many cached patterns share each key of _named_args and
+# _locale_sensitive. What was learned about a pattern is forgotten only when
+# the last of them is evicted.
+_cache_refs = {}
+
+# The arguments for _regex.compile of each compiled pattern which isn't
+# locale-sensitive, so that it needn't be compiled again to pickle it.
+_pattern_compile_args = _weakref.WeakKeyDictionary()
+
+# How far past where a match starts each compiled pattern might look, or None
+# if there's no limit. Used to bound the parts of a sharded search.
+_pattern_reaches = _weakref.WeakKeyDictionary()
+
 # Maximum size of the cache.
 _MAXCACHE = 500
 _MAXREPCACHE = 500
 
-def _compile(pattern, flags=0, kwargs={}):
-    "Compiles a regular expression to a PatternObject."
+# The statistics for the pattern cache: hits, misses and evictions.
+_cache_stats = [0, 0, 0]
+
+_CacheInfo = _namedtuple("CacheInfo", "hits misses evictions maxsize currsize")
+
+def _evict_from_cache(max_length):
+    """Discards the least recently used patterns until there are no more than
+    max_length of them. The cache lock must be held."""
+    while len(_cache) > max_length:
+        pattern_key = _cache.popitem(last=False)[0]
+        _cache_stats[2] += 1
+
+        # Forget what we learned about the pattern if no other cached entry
+        # needs it.
+        pattern, pattern_type, flags = pattern_key[ : 3]
+        for key, hints in (((pattern, pattern_type, flags), _named_args),
+          ((pattern_type, pattern), _locale_sensitive)):
+            _cache_refs[key] -= 1
+            if not _cache_refs[key]:
+                del _cache_refs[key]
+                hints.pop(key, None)
+
+# The directory of the on-disk cache, if enabled.
+_disk_cache_dir = None
+
+def _get_engine_tag():
+    """Gets a tag which identifies the engine and its Unicode tables. It
+    changes whenever the regex module is upgraded or rebuilt."""
+    parts = [__version__, _regex.MAGIC, _regex.CODE_SIZE, _sys.version]
+    for module in (_regex, _regex_core):
+        try:
+            st = _os.stat(module.__file__)
+            parts.extend([st.st_size, st.st_mtime])
+        except (AttributeError, OSError):
+            pass
+
+    return repr(tuple(parts))
+
+def _disk_cache_path(pattern, flags, kwargs):
+    """Gets the path of the on-disk cache file for a pattern, and the key
+    which the file must contain, or (None, None) if it can't be cached."""
+    try:
+        # The named lists are sorted so that the key doesn't depend on the
+        # order of iteration.
+        named_lists = sorted((name, sorted(values)) for name, values in
+          kwargs.items())
+    except TypeError:
+        return None, None
+
+    key = repr((_engine_tag, type(pattern).__name__, pattern, flags,
+      DEFAULT_VERSION, named_lists))
+    digest = _hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    return _os.path.join(_disk_cache_dir, digest + ".rxc"), key
+
+def _load_from_disk_cache(path, key):
+    """Loads the arguments for _regex.compile from the on-disk cache, or
+    returns None if they aren't there."""
+    try:
+        with open(path, "rb") as file:
+            stored_key, compile_args = _marshal.load(file)
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        return None
+
+    # Guard against a hash collision.
+    if stored_key != key:
+        return None
+
+    return compile_args
+
+def _store_in_disk_cache(path, key, compile_args):
+    "Stores the arguments for _regex.compile in the on-disk cache."
+    # Write to a temporary file and then rename it so that another process
+    # will never see a partly-written file.
+    temp_path = "{}.{}.tmp".format(path, _os.getpid())
+    try:
+        with open(temp_path, "wb") as file:
+            _marshal.dump((key, compile_args), file)
+
+        _os.rename(temp_path, path)
+    except (IOError, OSError, ValueError):
+        # The cache is only an optimisation, so just tidy up.
+        try:
+            _os.remove(temp_path)
+        except OSError:
+            pass
+
+def _compile(pattern, flags=0, kwargs={}, compile_args=None,
+  current_locale=None):
+    """Compiles a regular expression to a PatternObject. If compile_args is
+    provided, they are the arguments for _regex.compile from an earlier
+    compilation of the pattern. If current_locale is provided, it's the
+    current locale, which saves looking it up."""
 
     # We won't bother to cache the pattern if we're debugging.
     debugging = (flags & DEBUG) != 0
 
     # What locale is this pattern using?
     locale_key = (type(pattern), pattern)
-    if _locale_sensitive.get(locale_key, True) or (flags & LOCALE) != 0:
-        # This pattern is, or might be, locale-sensitive.
-        pattern_locale = _getlocale()[1]
-    else:
-        # This pattern is definitely not locale-sensitive.
-        pattern_locale = None
+    pattern_locale = _get_pattern_locale(pattern, flags, current_locale)
 
     if not debugging:
-        try:
-            # Do we know what keyword arguments are needed?
-            args_key = pattern, type(pattern), flags
-            args_needed = _named_args[args_key]
-
-            # Are we being provided with its required keyword arguments?
-            args_supplied = set()
-            if args_needed:
-                for k, v in args_needed:
-                    try:
-                        args_supplied.add((k, frozenset(kwargs[k])))
-                    except KeyError:
-                        raise error("missing named list: {!r}".format(k))
-
-            args_supplied = frozenset(args_supplied)
-
-            # Have we already seen this regular expression and named list?
-            pattern_key = (pattern, type(pattern), flags, args_supplied,
-              DEFAULT_VERSION, pattern_locale)
-            return _cache[pattern_key]
-        except KeyError:
-            # It's a new pattern, or new named list for a known pattern.
-            pass
+        compiled_pattern = _lookup_cache(pattern, flags, kwargs,
+          pattern_locale)
+        if compiled_pattern is not None:
+            return compiled_pattern
 
     # Guess the encoding from the class of the pattern string.
     if isinstance(pattern, str):
@@ -488,6 +956,50 @@ def _compile(pattern, flags=0, kwargs={}):
     else:
         raise TypeError("first argument must be a string or compiled pattern")
 
+    # Has the pattern been compiled by another process?
+    disk_path = None
+    if (compile_args is None and _disk_cache_dir is not None and not debugging
+      and not (flags & LOCALE)):
+        disk_path, disk_key = _disk_cache_path(pattern, flags, kwargs)
+        if disk_path:
+            compile_args = _load_from_disk_cache(disk_path, disk_key)
+            if compile_args is not None:
+                disk_path = None
+
+    if compile_args is not None:
+        # Only patterns which aren't locale-sensitive are compiled in advance.
+        args_needed = frozenset(compile_args[5].items())
+        inline_locale = False
+    else:
+        compile_args, args_needed, inline_locale = _compile_code(pattern,
+          flags, kwargs, guess_encoding)
+
+    # Remember whether this pattern as an inline locale flag.
+    _locale_sensitive[locale_key] = inline_locale
+
+    # Create the PatternObject.
+    compiled_pattern = _regex.compile(*compile_args)
+
+    if not debugging:
+        # A locale-sensitive pattern depends on more than its key.
+        locale = (compile_args[1] & LOCALE) != 0
+        if not locale:
+            pattern_locale = None
+
+        _cache_pattern(pattern, flags, args_needed, pattern_locale,
+          compiled_pattern)
+
+        if not locale:
+            _pattern_compile_args[compiled_pattern] = compile_args
+
+        if disk_path and not locale:
+            _store_in_disk_cache(disk_path, disk_key, compile_args)
+
+    return compiled_pattern
+
+def _parse(pattern, flags, kwargs, guess_encoding):
+    """Parses a regular expression and fixes its group references, returning
+    the parsed pattern, its info and its version."""
     # Set the default version in the core code in case it has been changed.
     _regex_core.DEFAULT_VERSION = DEFAULT_VERSION
 
@@ -533,10 +1045,6 @@ def _compile(pattern, flags=0, kwargs={}):
             info.flags |= ASCII
 
     reverse = bool(info.flags & REVERSE)
-    fuzzy = isinstance(parsed, _Fuzzy)
-
-    # Remember whether this pattern as an inline locale flag.
-    _locale_sensitive[locale_key] = info.inline_locale
 
     # Fix the group references.
     try:
@@ -548,6 +1056,17 @@ def _compile(pattern, flags=0, kwargs={}):
         raise error(caught_exception.msg, caught_exception.pattern,
           caught_exception.pos)
 
+    return parsed, info, version
+
+def _compile_code(pattern, flags, kwargs, guess_encoding):
+    """Compiles a regular expression to the arguments for _regex.compile.
+    Also returns the named lists it needs and whether it has an inline locale
+    flag."""
+    parsed, info, version = _parse(pattern, flags, kwargs, guess_encoding)
+
+    reverse = bool(info.flags & REVERSE)
+    fuzzy = isinstance(parsed, _Fuzzy)
+
     # Should we print the parsed pattern?
     if flags & DEBUG:
         parsed.dump(indent=0, reverse=reverse)
@@ -558,6 +1077,7 @@ def _compile(pattern, flags=0, kwargs={}):
 
     # Get the required string.
     req_offset, req_chars, req_flags = _get_required_string(parsed, info.flags)
+    req_literals = _get_required_literals(parsed, info.flags)
 
     # Build the named lists.
     named_lists = {}
@@ -605,38 +1125,258 @@ def _compile(pattern, flags=0, kwargs={}):
         except _FirstSetError:
             pass
 
+    # Compile the programs for the lazy DFA, if it can run the pattern.
+    dfa_code = _get_dfa_code(parsed, info.flags)
+
     # The named capture groups.
     index_group = dict((v, n) for n, v in info.group_index.items())
 
-    # Create the PatternObject.
+    # The arguments for creating the PatternObject.
     #
     # Local flags like IGNORECASE affect the code generation, but aren't needed
     # by the PatternObject itself. Conversely, global flags like LOCALE _don't_
     # affect the code generation but _are_ needed by the PatternObject.
-    compiled_pattern = _regex.compile(pattern, info.flags | version, code,
-      info.group_index, index_group, named_lists, named_list_indexes,
-      req_offset, req_chars, req_flags, info.group_count)
+    compile_args = (pattern, info.flags | version, code, info.group_index,
+      index_group, named_lists, named_list_indexes, req_offset, req_chars,
+      req_flags, req_literals, dfa_code, info.group_count)
+
+    return compile_args, frozenset(args_needed), info.inline_locale
+
+def _get_pattern_locale(pattern, flags, current_locale=None):
+    """Gets the locale which a pattern is using, or None if it's not
+    locale-sensitive. If current_locale is provided, it's the current locale,
+    which saves looking it up."""
+    if _locale_sensitive.get((type(pattern), pattern), True) or (flags &
+      LOCALE) != 0:
+        # This pattern is, or might be, locale-sensitive.
+        if current_locale is None:
+            current_locale = _getlocale()[1]
+
+        return current_locale
+
+    # This pattern is definitely not locale-sensitive.
+    return None
 
-    # Do we need to reduce the size of the cache?
-    if len(_cache) >= _MAXCACHE:
+def _lookup_cache(pattern, flags, kwargs, pattern_locale):
+    "Looks for a pattern in the cache, returning None if it's not there."
+    try:
+        # Do we know what keyword arguments are needed?
+        args_key = pattern, type(pattern), flags
+        args_needed = _named_args[args_key]
+
+        # Are we being provided with its required keyword arguments?
+        args_supplied = set()
+        if args_needed:
+            for k, v in args_needed:
+                try:
+                    args_supplied.add((k, frozenset(kwargs[k])))
+                except KeyError:
+                    raise error("missing named list: {!r}".format(k))
+
+        args_supplied = frozenset(args_supplied)
+
+        # Have we already seen this regular expression and named list?
+        pattern_key = (pattern, type(pattern), flags, args_supplied,
+          DEFAULT_VERSION, pattern_locale)
         with _cache_lock:
-            _shrink_cache(_cache, _named_args, _locale_sensitive, _MAXCACHE)
+            # Move it to the most recently used end.
+            compiled_pattern = _cache.pop(pattern_key)
+            _cache[pattern_key] = compiled_pattern
+            _cache_stats[0] += 1
+
+        return compiled_pattern
+    except KeyError:
+        # It's a new pattern, or new named list for a known pattern.
+        return None
+
+def _cache_pattern(pattern, flags, args_needed, pattern_locale,
+  compiled_pattern):
+    "Stores a newly-compiled pattern in the cache."
+    # Store this regular expression and named list.
+    pattern_key = (pattern, type(pattern), flags, args_needed,
+      DEFAULT_VERSION, pattern_locale)
+
+    with _cache_lock:
+        _cache_stats[1] += 1
+
+        if _MAXCACHE > 0:
+            # Make room in the cache by discarding the least recently used
+            # patterns.
+            _evict_from_cache(_MAXCACHE - 1)
 
-    if not debugging:
-        if (info.flags & LOCALE) == 0:
-            pattern_locale = None
+            args_key = pattern, type(pattern), flags
+            if pattern_key not in _cache:
+                for key in (args_key, (type(pattern), pattern)):
+                    _cache_refs[key] = _cache_refs.get(key, 0) + 1
 
-        args_needed = frozenset(args_needed)
+            _cache[pattern_key] = compiled_pattern
 
-        # Store this regular expression and named list.
-        pattern_key = (pattern, type(pattern), flags, args_needed,
-          DEFAULT_VERSION, pattern_locale)
-        _cache[pattern_key] = compiled_pattern
+            # Store what keyword arguments are needed.
+            _named_args[args_key] = args_needed
 
-        # Store what keyword arguments are needed.
-        _named_args[args_key] = args_needed
+def _compile_many(patterns, flags, kwargs, processes):
+    "Compiles a sequence of regular expressions to PatternObjects."
+    patterns = list(patterns)
+    results = [None] * len(patterns)
 
-    return compiled_pattern
+    # The locale is looked up only once for all of the patterns.
+    current_locale = _getlocale()[1]
+
+    # Look for the patterns in the cache, acquiring the lock only once.
+    missing = []
+    if flags & DEBUG:
+        missing = list(range(len(patterns)))
+    else:
+        with _cache_lock:
+            for i, pattern in enumerate(patterns):
+                try:
+                    pattern_locale = _get_pattern_locale(pattern, flags,
+                      current_locale)
+                    compiled_pattern = _lookup_cache(pattern, flags, kwargs,
+                      pattern_locale)
+                except (error, TypeError) as e:
+                    results[i] = e
+                else:
+                    if compiled_pattern is None:
+                        missing.append(i)
+                    else:
+                        results[i] = compiled_pattern
+
+    # Compile the missing patterns' code in worker processes if asked to. Any
+    # which fail will be compiled again below to report the error.
+    compile_args = [None] * len(missing)
+    if processes and len(missing) > 1 and not (flags & DEBUG):
+        import multiprocessing
+
+        work = [(patterns[i], flags, kwargs, DEFAULT_VERSION) for i in
+          missing]
+        chunk_size = max(1, len(work) // (processes * 4))
+        pool = multiprocessing.Pool(processes)
+        try:
+            compile_args = pool.map(_compile_code_worker, work, chunk_size)
+        finally:
+            pool.close()
+            pool.join()
+
+    for i, args in zip(missing, compile_args):
+        try:
+            results[i] = _compile(patterns[i], flags, kwargs, args,
+              current_locale)
+        except (error, TypeError, ValueError) as e:
+            results[i] = e
+
+    return results
+
+def _compile_code_worker(work):
+    """Compiles a regular expression to the arguments for _regex.compile in a
+    worker process of compile_many, returning None if it fails or is
+    locale-sensitive."""
+    global DEFAULT_VERSION
+
+    pattern, flags, kwargs, DEFAULT_VERSION = work
+    if isinstance(pattern, str):
+        guess_encoding = UNICODE
+    elif isinstance(pattern, bytes):
+        guess_encoding = ASCII
+    else:
+        return None
+
+    try:
+        compile_args = _compile_code(pattern, flags, kwargs, guess_encoding)[0]
+    except (error, TypeError, ValueError):
+        return None
+
+    if compile_args[1] & LOCALE:
+        return None
+
+    return compile_args
+
+def _compile_pattern_set(patterns, kwargs):
+    """Compiles those patterns of a PatternSet which can be searched for
+    together into a single PatternObject. Returns that PatternObject, or None,
+    the indexes of those patterns, and the indexes of those which must be
+    searched for individually."""
+    # The combined pattern is:
+    #
+    #     (?=p0|p1|...)(?:(?=(p0))|)(?:(?=(p1))|)...
+    #
+    # The first lookahead finds the positions where any of the patterns match
+    # and the others record which of them match there. The patterns can't
+    # contain group references because their captures are removed, and
+    # patterns with different global flags or named lists can't be combined.
+    merged = []
+    unmerged = []
+    guards = []
+    lookaheads = []
+    info = None
+    special_flags = REVERSE | BESTMATCH | ENHANCEMATCH | POSIX | LOCALE
+
+    for index, p in enumerate(patterns):
+        if p.flags & special_flags or p.named_lists:
+            unmerged.append(index)
+            continue
+
+        if info is None:
+            global_flags = p.flags & GLOBAL_FLAGS
+            pattern_type = type(p.pattern)
+            info = _Info(global_flags, _Source(p.pattern).char_type)
+            info.guess_encoding = global_flags & _ALL_ENCODINGS
+        elif (p.flags & GLOBAL_FLAGS != global_flags or type(p.pattern) is not
+          pattern_type):
+            unmerged.append(index)
+            continue
+
+        if isinstance(p.pattern, str):
+            guess_encoding = UNICODE
+        else:
+            guess_encoding = ASCII
+
+        # Each pattern is needed twice, so it's parsed twice.
+        try:
+            parsed = []
+            for i in range(2):
+                subpattern, p_info, version = _parse(p.pattern, p.flags,
+                  kwargs, guess_encoding)
+                if p_info.group_calls:
+                    raise error("group reference not allowed")
+
+                parsed.append(subpattern.remove_captures())
+        except error:
+            unmerged.append(index)
+            continue
+
+        merged.append(index)
+        guards.append(parsed[0])
+        group = _Group(info, len(merged), parsed[1])
+        lookaheads.append(_Branch([_LookAround(False, True, group),
+          _Sequence()]))
+
+    if not merged:
+        return None, merged, unmerged
+
+    info.group_count = len(merged)
+    guard = _Branch(guards)
+
+    # Every match must start with a character in the firstset of one of the
+    # patterns.
+    try:
+        fs_code = _flatten_code(_compile_firstset(info,
+          guard.get_firstset(False)))
+    except _FirstSetError:
+        fs_code = []
+
+    parsed = _Sequence([_LookAround(False, True, guard)] + lookaheads)
+    parsed = parsed.optimise(info)
+    parsed = parsed.pack_characters(info)
+
+    _check_group_features(info, parsed)
+
+    code = fs_code + _flatten_code(parsed.compile(False) + [(_OP.SUCCESS, )])
+
+    combined = _regex.compile(None, global_flags, code, {}, {}, {}, [], 0, (),
+      0, (0, (), ()), None, len(merged))
+
+    return combined, merged, unmerged
 
 def _compile_replacement_helper(pattern, template):
     "Compiles a replacement template."
@@ -690,6 +1430,414 @@ def _compile_replacement_helper(pattern, template):
 
     return compiled
 
+# The minimum length of the part of a string which a worker thread searches.
+_MIN_SHARD_SIZE = 0x10000
+
+# How the matches are stepped through by findall, split and sub. Each rule is
+# (drop_adjacent, drop_empty, restart): whether to skip an empty match where
+# the previous match ended, whether to skip all empty matches, and whether to
+# continue from the next character after an empty match.
+_FINDALL_RULE = (False, False, False)
+_SPLIT_RULES = {VERSION0: (False, True, True), VERSION1: (True, False,
+  False)}
+_SUB_RULES = {VERSION0: (True, False, True), VERSION1: (False, False,
+  False)}
+
+def _scan_matches(pattern, string, pos, endpos, overlapped, rule, prev_end,
+  limit, limits):
+    """Yields the matches of a pattern in a string, as found by a sequential
+    search from pos which follows the given rule, until one starts at or after
+    limit. prev_end is where the previous match ended, if any."""
+    drop_adjacent, drop_empty, restart = rule
+    timeout, max_steps, max_memory = limits
+
+    while True:
+        next_pos = None
+        for m in pattern.finditer(string, pos, endpos, overlapped, True,
+          timeout=timeout, max_steps=max_steps, max_memory=max_memory):
+            start, end = m.span()
+            if limit is not None and start >= limit:
+                return
+
+            if start == end:
+                if drop_empty:
+                    next_pos = start + 1
+                    break
+
+                if drop_adjacent and start == prev_end:
+                    continue
+
+                yield m
+                prev_end = end
+
+                if restart:
+                    next_pos = start + 1
+                    break
+            else:
+                yield m
+                prev_end = end
+
+        if next_pos is None or next_pos > endpos:
+            return
+
+        pos = next_pos
+
+def _sharded_matches(pattern, string, pos, endpos, overlapped, rule, limits,
+  workers):
+    """Finds the matches of a pattern in a string by dividing the string into
+    parts which are searched by worker threads. Returns None if the search
+    can't be divided."""
+    if pattern.flags & (REVERSE | BESTMATCH | ENHANCEMATCH):
+        return None
+
+    # Where \G matches depends on where the search started.
+    anchor = "\\G" if isinstance(pattern.pattern, str) else b"\\G"
+    if anchor in pattern.pattern:
+        return None
+
+    pos, endpos, step = slice(pos, endpos).indices(len(string))
+    count = min(workers, (endpos - pos) // _MIN_SHARD_SIZE)
+    if count < 2:
+        return None
+
+    # Each part is searched only as far as a match which starts in it could
+    # look, so if there's no limit to that, the search can't be divided.
+    reach = _get_reach(pattern)
+    if reach is None:
+        return None
+
+    # Each worker finds the matches which start in its part of the string.
+    bounds = [pos + (endpos - pos) * i // count for i in range(count)]
+    bounds.append(None)
+
+    def part_end(i):
+        "Returns where the search of a part can stop."
+        if bounds[i + 1] is None:
+            return endpos
+
+        return min(bounds[i + 1] + reach, endpos)
+
+    parts = [None] * count
+    errors = []
+
+    def search_part(i):
+        try:
+            parts[i] = list(_scan_matches(pattern, string, bounds[i],
+              part_end(i), overlapped, rule, None, bounds[i + 1], limits))
+        except Exception as e:
+            errors.append(e)
+
+    # The current thread searches the first part.
+    threads = [_Thread(target=search_part, args=(i, )) for i in range(1,
+      count)]
+    for t in threads:
+        t.start()
+
+    search_part(0)
+
+    for t in threads:
+        t.join()
+
+    if errors:
+        raise errors[0]
+
+    # Overlapping matches are independent of each other.
+    if overlapped:
+        return [m for part in parts for m in part]
+
+    # A part's matches are the same as those of a sequential search unless a
+    # match from the previous parts extends into it. If one does, search
+    # sequentially from where it ends until a match is the same as one which
+    # was found by the worker; from that point onwards they'll be the same.
+    matches = []
+    for i, part in enumerate(parts):
+        if matches and matches[-1].end() >= bounds[i]:
+            prev_end = matches[-1].end()
+            found = dict((m.span(), index) for index, m in enumerate(part))
+            for m in _scan_matches(pattern, string, prev_end, part_end(i),
+              False, rule, prev_end, bounds[i + 1], limits):
+                index = found.get(m.span())
+                if index is not None:
+                    matches.extend(part[index : ])
+                    break
+
+                matches.append(m)
+        else:
+            matches.extend(part)
+
+    return matches
+
+def _get_reach(pattern):
+    """Returns how far past where a match starts a compiled pattern might
+    look, or None if there's no limit."""
+    try:
+        return _pattern_reaches[pattern]
+    except KeyError:
+        pass
+
+    source = pattern.pattern
+    if isinstance(source, bytes):
+        source = source.decode("latin-1")
+
+    # A lookahead can look any distance, and so can a word boundary in WORD
+    # mode.
+    tokens = ["(?=", "(?!", "\\X"]
+    if pattern.flags & WORD:
+        tokens.extend(["\\b", "\\B", "\\m", "\\M"])
+
+    reach = None
+    if not any(token in source for token in tokens):
+        if isinstance(pattern.pattern, str):
+            guess_encoding = UNICODE
+        else:
+            guess_encoding = ASCII
+
+        parsed = _parse(pattern.pattern, pattern.flags & ~DEBUG,
+          pattern.named_lists, guess_encoding)[0]
+        width = parsed.max_width()
+        if width < _regex_core.UNLIMITED:
+            # A match can be followed by a line separator and then the end of
+            # the text, which $ and \Z look for.
+            reach = width + 2
+
+    _pattern_reaches[pattern] = reach
+
+    return reach
+
+# The items which might make a match depend on the text which follows it.
+_LOOKAHEAD_TOKENS = ("$", "\\b", "\\B", "\\m", "\\M", "\\X", "\\Z", "(?=",
+  "(?!")
+
+def _finditer_stream(pattern, source, chunk_size, concurrent, timeout,
+  max_steps, max_memory):
+    "Returns an iterator over the matches of a pattern in a stream."
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be positive")
+
+    matcher = IncrementalMatcher(pattern, history=chunk_size,
+      concurrent=concurrent, timeout=timeout, max_steps=max_steps,
+      max_memory=max_memory)
+
+    if hasattr(source, "read"):
+        chunks = iter(lambda: source.read(chunk_size) or None, None)
+    else:
+        chunks = iter(source)
+
+    return _scan_stream(matcher, chunks)
+
+def _scan_stream(matcher, chunks):
+    "Yields the matches of an incremental matcher as chunks are fed to it."
+    for chunk in chunks:
+        for m in matcher.feed(chunk):
+            yield m
+
+    for m in matcher.finish():
+        yield m
+
+# The number of matches which an asynchronous iterator finds at a time.
+_ASYNC_BATCH_SIZE = 64
+
+_async_executor = None
+_async_lock = _RLock()
+
+def _get_async_executor():
+    "Gets the thread pool on which asynchronous matching is done."
+    global _async_executor
+
+    with _async_lock:
+        if _async_executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            _async_executor = ThreadPoolExecutor(min(32, (_os.cpu_count() or
+              1) + 4))
+
+        return _async_executor
+
+def _call_async(pattern, name, args, kwargs):
+    "Calls a pattern method asynchronously."
+    kwargs = dict(kwargs or {})
+    kwargs.setdefault("concurrent", True)
+
+    if name == "finditer":
+        return _AsyncMatchIterator(pattern.finditer(*args, **kwargs))
+
+    return _run_async(getattr(pattern, name), args, kwargs)
+
+def _run_async(function, args, kwargs):
+    """Runs a function on the thread pool, returning an asyncio future. If the
+    future is cancelled, any matching in the thread is stopped."""
+    import asyncio
+
+    running = []
+    cancelled = []
+
+    def run():
+        ident = _get_ident()
+        with _async_lock:
+            running.append(ident)
+
+            if cancelled:
+                _regex.set_cancelled(ident, True)
+
+        try:
+            return function(*args, **kwargs)
+        finally:
+            with _async_lock:
+                running.remove(ident)
+                _regex.set_cancelled(ident, False)
+
+    def done(future):
+        if future.cancelled():
+            with _async_lock:
+                cancelled.append(True)
+                for ident in running:
+                    _regex.set_cancelled(ident, True)
+
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(_get_async_executor(), run)
+    future.add_done_callback(done)
+
+    return future
+
+class _AsyncMatchIterator(object):
+    "An asynchronous iterator over the matches of a scanner."
+
+    def __init__(self, scanner):
+        self._scanner = scanner
+        self._batch = _deque()
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        import asyncio
+
+        result = asyncio.get_running_loop().create_future()
+        if self._batch:
+            result.set_result(self._batch.popleft())
+            return result
+
+        batch = _run_async(lambda: list(_islice(self._scanner,
+          _ASYNC_BATCH_SIZE)), (), {})
+
+        def batch_done(batch):
+            if result.cancelled():
+                return
+
+            if batch.cancelled():
+                result.cancel()
+            elif batch.exception() is not None:
+                result.set_exception(batch.exception())
+            elif batch.result():
+                self._batch.extend(batch.result())
+                result.set_result(self._batch.popleft())
+            else:
+                result.set_exception(StopAsyncIteration())
+
+        def result_done(result):
+            if result.cancelled():
+                batch.cancel()
+
+        batch.add_done_callback(batch_done)
+        result.add_done_callback(result_done)
+
+        return result
+
+def _get_slicer(string):
+    "Returns a function which slices a string like the _regex module does."
+    if isinstance(string, (str, bytes)):
+        return lambda start, end: string[start : end]
+
+    return lambda start, end: bytes(string[start : end])
+
+def _findall_item(pattern, m, spans_only=False):
+    "Gets the item which findall returns for a match."
+    if spans_only:
+        if pattern.groups <= 1:
+            return m.span(pattern.groups)
+
+        return m.span(*range(1, pattern.groups + 1))
+
+    if pattern.groups == 0:
+        return m.group()
+
+    empty = m.group()[ : 0]
+    if pattern.groups == 1:
+        return m.groups(empty)[0]
+
+    return m.groups(empty)
+
+def _sharded_split(pattern, string, maxsplit, limits, workers,
+  spans_only=False):
+    "Splits a string using worker threads."
+    version = VERSION1 if pattern.flags & VERSION1 else VERSION0
+    matches = _sharded_matches(pattern, string, None, None, False,
+      _SPLIT_RULES[version], limits, workers)
+    if matches is None:
+        return None
+
+    if maxsplit > 0:
+        matches = matches[ : maxsplit]
+
+    if spans_only:
+        slice_string = lambda start, end: (start, end)
+    else:
+        slice_string = _get_slicer(string)
+
+    results = []
+    last_pos = 0
+    for m in matches:
+        results.append(slice_string(last_pos, m.start()))
+        if spans_only:
+            results.extend(m.span(g) for g in range(1, pattern.groups + 1))
+        else:
+            results.extend(m.groups())
+
+        last_pos = m.end()
+
+    results.append(slice_string(last_pos, len(string)))
+
+    return results
+
+def _sharded_subn(pattern, repl, string, count, pos, endpos, limits,
+  workers):
+    "Replaces the matches in a string, using worker threads to find them."
+    version = VERSION1 if pattern.flags & VERSION1 else VERSION0
+    matches = _sharded_matches(pattern, string, pos, endpos, False,
+      _SUB_RULES[version], limits, workers)
+    if matches is None:
+        return None
+
+    if count > 0:
+        matches = matches[ : count]
+
+    slice_string = _get_slicer(string)
+    empty = slice_string(0, 0)
+    if callable(repl):
+        expand = repl
+    else:
+        template = _compile_replacement_helper(pattern, repl)
+
+        def expand(m):
+            return empty.join(m.group(item) or empty if isinstance(item, int)
+              else item for item in template)
+
+    results = []
+    last_pos = 0
+    for m in matches:
+        results.append(slice_string(last_pos, m.start()))
+        item = expand(m)
+        if item is not None:
+            results.append(item)
+
+        last_pos = m.end()
+
+    results.append(slice_string(last_pos, len(string)))
+
+    return empty.join(results), len(matches)
+
+# The tag identifying the engine which compiled the code.
+_engine_tag = _get_engine_tag()
+
 # We define _pattern_type here after all the support objects have been defined.
 _pattern_type = type(_compile("", 0, {}))
 
@@ -701,6 +1849,33 @@ Regex = compile
 import copyreg as _copy_reg
 
 def _pickle(p):
-    return _compile, (p.pattern, p.flags)
+    # The compiled code is included so that it needn't be compiled again when
+    # it's unpickled, but a locale-sensitive pattern must always be compiled
+    # again.
+    flags = p.flags & ~DEBUG
+    compile_args = None
+    if not (flags & LOCALE):
+        # The code is kept when the pattern is compiled, unless it's compiled
+        # for debugging.
+        compile_args = _pattern_compile_args.get(p)
+        if compile_args is None:
+            if isinstance(p.pattern, str):
+                guess_encoding = UNICODE
+            else:
+                guess_encoding = ASCII
+
+            compile_args = _compile_code(p.pattern, flags, p.named_lists,
+              guess_encoding)[0]
+
+    return _unpickle, (p.pattern, flags, p.named_lists, _engine_tag,
+      compile_args)
+
+def _unpickle(pattern, flags, named_lists, engine_tag, compile_args):
+    "Recreates a pickled pattern."
+    # The compiled code can be used only if it came from the same engine.
+    if engine_tag != _engine_tag:
+        compile_args = None
+
+    return _compile(pattern, flags, named_lists, compile_args)
 
 _copy_reg.pickle(_pattern_type, _pickle, _compile)
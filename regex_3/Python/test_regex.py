@@ -3,6 +3,7 @@ import string
 from weakref import proxy
 import unittest
 import copy
+import io
 from test.support import run_unittest
 import sys
 
@@ -1694,6 +1695,13 @@ class RegexTests(unittest.TestCase):
         self.assertEqual(regex.findall("(?V1)[\w--a]","abc"), ["b", "c"])
         self.assertEqual(regex.findall("(?iV1)[\w--a]","abc"), ["b", "c"])
 
+        # A character can be in a set only because of its other cases.
+        self.assertEqual(regex.findall(r"(?i)[\u212A\d]", "kK\u212Ax1"),
+          ["k", "K", "\u212A", "1"])
+        self.assertEqual(regex.findall(r"(?i)[^\u212A\d]", "kK\u212Ax1"),
+          ["x"])
+        self.assertEqual(regex.findall(br"(?i)[^k\d]", b"kKx1"), [b"x"])
+
     def test_various(self):
         tests = [
             # Test ?P< and ?P= extensions.
@@ -2579,6 +2587,20 @@ xyzabc
         self.assertEqual(regex.search(r"^\L<options>$", "", options=[]).span(),
           (0, 0))
 
+        options = ["one", "two", "onetwo", "three"]
+        self.assertEqual(regex.findall(r"\L<words>", "onetwo two one",
+          words=options), ["onetwo", "two", "one"])
+        self.assertEqual(regex.findall(r"(?r)\L<words>", "onetwo two one",
+          words=options), ["one", "two", "onetwo"])
+        self.assertEqual(regex.findall(r"(?ri)\L<words>", "ONETWO TWO",
+          words=options), ["TWO", "ONETWO"])
+        self.assertEqual(regex.match(r"\L<words>", "onetw", words=options,
+          partial=True).partial, True)
+
+        options = ["w%d" % i for i in range(10000)]
+        self.assertEqual(regex.findall(r"\b\L<words>\b", "w1 w99999 w9999 x",
+          words=options), ["w1", "w9999"])
+
     def test_fuzzy(self):
         # Some tests borrowed from TRE library tests.
         self.assertEqual(repr(type(regex.compile('(fou){s,e<=1}'))),
@@ -3654,6 +3676,774 @@ thing
           '{x} {x[0]} {x[1]} {x[2]} {x[-1]} {x[-2]} {x[-3]}', 'abc'),
           'c a b c c b a')
 
+    def test_cache(self):
+        old_size = regex.cache_info().maxsize
+        try:
+            regex.purge()
+            regex.set_cache_size(2)
+            self.assertEqual(regex.cache_info(), (0, 0, 0, 2, 0))
+
+            p1 = regex.compile("a1")
+            p2 = regex.compile("a2")
+            self.assertEqual(regex.compile("a1") is p1, True)
+
+            # "a2" is now the least recently used, so it's the one discarded.
+            regex.compile("a3")
+            self.assertEqual(regex.compile("a1") is p1, True)
+            self.assertEqual(regex.compile("a2") is p2, False)
+
+            info = regex.cache_info()
+            self.assertEqual((info.hits, info.misses, info.evictions,
+              info.maxsize, info.currsize), (2, 4, 2, 2, 2))
+
+            regex.set_cache_size(1)
+            self.assertEqual(regex.cache_info().evictions, 3)
+            self.assertEqual(regex.cache_info().currsize, 1)
+
+            regex.set_cache_size(0)
+            regex.compile("a4")
+            self.assertEqual(regex.cache_info().currsize, 0)
+
+            # Evicting one entry for a pattern with a named list doesn't make
+            # the others for it miss.
+            regex.set_cache_size(2)
+            p1 = regex.compile(r"\L<x>", x=["a"])
+            p2 = regex.compile(r"\L<x>", x=["b"])
+            regex.compile("a5")
+            self.assertEqual(regex.compile(r"\L<x>", x=["b"]) is p2, True)
+            self.assertEqual(regex.compile(r"\L<x>", x=["a"]) is p1, False)
+
+            self.assertRaises(ValueError, lambda: regex.set_cache_size(-1))
+        finally:
+            regex.set_cache_size(old_size)
+            regex.purge()
+
+    def test_compile_many(self):
+        patterns = [r"\d+", r"(?i)\L<names>", r"a(b", r"\w+"]
+        for processes in (None, 2):
+            regex.purge()
+            regex.compile(r"\w+")
+            results = regex.compile_many(patterns, processes=processes,
+              names=["one", "two"])
+            self.assertEqual(len(results), 4)
+            self.assertEqual(results[0].match("123").group(), "123")
+            self.assertEqual(results[1].match("TWO").group(), "TWO")
+            self.assertEqual(isinstance(results[2], regex.error), True)
+            self.assertEqual(results[3] is regex.compile(r"\w+"), True)
+
+        results = regex.compile_many([r"\L<names>", 1])
+        self.assertEqual(isinstance(results[0], regex.error), True)
+        self.assertEqual(isinstance(results[1], TypeError), True)
+
+    def test_pickle(self):
+        import pickle
+
+        p = regex.compile(r"(?i)(?P<word>\w+) \L<names>", names=["one",
+          "two"])
+        regex.purge()
+        p2 = pickle.loads(pickle.dumps(p))
+        self.assertEqual(p2.pattern, p.pattern)
+        self.assertEqual(p2.flags, p.flags)
+        self.assertEqual(p2.groupindex, p.groupindex)
+        self.assertEqual(p2.named_lists, p.named_lists)
+        self.assertEqual(p2.search("a b TWO").group("word"), "b")
+
+        # A pattern pickled by a different engine is compiled again.
+        data = regex._pickle(p)[1][ : 3] + ("other engine", None)
+        regex.purge()
+        p3 = regex._unpickle(*data)
+        self.assertEqual(p3.search("a b TWO").group("word"), "b")
+
+        # The code from when the pattern was compiled is pickled, so it isn't
+        # compiled again.
+        def compile_code(*args):
+            raise AssertionError("pattern compiled again")
+
+        original_compile_code = regex._compile_code
+        regex._compile_code = compile_code
+        try:
+            data = pickle.dumps(p)
+        finally:
+            regex._compile_code = original_compile_code
+
+        regex.purge()
+        p4 = pickle.loads(data)
+        self.assertEqual(p4.search("a b TWO").group("word"), "b")
+
+        p = regex.compile(b"(?L)\\w+")
+        p2 = pickle.loads(pickle.dumps(p))
+        self.assertEqual(p2.flags, p.flags)
+        self.assertEqual(p2.match(b"abc").group(), b"abc")
+
+    def test_search_char(self):
+        # Characters and small sets of characters are searched for many at a
+        # time, so try them at every position in strings of each width.
+        for filler in ("a", "\u0101", "\U00010101"):
+            for length in range(20):
+                for pos in range(length):
+                    text = filler * pos + "Q" + filler * (length - pos - 1)
+                    self.assertEqual(regex.search("Q", text).start(), pos)
+                    self.assertEqual(regex.search("(?i)q", text).start(),
+                      pos)
+                    self.assertEqual(regex.search("Qx|Q", text).start(), pos)
+                    self.assertEqual(regex.search("Q", text, pos=pos + 1),
+                      None)
+                    self.assertEqual(regex.search("[QZ]", text).start(), pos)
+                    self.assertEqual(regex.search(r"[QZ]\d*", text).start(),
+                      pos)
+
+            # The lazy DFA skips to where a match could start.
+            text = (filler * 30 + "Q1" + filler + "Z") * 10
+            self.assertEqual(regex.findall(r"[QZ]\d*", text), ["Q1", "Z"] *
+              10)
+
+    def test_required_literals(self):
+        # A match must contain one of several alternative strings, or strings
+        # which follow the required string.
+        text = "info: ok\nERROR: disk\nFATAL: timeout\nERROR: timeout\n"
+        self.assertEqual(regex.findall(r"(?:ERROR|FATAL).*timeout", text),
+          ["FATAL: timeout", "ERROR: timeout"])
+        self.assertEqual(regex.findall(r"(?i)(?:error|fatal)", text),
+          ["ERROR", "FATAL", "ERROR"])
+        self.assertEqual(regex.search(r"(?:ERROR|FATAL).*panic", text), None)
+        self.assertEqual(regex.search(r"x?(?:ERROR|FATAL):", text,
+          pos=13).span(), (21, 27))
+        self.assertEqual(regex.findall(r"(?:ab|cd)+e", "abcde cde abx"),
+          ["abcde", "cde"])
+        self.assertEqual(regex.findall(r"(?:a|bb).{2,3}(?:c|dd)",
+          "xa12c bb123dd a1c"), ["a12c", "bb123dd"])
+        self.assertEqual(regex.findall("(?i)(?:\u0101|b)c",
+          "\u0100C bc"), ["\u0100C", "bc"])
+        self.assertEqual(regex.findall(r"(?:a|b|c|d|e|f)z", "fz az gz"),
+          ["fz", "az"])
+
+        self.assertEqual(regex.search(r"foo.*bar.*baz", "foo bar bar"), None)
+        self.assertEqual(regex.search(r"foo.*bar.*baz", "baz foo bar"), None)
+        self.assertEqual(regex.search(r"foo.*bar.*baz", "foo baz bar baz"
+          ).span(), (0, 15))
+        self.assertEqual(regex.findall(r"(?i)foo\w*bar", "fooxBAR foo bar"),
+          ["fooxBAR"])
+        self.assertEqual(regex.search(r"foo.*bar", "foobar", partial=True
+          ).span(), (0, 6))
+        self.assertEqual(regex.search(r"foo.*bar", "xfoo ba", partial=True
+          ).span(), (1, 7))
+
+    def test_lazy_dfa(self):
+        # Patterns without backreferences or lookaround are searched with a
+        # lazy DFA, and the backtracker is run only to find the captures.
+        text = "a" * 40
+        self.assertEqual(regex.search(r"(a|aa)*[bc]", text), None)
+        self.assertEqual(regex.search(r"(?:a|aa)*[bc]", text + "c").span(),
+          (0, 41))
+        self.assertEqual(regex.search(r"(a|ab)(c|bcd)(d*)", "xabcd").groups(),
+          ("a", "bcd", ""))
+        self.assertEqual(regex.search(r"(a|ab)(c|bcd)(d*)", "xabcd").span(),
+          (1, 5))
+        self.assertEqual(regex.findall(r"a+?b*", "aaabb"), ["a", "a", "abb"])
+        self.assertEqual(regex.findall(r"<.+?>", "<a><b>"), ["<a>", "<b>"])
+        self.assertEqual(regex.findall(r"\b\w+\b", "one two, three"),
+          ["one", "two", "three"])
+        self.assertEqual(regex.findall(r"(?m)^\d+$", "12\nx3\n45"),
+          ["12", "45"])
+        self.assertEqual(regex.findall(r"(?i)\p{Lu}+", "abcD"), ["abcD"])
+        self.assertEqual(regex.findall(r"(?:\s+){2,}", "x\n\ny"), ["\n\n"])
+        self.assertEqual(regex.search(r"x*y+", "xxyy xy", pos=1,
+          endpos=3).span(), (1, 3))
+        self.assertEqual(regex.findall(r"\w+$", "ab\ncd\n"), ["cd"])
+        self.assertEqual(regex.findall(r"(?m)\w+$", "ab\r\ncd"), ["cd"])
+        self.assertEqual(regex.findall(r"(?mw)\w+$", "ab\r\ncd"), ["ab",
+          "cd"])
+        self.assertEqual(regex.findall(r"(?m)\w+$", "ab cd", endpos=4),
+          ["c"])
+        self.assertEqual(regex.findall(r"\b\w+\b", "caf\xe9 na\xefve"),
+          ["caf\xe9", "na\xefve"])
+        self.assertEqual(regex.findall(r"(?a)\b\w+\b", "caf\xe9 na\xefve"),
+          ["caf", "na", "ve"])
+
+        # Searching for successive matches finds the same ones whichever way
+        # it's done.
+        pattern = regex.compile(r"(?m)(?s:.)(?:[ab]){1,2}(?:^|(?s:.))\b")
+        text = "\nbbc\nbc\na11ac\naaaba\nbaa\n\naca"
+        spans = [(0, 4), (4, 7), (10, 13), (15, 19), (19, 23)]
+        self.assertEqual([m.span() for m in pattern.finditer(text)], spans)
+        found = []
+        pattern.sub(lambda m: found.append(m.span()) or "", text)
+        self.assertEqual(found, spans)
+        found = []
+        pattern.subn(lambda m: found.append(m.span()) or "", text)
+        self.assertEqual(found, spans)
+        self.assertEqual(pattern.split(text), [text[s : e] for s, e in
+          zip([0] + [e for s, e in spans], [s for s, e in spans] +
+          [len(text)])])
+
+    def test_timeout(self):
+        # Matching which takes too long or too many steps raises TimeoutError.
+        pattern = regex.compile(r"^(([a-z])+.)+[A-Z]([a-z])+$")
+        text = "a" * 33 + "!"
+        self.assertRaises(regex.TimeoutError, lambda: pattern.search(text,
+          timeout=0.05))
+        self.assertRaises(regex.TimeoutError, lambda: pattern.search(text,
+          timeout=0.05, concurrent=True))
+        self.assertRaises(regex.TimeoutError, lambda: pattern.sub("", text,
+          max_steps=10000))
+        self.assertRaises(regex.TimeoutError, lambda: pattern.split(text,
+          max_steps=10000))
+        self.assertRaises(regex.TimeoutError, lambda: pattern.findall(text,
+          max_steps=10000))
+        self.assertRaises(regex.TimeoutError, lambda:
+          next(pattern.finditer(text, max_steps=10000)))
+        self.assertRaises(regex.TimeoutError, lambda: regex.search(
+          r"(?:a|b)*c", "ab" * 1000 + "c", max_steps=100))
+
+        try:
+            pattern.match(text, max_steps=1000)
+        except regex.TimeoutError as e:
+            self.assertTrue(isinstance(e, regex.error))
+            self.assertTrue(0 <= e.pos <= len(text))
+        else:
+            self.fail("TimeoutError not raised")
+
+        self.assertEqual(regex.findall(r"\d+", "12 34", timeout=1.0,
+          max_steps=1000), ["12", "34"])
+        self.assertEqual(regex.sub(r"\d", "x", "a1b2", max_steps=1000),
+          "axbx")
+        self.assertEqual(list(regex.splititer(",", "a,b,c", max_steps=5)),
+          ["a", "b", "c"])
+        self.assertRaises(ValueError, lambda: regex.search("a", "a",
+          timeout=-1))
+        self.assertRaises(ValueError, lambda: regex.search("a", "a",
+          max_steps=-1))
+
+    def test_max_memory(self):
+        # Matching which needs too much memory raises MemoryLimitError.
+        text = "ab" * 20000
+        self.assertRaises(regex.MemoryLimitError, lambda:
+          regex.search(r"(?:(a)|b)+", text, max_memory=10000))
+        self.assertRaises(regex.MemoryLimitError, lambda:
+          next(regex.finditer(r"(?:(a)|b)+", text, max_memory=10000)))
+        self.assertTrue(issubclass(regex.MemoryLimitError, regex.error))
+        self.assertEqual(len(regex.search(r"(?:(a)|b)+", text,
+          max_memory=10 ** 8).captures(1)), 20000)
+        self.assertEqual(regex.findall(r"(\w+)\s*\1", "aa bb cc cc",
+          max_memory=100000), ["a", "b", "cc"])
+
+        regex.set_max_memory(10000)
+        try:
+            self.assertRaises(regex.MemoryLimitError, lambda:
+              regex.search(r"(?:(a)|b)+", text))
+            self.assertEqual(regex.search(r"(?:(a)|b)+", text,
+              max_memory=10 ** 8).span(), (0, 40000))
+        finally:
+            regex.set_max_memory(None)
+
+        self.assertEqual(regex.search(r"(?:(a)|b)+", text).span(), (0, 40000))
+        self.assertRaises(ValueError, lambda: regex.set_max_memory(-1))
+
+    def test_pool_info(self):
+        # The storage for matching is reused between calls.
+        pattern = regex.compile(r"(?:(a)|b)*?c(\d+)")
+        self.assertEqual(pattern.pool_info(), {"hits": 0, "misses": 0,
+          "size": 0, "capacity": 4})
+        for i in range(10):
+            self.assertEqual(pattern.search("ab" * 100 + "c12").span(2),
+              (201, 203))
+        self.assertEqual(pattern.pool_info(), {"hits": 9, "misses": 1,
+          "size": 1, "capacity": 4})
+
+        # Concurrent iterators need a set each.
+        iterators = [pattern.finditer("abc1 c2") for i in range(6)]
+        self.assertEqual([m.group(2) for m in iterators[0]], ["1", "2"])
+        self.assertEqual(pattern.pool_info()["misses"], 6)
+        del iterators
+        self.assertEqual(pattern.pool_info()["size"], 4)
+
+    def test_search_many(self):
+        pattern = regex.compile(r"(?P<key>\w+)=(?P<value>\d+)")
+        strings = ["a=1", "xx", "bb=22 c=3", "zz=9"]
+        self.assertEqual(pattern.search_many(strings), [True, False, True,
+          True])
+        self.assertEqual(pattern.match_many(iter(strings), spans=True), [(0,
+          3), None, (0, 5), (0, 4)])
+        self.assertEqual(pattern.fullmatch_many(strings), [True, False,
+          False, True])
+        self.assertEqual(pattern.search_many(strings, group="value"), ["1",
+          None, "22", "9"])
+        self.assertEqual(pattern.search_many(strings, group=(0, "key", 2)),
+          [("a=1", "a", "1"), None, ("bb=22", "bb", "22"), ("zz=9", "zz",
+          "9")])
+        self.assertEqual(pattern.search_many(strings, 1, 4), [False, False,
+          True, True])
+        self.assertEqual(pattern.search_many([]), [])
+        self.assertEqual(regex.compile(r"(a)|b").search_many(["b", "a", ""],
+          group=1), [None, "a", None])
+        self.assertEqual(regex.compile(r"(?r)\d+").search_many(["ab12c3",
+          "x"], spans=True), [(5, 6), None])
+        self.assertRaises(IndexError, lambda: pattern.search_many(strings,
+          group=3))
+        self.assertRaises(regex.TimeoutError, lambda:
+          regex.compile(r"^(([a-z])+.)+[A-Z]([a-z])+$").search_many(["a" * 24
+          + "!"] * 200, timeout=0.1))
+
+    def test_workers(self):
+        # The parts of the string are searched by threads, and the results
+        # must be the same as when searching the whole string.
+        text = "".join("%s=%d; " % ("k" * (i % 7 + 1), i) for i in
+          range(14000))
+        for pattern in [r"(k+)=(\d+)", r"(?V1)k*", r"\b", r"(?s).{1000,}?;",
+          r"(k{1,3})=(\d{1,5})", r"(?V1)k?", r"\d;$|k\b", r"(?s).{1000}"]:
+            self.assertEqual(regex.findall(pattern, text, workers=4),
+              regex.findall(pattern, text))
+            self.assertEqual(regex.subn(pattern, r"<\g<0>>", text, pos=5,
+              workers=4), regex.subn(pattern, r"<\g<0>>", text, pos=5))
+            self.assertEqual(regex.split(pattern, text, workers=4),
+              regex.split(pattern, text))
+
+        self.assertEqual([m.span() for m in regex.finditer(r"k+", text,
+          overlapped=True, workers=3)], [m.span() for m in regex.finditer(r"k+",
+          text, overlapped=True)])
+        self.assertEqual(regex.sub(br"\d+", lambda m: b"#", text.encode(),
+          count=100, workers=2), regex.sub(br"\d+", b"#", text.encode(),
+          count=100))
+        self.assertRaises(regex.TimeoutError, lambda:
+          regex.findall(r"(([a-z])+.)+[A-Z]\2", ("a" * 24 + "!") * 6000,
+          workers=2, timeout=0.05))
+
+        # A part is searched only as far as a match which starts in it could
+        # look, and a pattern with no such limit is searched serially.
+        bounds = []
+
+        def scan_matches(pattern, string, pos, endpos, overlapped, rule,
+          prev_end, limit, limits):
+            bounds.append((endpos, limit))
+            return original_scan_matches(pattern, string, pos, endpos,
+              overlapped, rule, prev_end, limit, limits)
+
+        original_scan_matches = regex._scan_matches
+        regex._scan_matches = scan_matches
+        try:
+            text = "ab " * 100000
+            self.assertEqual(regex.findall(r"\d\w", text, workers=4), [])
+            self.assertEqual(len(bounds), 4)
+            self.assertTrue(all(endpos <= limit + 4 for endpos, limit in
+              bounds if limit is not None))
+
+            del bounds[ : ]
+            self.assertEqual(regex.findall(r"\d\w+", text, workers=4), [])
+            self.assertEqual(bounds, [])
+        finally:
+            regex._scan_matches = original_scan_matches
+
+    def test_spans_only(self):
+        self.assertEqual(regex.findall(r"\d+", "a12b345", spans_only=True),
+          [(1, 3), (4, 7)])
+        self.assertEqual(regex.findall(r"(a)|(b)", "ab", spans_only=True),
+          [((0, 1), (-1, -1)), ((-1, -1), (1, 2))])
+        self.assertEqual(regex.findall(r"(?r)\d(\d)", "a12b345",
+          spans_only=True), [(6, 7), (2, 3)])
+        self.assertEqual(list(regex.finditer(r"\w*", "ab cd", spans_only=True)),
+          [(0, 2), (2, 2), (3, 5), (5, 5)])
+        self.assertEqual(regex.split(r"(,)|;", "a,b;c", spans_only=True),
+          [(0, 1), (1, 2), (2, 3), (-1, -1), (4, 5)])
+
+        text = "".join("%d,%s;" % (i, "x" * (i % 5)) for i in range(30000))
+        for pattern in [r"\d+", r"(\d+),(x*)", r"(?V1)x*"]:
+            self.assertEqual(regex.findall(pattern, text, workers=2,
+              spans_only=True), regex.findall(pattern, text, spans_only=True))
+            self.assertEqual(regex.split(pattern, text, workers=2,
+              spans_only=True), regex.split(pattern, text, spans_only=True))
+
+        data = bytearray(b"key=value")
+        m = regex.match(br"(\w+)=(\w+)(;)?", data)
+        key, value, semi = m.group_view(1, 2, 3)
+        self.assertEqual((key.tobytes(), value.tobytes(), semi), (b"key",
+          b"value", None))
+
+        # The views share the buffer of the string.
+        key[ : ] = b"KEY"
+        self.assertEqual(bytes(data), b"KEY=value")
+        self.assertEqual(m.group_view().tobytes(), b"KEY=value")
+        self.assertRaises(TypeError, lambda: regex.match("a",
+          "a").group_view())
+        self.assertRaises(IndexError, lambda: m.group_view(4))
+
+    def test_finditer_stream(self):
+        # Matches which span the chunks are found, with their offsets in the
+        # stream.
+        chunks = ["ab1", "2 x", "y34", "", "5 ", "6"]
+        self.assertEqual([(m.span(), m[0]) for m in
+          regex.finditer_stream(r"\d+", iter(chunks))], [((2, 4), "12"),
+          ((7, 10), "345"), ((11, 12), "6")])
+        self.assertEqual([m.span() for m in regex.finditer_stream(r"(?<=y)\d+",
+          chunks)], [(7, 10)])
+        self.assertEqual([m.span() for m in regex.finditer_stream(r"\b",
+          chunks)], [(0, 0), (4, 4), (5, 5), (10, 10), (11, 11), (12, 12)])
+        self.assertEqual(regex.search(r"a.*?b", "xac", partial=True).span(), (1,
+          3))
+
+        text = "".join("<%d:%s>" % (i, "x" * (i % 9)) for i in range(3000))
+        pattern = regex.compile(r"<(\d+):(x*?)>")
+        for chunk_size in [1, 7, 100]:
+            found = pattern.finditer_stream(io.StringIO(text), chunk_size)
+            self.assertEqual([(m.span(), m.span(1), m[2]) for m in found],
+              [(m.span(), m.span(1), m[2]) for m in pattern.finditer(text)])
+
+        m = next(regex.finditer_stream(br"(?i)B(\w)", [b"xxb", b"yz"]))
+        self.assertEqual((m.string, m.span(1), m.group(1)), (None, (3, 4),
+          b"y"))
+        self.assertEqual([m.span() for m in regex.finditer_stream(r"x*", [])],
+          [(0, 0)])
+        self.assertRaises(ValueError, lambda: regex.finditer_stream(r"(?r)a",
+          []))
+        self.assertRaises(ValueError, lambda: regex.finditer_stream(r"a", [],
+          chunk_size=0))
+
+    def test_incremental_matcher(self):
+        matcher = regex.IncrementalMatcher(r"(\w+)=(\d+);")
+        self.assertEqual([m.span() for m in matcher.feed("a=1; bb")], [(0,
+          4)])
+        self.assertEqual([(m.span(), m.groups()) for m in matcher.feed("=22;")],
+          [((5, 11), ("bb", "22"))])
+        self.assertEqual(matcher.feed("c=3"), [])
+        self.assertEqual(matcher.finish(), [])
+        self.assertRaises(ValueError, lambda: matcher.feed("x"))
+
+        # A match which reaches the end of the text so far might change.
+        matcher = regex.IncrementalMatcher(r"\d+\b|\Gx")
+        self.assertEqual([m.span() for m in matcher.feed("x12")], [(0, 1)])
+        self.assertEqual([m.span() for m in matcher.feed("3 4")], [(1, 4)])
+        self.assertEqual([m.span() for m in matcher.finish()], [(5, 6)])
+
+        # \G matches where the previous match ended.
+        matcher = regex.IncrementalMatcher(r"\G\d")
+        self.assertEqual([m.group() for m in matcher.feed("12")], ["1",
+          "2"])
+        self.assertEqual([m.group() for m in matcher.feed("3a4")], ["3"])
+        self.assertEqual(matcher.finish(), [])
+
+        self.assertRaises(ValueError, lambda: regex.IncrementalMatcher("a",
+          regex.BESTMATCH))
+
+    def test_async_matching(self):
+        import asyncio
+        import threading
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self.addCleanup(asyncio.set_event_loop, None)
+        self.addCleanup(loop.close)
+
+        # The awaitables are created within a running event loop.
+        async def call(function, *args):
+            return await function(*args)
+
+        async def collect(iterator):
+            return [m async for m in iterator]
+
+        text = "a1b22c333 " * 100
+        pattern = regex.compile(r"\d+")
+        self.assertEqual(loop.run_until_complete(call(pattern.asearch, text,
+          5)).span(), pattern.search(text, 5).span())
+        self.assertEqual(loop.run_until_complete(call(pattern.asub, "#",
+          text)), pattern.sub("#", text))
+        self.assertEqual(loop.run_until_complete(call(regex.asub, r"\d", "#",
+          "a1b2", 1)), "a#b2")
+
+        self.assertEqual([m.span() for m in
+          loop.run_until_complete(collect(pattern.afinditer(text)))],
+          [m.span() for m in pattern.finditer(text)])
+        self.assertEqual([m.group() for m in
+          loop.run_until_complete(collect(regex.afinditer(r"\w", "ab")))],
+          ["a", "b"])
+
+        # Cancelling stops the matching in the worker thread.
+        slow = regex.compile(r"(([a-z])+.)+[A-Z]\2")
+        finished = threading.Event()
+
+        def search():
+            try:
+                slow.search(("a" * 24 + "!") * 6000, concurrent=True)
+            finally:
+                finished.set()
+
+        async def cancel_search():
+            future = regex._run_async(search, (), {})
+            await asyncio.sleep(0.1)
+            future.cancel()
+            await asyncio.sleep(0)
+
+        loop.run_until_complete(cancel_search())
+        self.assertTrue(finished.wait(10))
+
+    def test_threads_sharing_pattern(self):
+        import threading
+
+        pattern = regex.compile(r"(\w+)@(\w+)\.com|\d{3,}")
+        text = " ".join("user%d@host%d.com %d" % (i, i, i * 997) for i in
+          range(2000))
+        expected = [m.span() for m in pattern.finditer(text)]
+        results = []
+
+        def run_threads(target, count=8):
+            threads = [threading.Thread(target=target) for i in range(count)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+        # Independent searches with the same pattern.
+        def search_independently():
+            for i in range(5):
+                results.append([m.span() for m in pattern.finditer(text,
+                  concurrent=True)])
+
+        run_threads(search_independently)
+        self.assertEqual(results, [expected] * 40)
+
+        # A scanner shared by several threads returns each match once.
+        for i in range(5):
+            scanner = pattern.scanner(text, concurrent=True)
+            found = []
+
+            def search_shared():
+                for m in iter(scanner.search, None):
+                    found.append(m.span())
+
+            run_threads(search_shared)
+            self.assertEqual(sorted(found), expected)
+
+    def test_latin1_properties(self):
+        import unicodedata
+
+        # The Latin-1 range is looked up in flat tables.
+        for c in range(0x100):
+            ch = chr(c)
+            category = unicodedata.category(ch)
+            self.assertTrue(regex.match(r"\p{gc=%s}" % category, ch))
+            self.assertTrue(regex.match(r"\p{%s}" % category[0], ch))
+            self.assertEqual(bool(regex.match(r"\d", ch)), category == "Nd")
+            self.assertEqual(bool(regex.match(r"\w", ch)),
+              bool(regex.match(r"[\p{Alpha}\p{M}\p{Nd}\p{Pc}]", ch)))
+            self.assertEqual(bool(regex.match(r"\p{Alnum}", ch)),
+              bool(regex.match(r"[\p{Alpha}\p{Nd}]", ch)))
+
+        self.assertEqual(regex.findall(r"\b\w+\b",
+          "caf\xe9 \xa0na\xefve 12"), ["caf\xe9", "na\xefve", "12"])
+
+    def test_fuzzy_literal_scan(self):
+        # A fuzzy literal is found by a bit-parallel scan, but the matches and
+        # their fuzzy counts are the same as those of matching.
+        text = "x" * 1000 + " custmer_id cusTomer-id customer_id " + "y" * 1000
+        self.assertEqual([(m.span(), m.fuzzy_counts) for m in
+          regex.finditer(r"(?:customer_id){e<=2}", text)], [((1000, 1011), (0,
+          1, 1)), ((1012, 1023), (2, 0, 0)), ((1023, 1035), (1, 1, 0))])
+        self.assertEqual([(m.span(), m.fuzzy_counts) for m in
+          regex.finditer(r"(?i)(?:customer[_-]id){s<=1,i<=1,d<=1}", text)],
+          [((1000, 1011), (1, 1, 1)), ((1011, 1023), (1, 1, 0)), ((1023,
+          1035), (1, 1, 0))])
+        self.assertEqual([(m.span(), m.fuzzy_counts) for m in
+          regex.finditer(r"(?b)(?:customer_id){e<=2}", text)], [((1024, 1035),
+          (0, 0, 0))])
+        self.assertEqual([(m.span(), m.fuzzy_counts) for m in
+          regex.finditer(r"(?e)(?:customer_id){e<=2}", text)], [((1001, 1011),
+          (0, 0, 1)), ((1012, 1023), (2, 0, 0)), ((1024, 1035), (0, 0, 0))])
+
+        pattern = regex.compile(r"(?:customer_id){e<=1}")
+        self.assertEqual([m.span() for m in pattern.finditer(text)], [(1001,
+          1011), (1023, 1035)])
+        self.assertEqual([m.span() for m in pattern.finditer(text, 1003)],
+          [(1023, 1035)])
+        self.assertEqual(pattern.findall(text, 1012, 1030), [])
+
+    def test_bestmatch_single_pass(self):
+        # BESTMATCH carries on from each match looking only for a cheaper one
+        # instead of searching again, and counts the passes it didn't need.
+        pattern = regex.compile(r"(?b)(?:john\s+smith){e<=3}")
+        self.assertEqual(pattern.bestmatch_passes_avoided, 0)
+
+        m = pattern.search("jxhn smxth and john smyth and john smith")
+        self.assertEqual((m.span(), m.fuzzy_counts), ((30, 40), (0, 0, 0)))
+        self.assertEqual(pattern.bestmatch_passes_avoided, 3)
+
+        m = pattern.search("jxhn smxth and john smyth")
+        self.assertEqual((m.span(), m.fuzzy_counts), ((15, 25), (1, 0, 0)))
+        self.assertEqual(pattern.bestmatch_passes_avoided, 6)
+
+        m = regex.search(r"(?b)(\w+)\s+(smith){e<=2}",
+          "jon smxth, jane smyth, joan smithe")
+        self.assertEqual((m.span(), m.groups(), m.fuzzy_counts), ((23, 33),
+          ("joan", "smith"), (0, 0, 0)))
+        self.assertEqual([m.span() for m in regex.finditer(r"(?b)(?:cat){e<=1}",
+          "cut cat dog cot")], [(4, 7), (12, 15)])
+
+        # An atomic group can match differently when less is permitted, so it
+        # still needs a pass for each cost.
+        pattern = regex.compile(r"(?b)(?>john\s+smith){e<=3}")
+        self.assertTrue(pattern.search("jxhn smxth and john smyth"))
+        self.assertEqual(pattern.bestmatch_passes_avoided, 0)
+
+    def test_fuzzy_named_lists(self):
+        # A fuzzy named list walks the trie of its items with an error budget
+        # instead of trying each item in turn.
+        names = ["smith", "smyth", "jones", "johnson", "brown"]
+        self.assertEqual([(m.group(), m.fuzzy_counts) for m in
+          regex.finditer(r"\b(?:\L<names>){e<=1}\b",
+          "smithe jonse brawn jones", names=names)], [("smithe", (0, 1, 0)),
+          ("brawn", (1, 0, 0)), ("jones", (0, 0, 0))])
+        self.assertEqual([(m.group(), m.fuzzy_counts) for m in
+          regex.finditer(r"(?r)\b(?:\L<names>){e<=1}\b",
+          "smithe jonse brawn jones", names=names)], [("jones", (0, 0, 0)),
+          ("brawn", (1, 0, 0)), ("smithe", (0, 1, 0))])
+        self.assertEqual([(m.group(), m.fuzzy_counts) for m in
+          regex.finditer(br"\b(?:\L<names>){e<=1}\b",
+          b"smithe jonse brawn jones", names=[n.encode() for n in names])],
+          [(b"smithe", (0, 1, 0)), (b"brawn", (1, 0, 0)), (b"jones", (0, 0,
+          0))])
+        self.assertEqual([(m.group(), m.fuzzy_counts) for m in
+          regex.finditer(r"(?i)\b(?:\L<names>){s<=1}\b", "SMITH Jonas BROWN",
+          names=names)], [("SMITH", (0, 0, 0)), ("Jonas", (1, 0, 0)),
+          ("BROWN", (0, 0, 0))])
+        self.assertEqual([(m.group(), m.fuzzy_counts) for m in
+          regex.finditer(r"(?fi)\b(?:\L<names>){e<=1}\b", "STRASE strasse",
+          names=["stra\N{LATIN SMALL LETTER SHARP S}e"])], [("STRASE", (0, 0,
+          1)), ("strasse", (0, 0, 0))])
+
+        # It backtracks into the other items and errors.
+        self.assertEqual(regex.search(r"(?:\L<names>){e<=1}n", "johnsonn",
+          names=names).span(), (0, 8))
+        m = regex.search(r"^(?:\L<names>){e<=1}$", "jonson", names=names)
+        self.assertEqual((m.span(), m.fuzzy_counts), ((0, 6), (0, 0, 1)))
+        self.assertEqual(regex.search(r"^(?:\L<names>){i<=1}$", "jonsn",
+          names=names), None)
+
+        m = regex.search(r"(?:\L<names>){e<=1}", "jo", names=names,
+          partial=True)
+        self.assertEqual((m.span(), m.partial), ((0, 2), True))
+
+        big = ["name%05d" % i for i in range(50000)]
+        m = regex.search(r"\b(?:\L<big>){e<=1}\b", "see nane01234 here",
+          big=big)
+        self.assertEqual((m.span(), m.fuzzy_counts), ((4, 13), (1, 0, 0)))
+        m = regex.search(r"(?b)\b(?:\L<big>){e<=2}\b", "nome0123x name01234",
+          big=big)
+        self.assertEqual((m.span(), m.fuzzy_counts), ((10, 19), (0, 0, 0)))
+
+    def test_large_alternations(self):
+        # Literals in an alternation are merged into a trie, but the first
+        # alternative which matches must still be the one which is found.
+        self.assertEqual(regex.findall(r"ab|a|abc|b", "abcbab"), ["ab", "b",
+          "ab"])
+        self.assertEqual(regex.findall(r"a|ab|abc|c", "abcab"), ["a", "c",
+          "a"])
+        self.assertEqual(regex.findall(r"ab|c|abc", "abc"), ["ab", "c"])
+        self.assertEqual(regex.findall(r"(?r)ab|c|abc", "abc"), ["c", "ab"])
+        self.assertEqual(regex.findall(r"(?r)bc|abc|c", "xabc"), ["bc"])
+        self.assertEqual(regex.findall(r"(?<=cat|dog|cow)s",
+          "cats dogs cows"), ["s", "s", "s"])
+        self.assertEqual(regex.findall(r"(?<=ab|b)c|x", "abcbc"), ["c",
+          "c"])
+        self.assertEqual(regex.search(r"(cat|cow|c)(ow|s)", "cows").groups(),
+          ("cow", "s"))
+        self.assertEqual(regex.search(r"(?:cat|c[a-z]t|cab)s",
+          "cots").group(), "cots")
+        self.assertEqual(regex.search(r"(?:ab|(?i:AC)|ad)",
+          "xac").group(), "ac")
+        self.assertEqual(regex.search(r"(?:ab|ac){e<=1}", "bc").group(), "b")
+        self.assertEqual(regex.match(r"(?P<x>ab|abc|b)(?&x)c",
+          "abbc").group(), "abbc")
+
+        # A deeply nested trie mustn't hit the recursion limit.
+        pattern = "|".join("a" * n for n in range(1, 2000))
+        self.assertEqual(regex.match(r"(?:%s)b" % pattern, "a" * 1500 +
+          "b").span(), (0, 1501))
+        self.assertEqual(regex.search(r"(?r)(?:%s)" % pattern, "aaa").span(),
+          (2, 3))
+
+        words = ["word%d" % i for i in range(20000)]
+        pattern = regex.compile(r"\b(?:%s)\b" % "|".join(words))
+        self.assertEqual(pattern.findall("word1 word19999 word20000 word123"),
+          ["word1", "word19999", "word123"])
+
+        # A group which a partial match stops in ends where the match ends.
+        self.assertEqual(regex.fullmatch(r"(a|ab)b", "a",
+          partial=True).regs, ((0, 1), (0, 1)))
+        self.assertEqual(regex.search(r"(a|ab)b", "zz", partial=True).regs,
+          ((2, 2), (2, 2)))
+        self.assertEqual(regex.match(r"(cat|cow|c)(ow|s)", "co",
+          partial=True).regs, ((0, 2), (0, 2), (-1, -1)))
+        self.assertEqual(regex.match(r"x(ab|ac|ad)y", "xa",
+          partial=True).regs, ((0, 2), (1, 2)))
+        self.assertEqual(regex.match(r"(a)(b)c", "a", partial=True).regs,
+          ((0, 1), (0, 1), (1, 1)))
+        self.assertEqual(regex.search(r"(?r)(ab|cb)c", "bc",
+          partial=True).regs, ((0, 2), (0, 1)))
+
+    def test_pattern_set(self):
+        ps = regex.PatternSet([r"ERROR", r"(?i)fatal", r"\d+", r"(a)\1",
+          r"ab|b", r"(?r)x"])
+        self.assertEqual(len(ps), 6)
+        self.assertEqual(ps.findall("xx ERROR 12 aa fatal ab"), [(5, 0, 1),
+          (5, 1, 2), (0, 3, 8), (2, 9, 11), (2, 10, 11), (3, 12, 14), (1, 15,
+          20), (4, 21, 23), (4, 22, 23)])
+        self.assertEqual(ps.search("xx ERROR 12 aa fatal ab"), [0, 1, 2, 3,
+          4, 5])
+        self.assertEqual(ps.search("no match"), [])
+        self.assertEqual(ps.search("xx ERROR 12", 3, 8), [0])
+        self.assertEqual([(i, m.span(), m.group()) for i, m in
+          ps.finditer("x aab", captures=True)], [(5, (0, 1), "x"), (3, (2,
+          4), "aa"), (4, (3, 5), "ab"), (4, (4, 5), "b")])
+
+        ps = regex.PatternSet([r"\L<names>", r"\w+"], names=["one", "two"])
+        self.assertEqual(ps.search("two"), [0, 1])
+
+        self.assertRaises(regex.error, lambda: regex.PatternSet([r"a(b"]))
+
+        # Lookbehinds.
+        ps = regex.PatternSet([r"(?<!a)b", r"q"])
+        self.assertEqual(ps.findall("ab cb"), [(0, 4, 5)])
+        ps = regex.PatternSet([r"(?<=a)b", r"b(?<=ab)"])
+        self.assertEqual(ps.findall("xab b"), [(0, 2, 3), (1, 2, 3)])
+
+        # Precompiled patterns keep their own flags.
+        ps = regex.PatternSet([regex.compile(r"abc", regex.I),
+          regex.compile(r"^x", regex.M), regex.compile(r"a.c", regex.S)])
+        self.assertEqual(ps.findall("ABC\nxa\nc"), [(0, 0, 3), (1, 4, 5), (2,
+          5, 8)])
+
+    def test_disk_cache(self):
+        import os
+        import shutil
+        import tempfile
+
+        directory = tempfile.mkdtemp()
+        try:
+            regex.set_disk_cache(directory)
+
+            regex.purge()
+            p = regex.compile(r"(?i)(\w+) \L<names>", names=["one", "two"])
+            self.assertEqual(len(os.listdir(directory)), 1)
+
+            # The order of the named list doesn't matter.
+            regex.purge()
+            p2 = regex.compile(r"(?i)(\w+) \L<names>", names=["two", "one"])
+            self.assertEqual(len(os.listdir(directory)), 1)
+            self.assertEqual(p2.pattern, p.pattern)
+            self.assertEqual(p2.groupindex, p.groupindex)
+            self.assertEqual(p2.named_lists, p.named_lists)
+            self.assertEqual(p2.search("a b TWO").span(), (2, 7))
+
+            # A damaged file is ignored.
+            path = os.path.join(directory, os.listdir(directory)[0])
+            f = open(path, "wb")
+            f.write(b"junk")
+            f.close()
+            regex.purge()
+            p3 = regex.compile(r"(?i)(\w+) \L<names>", names=["one", "two"])
+            self.assertEqual(p3.search("a b TWO").span(), (2, 7))
+        finally:
+            regex.set_disk_cache(None)
+            regex.purge()
+            shutil.rmtree(directory)
+
 if sys.version_info < (3, 2, 0):
     # In Python 3.1 it's called assertRaisesRegexp.
     RegexTests.assertRaisesRegex = RegexTests.assertRaisesRegexp
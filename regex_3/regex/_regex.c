@@ -46,6 +46,7 @@
 #include "Python.h"
 #include "structmember.h" /* offsetof */
 #include <ctype.h>
+#include <wchar.h>
 #include "_regex.h"
 #include "pyport.h"
 #include "pythread.h"
@@ -110,6 +111,10 @@ typedef unsigned short RE_STATUS_T;
 #define RE_ERROR_NOT_UNICODE -13 /* Not a Unicode string. */
 #define RE_ERROR_NOT_BYTES -14 /* Not a bytestring. */
 #define RE_ERROR_PARTIAL -15 /* Partial match. */
+#define RE_ERROR_TIMEOUT -16 /* Matching ran out of time. */
+#define RE_ERROR_MAX_STEPS -17 /* Matching ran out of steps. */
+#define RE_ERROR_MAX_MEMORY -18 /* Matching ran out of memory allowance. */
+#define RE_ERROR_CANCELLED -19 /* Matching was cancelled. */
 
 /* The number of backtrack entries per allocated block. */
 #define RE_BACKTRACK_BLOCK_SIZE 64
@@ -120,6 +125,17 @@ typedef unsigned short RE_STATUS_T;
 /* The number of atomic entries per allocated block. */
 #define RE_ATOMIC_BLOCK_SIZE 64
 
+/* The number of sets of matching storage that a pattern keeps for reuse. */
+#define RE_STATE_POOL_SIZE 4
+
+/* The maximum number of spare backtrack blocks kept in a pooled set. */
+#define RE_POOL_BACKTRACK_BLOCKS 16
+
+/* The number of steps the matching engine performs between checks for
+ * KeyboardInterrupt and whether it has run out of time.
+ */
+#define RE_CHECK_INTERVAL 0x10000
+
 /* The initial maximum capacity of the guard block. */
 #define RE_INIT_GUARDS_BLOCK_SIZE 16
 
@@ -176,6 +192,12 @@ typedef unsigned short RE_STATUS_T;
 #define RE_STATUS_REVERSE (RE_REVERSE_OP << RE_STATUS_SHIFT)
 #define RE_STATUS_REQUIRED (RE_REQUIRED_OP << RE_STATUS_SHIFT)
 
+/* The number of codepoints covered by the bitmap of a set, and the number of
+ * values it occupies.
+ */
+#define RE_SET_BITMAP_CHARS 0x100
+#define RE_SET_BITMAP_SIZE (RE_SET_BITMAP_CHARS / 32)
+
 /* The different error types for fuzzy matching. */
 #define RE_FUZZY_SUB 0
 #define RE_FUZZY_INS 1
@@ -214,6 +236,21 @@ static char copyright[] =
 /* The exception to raise on error. */
 static PyObject* error_exception;
 
+/* The exception to raise when matching runs out of time or steps. */
+static PyObject* timeout_exception;
+
+/* The function which reads the monotonic clock. */
+static PyObject* monotonic_clock;
+
+/* The exception to raise when matching needs too much memory. */
+static PyObject* memory_limit_exception;
+
+/* The default maximum memory for matching, or -1 if unlimited. */
+static Py_ssize_t default_max_memory = -1;
+
+/* The idents of the threads whose matching has been cancelled, or NULL. */
+static PyObject* cancelled_threads;
+
 /* The dictionary of Unicode properties. */
 static PyObject* property_dict;
 
@@ -306,6 +343,12 @@ typedef struct RE_BacktrackData {
             RE_INT8 fuzzy_type;
             RE_INT8 step;
         } fuzzy_item;
+        struct {
+            RE_Position position;
+            size_t max_cost;
+            size_t index;
+            size_t counts[RE_FUZZY_COUNT];
+        } fuzzy_string_set;
         struct {
             RE_Position position;
             Py_ssize_t string_pos;
@@ -523,12 +566,146 @@ typedef struct RE_StringInfo {
  */
 #define MAX_SEARCH_POSITIONS 7
 
+/* The maximum number of strings following the required string which are
+ * looked for before matching.
+ */
+#define RE_MAX_REQ_FOLLOWING 4
+
 /* Info about a search position. */
 typedef struct {
     Py_ssize_t start_pos;
     Py_ssize_t match_pos;
 } RE_SearchPosition;
 
+/* The kinds of instruction in a program for the lazy DFA. */
+#define RE_DFA_TEST 0
+#define RE_DFA_ASSERT 1
+#define RE_DFA_SPLIT 2
+#define RE_DFA_MATCH 3
+
+/* The maximum number of states which the lazy DFA will cache. When there are
+ * more, they're discarded and then rebuilt as they're needed.
+ */
+#define RE_DFA_MAX_STATES 256
+
+/* The number of buckets in the hash table of the lazy DFA's states. */
+#define RE_DFA_BUCKETS 251
+
+/* The number of entries in the table of the lazy DFA's transitions which
+ * can't be cached in the states themselves. It's a power of 2.
+ */
+#define RE_DFA_TRANSITIONS 1024
+
+/* The maximum number of different assertions in a program for the lazy DFA.
+ * Their results at a position are a bitmask, the context.
+ */
+#define RE_DFA_MAX_ASSERTIONS 32
+
+/* The classes of the character next to a state of the lazy DFA, which is the
+ * previous character when searching forwards and the following character when
+ * searching backwards. The assertions depend only on the classes of the
+ * characters on either side, except at the end of the string.
+ */
+#define RE_DFA_CLASS_NONE 0x1 /* There's no character there. */
+#define RE_DFA_CLASS_WORD 0x2
+#define RE_DFA_CLASS_LINE_FEED 0x4
+#define RE_DFA_CLASS_CARRIAGE_RETURN 0x8
+#define RE_DFA_CLASS_LINE_SEP 0x10
+#define RE_DFA_CLASS_SLICE_END 0x20 /* The state is at the end of the slice. */
+#define RE_DFA_CLASSES 0x40
+
+/* Skipping ahead to where a match could start costs the lazy DFA about as much
+ * as stepping over RE_DFA_SKIP_COST characters. A scan starts with some credit,
+ * gains what each skip saves or loses what it wastes, and stops skipping if it
+ * runs out.
+ */
+#define RE_DFA_SKIP_COST 8
+#define RE_DFA_SKIP_CREDIT 64
+
+/* The limits on matching. */
+typedef struct RE_Limits {
+    double timeout; /* The maximum time for matching in seconds, or -1.0 if unlimited. */
+    Py_ssize_t max_steps; /* The maximum number of iterations, or -1 if unlimited. */
+    Py_ssize_t max_memory; /* The maximum number of bytes allocated while matching, or -1 if unlimited. */
+} RE_Limits;
+
+/* An instruction in a program for the lazy DFA. */
+typedef struct RE_DFAInstr {
+    RE_Node* node; /* The character test or assertion, if there's one. */
+    Py_ssize_t next_1; /* The next instruction. */
+    Py_ssize_t next_2; /* The lower-priority next instruction of a split. */
+    RE_UINT32 context_bit; /* The bit of an assertion in the context. */
+    RE_UINT8 kind;
+} RE_DFAInstr;
+
+/* A program for the lazy DFA. It simulates the pattern as an NFA. */
+typedef struct RE_DFAProgram {
+    RE_DFAInstr* instrs;
+    RE_Node* assertions[RE_DFA_MAX_ASSERTIONS]; /* The different assertions. */
+    Py_ssize_t count;
+    Py_ssize_t entry;
+    size_t assertion_count;
+    RE_UINT8 classes; /* The classes which the assertions depend on. */
+    BOOL local; /* Whether the assertions depend only on the classes. */
+    BOOL at_final_line_sep; /* Whether an assertion depends on the final line separator. */
+} RE_DFAProgram;
+
+/* A state of the lazy DFA. Its threads are the instructions of the NFA which
+ * are waiting to be followed from its position, in order of priority.
+ *
+ * The assertions at a position are tested when the character after it is
+ * tested, so whether a match finished at the previous position is known only
+ * in the next state.
+ */
+typedef struct RE_DFAState {
+    struct RE_DFAState* next[256]; /* The transitions on Latin-1 characters, if they're known. */
+    struct RE_DFAState* hash_next; /* The next state in the same hash bucket. */
+    size_t hash;
+    Py_ssize_t count; /* The number of threads. */
+    BOOL matched; /* Whether a match finished at the previous position. */
+    BOOL is_start; /* Whether no match is in progress when searching. */
+    RE_UINT8 char_class; /* The class of the character next to it. */
+    Py_ssize_t threads[1];
+} RE_DFAState;
+
+/* A transition of the lazy DFA which depends on the results of the assertions
+ * at a position, its context, in a way which the classes of the characters
+ * don't determine, or which is on a character that isn't Latin-1.
+ */
+typedef struct RE_DFATransition {
+    RE_DFAState* from;
+    RE_DFAState* to; /* NULL if the entry is unused. */
+    Py_UCS4 ch;
+    RE_UINT32 context;
+} RE_DFATransition;
+
+/* The states of the lazy DFA, which are built as they're needed. */
+typedef struct RE_DFACache {
+    RE_DFAProgram* program;
+    BOOL forward; /* Whether it searches forwards for the first match. */
+    RE_DFAState* buckets[RE_DFA_BUCKETS];
+    RE_DFAState* start[RE_DFA_CLASSES]; /* The start states for each class, if they're known. */
+    size_t state_count;
+    size_t generation; /* Incremented whenever the states are discarded. */
+    Py_ssize_t* kernel; /* The threads of a state. */
+    Py_ssize_t* threads; /* The instructions which test the next character. */
+    Py_ssize_t* stack; /* The instructions waiting to be visited. */
+    RE_UINT32* marks; /* When the instructions were last visited. */
+    RE_UINT32 mark;
+    RE_DFATransition transitions[RE_DFA_TRANSITIONS];
+} RE_DFACache;
+
+/* The progress of the bit-parallel scan for a fuzzy literal. */
+typedef struct RE_FuzzyScan {
+    Py_ssize_t start; /* Where the previous search for a possible match started, or -1 if there isn't a scan. */
+    Py_ssize_t text_pos; /* Where the scan has reached. */
+    Py_ssize_t end; /* The end of the last possible match found, or -1. */
+    Py_ssize_t slice_end; /* The end of the slice being scanned. */
+    size_t score; /* The edit distance of the best match ending here. */
+    size_t pv; /* The positive vertical deltas. */
+    size_t mv; /* The negative vertical deltas. */
+} RE_FuzzyScan;
+
 /* The state object used during matching. */
 typedef struct RE_State {
     struct PatternObject* pattern; /* Parent PatternObject. */
@@ -566,6 +743,12 @@ typedef struct RE_State {
     /* Info about the best POSIX match (leftmost longest). */
     Py_ssize_t best_text_pos;
     RE_GroupData* best_match_groups;
+    /* Info about the best fuzzy match found so far in a single pass. */
+    Py_ssize_t best_fuzzy_match_pos;
+    Py_ssize_t best_fuzzy_text_pos;
+    RE_GroupData* best_fuzzy_groups;
+    size_t best_fuzzy_counts[RE_FUZZY_COUNT];
+    size_t passes_avoided; /* The number of passes that the single pass avoided. */
     /* Miscellaneous. */
     Py_ssize_t min_width; /* The minimum width of the string to match (assuming it's not a fuzzy pattern). */
     RE_EncodingTable* encoding; /* The 'encoding' of the string being searched. */
@@ -573,7 +756,14 @@ typedef struct RE_State {
     Py_UCS4 (*char_at)(void* text, Py_ssize_t pos);
     void (*set_char_at)(void* text, Py_ssize_t pos, Py_UCS4 ch);
     void* (*point_to)(void* text, Py_ssize_t pos);
-    PyThread_type_lock lock; /* A lock for accessing the state across threads. */
+    /* Guarding a state which is shared across threads. The flags and counts
+     * are protected by the GIL.
+     */
+    PyThread_type_lock lock; /* The gate on which waiting threads block, or NULL until there's one. */
+    size_t waiters; /* The number of threads waiting for the state. */
+    BOOL use_lock; /* Whether the state might be shared across threads. */
+    BOOL busy; /* Whether a thread is using the state. */
+    BOOL gate_open; /* Whether the gate has been opened for a waiting thread. */
     RE_FuzzyInfo fuzzy_info; /* Info about fuzzy matching. */
     size_t total_fuzzy_counts[RE_FUZZY_COUNT]; /* Totals for fuzzy matching. */
     RE_FuzzyGuards* fuzzy_guards; /* The guards for a fuzzy match. */
@@ -588,8 +778,15 @@ typedef struct RE_State {
     size_t capture_change; /* Incremented every time a captive group changes. */
     Py_ssize_t req_pos; /* The position where the required string matched. */
     Py_ssize_t req_end; /* The end position where the required string matched. */
+    Py_ssize_t req_alt_pos; /* The position where an alternative required string matched. */
+    Py_ssize_t req_following_pos[RE_MAX_REQ_FOLLOWING]; /* The positions where the strings following the required string matched. */
     int partial_side; /* The side that could truncate in a partial match. */
-    RE_UINT16 iterations; /* The number of iterations the matching engine has performed since checking for KeyboardInterrupt. */
+    size_t iterations; /* The number of iterations the matching engine will perform before checking for KeyboardInterrupt. */
+    size_t check_interval; /* The number of iterations between the previous check and the next. */
+    size_t steps; /* The number of iterations performed before the previous check. */
+    double deadline; /* When matching runs out of time. */
+    size_t memory_used; /* The number of bytes allocated while matching. */
+    RE_Limits limits; /* The limits on matching. */
     BOOL is_unicode; /* Whether the string to be matched is Unicode. */
     BOOL should_release; /* Whether the buffer should be released. */
     BOOL overlapped; /* Whether the matches can be overlapped. */
@@ -601,6 +798,11 @@ typedef struct RE_State {
     BOOL too_few_errors; /* Whether there were too few fuzzy errors. */
     BOOL match_all; /* Whether to match all of the string ('fullmatch'). */
     BOOL found_match; /* Whether a POSIX match has been found. */
+    BOOL single_pass_best; /* Whether to look for the best fuzzy match in a single pass. */
+    BOOL found_fuzzy_match; /* Whether a fuzzy match has been found in that pass. */
+    BOOL memory_exceeded; /* Whether matching needed more than the maximum memory. */
+    RE_DFACache* dfa_caches[2]; /* The states of the lazy DFA, forwards and backwards. */
+    RE_FuzzyScan fuzzy_scan; /* The scan for a fuzzy literal. */
 } RE_State;
 
 /* Storage for the regex state and thread state.
@@ -616,7 +818,137 @@ typedef struct RE_SafeState {
     PyThreadState* thread_state;
 } RE_SafeState;
 
-/* The PatternObject created from a regular expression. */
+/* The kinds of member of a string set. */
+#define RE_TRIE_UNICODE 0x1
+#define RE_TRIE_BYTES 0x2
+
+/* How the text is case-folded when matching a string set. */
+#define RE_TRIE_NO_FOLD 0
+#define RE_TRIE_SIMPLE_FOLD 1
+#define RE_TRIE_FULL_FOLD 2
+
+/* A node in the trie of a string set. */
+typedef struct RE_TrieNode {
+    RE_UINT32 first_edge; /* Index of the first edge from the node. */
+    RE_UINT32 edge_count; /* Number of edges from the node. */
+    RE_UINT8 end_kinds; /* Kinds of member which end at the node. */
+    RE_UINT8 below_kinds; /* Kinds of member which continue past the node. */
+} RE_TrieNode;
+
+/* An edge in the trie of a string set. */
+typedef struct RE_TrieEdge {
+    Py_UCS4 ch;
+    RE_UINT32 target;
+} RE_TrieEdge;
+
+/* The trie of a string set, built from the members forwards or reversed. The
+ * edges from each node are contiguous and sorted by codepoint.
+ */
+typedef struct RE_StringTrie {
+    RE_TrieNode* nodes;
+    RE_TrieEdge* edges;
+} RE_StringTrie;
+
+/* A member of a string set while its trie is being built. */
+typedef struct RE_TrieKey {
+    Py_UCS4* chars;
+    Py_ssize_t length;
+    RE_UINT8 kinds;
+} RE_TrieKey;
+
+/* A position while walking along the text and the trie of a string set. */
+typedef struct RE_TrieCursor {
+    RE_UINT32 node; /* The current node in the trie. */
+    Py_ssize_t text_pos; /* The position of the next character in the text. */
+    Py_ssize_t consumed; /* The number of characters consumed from the text. */
+    int fold_count; /* The number of codepoints the character folded to. */
+    int fold_index; /* The number of those codepoints consumed. */
+    Py_UCS4 folded[RE_MAX_FOLDED]; /* The folded character. */
+} RE_TrieCursor;
+
+/* Info about a walk along the text and the trie of a string set. */
+typedef struct RE_TrieWalk {
+    RE_State* state;
+    RE_StringTrie* trie;
+    Py_ssize_t available; /* The number of characters available in the slice. */
+    Py_ssize_t longest; /* The length of the longest member found, or -1. */
+    int step;
+    int folding;
+    RE_UINT8 kind; /* The kind of member which can match the text. */
+    BOOL partial_allowed;
+    BOOL partial; /* Whether the text ran out part-way through a member. */
+} RE_TrieWalk;
+
+/* Info about a fuzzy walk along the text and the trie of a string set.
+ *
+ * The walk tries the members depth-first with an error budget, so members
+ * which share a prefix share the work, and it stops at the first candidate it
+ * hasn't already tried.
+ */
+typedef struct RE_FuzzyTrieWalk {
+    RE_State* state;
+    RE_StringTrie* trie;
+    RE_CODE* values; /* The constraints of the fuzzy section. */
+    size_t max_cost; /* The limit on the total cost when the walk began. */
+    size_t counts[RE_FUZZY_COUNT]; /* The errors along the walk so far. */
+    size_t errors;
+    size_t cost;
+    size_t skip; /* The number of candidates already tried. */
+    size_t seen; /* The number of candidates found so far. */
+    size_t index; /* The index of the candidate found. */
+    size_t found_counts[RE_FUZZY_COUNT]; /* The errors of the candidate. */
+    Py_ssize_t text_pos; /* Where the candidate found ends. */
+    int step;
+    int folding;
+    RE_UINT8 kind; /* The kind of member which can match the text. */
+    BOOL search;
+    BOOL partial_allowed;
+    BOOL partial; /* Whether the text ran out part-way through a member. */
+    BOOL found;
+} RE_FuzzyTrieWalk;
+
+/* The alternative required strings, one of which must be in a match. */
+typedef struct RE_RequiredAlts {
+    RE_Node* strings; /* The strings, linked by 'next_1'. */
+    Py_ssize_t offset; /* The offset to the strings, or -1 if it's unknown. */
+    int first_count; /* The number of first characters, or 0 if there are too many to list. */
+    Py_UCS4 firsts[RE_MAX_CASES]; /* The first characters. */
+    RE_CODE first_bitmap[RE_SET_BITMAP_SIZE]; /* The first characters in the Latin-1 range. */
+    BOOL wide_first; /* Whether any first character is outside the Latin-1 range. */
+} RE_RequiredAlts;
+
+/* A pattern which is just a fuzzy section around a sequence of single
+ * characters or sets. The possible ends of a match are found with a
+ * bit-parallel scan for the edit distance (Myers' algorithm), and matching is
+ * tried only where a match could start.
+ */
+typedef struct RE_FuzzyLiteral {
+    RE_Node** nodes; /* The node that matches each position. */
+    Py_ssize_t* offsets; /* The offset of the character within a string node, or -1. */
+    size_t length; /* The number of positions. */
+    size_t max_errors; /* The maximum number of errors in a match. */
+    size_t masks[256]; /* The positions that each Latin-1 character matches. */
+} RE_FuzzyLiteral;
+
+/* The storage of a state that's kept by its pattern for reuse. */
+typedef struct RE_StateStorage {
+    RE_GroupData* groups;
+    RE_RepeatData* repeats;
+    RE_FuzzyGuards* fuzzy_guards;
+    RE_GuardList* group_call_guard_list;
+    RE_BacktrackBlock* backtrack_blocks; /* The spare backtrack blocks. */
+    size_t backtrack_block_count;
+} RE_StateStorage;
+
+/* The PatternObject created from a regular expression.
+ *
+ * The compiled program (the nodes, the info about the groups, repeats and
+ * calls, the tries of the named lists, the required strings and the programs
+ * of the lazy DFA) isn't modified after compilation, so any number of threads
+ * can match with it at the same time with the GIL released. Everything that
+ * matching modifies is in its RE_State. The storage which the pattern keeps
+ * for reuse is taken and returned only while the GIL is held.
+ */
 typedef struct PatternObject {
     PyObject_HEAD
     PyObject* pattern; /* Pattern source (or None). */
@@ -632,9 +964,9 @@ typedef struct PatternObject {
     PyObject* groupindex;
     PyObject* indexgroup;
     PyObject* named_lists;
-    size_t named_lists_count;
-    PyObject** partial_named_lists[2];
     PyObject* named_list_indexes;
+    size_t named_lists_count; /* The number of named list indexes. */
+    RE_StringTrie* named_list_tries[2]; /* Tries of the named lists. */
     /* Storage for the pattern nodes. */
     size_t node_capacity;
     size_t node_count;
@@ -653,12 +985,21 @@ typedef struct PatternObject {
     Py_ssize_t min_width; /* The minimum width of the string to match (assuming it isn't a fuzzy pattern). */
     RE_EncodingTable* encoding; /* Encoding handlers. */
     RE_LocaleInfo* locale_info; /* Info about the locale, if needed. */
-    RE_GroupData* groups_storage;
-    RE_RepeatData* repeats_storage;
+    RE_StateStorage state_pool[RE_STATE_POOL_SIZE]; /* Storage for reuse. */
+    size_t state_pool_count; /* The number of sets in the pool. */
+    size_t state_pool_hits; /* The number of times the pool was used. */
+    size_t state_pool_misses; /* The number of times it was empty. */
     size_t fuzzy_count; /* The number of fuzzy sections. */
     Py_ssize_t req_offset; /* The offset to the required string. */
     RE_Node* req_string; /* The required string. */
+    RE_RequiredAlts* req_alts; /* The alternative required strings, if any. */
+    RE_Node* req_following; /* The strings following the required string, linked by 'next_1'. */
+    RE_DFAProgram* dfa_programs[2]; /* The programs of the lazy DFA, forwards and backwards, if any. */
+    RE_DFACache* dfa_storage[2];
+    RE_FuzzyLiteral* fuzzy_literal; /* The fuzzy literal, if the pattern is one. */
+    Py_ssize_t bestmatch_passes_avoided; /* The passes that BESTMATCH didn't need. */
     BOOL is_fuzzy; /* Whether it's a fuzzy pattern. */
+    BOOL single_pass_best; /* Whether the best fuzzy match can be found in a single pass. */
     BOOL do_search_start; /* Whether to do an initial search. */
     BOOL recursive; /* Whether the entire pattern is recursive. */
 } PatternObject;
@@ -689,6 +1030,7 @@ typedef struct ScannerObject {
     PatternObject* pattern;
     RE_State state;
     int status;
+    BOOL spans_only; /* Whether to return spans instead of matches. */
 } ScannerObject;
 
 /* The SplitterObject. */
@@ -1397,6 +1739,36 @@ static RE_EncodingTable locale_encoding = {
 
 /* Unicode-specific. */
 
+/* Gets the value of a property of a Unicode character, using the flat tables
+ * for the commonest properties in the Latin-1 range.
+ */
+Py_LOCAL_INLINE(RE_UINT32) unicode_get_property(RE_UINT32 prop, Py_UCS4 ch) {
+    if (ch <= RE_LOCALE_MAX) {
+        switch (prop) {
+        case RE_PROP_GC:
+            return re_latin1_gc[ch];
+        case RE_PROP_ALNUM >> 16:
+            return (re_latin1_flags[ch] & RE_LATIN1_ALNUM) != 0;
+        case RE_PROP_ALPHA >> 16:
+            return (re_latin1_flags[ch] & RE_LATIN1_ALPHA) != 0;
+        case RE_PROP_SPACE >> 16:
+            return (re_latin1_flags[ch] & RE_LATIN1_SPACE) != 0;
+        case RE_PROP_WORD >> 16:
+            return (re_latin1_flags[ch] & RE_LATIN1_WORD) != 0;
+        }
+    }
+
+    return re_get_property[prop](ch);
+}
+
+/* Checks whether a Unicode character is a word character. */
+Py_LOCAL_INLINE(BOOL) unicode_is_word(Py_UCS4 ch) {
+    if (ch <= RE_LOCALE_MAX)
+        return (re_latin1_flags[ch] & RE_LATIN1_WORD) != 0;
+
+    return re_get_word(ch) == 1;
+}
+
 /* Checks whether a Unicode character has a property. */
 Py_LOCAL_INLINE(BOOL) unicode_has_property(RE_CODE property, Py_UCS4 ch) {
     RE_UINT32 prop;
@@ -1408,7 +1780,7 @@ Py_LOCAL_INLINE(BOOL) unicode_has_property(RE_CODE property, Py_UCS4 ch) {
         return FALSE;
 
     value = property & 0xFFFF;
-    v = re_get_property[prop](ch);
+    v = unicode_get_property(prop, ch);
 
     if (v == value)
         return TRUE;
@@ -1447,15 +1819,15 @@ static BOOL unicode_has_property_wrapper(RE_LocaleInfo* locale_info, RE_CODE
 
 /* Checks whether there's a word character to the left. */
 Py_LOCAL_INLINE(BOOL) unicode_word_left(RE_State* state, Py_ssize_t text_pos) {
-    return text_pos > 0 && unicode_has_property(RE_PROP_WORD,
-      state->char_at(state->text, text_pos - 1));
+    return text_pos > 0 && unicode_is_word(state->char_at(state->text, text_pos
+      - 1));
 }
 
 /* Checks whether there's a word character to the right. */
 Py_LOCAL_INLINE(BOOL) unicode_word_right(RE_State* state, Py_ssize_t text_pos)
   {
-    return text_pos < state->text_length && unicode_has_property(RE_PROP_WORD,
-      state->char_at(state->text, text_pos));
+    return text_pos < state->text_length &&
+      unicode_is_word(state->char_at(state->text, text_pos));
 }
 
 /* Checks whether a position is on a word boundary. */
@@ -2061,6 +2433,39 @@ static RE_EncodingTable unicode_encoding = {
 
 Py_LOCAL_INLINE(PyObject*) get_object(char* module_name, char* object_name);
 
+/* Raises a TimeoutError for matching which has run out of time or steps or
+ * has been cancelled. The position reached is unknown if it's negative.
+ */
+Py_LOCAL_INLINE(void) set_timeout_error(int status, Py_ssize_t text_pos) {
+    char* message;
+    PyObject* exception;
+
+    if (!timeout_exception) {
+        timeout_exception = get_object("_" RE_MODULE "_core", "TimeoutError");
+        if (!timeout_exception)
+            return;
+    }
+
+    if (status == RE_ERROR_TIMEOUT)
+        message = "matching timed out";
+    else if (status == RE_ERROR_CANCELLED)
+        message = "matching was cancelled";
+    else
+        message = "matching exceeded max_steps";
+
+    if (text_pos >= 0)
+        exception = PyObject_CallFunction(timeout_exception, "sn", message,
+          text_pos);
+    else
+        exception = PyObject_CallFunction(timeout_exception, "s", message);
+
+    if (!exception)
+        return;
+
+    PyErr_SetObject(timeout_exception, exception);
+    Py_DECREF(exception);
+}
+
 /* Sets the error message. */
 Py_LOCAL_INLINE(void) set_error(int status, PyObject* object) {
     TRACE(("<<set_error>>\n"))
@@ -2118,6 +2523,19 @@ Py_LOCAL_INLINE(void) set_error(int status, PyObject* object) {
     case RE_ERROR_REPLACEMENT:
         PyErr_SetString(error_exception, "invalid replacement");
         break;
+    case RE_ERROR_TIMEOUT:
+    case RE_ERROR_MAX_STEPS:
+    case RE_ERROR_CANCELLED:
+        set_timeout_error(status, -1);
+        break;
+    case RE_ERROR_MAX_MEMORY:
+        if (!memory_limit_exception)
+            memory_limit_exception = get_object("_" RE_MODULE "_core",
+              "MemoryLimitError");
+        if (memory_limit_exception)
+            PyErr_SetString(memory_limit_exception,
+              "matching exceeded max_memory");
+        break;
     default:
         /* Other error codes indicate compiler/engine bugs. */
         PyErr_SetString(PyExc_RuntimeError,
@@ -2213,17 +2631,140 @@ Py_LOCAL_INLINE(void) safe_dealloc(RE_SafeState* safe_state, void* ptr) {
     release_GIL(safe_state);
 }
 
-/* Checks for KeyboardInterrupt, holding the GIL during the check. */
-Py_LOCAL_INLINE(BOOL) safe_check_signals(RE_SafeState* safe_state) {
-    BOOL result;
+/* Reads the monotonic clock, returning -1.0 if there's an error. The GIL must
+ * be held.
+ */
+Py_LOCAL_INLINE(double) get_monotonic_time(void) {
+    PyObject* result;
+    double now;
+
+    if (!monotonic_clock) {
+        monotonic_clock = get_object("time", "monotonic");
+        if (!monotonic_clock)
+            return -1.0;
+    }
+
+    result = PyObject_CallObject(monotonic_clock, NULL);
+    if (!result)
+        return -1.0;
+
+    now = PyFloat_AsDouble(result);
+    Py_DECREF(result);
+
+    return now;
+}
+
+/* Sets the number of iterations before the next check, which must not be past
+ * the maximum number of steps.
+ */
+Py_LOCAL_INLINE(void) set_check_interval(RE_State* state) {
+    size_t interval;
+
+    interval = RE_CHECK_INTERVAL;
+    if (state->limits.max_steps >= 0 && (size_t)state->limits.max_steps + 1 -
+      state->steps < interval)
+        interval = (size_t)state->limits.max_steps + 1 - state->steps;
+
+    state->check_interval = interval;
+    state->iterations = interval;
+}
+
+/* Restarts the count of steps and memory and the clock for matching. The GIL
+ * must be held.
+ */
+Py_LOCAL_INLINE(BOOL) reset_limits(RE_State* state) {
+    state->steps = 0;
+    set_check_interval(state);
+
+    state->memory_used = 0;
+    state->memory_exceeded = FALSE;
+
+    if (state->limits.timeout >= 0.0) {
+        double now;
+
+        now = get_monotonic_time();
+        if (now == -1.0 && PyErr_Occurred())
+            return FALSE;
+
+        state->deadline = now + state->limits.timeout;
+    }
+
+    return TRUE;
+}
+
+/* Checks whether the matching in the current thread has been cancelled. The
+ * GIL must be held.
+ */
+Py_LOCAL_INLINE(int) is_thread_cancelled(void) {
+    PyObject* ident;
+    int result;
+
+    if (!cancelled_threads || PySet_GET_SIZE(cancelled_threads) == 0)
+        return FALSE;
+
+    ident = PyLong_FromUnsignedLong(PyThread_get_thread_ident());
+    if (!ident)
+        return -1;
+
+    result = PySet_Contains(cancelled_threads, ident);
+    Py_DECREF(ident);
+
+    return result;
+}
+
+/* Checks for KeyboardInterrupt and whether matching has run out of time or
+ * steps or has been cancelled, holding the GIL during the check.
+ */
+Py_LOCAL_INLINE(int) safe_check_limits(RE_SafeState* safe_state) {
+    RE_State* state;
+    int status;
+
+    state = safe_state->re_state;
+
+    state->steps += state->check_interval;
+    if (state->limits.max_steps >= 0 && state->steps >
+      (size_t)state->limits.max_steps)
+        return RE_ERROR_MAX_STEPS;
 
     acquire_GIL(safe_state);
 
-    result = (BOOL)PyErr_CheckSignals();
+    if (PyErr_CheckSignals())
+        status = RE_ERROR_INTERRUPTED;
+    else if ((status = is_thread_cancelled()) != FALSE)
+        status = status < 0 ? RE_ERROR_INTERRUPTED : RE_ERROR_CANCELLED;
+    else if (state->limits.timeout >= 0.0) {
+        double now;
+
+        now = get_monotonic_time();
+        if (now == -1.0 && PyErr_Occurred())
+            status = RE_ERROR_INTERRUPTED;
+        else if (now >= state->deadline)
+            status = RE_ERROR_TIMEOUT;
+        else
+            status = RE_ERROR_SUCCESS;
+    } else
+        status = RE_ERROR_SUCCESS;
 
     release_GIL(safe_state);
 
-    return result;
+    set_check_interval(state);
+
+    return status;
+}
+
+/* Checks whether matching may allocate more memory for its working storage,
+ * and if it may then adds it to the total.
+ */
+Py_LOCAL_INLINE(BOOL) charge_memory(RE_State* state, size_t size) {
+    if (state->limits.max_memory >= 0 && size >
+      (size_t)state->limits.max_memory - state->memory_used) {
+        state->memory_exceeded = TRUE;
+        return FALSE;
+    }
+
+    state->memory_used += size;
+
+    return TRUE;
 }
 
 /* Checks whether a character is in a range. */
@@ -2333,7 +2874,7 @@ Py_LOCAL_INLINE(BOOL) matches_PROPERTY_IGN(RE_EncodingTable* encoding,
           == RE_PROP_GC_LT) {
             RE_UINT32 value;
 
-            value = re_get_general_category(ch);
+            value = unicode_get_property(RE_PROP_GC, ch);
 
             return value == RE_PROP_LU || value == RE_PROP_LL || value ==
               RE_PROP_LT;
@@ -2674,6 +3215,10 @@ Py_LOCAL_INLINE(BOOL) in_set_union_ign(RE_EncodingTable* encoding,
 /* Checks whether a character is in a set. */
 Py_LOCAL_INLINE(BOOL) matches_SET(RE_EncodingTable* encoding,
 RE_LocaleInfo* locale_info, RE_Node* node, Py_UCS4 ch) {
+    /* Look in the bitmap, if there's one. */
+    if (ch < RE_SET_BITMAP_CHARS && node->value_count == RE_SET_BITMAP_SIZE)
+        return (node->values[ch >> 5] >> (ch & 0x1F)) & 0x1;
+
     switch (node->op) {
     case RE_OP_SET_DIFF:
     case RE_OP_SET_DIFF_REV:
@@ -2698,6 +3243,10 @@ RE_LocaleInfo* locale_info, RE_Node* node, Py_UCS4 ch) {
     Py_UCS4 cases[RE_MAX_CASES];
     int case_count;
 
+    /* Look in the bitmap, if there's one. */
+    if (ch < RE_SET_BITMAP_CHARS && node->value_count == RE_SET_BITMAP_SIZE)
+        return (node->values[ch >> 5] >> (ch & 0x1F)) & 0x1;
+
     case_count = encoding->all_cases(locale_info, ch, cases);
 
     switch (node->op) {
@@ -2796,8 +3345,8 @@ Py_LOCAL_INLINE(void) init_match(RE_State* state) {
     state->total_cost = 0;
     state->too_few_errors = FALSE;
     state->found_match = FALSE;
+    state->found_fuzzy_match = FALSE;
     state->capture_change = 0;
-    state->iterations = 0;
 }
 
 /* Adds a new backtrack entry. */
@@ -2816,6 +3365,9 @@ Py_LOCAL_INLINE(BOOL) add_backtrack(RE_SafeState* safe_state, RE_UINT8 op) {
             if (state->backtrack_allocated >= RE_MAX_BACKTRACK_ALLOC)
                 return FALSE;
 
+            if (!charge_memory(state, sizeof(RE_BacktrackBlock)))
+                return FALSE;
+
             next = (RE_BacktrackBlock*)safe_alloc(safe_state,
               sizeof(RE_BacktrackBlock));
             if (!next)
@@ -2883,6 +3435,9 @@ Py_LOCAL_INLINE(RE_AtomicData*) push_atomic(RE_SafeState* safe_state) {
             /* Add a new block. */
             RE_AtomicBlock* next;
 
+            if (!charge_memory(state, sizeof(RE_AtomicBlock)))
+                return NULL;
+
             next = (RE_AtomicBlock*)safe_alloc(safe_state,
               sizeof(RE_AtomicBlock));
             if (!next)
@@ -2942,6 +3497,10 @@ Py_LOCAL_INLINE(BOOL) copy_guard_data(RE_SafeState* safe_state, RE_GuardList*
         if (!safe_state)
             return FALSE;
 
+        if (!charge_memory(safe_state->re_state, (src->count - dst->capacity) *
+          sizeof(RE_GuardSpan)))
+            return FALSE;
+
         dst->capacity = src->count;
         new_spans = (RE_GuardSpan*)safe_realloc(safe_state, dst->spans,
           dst->capacity * sizeof(RE_GuardSpan));
@@ -2997,6 +3556,11 @@ Py_LOCAL_INLINE(BOOL) push_group_return(RE_SafeState* safe_state, RE_Node*
         frame = state->first_group_call_frame;
     else {
         /* Create a new frame. */
+        if (!charge_memory(state, sizeof(RE_GroupCallFrame) +
+          pattern->true_group_count * sizeof(RE_GroupData) +
+          pattern->repeat_count * sizeof(RE_RepeatData)))
+            return FALSE;
+
         frame = (RE_GroupCallFrame*)safe_alloc(safe_state,
           sizeof(RE_GroupCallFrame));
         if (!frame)
@@ -3204,6 +3768,154 @@ Py_LOCAL_INLINE(BOOL) any_case(Py_UCS4 ch, int case_count, Py_UCS4* cases) {
     return FALSE;
 }
 
+/* Finds the first character in a string which is one of several, looking at a
+ * word of characters at a time. The characters must be 1 or 2 bytes wide.
+ * Returns the limit if there's no such character.
+ */
+Py_LOCAL_INLINE(void*) find_any_char(void* text_ptr, void* limit_ptr,
+  Py_ssize_t charsize, int case_count, Py_UCS4* cases) {
+    size_t lows;
+    size_t highs;
+    Py_UCS4 max_char;
+    size_t patterns[RE_MAX_CASES];
+    int count;
+    int i;
+    char* ptr;
+    char* end_ptr;
+
+    if (charsize == 1) {
+        lows = (size_t)-1 / 0xFF;
+        max_char = 0xFF;
+    } else {
+        lows = (size_t)-1 / 0xFFFF;
+        max_char = 0xFFFF;
+    }
+
+    highs = lows << (charsize * 8 - 1);
+
+    /* A character which is too wide can't be in the string. */
+    count = 0;
+    for (i = 0; i < case_count; i++) {
+        if (cases[i] <= max_char)
+            patterns[count++] = lows * cases[i];
+    }
+
+    if (count == 0)
+        return limit_ptr;
+
+    ptr = (char*)text_ptr;
+    end_ptr = (char*)limit_ptr;
+
+    /* A word contains one of the characters if XORing it with a pattern of
+     * that character gives a zero character.
+     */
+    while (end_ptr - ptr >= (Py_ssize_t)sizeof(size_t)) {
+        size_t word;
+        BOOL found;
+
+        memcpy(&word, ptr, sizeof(word));
+
+        found = FALSE;
+        for (i = 0; i < count; i++) {
+            size_t x;
+
+            x = word ^ patterns[i];
+            if ((x - lows) & ~x & highs) {
+                found = TRUE;
+                break;
+            }
+        }
+
+        if (found)
+            break;
+
+        ptr += sizeof(size_t);
+    }
+
+    /* Find the character itself. */
+    while (ptr < end_ptr) {
+        Py_UCS4 ch;
+
+        if (charsize == 1)
+            ch = *(Py_UCS1*)ptr;
+        else
+            ch = *(Py_UCS2*)ptr;
+
+        if (any_case(ch, case_count, cases))
+            return ptr;
+
+        ptr += charsize;
+    }
+
+    return limit_ptr;
+}
+
+/* Finds the first occurrence of a character in a string, looking at many
+ * characters at a time. Returns the limit if it isn't found.
+ */
+Py_LOCAL_INLINE(void*) find_char(void* text_ptr, void* limit_ptr, Py_ssize_t
+  charsize, Py_UCS4 ch) {
+    void* found;
+
+    switch (charsize) {
+    case 1:
+        if (ch > 0xFF)
+            return limit_ptr;
+
+        found = memchr(text_ptr, (int)ch, (size_t)((Py_UCS1*)limit_ptr -
+          (Py_UCS1*)text_ptr));
+        break;
+    case 2:
+        return find_any_char(text_ptr, limit_ptr, charsize, 1, &ch);
+    default:
+    {
+        Py_UCS4* ptr;
+
+        /* wmemchr can be used if wchar_t is the same width. */
+        if (sizeof(wchar_t) == sizeof(Py_UCS4)) {
+            found = wmemchr((wchar_t*)text_ptr, (wchar_t)ch,
+              (size_t)((Py_UCS4*)limit_ptr - (Py_UCS4*)text_ptr));
+            break;
+        }
+
+        ptr = (Py_UCS4*)text_ptr;
+        while (ptr < (Py_UCS4*)limit_ptr && ptr[0] != ch)
+            ++ptr;
+
+        return ptr;
+    }
+    }
+
+    return found ? found : limit_ptr;
+}
+
+/* Gets the characters of a set which is a union of only a few characters, so
+ * that they can be searched for many at a time. Returns how many there are, or
+ * 0 if the set isn't like that.
+ */
+Py_LOCAL_INLINE(int) get_small_set(RE_Node* node, Py_UCS4* chars) {
+    RE_Node* member;
+    int i;
+
+    if (node->op != RE_OP_SET_UNION)
+        return 0;
+
+    member = node->nonstring.next_2.node;
+    if (!member || member->next_1.node || !member->match)
+        return 0;
+
+    if (member->op != RE_OP_CHARACTER && member->op != RE_OP_STRING)
+        return 0;
+
+    if (member->value_count > RE_MAX_CASES)
+        return 0;
+
+    for (i = 0; i < (int)member->value_count; i++)
+        chars[i] = member->values[i];
+
+    return (int)member->value_count;
+}
+
 /* Matches many ANYs, up to a limit. */
 Py_LOCAL_INLINE(Py_ssize_t) match_many_ANY(RE_State* state, RE_Node* node,
   Py_ssize_t text_pos, Py_ssize_t limit, BOOL match) {
@@ -3463,6 +4175,10 @@ Py_LOCAL_INLINE(Py_ssize_t) match_many_CHARACTER(RE_State* state, RE_Node*
         text_ptr = (Py_UCS1*)text + text_pos;
         limit_ptr = (Py_UCS1*)text + limit;
 
+        /* If we're looking for the character, skip to it. */
+        if (!match && text_ptr < limit_ptr)
+            text_ptr = (Py_UCS1*)find_char(text_ptr, limit_ptr, 1, ch);
+
         while (text_ptr < limit_ptr && (text_ptr[0] == ch) == match)
             ++text_ptr;
 
@@ -3477,6 +4193,10 @@ Py_LOCAL_INLINE(Py_ssize_t) match_many_CHARACTER(RE_State* state, RE_Node*
         text_ptr = (Py_UCS2*)text + text_pos;
         limit_ptr = (Py_UCS2*)text + limit;
 
+        /* If we're looking for the character, skip to it. */
+        if (!match && text_ptr < limit_ptr)
+            text_ptr = (Py_UCS2*)find_char(text_ptr, limit_ptr, 2, ch);
+
         while (text_ptr < limit_ptr && (text_ptr[0] == ch) == match)
             ++text_ptr;
 
@@ -3491,6 +4211,10 @@ Py_LOCAL_INLINE(Py_ssize_t) match_many_CHARACTER(RE_State* state, RE_Node*
         text_ptr = (Py_UCS4*)text + text_pos;
         limit_ptr = (Py_UCS4*)text + limit;
 
+        /* If we're looking for the character, skip to it. */
+        if (!match && text_ptr < limit_ptr)
+            text_ptr = (Py_UCS4*)find_char(text_ptr, limit_ptr, 4, ch);
+
         while (text_ptr < limit_ptr && (text_ptr[0] == ch) == match)
             ++text_ptr;
 
@@ -3523,6 +4247,11 @@ Py_LOCAL_INLINE(Py_ssize_t) match_many_CHARACTER_IGN(RE_State* state, RE_Node*
         text_ptr = (Py_UCS1*)text + text_pos;
         limit_ptr = (Py_UCS1*)text + limit;
 
+        /* If we're looking for the character, skip to it. */
+        if (!match && text_ptr < limit_ptr)
+            text_ptr = (Py_UCS1*)find_any_char(text_ptr, limit_ptr, 1,
+              case_count, cases);
+
         while (text_ptr < limit_ptr && any_case(text_ptr[0], case_count, cases)
           == match)
             ++text_ptr;
@@ -3538,6 +4267,11 @@ Py_LOCAL_INLINE(Py_ssize_t) match_many_CHARACTER_IGN(RE_State* state, RE_Node*
         text_ptr = (Py_UCS2*)text + text_pos;
         limit_ptr = (Py_UCS2*)text + limit;
 
+        /* If we're looking for the character, skip to it. */
+        if (!match && text_ptr < limit_ptr)
+            text_ptr = (Py_UCS2*)find_any_char(text_ptr, limit_ptr, 2,
+              case_count, cases);
+
         while (text_ptr < limit_ptr && any_case(text_ptr[0], case_count, cases)
           == match)
             ++text_ptr;
@@ -4196,12 +4930,17 @@ Py_LOCAL_INLINE(Py_ssize_t) match_many_SET(RE_State* state, RE_Node* node,
     void* text;
     RE_EncodingTable* encoding;
     RE_LocaleInfo* locale_info;
+    Py_UCS4 chars[RE_MAX_CASES];
+    int char_count;
 
     text = state->text;
     match = node->match == match;
     encoding = state->encoding;
     locale_info = state->locale_info;
 
+    /* Is it looking for one of only a few characters? */
+    char_count = match ? 0 : get_small_set(node, chars);
+
     switch (state->charsize) {
     case 1:
     {
@@ -4211,6 +4950,13 @@ Py_LOCAL_INLINE(Py_ssize_t) match_many_SET(RE_State* state, RE_Node* node,
         text_ptr = (Py_UCS1*)text + text_pos;
         limit_ptr = (Py_UCS1*)text + limit;
 
+        /* If we're looking for a few characters, skip to them. */
+        if (char_count == 1 && text_ptr < limit_ptr)
+            text_ptr = (Py_UCS1*)find_char(text_ptr, limit_ptr, 1, chars[0]);
+        else if (char_count > 1 && text_ptr < limit_ptr)
+            text_ptr = (Py_UCS1*)find_any_char(text_ptr, limit_ptr, 1,
+              char_count, chars);
+
         while (text_ptr < limit_ptr && matches_SET(encoding, locale_info, node,
           text_ptr[0]) == match)
             ++text_ptr;
@@ -4226,6 +4972,13 @@ Py_LOCAL_INLINE(Py_ssize_t) match_many_SET(RE_State* state, RE_Node* node,
         text_ptr = (Py_UCS2*)text + text_pos;
         limit_ptr = (Py_UCS2*)text + limit;
 
+        /* If we're looking for a few characters, skip to them. */
+        if (char_count == 1 && text_ptr < limit_ptr)
+            text_ptr = (Py_UCS2*)find_char(text_ptr, limit_ptr, 2, chars[0]);
+        else if (char_count > 1 && text_ptr < limit_ptr)
+            text_ptr = (Py_UCS2*)find_any_char(text_ptr, limit_ptr, 2,
+              char_count, chars);
+
         while (text_ptr < limit_ptr && matches_SET(encoding, locale_info, node,
           text_ptr[0]) == match)
             ++text_ptr;
@@ -4241,6 +4994,10 @@ Py_LOCAL_INLINE(Py_ssize_t) match_many_SET(RE_State* state, RE_Node* node,
         text_ptr = (Py_UCS4*)text + text_pos;
         limit_ptr = (Py_UCS4*)text + limit;
 
+        /* If we're looking for a character, skip to it. */
+        if (char_count == 1 && text_ptr < limit_ptr)
+            text_ptr = (Py_UCS4*)find_char(text_ptr, limit_ptr, 4, chars[0]);
+
         while (text_ptr < limit_ptr && matches_SET(encoding, locale_info, node,
           text_ptr[0]) == match)
             ++text_ptr;
@@ -4705,6 +5462,11 @@ Py_LOCAL_INLINE(Py_ssize_t) simple_string_search(RE_State* state, RE_Node*
         Py_UCS1* limit_ptr = text + limit;
 
         while (text_ptr < limit_ptr) {
+            /* Skip to the next possible start of the string. */
+            text_ptr = (Py_UCS1*)find_char(text_ptr, limit_ptr, 1, check_char);
+            if (text_ptr >= limit_ptr)
+                break;
+
             if (text_ptr[0] == check_char) {
                 Py_ssize_t s_pos;
 
@@ -4746,6 +5508,11 @@ Py_LOCAL_INLINE(Py_ssize_t) simple_string_search(RE_State* state, RE_Node*
         Py_UCS2* limit_ptr = text + limit;
 
         while (text_ptr < limit_ptr) {
+            /* Skip to the next possible start of the string. */
+            text_ptr = (Py_UCS2*)find_char(text_ptr, limit_ptr, 2, check_char);
+            if (text_ptr >= limit_ptr)
+                break;
+
             if (text_ptr[0] == check_char) {
                 Py_ssize_t s_pos;
 
@@ -4787,6 +5554,11 @@ Py_LOCAL_INLINE(Py_ssize_t) simple_string_search(RE_State* state, RE_Node*
         Py_UCS4* limit_ptr = text + limit;
 
         while (text_ptr < limit_ptr) {
+            /* Skip to the next possible start of the string. */
+            text_ptr = (Py_UCS4*)find_char(text_ptr, limit_ptr, 4, check_char);
+            if (text_ptr >= limit_ptr)
+                break;
+
             if (text_ptr[0] == check_char) {
                 Py_ssize_t s_pos;
 
@@ -4859,6 +5631,12 @@ Py_LOCAL_INLINE(Py_ssize_t) simple_string_search_ign(RE_State* state, RE_Node*
         Py_UCS1* limit_ptr = text + limit;
 
         while (text_ptr < limit_ptr) {
+            /* Skip to the next possible start of the string. */
+            text_ptr = (Py_UCS1*)find_any_char(text_ptr, limit_ptr, 1,
+              case_count, cases);
+            if (text_ptr >= limit_ptr)
+                break;
+
             if (any_case(text_ptr[0], case_count, cases)) {
                 Py_ssize_t s_pos;
 
@@ -4901,6 +5679,12 @@ Py_LOCAL_INLINE(Py_ssize_t) simple_string_search_ign(RE_State* state, RE_Node*
         Py_UCS2* limit_ptr = text + limit;
 
         while (text_ptr < limit_ptr) {
+            /* Skip to the next possible start of the string. */
+            text_ptr = (Py_UCS2*)find_any_char(text_ptr, limit_ptr, 2,
+              case_count, cases);
+            if (text_ptr >= limit_ptr)
+                break;
+
             if (any_case(text_ptr[0], case_count, cases)) {
                 Py_ssize_t s_pos;
 
@@ -8680,6 +9464,10 @@ Py_LOCAL_INLINE(BOOL) save_capture(RE_SafeState* safe_state, size_t
 
         new_capacity = public_group->capture_capacity * 2;
         new_capacity = max_size_t(new_capacity, RE_INIT_CAPTURE_SIZE);
+        if (!charge_memory(state, (new_capacity -
+          public_group->capture_capacity) * sizeof(RE_GroupSpan)))
+            return FALSE;
+
         new_captures = (RE_GroupSpan*)safe_realloc(safe_state,
           public_group->captures, new_capacity * sizeof(RE_GroupSpan));
         if (!new_captures)
@@ -8727,6 +9515,10 @@ Py_LOCAL_INLINE(BOOL) push_groups(RE_SafeState* safe_state) {
     else {
         RE_SavedGroups* new_block;
 
+        if (!charge_memory(state, sizeof(RE_SavedGroups) + group_count *
+          (sizeof(RE_GroupSpan) + sizeof(Py_ssize_t))))
+            return FALSE;
+
         new_block = (RE_SavedGroups*)safe_alloc(safe_state,
           sizeof(RE_SavedGroups));
         if (!new_block)
@@ -8814,6 +9606,10 @@ Py_LOCAL_INLINE(BOOL) push_repeats(RE_SafeState* safe_state) {
     else {
         RE_SavedRepeats* new_block;
 
+        if (!charge_memory(state, sizeof(RE_SavedRepeats) + repeat_count *
+          sizeof(RE_RepeatData)))
+            return FALSE;
+
         new_block = (RE_SavedRepeats*)safe_alloc(safe_state,
           sizeof(RE_SavedRepeats));
         if (!new_block)
@@ -8901,6 +9697,10 @@ Py_LOCAL_INLINE(BOOL) insert_guard_span(RE_SafeState* safe_state, RE_GuardList*
         new_capacity = guard_list->capacity * 2;
         if (new_capacity == 0)
             new_capacity = RE_INIT_GUARDS_BLOCK_SIZE;
+        if (!charge_memory(safe_state->re_state, (new_capacity -
+          guard_list->capacity) * sizeof(RE_GuardSpan)))
+            return FALSE;
+
         new_spans = (RE_GuardSpan*)safe_realloc(safe_state, guard_list->spans,
           new_capacity * sizeof(RE_GuardSpan));
         if (!new_spans)
@@ -8970,9 +9770,19 @@ Py_LOCAL_INLINE(BOOL) is_guarded(RE_GuardList* guard_list, Py_ssize_t text_pos)
 /* Guards a position against further matching. */
 Py_LOCAL_INLINE(BOOL) guard(RE_SafeState* safe_state, RE_GuardList* guard_list,
   Py_ssize_t text_pos, BOOL protect) {
+    RE_State* state;
     size_t low;
     size_t high;
 
+    state = safe_state->re_state;
+
+    /* While looking for a better fuzzy match, a failure might be only because
+     * the match so far already costs too much, in which case a cheaper match
+     * could still succeed from here.
+     */
+    if (state->total_cost > state->max_cost)
+        return TRUE;
+
     /* Where should be new position be added? */
     if (text_pos == guard_list->last_text_pos)
         low = guard_list->last_low;
@@ -9202,823 +10012,312 @@ too_wide:
     return NULL;
 }
 
-/* Looks for a string in a string set. */
-Py_LOCAL_INLINE(int) string_set_contains(RE_State* state, PyObject* string_set,
-  Py_ssize_t first, Py_ssize_t last) {
-    PyObject* string;
-    int status;
-
-    if (state->is_unicode)
-        string = build_unicode_value(state->point_to(state->text, first), last
-          - first, state->charsize);
-    else
-        string = build_bytes_value(state->point_to(state->text, first), last -
-          first, state->charsize);
-    if (!string)
-        return RE_ERROR_INTERNAL;
-
-    status = PySet_Contains(string_set, string);
-    Py_DECREF(string);
+/* Finds the child of a trie node along the edge for a codepoint. Returns -1 if
+ * there's no such edge.
+ */
+Py_LOCAL_INLINE(Py_ssize_t) trie_child(RE_StringTrie* trie, RE_TrieNode* node,
+  Py_UCS4 ch) {
+    RE_TrieEdge* edges;
+    Py_ssize_t lo;
+    Py_ssize_t hi;
+
+    /* The edges are sorted by codepoint. */
+    edges = trie->edges + node->first_edge;
+    lo = 0;
+    hi = (Py_ssize_t)node->edge_count;
+
+    while (lo < hi) {
+        Py_ssize_t mid;
+
+        mid = (lo + hi) / 2;
+        if (edges[mid].ch < ch)
+            lo = mid + 1;
+        else if (edges[mid].ch > ch)
+            hi = mid;
+        else
+            return (Py_ssize_t)edges[mid].target;
+    }
 
-    return status;
+    return -1;
 }
 
-/* Looks for a string in a string set, ignoring case. */
-Py_LOCAL_INLINE(int) string_set_contains_ign(RE_State* state, PyObject*
-  string_set, void* buffer, Py_ssize_t index, Py_ssize_t len, Py_ssize_t
-  buffer_charsize) {
-    Py_UCS4 (*char_at)(void* text, Py_ssize_t pos);
-    void (*set_char_at)(void* text, Py_ssize_t pos, Py_UCS4 ch);
+/* Walks along the text and the trie of a string set, recording the longest
+ * member found and whether the text ran out part-way through a member.
+ */
+Py_LOCAL_INLINE(void) string_trie_walk(RE_TrieWalk* walk, RE_TrieCursor
+  cursor) {
+    RE_State* state;
+    RE_StringTrie* trie;
     RE_EncodingTable* encoding;
     RE_LocaleInfo* locale_info;
-    BOOL (*possible_turkic)(RE_LocaleInfo* locale_info, Py_UCS4 ch);
-    Py_UCS4 codepoints[4];
-
-    switch (buffer_charsize) {
-    case 1:
-        char_at = bytes1_char_at;
-        set_char_at = bytes1_set_char_at;
-        break;
-    case 2:
-        char_at = bytes2_char_at;
-        set_char_at = bytes2_set_char_at;
-        break;
-    case 4:
-        char_at = bytes4_char_at;
-        set_char_at = bytes4_set_char_at;
-        break;
-    default:
-        char_at = bytes1_char_at;
-        set_char_at = bytes1_set_char_at;
-        break;
-    }
 
+    state = walk->state;
+    trie = walk->trie;
     encoding = state->encoding;
     locale_info = state->locale_info;
-    possible_turkic = encoding->possible_turkic;
-
-    /* Look for a possible Turkic 'I'. */
-    while (index < len && !possible_turkic(locale_info, char_at(buffer,
-      index)))
-        ++index;
 
-    if (index < len) {
-        /* Possible Turkic 'I'. */
-        int count;
-        int i;
-
-        /* Try all the alternatives to the 'I'. */
-        count = encoding->all_turkic_i(locale_info, char_at(buffer, index),
-          codepoints);
-
-        for (i = 0; i < count; i++) {
-            int status;
-
-            set_char_at(buffer, index, codepoints[i]);
-
-            /* Recurse for the remainder of the string. */
-            status = string_set_contains_ign(state, string_set, buffer, index +
-              1, len, buffer_charsize);
-            if (status != 0)
-                return status;
-        }
-
-        return 0;
-    } else {
-        /* No Turkic 'I'. */
-        PyObject* string;
-        int status;
-
-        if (state->is_unicode)
-            string = build_unicode_value(buffer, len, buffer_charsize);
-        else
-            string = build_bytes_value(buffer, len, buffer_charsize);
-        if (!string)
-            return RE_ERROR_MEMORY;
-
-        status = PySet_Contains(string_set, string);
-        Py_DECREF(string);
-
-        return status;
-    }
-}
-
-/* Creates a partial string set for truncation at the left or right side. */
-Py_LOCAL_INLINE(int) make_partial_string_set(RE_State* state, RE_Node* node) {
-    PatternObject* pattern;
-    int partial_side;
-    PyObject* string_set;
-    PyObject* partial_set;
-    PyObject* iter = NULL;
-    PyObject* item = NULL;
-    PyObject* slice = NULL;
+    for (;;) {
+        RE_TrieNode* node;
+        Py_UCS4 ch;
+        Py_ssize_t child;
 
-    pattern = state->pattern;
-    partial_side = state->partial_side;
-    if (partial_side != RE_PARTIAL_LEFT && partial_side != RE_PARTIAL_RIGHT)
-        return RE_ERROR_INTERNAL;
+        node = &trie->nodes[cursor.node];
 
-    /* Fetch the full string set. PyList_GET_ITEM borrows a reference. */
-    string_set = PyList_GET_ITEM(pattern->named_list_indexes, node->values[0]);
-    if (!string_set)
-        return RE_ERROR_INTERNAL;
+        if (cursor.fold_index >= cursor.fold_count) {
+            /* We're at the end of a character from the text. */
+            if ((node->end_kinds & walk->kind) && cursor.consumed >
+              walk->longest)
+                walk->longest = cursor.consumed;
 
-    /* Gets the list of partial string sets. */
-    if (!pattern->partial_named_lists[partial_side]) {
-        size_t size;
+            if (!(node->below_kinds & walk->kind))
+                return;
 
-        size = pattern->named_lists_count * sizeof(PyObject*);
-        pattern->partial_named_lists[partial_side] = re_alloc(size);
-        if (!pattern->partial_named_lists[partial_side])
-            return RE_ERROR_INTERNAL;
+            if (cursor.consumed >= walk->available) {
+                /* The text ran out part-way through a member. */
+                if (walk->partial_allowed)
+                    walk->partial = TRUE;
 
-        memset(pattern->partial_named_lists[partial_side], 0, size);
-    }
+                return;
+            }
 
-    /* Get the partial string set. */
-    partial_set = pattern->partial_named_lists[partial_side][node->values[0]];
-    if (partial_set)
-        return 1;
+            /* Get the next character from the text. */
+            ch = state->char_at(state->text, cursor.text_pos);
+            cursor.text_pos += walk->step;
+            ++cursor.consumed;
 
-    /* Build the partial string set. */
-    partial_set = PySet_New(NULL);
-    if (!partial_set)
-        return RE_ERROR_INTERNAL;
+            switch (walk->folding) {
+            case RE_TRIE_SIMPLE_FOLD:
+                cursor.folded[0] = encoding->simple_case_fold(locale_info, ch);
+                cursor.fold_count = 1;
+                break;
+            case RE_TRIE_FULL_FOLD:
+                cursor.fold_count = encoding->full_case_fold(locale_info, ch,
+                  cursor.folded);
 
-    iter = PyObject_GetIter(string_set);
-    if (!iter)
-        goto error;
+                /* The trie of a reversed string set holds the members
+                 * reversed.
+                 */
+                if (walk->step < 0 && cursor.fold_count > 1) {
+                    Py_UCS4 tmp;
 
-    item = PyIter_Next(iter);
+                    tmp = cursor.folded[0];
+                    cursor.folded[0] = cursor.folded[cursor.fold_count - 1];
+                    cursor.folded[cursor.fold_count - 1] = tmp;
+                }
+                break;
+            default:
+                cursor.folded[0] = ch;
+                cursor.fold_count = 1;
+                break;
+            }
 
-    while (item) {
-        Py_ssize_t len;
-        Py_ssize_t first;
-        Py_ssize_t last;
+            cursor.fold_index = 0;
+        } else if (!(node->below_kinds & walk->kind))
+            return;
 
-        len = PySequence_Length(item);
-        if (len == -1)
-            goto error;
+        ch = cursor.folded[cursor.fold_index++];
 
-        first = 0;
-        last = len;
+        if (walk->folding != RE_TRIE_NO_FOLD &&
+          encoding->possible_turkic(locale_info, ch)) {
+            /* Try all the alternatives to the Turkic 'I'. */
+            Py_UCS4 cases[RE_MAX_CASES];
+            int count;
+            int i;
 
-        while (last - first > 1) {
-            int status;
+            count = encoding->all_turkic_i(locale_info, ch, cases);
 
-            /* Shorten the entry. */
-            if (partial_side == RE_PARTIAL_LEFT)
-                ++first;
-            else
-                --last;
+            for (i = 0; i < count; i++) {
+                child = trie_child(trie, node, cases[i]);
+                if (child >= 0) {
+                    RE_TrieCursor alt_cursor;
 
-            slice = PySequence_GetSlice(item, first, last);
-            if (!slice)
-                goto error;
+                    alt_cursor = cursor;
+                    alt_cursor.node = (RE_UINT32)child;
+                    string_trie_walk(walk, alt_cursor);
+                }
+            }
 
-            status = PySet_Add(partial_set, slice);
-            Py_DECREF(slice);
-            if (status < 0)
-                goto error;
+            return;
         }
 
-        Py_DECREF(item);
-        item = PyIter_Next(iter);
-    }
-
-    if (PyErr_Occurred())
-        goto error;
-
-    Py_DECREF(iter);
-
-    pattern->partial_named_lists[partial_side][node->values[0]] = partial_set;
-
-    return 1;
-
-error:
-    Py_XDECREF(item);
-    Py_XDECREF(iter);
-    Py_DECREF(partial_set);
+        child = trie_child(trie, node, ch);
+        if (child < 0)
+            return;
 
-    return RE_ERROR_INTERNAL;
+        cursor.node = (RE_UINT32)child;
+    }
 }
 
 /* Tries to match a string at the current position with a member of a string
- * set, forwards or backwards.
+ * set, forwards or backwards, possibly ignoring case.
+ *
+ * The members are held in a trie, so this doesn't need to create any Python
+ * objects or hold the GIL.
  */
-Py_LOCAL_INLINE(int) string_set_match_fwdrev(RE_SafeState* safe_state, RE_Node*
-  node, BOOL reverse) {
-    RE_State* state;
-    Py_ssize_t min_len;
-    Py_ssize_t max_len;
+Py_LOCAL_INLINE(int) string_set_match_fwdrev(RE_State* state, RE_Node* node,
+  BOOL reverse) {
+    RE_TrieWalk walk;
+    RE_TrieCursor cursor;
     Py_ssize_t text_available;
-    Py_ssize_t slice_available;
     int partial_side;
-    Py_ssize_t len;
-    Py_ssize_t first;
-    Py_ssize_t last;
-    int status;
-    PyObject* string_set;
 
-    state = safe_state->re_state;
-
-    min_len = (Py_ssize_t)node->values[1];
-    max_len = (Py_ssize_t)node->values[2];
+    walk.state = state;
+    walk.trie = &state->pattern->named_list_tries[reverse][node->values[0]];
+    walk.kind = state->is_unicode ? RE_TRIE_UNICODE : RE_TRIE_BYTES;
+    walk.longest = -1;
+    walk.partial = FALSE;
 
-    acquire_GIL(safe_state);
+    switch (node->op) {
+    case RE_OP_STRING_SET_FLD:
+    case RE_OP_STRING_SET_FLD_REV:
+        walk.folding = RE_TRIE_FULL_FOLD;
+        break;
+    case RE_OP_STRING_SET_IGN:
+    case RE_OP_STRING_SET_IGN_REV:
+        walk.folding = RE_TRIE_SIMPLE_FOLD;
+        break;
+    default:
+        walk.folding = RE_TRIE_NO_FOLD;
+        break;
+    }
 
     if (reverse) {
         text_available = state->text_pos;
-        slice_available = state->text_pos - state->slice_start;
+        walk.available = state->text_pos - state->slice_start;
+        walk.step = -1;
         partial_side = RE_PARTIAL_LEFT;
+        cursor.text_pos = state->text_pos - 1;
     } else {
         text_available = state->text_length - state->text_pos;
-        slice_available = state->slice_end - state->text_pos;
+        walk.available = state->slice_end - state->text_pos;
+        walk.step = 1;
         partial_side = RE_PARTIAL_RIGHT;
+        cursor.text_pos = state->text_pos;
     }
 
-    /* Get as many characters as we need for the longest possible match. */
-    len = min_ssize_t(max_len, slice_available);
-
-    if (reverse) {
-        first = state->text_pos - len;
-        last = state->text_pos;
-    } else {
-        first = state->text_pos;
-        last = state->text_pos + len;
-    }
-
-    /* If we didn't get all of the characters we need, is a partial match
-     * allowed?
-     */
-    if (len < max_len && len == text_available && state->partial_side ==
-      partial_side) {
-        if (len == 0) {
-            /* An empty string is always a possible partial match. */
-            status = RE_ERROR_PARTIAL;
-            goto finished;
-        }
-
-        /* Make a set of the possible partial matches. */
-        status = make_partial_string_set(state, node);
-        if (status < 0)
-            goto finished;
-
-        /* Fetch the partial string set. */
-        string_set =
-          state->pattern->partial_named_lists[partial_side][node->values[0]];
+    /* A partial match is allowed only if the text ends within the slice. */
+    walk.partial_allowed = walk.available == text_available &&
+      state->partial_side == partial_side;
 
-        /* Is the text we have a partial match? */
-        status = string_set_contains(state, string_set, first, last);
-        if (status < 0)
-            goto finished;
+    cursor.node = 0;
+    cursor.consumed = 0;
+    cursor.fold_count = 0;
+    cursor.fold_index = 0;
 
-        if (status == 1) {
-            /* Advance past the match. */
-            if (reverse)
-                state->text_pos -= len;
-            else
-                state->text_pos += len;
+    string_trie_walk(&walk, cursor);
 
-            status = RE_ERROR_PARTIAL;
-            goto finished;
-        }
-    }
+    if (walk.partial) {
+        /* Advance past the partial match. */
+        if (reverse)
+            state->text_pos -= walk.available;
+        else
+            state->text_pos += walk.available;
 
-    /* Fetch the string set. PyList_GET_ITEM borrows a reference. */
-    string_set = PyList_GET_ITEM(state->pattern->named_list_indexes,
-      node->values[0]);
-    if (!string_set) {
-        status = RE_ERROR_INTERNAL;
-        goto finished;
+        return RE_ERROR_PARTIAL;
     }
 
-    /* We've already looked for a partial match (if allowed), but what about a
-     * complete match?
-     */
-    while (len >= min_len) {
-        status = string_set_contains(state, string_set, first, last);
-
-        if (status == 1) {
-            /* Advance past the match. */
-            if (reverse)
-                state->text_pos -= len;
-            else
-                state->text_pos += len;
+    if (walk.longest < 0)
+        return 0;
 
-            status = 1;
-            goto finished;
-        }
+    /* Advance past the match. */
+    if (reverse)
+        state->text_pos -= walk.longest;
+    else
+        state->text_pos += walk.longest;
 
-        /* Look for a shorter match. */
-        --len;
-        if (reverse)
-            ++first;
-        else
-            --last;
-    }
+    return 1;
+}
 
-    /* No match. */
-    status = 0;
+/* Checks whether any additional fuzzy error is permitted. */
+Py_LOCAL_INLINE(BOOL) any_error_permitted(RE_State* state) {
+    RE_FuzzyInfo* fuzzy_info;
+    RE_CODE* values;
 
-finished:
-    release_GIL(safe_state);
+    fuzzy_info = &state->fuzzy_info;
+    values = fuzzy_info->node->values;
 
-    return status;
+    return fuzzy_info->total_cost <= values[RE_FUZZY_VAL_MAX_COST] &&
+      fuzzy_info->counts[RE_FUZZY_ERR] < values[RE_FUZZY_VAL_MAX_ERR] &&
+      state->total_cost <= state->max_cost;
 }
 
-/* Tries to match a string at the current position with a member of a string
- * set, ignoring case, forwards or backwards.
- */
-Py_LOCAL_INLINE(int) string_set_match_fld_fwdrev(RE_SafeState* safe_state,
-  RE_Node* node, BOOL reverse) {
-    RE_State* state;
-    int (*full_case_fold)(RE_LocaleInfo* locale_info, Py_UCS4 ch, Py_UCS4*
-      folded);
-    Py_UCS4 (*char_at)(void* text, Py_ssize_t pos);
-    Py_ssize_t folded_charsize;
-    void (*set_char_at)(void* text, Py_ssize_t pos, Py_UCS4 ch);
-    Py_ssize_t min_len;
-    Py_ssize_t max_len;
-    Py_ssize_t buf_len;
-    void* folded;
-    int status;
-    BOOL* end_of_fold = NULL;
-    Py_ssize_t text_available;
-    Py_ssize_t slice_available;
-    Py_ssize_t t_pos;
-    Py_ssize_t f_pos;
-    int step;
-    int partial_side;
-    Py_ssize_t len;
-    Py_ssize_t consumed;
-    Py_UCS4 codepoints[RE_MAX_FOLDED];
-    Py_ssize_t first;
-    Py_ssize_t last;
-    PyObject* string_set;
+/* Checks whether this additional fuzzy error is permitted. */
+Py_LOCAL_INLINE(BOOL) this_error_permitted(RE_State* state, int fuzzy_type) {
+    RE_FuzzyInfo* fuzzy_info;
+    RE_CODE* values;
 
-    state = safe_state->re_state;
-    full_case_fold = state->encoding->full_case_fold;
-    char_at = state->char_at;
+    fuzzy_info = &state->fuzzy_info;
+    values = fuzzy_info->node->values;
 
-#if PY_VERSION_HEX >= 0x03030000
-    /* The folded string needs to be at least 2 bytes per character. */
-    folded_charsize = max_ssize_t(state->charsize, sizeof(Py_UCS2));
-#else
-    /* The folded string will have the same width as the original string. */
-    folded_charsize = state->charsize;
-#endif
+    return fuzzy_info->total_cost + values[RE_FUZZY_VAL_COST_BASE + fuzzy_type]
+      <= values[RE_FUZZY_VAL_MAX_COST] && fuzzy_info->counts[fuzzy_type] <
+      values[RE_FUZZY_VAL_MAX_BASE + fuzzy_type] && state->total_cost +
+      values[RE_FUZZY_VAL_COST_BASE + fuzzy_type] <= state->max_cost;
+}
 
-    switch (folded_charsize) {
-    case 1:
-        set_char_at = bytes1_set_char_at;
-        break;
-    case 2:
-        set_char_at = bytes2_set_char_at;
+/* Checks whether we've reachsd the end of the text during a fuzzy partial
+ * match.
+ */
+Py_LOCAL_INLINE(int) check_fuzzy_partial(RE_State* state, Py_ssize_t text_pos)
+  {
+    switch (state->partial_side) {
+    case RE_PARTIAL_LEFT:
+        if (text_pos < 0)
+            return RE_ERROR_PARTIAL;
         break;
-    case 4:
-        set_char_at = bytes4_set_char_at;
+    case RE_PARTIAL_RIGHT:
+        if (text_pos > state->text_length)
+            return RE_ERROR_PARTIAL;
         break;
-    default:
-        return RE_ERROR_INTERNAL;
     }
 
-    min_len = (Py_ssize_t)node->values[1];
-    max_len = (Py_ssize_t)node->values[2];
+    return RE_ERROR_FAILURE;
+}
 
-    acquire_GIL(safe_state);
+/* Checks a fuzzy match of an item. */
+Py_LOCAL_INLINE(int) next_fuzzy_match_item(RE_State* state, RE_FuzzyData* data,
+  BOOL is_string, int step) {
+    Py_ssize_t new_pos;
 
-    /* Allocate a buffer for the folded string. */
-    buf_len = max_len + RE_MAX_FOLDED;
-    folded = re_alloc((size_t)(buf_len * folded_charsize));
-    if (!folded) {
-        status = RE_ERROR_MEMORY;
-        goto finished;
-    }
+    if (this_error_permitted(state, data->fuzzy_type)) {
+        switch (data->fuzzy_type) {
+        case RE_FUZZY_DEL:
+            /* Could a character at text_pos have been deleted? */
+            if (is_string)
+                data->new_string_pos += step;
+            else
+                data->new_node = data->new_node->next_1.node;
+            return RE_ERROR_SUCCESS;
+        case RE_FUZZY_INS:
+            /* Could the character at text_pos have been inserted? */
+            if (!data->permit_insertion)
+                return RE_ERROR_FAILURE;
 
-    end_of_fold = re_alloc((size_t)buf_len * sizeof(BOOL));
-    if (!end_of_fold) {
-        status = RE_ERROR_MEMORY;
-        goto finished;
-    }
+            new_pos = data->new_text_pos + step;
+            if (state->slice_start <= new_pos && new_pos <= state->slice_end) {
+                data->new_text_pos = new_pos;
+                return RE_ERROR_SUCCESS;
+            }
 
-    memset(end_of_fold, 0, (size_t)buf_len * sizeof(BOOL));
+            return check_fuzzy_partial(state, new_pos);
+        case RE_FUZZY_SUB:
+            /* Could the character at text_pos have been substituted? */
+            new_pos = data->new_text_pos + step;
+            if (state->slice_start <= new_pos && new_pos <= state->slice_end) {
+                data->new_text_pos = new_pos;
+                if (is_string)
+                    data->new_string_pos += step;
+                else
+                    data->new_node = data->new_node->next_1.node;
+                return RE_ERROR_SUCCESS;
+            }
 
-    if (reverse) {
-        text_available = state->text_pos;
-        slice_available = state->text_pos - state->slice_start;
-        t_pos = state->text_pos - 1;
-        f_pos = buf_len;
-        step = -1;
-        partial_side = RE_PARTIAL_LEFT;
-    } else {
-        text_available = state->text_length - state->text_pos;
-        slice_available = state->slice_end - state->text_pos;
-        t_pos = state->text_pos;
-        f_pos = 0;
-        step = 1;
-        partial_side = RE_PARTIAL_RIGHT;
+            return check_fuzzy_partial(state, new_pos);
+        }
     }
 
-    /* We can stop getting characters as soon as the case-folded string is long
-     * enough (each codepoint from the text can expand to more than one folded
-     * codepoint).
-     */
-    len = 0;
-    end_of_fold[len] = TRUE;
-
-    consumed = 0;
-    while (len < max_len && consumed < slice_available) {
-        int count;
-        int j;
-
-        count = full_case_fold(state->locale_info, char_at(state->text, t_pos),
-          codepoints);
-
-        if (reverse)
-            f_pos -= count;
-
-        for (j = 0; j < count; j++)
-            set_char_at(folded, f_pos + j, codepoints[j]);
-
-        if (!reverse)
-            f_pos += count;
-
-        len += count;
-        end_of_fold[len] = TRUE;
-        ++consumed;
-        t_pos += step;
-    }
-
-    if (reverse) {
-        first = f_pos;
-        last = buf_len;
-    } else {
-        first = 0;
-        last = f_pos;
-    }
-
-    /* If we didn't get all of the characters we need, is a partial match
-     * allowed?
-     */
-    if (len < max_len && len == text_available && state->partial_side ==
-      partial_side) {
-        if (len == 0) {
-            /* An empty string is always a possible partial match. */
-            status = RE_ERROR_PARTIAL;
-            goto finished;
-        }
-
-        /* Make a set of the possible partial matches. */
-        status = make_partial_string_set(state, node);
-        if (status < 0)
-            goto finished;
-
-        /* Fetch the partial string set. */
-        string_set =
-          state->pattern->partial_named_lists[partial_side][node->values[0]];
-
-        /* Is the text we have a partial match? */
-        status = string_set_contains_ign(state, string_set, folded, first,
-          last, folded_charsize);
-        if (status < 0)
-            goto finished;
-
-        if (status == 1) {
-            /* Advance past the match. */
-            if (reverse)
-                state->text_pos -= consumed;
-            else
-                state->text_pos += consumed;
-
-            status = RE_ERROR_PARTIAL;
-            goto finished;
-        }
-    }
-
-    /* Fetch the string set. PyList_GET_ITEM borrows a reference. */
-    string_set = PyList_GET_ITEM(state->pattern->named_list_indexes,
-      node->values[0]);
-    if (!string_set) {
-        status = RE_ERROR_INTERNAL;
-        goto finished;
-    }
-
-    /* We've already looked for a partial match (if allowed), but what about a
-     * complete match?
-     */
-    while (len >= min_len) {
-        if (end_of_fold[len]) {
-            status = string_set_contains_ign(state, string_set, folded, first,
-              last, folded_charsize);
-
-            if (status == 1) {
-                /* Advance past the match. */
-                if (reverse)
-                    state->text_pos -= consumed;
-                else
-                    state->text_pos += consumed;
-
-                status = 1;
-                goto finished;
-            }
-
-            --consumed;
-        }
-
-        /* Look for a shorter match. */
-        --len;
-        if (reverse)
-            ++first;
-        else
-            --last;
-    }
-
-    /* No match. */
-    status = 0;
-
-finished:
-    re_dealloc(end_of_fold);
-    re_dealloc(folded);
-
-    release_GIL(safe_state);
-
-    return status;
-}
-
-/* Tries to match a string at the current position with a member of a string
- * set, ignoring case, forwards or backwards.
- */
-Py_LOCAL_INLINE(int) string_set_match_ign_fwdrev(RE_SafeState* safe_state,
-  RE_Node* node, BOOL reverse) {
-    RE_State* state;
-    Py_UCS4 (*simple_case_fold)(RE_LocaleInfo* locale_info, Py_UCS4 ch);
-    Py_UCS4 (*char_at)(void* text, Py_ssize_t pos);
-    Py_ssize_t folded_charsize;
-    void (*set_char_at)(void* text, Py_ssize_t pos, Py_UCS4 ch);
-    Py_ssize_t min_len;
-    Py_ssize_t max_len;
-    void* folded;
-    int status;
-    Py_ssize_t text_available;
-    Py_ssize_t slice_available;
-    Py_ssize_t t_pos;
-    Py_ssize_t f_pos;
-    int step;
-    int partial_side;
-    Py_ssize_t len;
-    Py_ssize_t i;
-    Py_ssize_t first;
-    Py_ssize_t last;
-    PyObject* string_set;
-
-    state = safe_state->re_state;
-    simple_case_fold = state->encoding->simple_case_fold;
-    char_at = state->char_at;
-
-#if PY_VERSION_HEX >= 0x03030000
-    /* The folded string needs to be at least 2 bytes per character. */
-    folded_charsize = max_ssize_t(state->charsize, sizeof(Py_UCS2));
-#else
-    /* The folded string will have the same width as the original string. */
-    folded_charsize = state->charsize;
-#endif
-
-    switch (folded_charsize) {
-    case 1:
-        set_char_at = bytes1_set_char_at;
-        break;
-    case 2:
-        set_char_at = bytes2_set_char_at;
-        break;
-    case 4:
-        set_char_at = bytes4_set_char_at;
-        break;
-    default:
-        return RE_ERROR_INTERNAL;
-    }
-
-    min_len = (Py_ssize_t)node->values[1];
-    max_len = (Py_ssize_t)node->values[2];
-
-    acquire_GIL(safe_state);
-
-    /* Allocate a buffer for the folded string. */
-    folded = re_alloc((size_t)(max_len * folded_charsize));
-    if (!folded) {
-        status = RE_ERROR_MEMORY;
-        goto finished;
-    }
-
-    if (reverse) {
-        text_available = state->text_pos;
-        slice_available = state->text_pos - state->slice_start;
-        t_pos = state->text_pos - 1;
-        f_pos = max_len - 1;
-        step = -1;
-        partial_side = RE_PARTIAL_LEFT;
-    } else {
-        text_available = state->text_length - state->text_pos;
-        slice_available = state->slice_end - state->text_pos;
-        t_pos = state->text_pos;
-        f_pos = 0;
-        step = 1;
-        partial_side = RE_PARTIAL_RIGHT;
-    }
-
-    /* Get as many characters as we need for the longest possible match. */
-    len = min_ssize_t(max_len, slice_available);
-
-    for (i = 0; i < len; i ++) {
-        Py_UCS4 ch;
-
-        ch = simple_case_fold(state->locale_info, char_at(state->text, t_pos));
-        set_char_at(folded, f_pos, ch);
-        t_pos += step;
-        f_pos += step;
-    }
-
-    if (reverse) {
-        first = f_pos;
-        last = max_len;
-    } else {
-        first = 0;
-        last = f_pos;
-    }
-
-    /* If we didn't get all of the characters we need, is a partial match
-     * allowed?
-     */
-    if (len < max_len && len == text_available && state->partial_side ==
-      partial_side) {
-        if (len == 0) {
-            /* An empty string is always a possible partial match. */
-            status = RE_ERROR_PARTIAL;
-            goto finished;
-        }
-
-        /* Make a set of the possible partial matches. */
-        status = make_partial_string_set(state, node);
-        if (status < 0)
-            goto finished;
-
-        /* Fetch the partial string set. */
-        string_set =
-          state->pattern->partial_named_lists[partial_side][node->values[0]];
-
-        /* Is the text we have a partial match? */
-        status = string_set_contains_ign(state, string_set, folded, first,
-          last, folded_charsize);
-        if (status < 0)
-            goto finished;
-
-        if (status == 1) {
-            /* Advance past the match. */
-            if (reverse)
-                state->text_pos -= len;
-            else
-                state->text_pos += len;
-
-            status = RE_ERROR_PARTIAL;
-            goto finished;
-        }
-    }
-
-    /* Fetch the string set. PyList_GET_ITEM borrows a reference. */
-    string_set = PyList_GET_ITEM(state->pattern->named_list_indexes,
-      node->values[0]);
-    if (!string_set) {
-        status = RE_ERROR_INTERNAL;
-        goto finished;
-    }
-
-    /* We've already looked for a partial match (if allowed), but what about a
-     * complete match?
-     */
-    while (len >= min_len) {
-        status = string_set_contains_ign(state, string_set, folded, first,
-          last, folded_charsize);
-
-        if (status == 1) {
-            /* Advance past the match. */
-            if (reverse)
-                state->text_pos -= len;
-            else
-                state->text_pos += len;
-
-            status = 1;
-            goto finished;
-        }
-
-        /* Look for a shorter match. */
-        --len;
-        if (reverse)
-            ++first;
-        else
-            --last;
-    }
-
-    /* No match. */
-    status = 0;
-
-finished:
-    re_dealloc(folded);
-
-    release_GIL(safe_state);
-
-    return status;
-}
-
-/* Checks whether any additional fuzzy error is permitted. */
-Py_LOCAL_INLINE(BOOL) any_error_permitted(RE_State* state) {
-    RE_FuzzyInfo* fuzzy_info;
-    RE_CODE* values;
-
-    fuzzy_info = &state->fuzzy_info;
-    values = fuzzy_info->node->values;
-
-    return fuzzy_info->total_cost <= values[RE_FUZZY_VAL_MAX_COST] &&
-      fuzzy_info->counts[RE_FUZZY_ERR] < values[RE_FUZZY_VAL_MAX_ERR] &&
-      state->total_cost <= state->max_cost;
-}
-
-/* Checks whether this additional fuzzy error is permitted. */
-Py_LOCAL_INLINE(BOOL) this_error_permitted(RE_State* state, int fuzzy_type) {
-    RE_FuzzyInfo* fuzzy_info;
-    RE_CODE* values;
-
-    fuzzy_info = &state->fuzzy_info;
-    values = fuzzy_info->node->values;
-
-    return fuzzy_info->total_cost + values[RE_FUZZY_VAL_COST_BASE + fuzzy_type]
-      <= values[RE_FUZZY_VAL_MAX_COST] && fuzzy_info->counts[fuzzy_type] <
-      values[RE_FUZZY_VAL_MAX_BASE + fuzzy_type] && state->total_cost +
-      values[RE_FUZZY_VAL_COST_BASE + fuzzy_type] <= state->max_cost;
-}
-
-/* Checks whether we've reachsd the end of the text during a fuzzy partial
- * match.
- */
-Py_LOCAL_INLINE(int) check_fuzzy_partial(RE_State* state, Py_ssize_t text_pos)
-  {
-    switch (state->partial_side) {
-    case RE_PARTIAL_LEFT:
-        if (text_pos < 0)
-            return RE_ERROR_PARTIAL;
-        break;
-    case RE_PARTIAL_RIGHT:
-        if (text_pos > state->text_length)
-            return RE_ERROR_PARTIAL;
-        break;
-    }
-
-    return RE_ERROR_FAILURE;
-}
-
-/* Checks a fuzzy match of an item. */
-Py_LOCAL_INLINE(int) next_fuzzy_match_item(RE_State* state, RE_FuzzyData* data,
-  BOOL is_string, int step) {
-    Py_ssize_t new_pos;
-
-    if (this_error_permitted(state, data->fuzzy_type)) {
-        switch (data->fuzzy_type) {
-        case RE_FUZZY_DEL:
-            /* Could a character at text_pos have been deleted? */
-            if (is_string)
-                data->new_string_pos += step;
-            else
-                data->new_node = data->new_node->next_1.node;
-            return RE_ERROR_SUCCESS;
-        case RE_FUZZY_INS:
-            /* Could the character at text_pos have been inserted? */
-            if (!data->permit_insertion)
-                return RE_ERROR_FAILURE;
-
-            new_pos = data->new_text_pos + step;
-            if (state->slice_start <= new_pos && new_pos <= state->slice_end) {
-                data->new_text_pos = new_pos;
-                return RE_ERROR_SUCCESS;
-            }
-
-            return check_fuzzy_partial(state, new_pos);
-        case RE_FUZZY_SUB:
-            /* Could the character at text_pos have been substituted? */
-            new_pos = data->new_text_pos + step;
-            if (state->slice_start <= new_pos && new_pos <= state->slice_end) {
-                data->new_text_pos = new_pos;
-                if (is_string)
-                    data->new_string_pos += step;
-                else
-                    data->new_node = data->new_node->next_1.node;
-                return RE_ERROR_SUCCESS;
-            }
-
-            return check_fuzzy_partial(state, new_pos);
-        }
-    }
-
-    return RE_ERROR_FAILURE;
-}
+    return RE_ERROR_FAILURE;
+}
 
 /* Tries a fuzzy match of an item of width 0 or 1. */
 Py_LOCAL_INLINE(int) fuzzy_match_item(RE_SafeState* safe_state, BOOL search,
@@ -10799,29 +11098,512 @@ found:
     return RE_ERROR_SUCCESS;
 }
 
-/* Locates the required string, if there's one. */
-Py_LOCAL_INLINE(Py_ssize_t) locate_required_string(RE_SafeState* safe_state,
-  BOOL search) {
-    RE_State* state;
-    PatternObject* pattern;
-    Py_ssize_t found_pos;
-    Py_ssize_t end_pos;
+/* Checks whether a character from the text matches the codepoint of an edge in
+ * the trie of a string set.
+ */
+Py_LOCAL_INLINE(BOOL) trie_edge_matches(RE_FuzzyTrieWalk* walk, Py_UCS4
+  edge_ch, Py_UCS4 ch) {
+    RE_EncodingTable* encoding;
+    RE_LocaleInfo* locale_info;
+    Py_UCS4 cases[RE_MAX_CASES];
+    int count;
+    int i;
 
-    state = safe_state->re_state;
-    pattern = state->pattern;
+    if (edge_ch == ch)
+        return TRUE;
 
-    if (!pattern->req_string)
-        /* There isn't a required string, so start matching from the current
-         * position.
-         */
-        return state->text_pos;
+    encoding = walk->state->encoding;
+    locale_info = walk->state->locale_info;
 
-    /* Search for the required string and calculate where to start matching. */
-    switch (pattern->req_string->op) {
-    case RE_OP_STRING:
-    {
-        BOOL is_partial;
-        Py_ssize_t limit;
+    if (walk->folding == RE_TRIE_NO_FOLD ||
+      !encoding->possible_turkic(locale_info, ch))
+        return FALSE;
+
+    /* Try all the alternatives to the Turkic 'I'. */
+    count = encoding->all_turkic_i(locale_info, ch, cases);
+
+    for (i = 0; i < count; i++) {
+        if (edge_ch == cases[i])
+            return TRUE;
+    }
+
+    return FALSE;
+}
+
+/* Checks whether an additional fuzzy error is permitted during a fuzzy walk
+ * along the trie of a string set.
+ */
+Py_LOCAL_INLINE(BOOL) trie_error_permitted(RE_FuzzyTrieWalk* walk, int
+  fuzzy_type) {
+    RE_State* state;
+    RE_FuzzyInfo* fuzzy_info;
+    RE_CODE* values;
+    size_t cost;
+
+    state = walk->state;
+    fuzzy_info = &state->fuzzy_info;
+    values = walk->values;
+    cost = walk->cost + values[RE_FUZZY_VAL_COST_BASE + fuzzy_type];
+
+    return fuzzy_info->total_cost + cost <= values[RE_FUZZY_VAL_MAX_COST] &&
+      fuzzy_info->counts[fuzzy_type] + walk->counts[fuzzy_type] <
+      values[RE_FUZZY_VAL_MAX_BASE + fuzzy_type] &&
+      fuzzy_info->counts[RE_FUZZY_ERR] + walk->errors <
+      values[RE_FUZZY_VAL_MAX_ERR] && state->total_cost + cost <=
+      walk->max_cost;
+}
+
+/* Adds or removes a fuzzy error during a fuzzy walk along the trie of a string
+ * set.
+ */
+Py_LOCAL_INLINE(void) trie_add_error(RE_FuzzyTrieWalk* walk, int fuzzy_type,
+  BOOL add) {
+    size_t cost;
+
+    cost = walk->values[RE_FUZZY_VAL_COST_BASE + fuzzy_type];
+
+    if (add) {
+        ++walk->counts[fuzzy_type];
+        ++walk->errors;
+        walk->cost += cost;
+    } else {
+        --walk->counts[fuzzy_type];
+        --walk->errors;
+        walk->cost -= cost;
+    }
+}
+
+Py_LOCAL_INLINE(void) fuzzy_trie_walk(RE_FuzzyTrieWalk* walk, RE_UINT32
+  node_index, Py_ssize_t text_pos, Py_ssize_t forced_edge);
+
+/* Follows the rest of a case-folded character from the text along the trie of
+ * a string set.
+ */
+Py_LOCAL_INLINE(void) fuzzy_trie_follow(RE_FuzzyTrieWalk* walk, RE_UINT32
+  node_index, Py_ssize_t text_pos, Py_UCS4* folded, int folded_pos, int
+  folded_len) {
+    RE_StringTrie* trie;
+    RE_TrieNode* node;
+    RE_EncodingTable* encoding;
+    RE_LocaleInfo* locale_info;
+    Py_UCS4 cases[RE_MAX_CASES];
+    int count;
+    int i;
+
+    if (folded_pos >= folded_len) {
+        fuzzy_trie_walk(walk, node_index, text_pos, -1);
+        return;
+    }
+
+    trie = walk->trie;
+    node = &trie->nodes[node_index];
+    encoding = walk->state->encoding;
+    locale_info = walk->state->locale_info;
+
+    if (walk->folding != RE_TRIE_NO_FOLD &&
+      encoding->possible_turkic(locale_info, folded[folded_pos]))
+        count = encoding->all_turkic_i(locale_info, folded[folded_pos], cases);
+    else {
+        cases[0] = folded[folded_pos];
+        count = 1;
+    }
+
+    for (i = 0; i < count; i++) {
+        Py_ssize_t child;
+
+        child = trie_child(trie, node, cases[i]);
+        if (child >= 0) {
+            fuzzy_trie_follow(walk, (RE_UINT32)child, text_pos, folded,
+              folded_pos + 1, folded_len);
+            if (walk->found || walk->partial)
+                return;
+        }
+    }
+}
+
+/* Tries the fuzzy errors where the text doesn't match an edge in the trie of a
+ * string set.
+ */
+Py_LOCAL_INLINE(void) fuzzy_trie_errors(RE_FuzzyTrieWalk* walk, RE_UINT32
+  node_index, RE_UINT32 edge_index, Py_ssize_t text_pos, BOOL text_left) {
+    RE_State* state;
+    RE_UINT32 target;
+
+    state = walk->state;
+    target = walk->trie->edges[edge_index].target;
+
+    /* Could the character at text_pos have been substituted? */
+    if (text_left && trie_error_permitted(walk, RE_FUZZY_SUB)) {
+        trie_add_error(walk, RE_FUZZY_SUB, TRUE);
+        fuzzy_trie_walk(walk, target, text_pos + walk->step, -1);
+        trie_add_error(walk, RE_FUZZY_SUB, FALSE);
+        if (walk->found || walk->partial)
+            return;
+    }
+
+    /* Could the character at text_pos have been inserted? Insertion isn't
+     * permitted initially when searching (it's better just to start searching
+     * one character later).
+     */
+    if (text_left && (!walk->search || text_pos != state->search_anchor) &&
+      trie_error_permitted(walk, RE_FUZZY_INS)) {
+        trie_add_error(walk, RE_FUZZY_INS, TRUE);
+        fuzzy_trie_walk(walk, node_index, text_pos + walk->step,
+          (Py_ssize_t)edge_index);
+        trie_add_error(walk, RE_FUZZY_INS, FALSE);
+        if (walk->found || walk->partial)
+            return;
+    }
+
+    /* Could a character at text_pos have been deleted? */
+    if (trie_error_permitted(walk, RE_FUZZY_DEL)) {
+        trie_add_error(walk, RE_FUZZY_DEL, TRUE);
+        fuzzy_trie_walk(walk, target, text_pos, -1);
+        trie_add_error(walk, RE_FUZZY_DEL, FALSE);
+    }
+}
+
+/* Walks along the text and the trie of a string set with an error budget.
+ *
+ * At each node it follows the edge which matches the text, then tries the
+ * errors along the others, then tries the member which ends at the node, if
+ * any, so longer members are tried before shorter ones. If forced_edge isn't
+ * negative then a character has just been inserted and the walk must continue
+ * along that edge.
+ */
+Py_LOCAL_INLINE(void) fuzzy_trie_walk(RE_FuzzyTrieWalk* walk, RE_UINT32
+  node_index, Py_ssize_t text_pos, Py_ssize_t forced_edge) {
+    RE_State* state;
+    RE_EncodingTable* encoding;
+    RE_LocaleInfo* locale_info;
+    RE_TrieNode* node;
+    RE_UINT32 first_edge;
+    RE_UINT32 end_edge;
+
+    state = walk->state;
+    encoding = state->encoding;
+    locale_info = state->locale_info;
+    node = &walk->trie->nodes[node_index];
+
+    if (forced_edge >= 0) {
+        first_edge = (RE_UINT32)forced_edge;
+        end_edge = first_edge + 1;
+    } else {
+        first_edge = node->first_edge;
+        end_edge = first_edge + node->edge_count;
+    }
+
+    if (node->below_kinds & walk->kind) {
+        BOOL text_left;
+        Py_UCS4 folded[RE_MAX_FOLDED];
+        int folded_len;
+        RE_UINT32 e;
+
+        if (walk->step > 0)
+            text_left = text_pos < state->slice_end;
+        else
+            text_left = text_pos > state->slice_start;
+
+        if (text_left) {
+            Py_UCS4 ch;
+
+            ch = state->char_at(state->text, walk->step > 0 ? text_pos :
+              text_pos - 1);
+
+            switch (walk->folding) {
+            case RE_TRIE_SIMPLE_FOLD:
+                folded[0] = encoding->simple_case_fold(locale_info, ch);
+                folded_len = 1;
+                break;
+            case RE_TRIE_FULL_FOLD:
+                folded_len = encoding->full_case_fold(locale_info, ch, folded);
+
+                /* The trie of a reversed string set holds the members
+                 * reversed.
+                 */
+                if (walk->step < 0 && folded_len > 1) {
+                    Py_UCS4 tmp;
+
+                    tmp = folded[0];
+                    folded[0] = folded[folded_len - 1];
+                    folded[folded_len - 1] = tmp;
+                }
+                break;
+            default:
+                folded[0] = ch;
+                folded_len = 1;
+                break;
+            }
+
+            /* Follow the edges which match the text. */
+            for (e = first_edge; e < end_edge; e++) {
+                RE_TrieEdge* edge;
+
+                edge = &walk->trie->edges[e];
+                if (trie_edge_matches(walk, edge->ch, folded[0])) {
+                    fuzzy_trie_follow(walk, edge->target, text_pos +
+                      walk->step, folded, 1, folded_len);
+                    if (walk->found || walk->partial)
+                        return;
+                }
+            }
+        } else if (walk->partial_allowed) {
+            /* The text ran out part-way through a member. */
+            walk->partial = TRUE;
+            return;
+        }
+
+        /* Try the errors along the edges which don't match the text. */
+        for (e = first_edge; e < end_edge; e++) {
+            if (text_left && trie_edge_matches(walk, walk->trie->edges[e].ch,
+              folded[0]))
+                continue;
+
+            fuzzy_trie_errors(walk, node_index, e, text_pos, text_left);
+            if (walk->found || walk->partial)
+                return;
+        }
+    }
+
+    if (forced_edge < 0 && (node->end_kinds & walk->kind)) {
+        size_t index;
+
+        /* A member ends here. Has it already been tried? */
+        index = walk->seen++;
+        if (index < walk->skip)
+            return;
+
+        /* A better match found since the walk began might have lowered the
+         * limit on the total cost.
+         */
+        if (state->total_cost + walk->cost > state->max_cost)
+            return;
+
+        walk->found = TRUE;
+        walk->index = index;
+        walk->text_pos = text_pos;
+        memcpy(walk->found_counts, walk->counts, sizeof(walk->counts));
+    }
+}
+
+/* Initialises a fuzzy walk along the text and the trie of a string set. */
+Py_LOCAL_INLINE(void) init_fuzzy_trie_walk(RE_FuzzyTrieWalk* walk, RE_State*
+  state, RE_Node* node, BOOL search, size_t max_cost, size_t skip) {
+    BOOL reverse;
+    Py_ssize_t text_available;
+    Py_ssize_t available;
+    int partial_side;
+
+    switch (node->op) {
+    case RE_OP_STRING_SET_FLD:
+    case RE_OP_STRING_SET_FLD_REV:
+        walk->folding = RE_TRIE_FULL_FOLD;
+        break;
+    case RE_OP_STRING_SET_IGN:
+    case RE_OP_STRING_SET_IGN_REV:
+        walk->folding = RE_TRIE_SIMPLE_FOLD;
+        break;
+    default:
+        walk->folding = RE_TRIE_NO_FOLD;
+        break;
+    }
+
+    switch (node->op) {
+    case RE_OP_STRING_SET_FLD_REV:
+    case RE_OP_STRING_SET_IGN_REV:
+    case RE_OP_STRING_SET_REV:
+        reverse = TRUE;
+        break;
+    default:
+        reverse = FALSE;
+        break;
+    }
+
+    walk->state = state;
+    walk->trie = &state->pattern->named_list_tries[reverse][node->values[0]];
+    walk->values = state->fuzzy_info.node->values;
+    walk->max_cost = max_cost;
+    memset(walk->counts, 0, sizeof(walk->counts));
+    walk->errors = 0;
+    walk->cost = 0;
+    walk->skip = skip;
+    walk->seen = 0;
+    walk->kind = state->is_unicode ? RE_TRIE_UNICODE : RE_TRIE_BYTES;
+    walk->search = search;
+    walk->partial = FALSE;
+    walk->found = FALSE;
+
+    if (reverse) {
+        text_available = state->text_pos;
+        available = state->text_pos - state->slice_start;
+        walk->step = -1;
+        partial_side = RE_PARTIAL_LEFT;
+    } else {
+        text_available = state->text_length - state->text_pos;
+        available = state->slice_end - state->text_pos;
+        walk->step = 1;
+        partial_side = RE_PARTIAL_RIGHT;
+    }
+
+    /* A partial match is allowed only if the text ends within the slice. */
+    walk->partial_allowed = available == text_available && state->partial_side
+      == partial_side;
+}
+
+/* Adds or removes the errors of a fuzzy match of a string set. */
+Py_LOCAL_INLINE(void) apply_string_set_errors(RE_State* state, size_t* counts,
+  int delta) {
+    RE_FuzzyInfo* fuzzy_info;
+    RE_CODE* values;
+    int fuzzy_type;
+
+    fuzzy_info = &state->fuzzy_info;
+    values = fuzzy_info->node->values;
+
+    for (fuzzy_type = 0; fuzzy_type < RE_FUZZY_COUNT; fuzzy_type++) {
+        size_t count;
+        size_t cost;
+
+        count = counts[fuzzy_type];
+        if (count == 0)
+            continue;
+
+        cost = count * values[RE_FUZZY_VAL_COST_BASE + fuzzy_type];
+
+        if (delta > 0) {
+            fuzzy_info->counts[fuzzy_type] += count;
+            fuzzy_info->counts[RE_FUZZY_ERR] += count;
+            fuzzy_info->total_cost += cost;
+            state->total_errors += count;
+            state->total_cost += cost;
+        } else {
+            fuzzy_info->counts[fuzzy_type] -= count;
+            fuzzy_info->counts[RE_FUZZY_ERR] -= count;
+            fuzzy_info->total_cost -= cost;
+            state->total_errors -= count;
+            state->total_cost -= cost;
+        }
+    }
+}
+
+/* Tries a fuzzy match of a member of a string set.
+ *
+ * Instead of trying each member in turn, it walks along the trie of the
+ * string set with an error budget.
+ */
+Py_LOCAL_INLINE(int) fuzzy_match_string_set(RE_SafeState* safe_state, BOOL
+  search, RE_Node* node) {
+    RE_State* state;
+    RE_FuzzyTrieWalk walk;
+    RE_BacktrackData* bt_data;
+
+    state = safe_state->re_state;
+
+    init_fuzzy_trie_walk(&walk, state, node, search, state->max_cost, 0);
+    fuzzy_trie_walk(&walk, 0, state->text_pos, -1);
+
+    if (walk.partial) {
+        /* Advance past the partial match. */
+        if (walk.step < 0)
+            state->text_pos = state->slice_start;
+        else
+            state->text_pos = state->slice_end;
+
+        return RE_ERROR_PARTIAL;
+    }
+
+    if (!walk.found)
+        return 0;
+
+    if (!add_backtrack(safe_state, node->op))
+        return RE_ERROR_BACKTRACKING;
+    bt_data = state->backtrack;
+    bt_data->fuzzy_string_set.position.text_pos = state->text_pos;
+    bt_data->fuzzy_string_set.position.node = node;
+    bt_data->fuzzy_string_set.max_cost = walk.max_cost;
+    bt_data->fuzzy_string_set.index = walk.index;
+    memcpy(bt_data->fuzzy_string_set.counts, walk.found_counts,
+      sizeof(walk.found_counts));
+
+    apply_string_set_errors(state, walk.found_counts, 1);
+    state->text_pos = walk.text_pos;
+
+    return 1;
+}
+
+/* Retries a fuzzy match of a member of a string set. */
+Py_LOCAL_INLINE(int) retry_fuzzy_match_string_set(RE_SafeState* safe_state,
+  BOOL search, RE_Node** node) {
+    RE_State* state;
+    RE_BacktrackData* bt_data;
+    RE_FuzzyTrieWalk walk;
+
+    state = safe_state->re_state;
+    bt_data = state->backtrack;
+
+    apply_string_set_errors(state, bt_data->fuzzy_string_set.counts, -1);
+    state->text_pos = bt_data->fuzzy_string_set.position.text_pos;
+    *node = bt_data->fuzzy_string_set.position.node;
+
+    /* Walk the trie again with the same budget, skipping the candidates which
+     * have already been tried.
+     */
+    init_fuzzy_trie_walk(&walk, state, *node, search,
+      bt_data->fuzzy_string_set.max_cost, bt_data->fuzzy_string_set.index +
+      1);
+    fuzzy_trie_walk(&walk, 0, state->text_pos, -1);
+
+    if (walk.partial) {
+        discard_backtrack(state);
+
+        /* Advance past the partial match. */
+        if (walk.step < 0)
+            state->text_pos = state->slice_start;
+        else
+            state->text_pos = state->slice_end;
+
+        return RE_ERROR_PARTIAL;
+    }
+
+    if (!walk.found) {
+        discard_backtrack(state);
+        return 0;
+    }
+
+    bt_data->fuzzy_string_set.index = walk.index;
+    memcpy(bt_data->fuzzy_string_set.counts, walk.found_counts,
+      sizeof(walk.found_counts));
+
+    apply_string_set_errors(state, walk.found_counts, 1);
+    state->text_pos = walk.text_pos;
+    *node = (*node)->next_1.node;
+
+    return 1;
+}
+
+/* Locates the required string, if there's one. */
+Py_LOCAL_INLINE(Py_ssize_t) locate_required_string(RE_SafeState* safe_state,
+  BOOL search) {
+    RE_State* state;
+    PatternObject* pattern;
+    Py_ssize_t found_pos;
+    Py_ssize_t end_pos;
+
+    state = safe_state->re_state;
+    pattern = state->pattern;
+
+    if (!pattern->req_string)
+        /* There isn't a required string, so start matching from the current
+         * position.
+         */
+        return state->text_pos;
+
+    /* Search for the required string and calculate where to start matching. */
+    switch (pattern->req_string->op) {
+    case RE_OP_STRING:
+    {
+        BOOL is_partial;
+        Py_ssize_t limit;
 
         if (search || pattern->req_offset < 0)
             limit = state->slice_end;
@@ -11086,43 +11868,433 @@ Py_LOCAL_INLINE(Py_ssize_t) locate_required_string(RE_SafeState* safe_state,
     return state->text_pos;
 }
 
-/* Tries to match a character pattern. */
-Py_LOCAL_INLINE(int) match_one(RE_State* state, RE_Node* node, Py_ssize_t
-  text_pos) {
-    switch (node->op) {
-    case RE_OP_ANY:
-        return try_match_ANY(state, node, text_pos);
-    case RE_OP_ANY_ALL:
-        return try_match_ANY_ALL(state, node, text_pos);
-    case RE_OP_ANY_ALL_REV:
-        return try_match_ANY_ALL_REV(state, node, text_pos);
-    case RE_OP_ANY_REV:
-        return try_match_ANY_REV(state, node, text_pos);
-    case RE_OP_ANY_U:
-        return try_match_ANY_U(state, node, text_pos);
-    case RE_OP_ANY_U_REV:
-        return try_match_ANY_U_REV(state, node, text_pos);
-    case RE_OP_CHARACTER:
-        return try_match_CHARACTER(state, node, text_pos);
-    case RE_OP_CHARACTER_IGN:
-        return try_match_CHARACTER_IGN(state, node, text_pos);
-    case RE_OP_CHARACTER_IGN_REV:
-        return try_match_CHARACTER_IGN_REV(state, node, text_pos);
-    case RE_OP_CHARACTER_REV:
-        return try_match_CHARACTER_REV(state, node, text_pos);
-    case RE_OP_PROPERTY:
-        return try_match_PROPERTY(state, node, text_pos);
-    case RE_OP_PROPERTY_IGN:
-        return try_match_PROPERTY_IGN(state, node, text_pos);
-    case RE_OP_PROPERTY_IGN_REV:
-        return try_match_PROPERTY_IGN_REV(state, node, text_pos);
-    case RE_OP_PROPERTY_REV:
-        return try_match_PROPERTY_REV(state, node, text_pos);
-    case RE_OP_RANGE:
-        return try_match_RANGE(state, node, text_pos);
-    case RE_OP_RANGE_IGN:
-        return try_match_RANGE_IGN(state, node, text_pos);
-    case RE_OP_RANGE_IGN_REV:
+/* Checks whether a required string matches at a position. */
+Py_LOCAL_INLINE(BOOL) required_string_at(RE_State* state, RE_Node* node,
+  Py_ssize_t text_pos) {
+    Py_UCS4 (*char_at)(void* text, Py_ssize_t pos);
+    void* text;
+    RE_CODE* values;
+    Py_ssize_t length;
+    Py_ssize_t i;
+
+    length = (Py_ssize_t)node->value_count;
+    if (text_pos + length > state->slice_end)
+        return FALSE;
+
+    char_at = state->char_at;
+    text = state->text;
+    values = node->values;
+
+    if (node->op == RE_OP_STRING_IGN) {
+        RE_EncodingTable* encoding;
+        RE_LocaleInfo* locale_info;
+
+        encoding = state->encoding;
+        locale_info = state->locale_info;
+
+        for (i = 0; i < length; i++) {
+            if (!same_char_ign(encoding, locale_info, char_at(text, text_pos +
+              i), values[i]))
+                return FALSE;
+        }
+    } else {
+        for (i = 0; i < length; i++) {
+            if (char_at(text, text_pos + i) != values[i])
+                return FALSE;
+        }
+    }
+
+    return TRUE;
+}
+
+/* Searches for the first position where any of the alternative required
+ * strings matches. Returns -1 if there's none.
+ */
+Py_LOCAL_INLINE(Py_ssize_t) search_required_alts(RE_State* state,
+  RE_RequiredAlts* alts, Py_ssize_t text_pos) {
+    Py_ssize_t charsize;
+    char* text;
+    Py_ssize_t limit;
+    BOOL skip;
+
+    charsize = state->charsize;
+    text = (char*)state->text;
+    limit = state->slice_end;
+
+    /* Can we skip along the text to the next possible first character? */
+    skip = alts->first_count == 1 || (alts->first_count > 1 && charsize < 4);
+
+    while (text_pos < limit) {
+        RE_Node* node;
+
+        if (skip) {
+            char* text_ptr;
+            char* limit_ptr;
+
+            text_ptr = text + text_pos * charsize;
+            limit_ptr = text + limit * charsize;
+
+            if (alts->first_count == 1)
+                text_ptr = (char*)find_char(text_ptr, limit_ptr, charsize,
+                  alts->firsts[0]);
+            else
+                text_ptr = (char*)find_any_char(text_ptr, limit_ptr, charsize,
+                  alts->first_count, alts->firsts);
+
+            text_pos = (text_ptr - text) / charsize;
+            if (text_pos >= limit)
+                break;
+        } else {
+            Py_UCS4 ch;
+            BOOL is_first;
+
+            ch = state->char_at(state->text, text_pos);
+            if (ch < RE_SET_BITMAP_CHARS)
+                is_first = (alts->first_bitmap[ch >> 5] >> (ch & 0x1F)) & 0x1;
+            else
+                is_first = alts->wide_first;
+
+            if (!is_first) {
+                ++text_pos;
+                continue;
+            }
+        }
+
+        for (node = alts->strings; node; node = node->next_1.node) {
+            if (required_string_at(state, node, text_pos))
+                return text_pos;
+        }
+
+        ++text_pos;
+    }
+
+    return -1;
+}
+
+/* Deallocates the info for scanning for a fuzzy literal. */
+Py_LOCAL_INLINE(void) dealloc_fuzzy_literal(RE_FuzzyLiteral* literal) {
+    if (!literal)
+        return;
+
+    re_dealloc(literal->nodes);
+    re_dealloc(literal->offsets);
+    re_dealloc(literal);
+}
+
+/* Checks whether a character matches a position of a fuzzy literal. */
+Py_LOCAL_INLINE(BOOL) fuzzy_literal_matches(RE_EncodingTable* encoding,
+  RE_LocaleInfo* locale_info, RE_Node* node, Py_ssize_t offset, Py_UCS4 ch) {
+    switch (node->op) {
+    case RE_OP_ANY:
+        return matches_ANY(encoding, node, ch);
+    case RE_OP_ANY_ALL:
+        return TRUE;
+    case RE_OP_ANY_U:
+        return matches_ANY_U(encoding, node, ch);
+    case RE_OP_CHARACTER:
+        return matches_CHARACTER(encoding, locale_info, node, ch) ==
+          node->match;
+    case RE_OP_CHARACTER_IGN:
+        return matches_CHARACTER_IGN(encoding, locale_info, node, ch) ==
+          node->match;
+    case RE_OP_PROPERTY:
+        return matches_PROPERTY(encoding, locale_info, node, ch) ==
+          node->match;
+    case RE_OP_PROPERTY_IGN:
+        return matches_PROPERTY_IGN(encoding, locale_info, node, ch) ==
+          node->match;
+    case RE_OP_RANGE:
+        return matches_RANGE(encoding, locale_info, node, ch) == node->match;
+    case RE_OP_RANGE_IGN:
+        return matches_RANGE_IGN(encoding, locale_info, node, ch) ==
+          node->match;
+    case RE_OP_SET_DIFF:
+    case RE_OP_SET_INTER:
+    case RE_OP_SET_SYM_DIFF:
+    case RE_OP_SET_UNION:
+        return matches_SET(encoding, locale_info, node, ch) == node->match;
+    case RE_OP_SET_DIFF_IGN:
+    case RE_OP_SET_INTER_IGN:
+    case RE_OP_SET_SYM_DIFF_IGN:
+    case RE_OP_SET_UNION_IGN:
+        return matches_SET_IGN(encoding, locale_info, node, ch) ==
+          node->match;
+    case RE_OP_STRING:
+        return same_char(ch, node->values[offset]);
+    case RE_OP_STRING_IGN:
+        return same_char_ign(encoding, locale_info, ch, node->values[offset]);
+    }
+
+    return FALSE;
+}
+
+/* Gets the positions of a fuzzy literal that a character matches, as a
+ * bitmask.
+ */
+Py_LOCAL_INLINE(size_t) fuzzy_literal_mask(RE_EncodingTable* encoding,
+  RE_LocaleInfo* locale_info, RE_FuzzyLiteral* literal, Py_UCS4 ch) {
+    size_t mask;
+    size_t i;
+
+    if (ch < 256)
+        return literal->masks[ch];
+
+    mask = 0;
+
+    for (i = 0; i < literal->length; i++) {
+        if (fuzzy_literal_matches(encoding, locale_info, literal->nodes[i],
+          literal->offsets[i], ch))
+            mask |= (size_t)1 << i;
+    }
+
+    return mask;
+}
+
+/* Locates where a match of a fuzzy literal could start when searching.
+ *
+ * A match with at most k errors of a literal of length m has a text whose edit
+ * distance from the literal is at most k, so it ends where the bit-parallel
+ * scan finds a distance of at most k, and starts at most m + k characters
+ * before that. The scan continues from where it reached the previous time if
+ * the search doesn't start before the previous one, which is safe because
+ * starting the scan earlier can only find more possible matches.
+ */
+Py_LOCAL_INLINE(int) locate_fuzzy_literal(RE_SafeState* safe_state,
+  Py_ssize_t* found_pos) {
+    RE_State* state;
+    RE_FuzzyLiteral* literal;
+    RE_FuzzyScan* scan;
+    Py_ssize_t length;
+    Py_ssize_t max_errors;
+    Py_ssize_t min_end;
+    size_t last_bit;
+    size_t pv;
+    size_t mv;
+    size_t score;
+    Py_ssize_t text_pos;
+    Py_ssize_t slice_end;
+    Py_UCS4 (*char_at)(void* text, Py_ssize_t pos);
+    void* text;
+
+    state = safe_state->re_state;
+    literal = state->pattern->fuzzy_literal;
+    scan = &state->fuzzy_scan;
+
+    length = (Py_ssize_t)literal->length;
+    max_errors = (Py_ssize_t)literal->max_errors;
+
+    /* A match can't end before this. */
+    min_end = *found_pos + length - max_errors;
+
+    if (scan->start < 0 || *found_pos < scan->start || scan->slice_end !=
+      state->slice_end) {
+        /* Start a new scan. */
+        scan->text_pos = *found_pos;
+        scan->end = -1;
+        scan->slice_end = state->slice_end;
+        scan->score = literal->length;
+        scan->pv = ~(size_t)0;
+        scan->mv = 0;
+    }
+
+    scan->start = *found_pos;
+
+    if (scan->end < min_end) {
+        last_bit = (size_t)1 << (literal->length - 1);
+        pv = scan->pv;
+        mv = scan->mv;
+        score = scan->score;
+        text_pos = scan->text_pos;
+        slice_end = state->slice_end;
+        char_at = state->char_at;
+        text = state->text;
+
+        for (;;) {
+            size_t eq;
+            size_t xv;
+            size_t xh;
+            size_t ph;
+            size_t mh;
+
+            if (text_pos >= slice_end) {
+                scan->text_pos = text_pos;
+                scan->pv = pv;
+                scan->mv = mv;
+                scan->score = score;
+
+                return RE_ERROR_FAILURE;
+            }
+
+            /* Should we abort the matching? */
+            if (--state->iterations == 0) {
+                int status;
+
+                status = safe_check_limits(safe_state);
+                if (status < 0)
+                    return status;
+            }
+
+            eq = fuzzy_literal_mask(state->encoding, state->locale_info,
+              literal, char_at(text, text_pos));
+            ++text_pos;
+
+            xv = eq | mv;
+            xh = (((eq & pv) + pv) ^ pv) | eq;
+            ph = mv | ~(xh | pv);
+            mh = pv & xh;
+
+            if (ph & last_bit)
+                ++score;
+            else if (mh & last_bit)
+                --score;
+
+            ph <<= 1;
+            mh <<= 1;
+            pv = mh | ~(xv | ph);
+            mv = ph & xv;
+
+            if (score <= literal->max_errors && text_pos >= min_end)
+                break;
+        }
+
+        scan->text_pos = text_pos;
+        scan->pv = pv;
+        scan->mv = mv;
+        scan->score = score;
+        scan->end = text_pos;
+    }
+
+    if (scan->end - length - max_errors > *found_pos)
+        *found_pos = scan->end - length - max_errors;
+
+    return RE_ERROR_SUCCESS;
+}
+
+/* Locates the other required strings, if there are any, when searching, and
+ * calculates where to start matching.
+ */
+Py_LOCAL_INLINE(Py_ssize_t) locate_other_required_strings(RE_SafeState*
+  safe_state, Py_ssize_t found_pos) {
+    RE_State* state;
+    PatternObject* pattern;
+
+    state = safe_state->re_state;
+    pattern = state->pattern;
+
+    /* A partial match might not contain them. */
+    if (state->partial_side != RE_PARTIAL_NONE)
+        return found_pos;
+
+    if (pattern->req_following) {
+        RE_Node* node;
+        Py_ssize_t text_pos;
+        int i;
+
+        /* The strings must follow the required string in order. */
+        if (pattern->req_string->op == RE_OP_STRING_FLD)
+            text_pos = state->req_pos;
+        else
+            text_pos = state->req_end;
+
+        for (node = pattern->req_following, i = 0; node; node =
+          node->next_1.node, i++) {
+            Py_ssize_t pos;
+
+            pos = state->req_following_pos[i];
+
+            if (pos < 0 || text_pos > pos) {
+                /* First time or already passed it. */
+                BOOL is_partial;
+                Py_ssize_t end_pos;
+
+                switch (node->op) {
+                case RE_OP_STRING:
+                    pos = string_search(safe_state, node, text_pos,
+                      state->slice_end, &is_partial);
+                    break;
+                case RE_OP_STRING_FLD:
+                    pos = string_search_fld(safe_state, node, text_pos,
+                      state->slice_end, &end_pos, &is_partial);
+                    break;
+                case RE_OP_STRING_IGN:
+                    pos = string_search_ign(safe_state, node, text_pos,
+                      state->slice_end, &is_partial);
+                    break;
+                }
+
+                if (pos < 0)
+                    /* The string wasn't found. */
+                    return -1;
+
+                state->req_following_pos[i] = pos;
+            }
+
+            if (node->op == RE_OP_STRING_FLD)
+                text_pos = pos;
+            else
+                text_pos = pos + (Py_ssize_t)node->value_count;
+        }
+    }
+
+    if (pattern->req_alts) {
+        RE_RequiredAlts* alts;
+
+        alts = pattern->req_alts;
+
+        if (state->req_alt_pos < 0 || found_pos > state->req_alt_pos)
+            /* First time or already passed it. */
+            state->req_alt_pos = search_required_alts(state, alts, found_pos);
+
+        if (state->req_alt_pos < 0)
+            /* None of the strings was found. */
+            return -1;
+
+        if (alts->offset >= 0 && state->req_alt_pos - alts->offset >
+          found_pos)
+            /* Step back from the string to where we should start matching. */
+            found_pos = state->req_alt_pos - alts->offset;
+    }
+
+    return found_pos;
+}
+
+/* Tries to match a character pattern. */
+Py_LOCAL_INLINE(int) match_one(RE_State* state, RE_Node* node, Py_ssize_t
+  text_pos) {
+    switch (node->op) {
+    case RE_OP_ANY:
+        return try_match_ANY(state, node, text_pos);
+    case RE_OP_ANY_ALL:
+        return try_match_ANY_ALL(state, node, text_pos);
+    case RE_OP_ANY_ALL_REV:
+        return try_match_ANY_ALL_REV(state, node, text_pos);
+    case RE_OP_ANY_REV:
+        return try_match_ANY_REV(state, node, text_pos);
+    case RE_OP_ANY_U:
+        return try_match_ANY_U(state, node, text_pos);
+    case RE_OP_ANY_U_REV:
+        return try_match_ANY_U_REV(state, node, text_pos);
+    case RE_OP_CHARACTER:
+        return try_match_CHARACTER(state, node, text_pos);
+    case RE_OP_CHARACTER_IGN:
+        return try_match_CHARACTER_IGN(state, node, text_pos);
+    case RE_OP_CHARACTER_IGN_REV:
+        return try_match_CHARACTER_IGN_REV(state, node, text_pos);
+    case RE_OP_CHARACTER_REV:
+        return try_match_CHARACTER_REV(state, node, text_pos);
+    case RE_OP_PROPERTY:
+        return try_match_PROPERTY(state, node, text_pos);
+    case RE_OP_PROPERTY_IGN:
+        return try_match_PROPERTY_IGN(state, node, text_pos);
+    case RE_OP_PROPERTY_IGN_REV:
+        return try_match_PROPERTY_IGN_REV(state, node, text_pos);
+    case RE_OP_PROPERTY_REV:
+        return try_match_PROPERTY_REV(state, node, text_pos);
+    case RE_OP_RANGE:
+        return try_match_RANGE(state, node, text_pos);
+    case RE_OP_RANGE_IGN:
+        return try_match_RANGE_IGN(state, node, text_pos);
+    case RE_OP_RANGE_IGN_REV:
         return try_match_RANGE_IGN_REV(state, node, text_pos);
     case RE_OP_RANGE_REV:
         return try_match_RANGE_REV(state, node, text_pos);
@@ -11151,6 +12323,37 @@ Py_LOCAL_INLINE(int) match_one(RE_State* state, RE_Node* node, Py_ssize_t
     return FALSE;
 }
 
+/* Checks whether a lazy repeat of a character pattern could continue to the
+ * end of the text when matching partially, in which case its tail might match
+ * the text which follows.
+ *
+ * Returns RE_ERROR_PARTIAL if it could.
+ */
+Py_LOCAL_INLINE(int) try_match_lazy_to_end(RE_State* state, RE_Node* repeated,
+  Py_ssize_t text_pos, Py_ssize_t step, size_t max_count) {
+    for (;;) {
+        int status;
+
+        if (max_count == 0) {
+            /* The tail would start at the end of the text. */
+            if (step > 0 ? text_pos >= state->text_length &&
+              state->partial_side == RE_PARTIAL_RIGHT : text_pos <= 0 &&
+              state->partial_side == RE_PARTIAL_LEFT)
+                return RE_ERROR_PARTIAL;
+
+            return RE_ERROR_FAILURE;
+        }
+
+        /* A character pattern gives a partial match at the end of the text. */
+        status = match_one(state, repeated, text_pos);
+        if (status != RE_ERROR_SUCCESS)
+            return status;
+
+        text_pos += step;
+        --max_count;
+    }
+}
+
 /* Tests whether 2 nodes contains the same values. */
 Py_LOCAL_INLINE(BOOL) same_values(RE_Node* node_1, RE_Node* node_2) {
     size_t i;
@@ -11423,6 +12626,8 @@ Py_LOCAL_INLINE(BOOL) check_posix_match(RE_SafeState* safe_state) {
     return TRUE;
 }
 
+Py_LOCAL_INLINE(BOOL) save_best_fuzzy_match(RE_SafeState* safe_state);
+
 /* Performs a depth-first match or search from the context. */
 Py_LOCAL_INLINE(int) basic_match(RE_SafeState* safe_state, BOOL search) {
     RE_State* state;
@@ -11512,6 +12717,21 @@ start_match:
             return RE_ERROR_FAILURE;
     }
 
+    /* Locate the other required strings, if there are any. */
+    if (search && (pattern->req_alts || pattern->req_following)) {
+        found_pos = locate_other_required_strings(safe_state, found_pos);
+        if (found_pos < 0)
+            return RE_ERROR_FAILURE;
+    }
+
+    /* Skip to where a fuzzy literal could match, if the pattern is one. */
+    if (search && pattern->fuzzy_literal && !state->reverse &&
+      state->partial_side == RE_PARTIAL_NONE) {
+        status = locate_fuzzy_literal(safe_state, &found_pos);
+        if (status != RE_ERROR_SUCCESS)
+            return status;
+    }
+
     if (search) {
         state->text_pos = found_pos;
 
@@ -11602,15 +12822,22 @@ next_match_2:
     }
 
 advance:
+    /* While looking for a better fuzzy match, a path that already costs too
+     * much can't lead to one.
+     */
+    if (state->total_cost > state->max_cost)
+        goto backtrack;
+
     /* The main matching loop. */
     for (;;) {
         TRACE(("%d|", state->text_pos))
 
         /* Should we abort the matching? */
-        ++state->iterations;
-
-        if (state->iterations == 0 && safe_check_signals(safe_state))
-            return RE_ERROR_INTERRUPTED;
+        if (--state->iterations == 0) {
+            status = safe_check_limits(safe_state);
+            if (status < 0)
+                return status;
+        }
 
         switch (node->op) {
         case RE_OP_ANY: /* Any character except a newline. */
@@ -14341,7 +15568,10 @@ advance:
             int status;
             TRACE(("%s\n", re_op_text[node->op]))
 
-            status = string_set_match_fwdrev(safe_state, node, FALSE);
+            if (node->status & RE_STATUS_FUZZY)
+                status = fuzzy_match_string_set(safe_state, search, node);
+            else
+                status = string_set_match_fwdrev(state, node, FALSE);
             if (status < 0)
                 return status;
             if (status == 0)
@@ -14354,7 +15584,10 @@ advance:
             int status;
             TRACE(("%s\n", re_op_text[node->op]))
 
-            status = string_set_match_fld_fwdrev(safe_state, node, FALSE);
+            if (node->status & RE_STATUS_FUZZY)
+                status = fuzzy_match_string_set(safe_state, search, node);
+            else
+                status = string_set_match_fwdrev(state, node, FALSE);
             if (status < 0)
                 return status;
             if (status == 0)
@@ -14367,7 +15600,10 @@ advance:
             int status;
             TRACE(("%s\n", re_op_text[node->op]))
 
-            status = string_set_match_fld_fwdrev(safe_state, node, TRUE);
+            if (node->status & RE_STATUS_FUZZY)
+                status = fuzzy_match_string_set(safe_state, search, node);
+            else
+                status = string_set_match_fwdrev(state, node, TRUE);
             if (status < 0)
                 return status;
             if (status == 0)
@@ -14380,7 +15616,10 @@ advance:
             int status;
             TRACE(("%s\n", re_op_text[node->op]))
 
-            status = string_set_match_ign_fwdrev(safe_state, node, FALSE);
+            if (node->status & RE_STATUS_FUZZY)
+                status = fuzzy_match_string_set(safe_state, search, node);
+            else
+                status = string_set_match_fwdrev(state, node, FALSE);
             if (status < 0)
                 return status;
             if (status == 0)
@@ -14393,7 +15632,10 @@ advance:
             int status;
             TRACE(("%s\n", re_op_text[node->op]))
 
-            status = string_set_match_ign_fwdrev(safe_state, node, TRUE);
+            if (node->status & RE_STATUS_FUZZY)
+                status = fuzzy_match_string_set(safe_state, search, node);
+            else
+                status = string_set_match_fwdrev(state, node, TRUE);
             if (status < 0)
                 return status;
             if (status == 0)
@@ -14406,7 +15648,10 @@ advance:
             int status;
             TRACE(("%s\n", re_op_text[node->op]))
 
-            status = string_set_match_fwdrev(safe_state, node, TRUE);
+            if (node->status & RE_STATUS_FUZZY)
+                status = fuzzy_match_string_set(safe_state, search, node);
+            else
+                status = string_set_match_fwdrev(state, node, TRUE);
             if (status < 0)
                 return status;
             if (status == 0)
@@ -14442,6 +15687,14 @@ advance:
                 goto backtrack;
             }
 
+            if (state->single_pass_best && state->total_cost > 0) {
+                /* Keep the match and look only for a better one. */
+                if (!save_best_fuzzy_match(safe_state))
+                    return RE_ERROR_MEMORY;
+
+                goto backtrack;
+            }
+
             return RE_ERROR_SUCCESS;
         default: /* Illegal opcode! */
             TRACE(("UNKNOWN OP %d\n", node->op))
@@ -14455,11 +15708,12 @@ backtrack:
         TRACE(("BACKTRACK "))
 
         /* Should we abort the matching? */
-        ++state->iterations;
-
-        if (state->iterations == 0 && safe_check_signals(safe_state))
-            return RE_ERROR_INTERRUPTED;
-
+        if (--state->iterations == 0) {
+            status = safe_check_limits(safe_state);
+            if (status < 0)
+                return status;
+        }
+
         bt_data = last_backtrack(state);
 
         switch (bt_data->op) {
@@ -15882,6 +17136,17 @@ backtrack:
                 }
             }
 
+            /* The fast searches for the tail stop short of the end of the
+             * text, but a partial match might need to continue past it.
+             */
+            if (!match && state->partial_side != RE_PARTIAL_NONE) {
+                status = try_match_lazy_to_end(state, repeated,
+                  state->text_pos + (Py_ssize_t)count * step, step,
+                  node->values[2] - count);
+                if (status < 0)
+                    return status;
+            }
+
             if (match) {
                 /* The tail could match. */
                 count = (size_t)abs_ssize_t(pos - state->text_pos);
@@ -16049,6 +17314,22 @@ backtrack:
             string_pos = -1;
             break;
         }
+        case RE_OP_STRING_SET: /* Member of a string set. */
+        case RE_OP_STRING_SET_FLD: /* Member of a string set, ignoring case. */
+        case RE_OP_STRING_SET_FLD_REV: /* Member of a string set, ignoring case. */
+        case RE_OP_STRING_SET_IGN: /* Member of a string set, ignoring case. */
+        case RE_OP_STRING_SET_IGN_REV: /* Member of a string set, ignoring case. */
+        case RE_OP_STRING_SET_REV: /* Member of a string set. */
+            TRACE(("%s\n", re_op_text[bt_data->op]))
+
+            status = retry_fuzzy_match_string_set(safe_state, search, &node);
+            if (status < 0)
+                return status;
+
+            if (status > 0)
+                goto advance;
+
+            break;
         case RE_OP_START_GROUP: /* Start of a capture group. */
         {
             RE_CODE private_index;
@@ -16226,4213 +17507,3986 @@ Py_LOCAL_INLINE(void) restore_fuzzy_counts(RE_State* state, size_t*
       sizeof(state->total_fuzzy_counts));
 }
 
-/* Performs a match or search from the current text position.
- *
- * The state can sometimes be shared across threads. In such instances there's
- * a lock (mutex) on it. The lock is held for the duration of matching.
+/* Saves a match as the best fuzzy match found so far in a single pass and
+ * lowers the maximum permitted cost so that matching continues only for a
+ * better one instead of searching again from the start of the match.
  */
-Py_LOCAL_INLINE(int) do_match(RE_SafeState* safe_state, BOOL search) {
+Py_LOCAL_INLINE(BOOL) save_best_fuzzy_match(RE_SafeState* safe_state) {
     RE_State* state;
-    PatternObject* pattern;
-    Py_ssize_t available;
-    BOOL get_best;
-    BOOL enhance_match;
-    size_t lower_cost;
-    size_t upper_cost;
-    RE_GroupData* best_groups;
-    Py_ssize_t best_match_pos;
-    BOOL must_advance;
-    Py_ssize_t slice_start;
-    Py_ssize_t slice_end;
-    int status;
-    size_t best_fuzzy_counts[RE_FUZZY_COUNT];
-    Py_ssize_t best_text_pos = 0; /* Initialise to stop compiler warning. */
-    TRACE(("<<do_match>>\n"))
 
     state = safe_state->re_state;
-    pattern = state->pattern;
 
-    /* Release the GIL. */
-    release_GIL(safe_state);
+    state->best_fuzzy_groups = save_groups(safe_state,
+      state->best_fuzzy_groups);
+    if (!state->best_fuzzy_groups)
+        return FALSE;
 
-    /* Is there enough to search? */
-    if (state->reverse) {
-        if (state->text_pos < state->slice_start) {
-            acquire_GIL(safe_state);
-            return FALSE;
-        }
+    state->best_fuzzy_match_pos = state->match_pos;
+    state->best_fuzzy_text_pos = state->text_pos;
+    save_fuzzy_counts(state, state->best_fuzzy_counts);
+    state->found_fuzzy_match = TRUE;
+    ++state->passes_avoided;
 
-        available = state->text_pos - state->slice_start;
-    } else {
-        if (state->text_pos > state->slice_end) {
-            acquire_GIL(safe_state);
-            return FALSE;
-        }
+    state->max_cost = state->total_cost - 1;
 
-        available = state->slice_end - state->text_pos;
-    }
+    return TRUE;
+}
 
-    get_best = (pattern->flags & RE_FLAG_BESTMATCH) != 0;
-    enhance_match = (pattern->flags & RE_FLAG_ENHANCEMATCH) != 0 && !get_best;
+/* Checks whether a zero-width assertion of the lazy DFA is true at a position.
+ */
+Py_LOCAL_INLINE(BOOL) dfa_assertion(RE_State* state, RE_Node* node, Py_ssize_t
+  text_pos) {
+    int status;
 
-    /* The maximum permitted cost. */
-    state->max_cost = pattern->is_fuzzy ? PY_SSIZE_T_MAX : 0;
-    lower_cost = 0;
-    upper_cost = state->max_cost;
+    switch (node->op) {
+    case RE_OP_BOUNDARY:
+        status = try_match_BOUNDARY(state, node, text_pos);
+        break;
+    case RE_OP_DEFAULT_BOUNDARY:
+        status = try_match_DEFAULT_BOUNDARY(state, node, text_pos);
+        break;
+    case RE_OP_DEFAULT_END_OF_WORD:
+        status = try_match_DEFAULT_END_OF_WORD(state, node, text_pos);
+        break;
+    case RE_OP_DEFAULT_START_OF_WORD:
+        status = try_match_DEFAULT_START_OF_WORD(state, node, text_pos);
+        break;
+    case RE_OP_END_OF_LINE:
+        status = try_match_END_OF_LINE(state, node, text_pos);
+        break;
+    case RE_OP_END_OF_LINE_U:
+        status = try_match_END_OF_LINE_U(state, node, text_pos);
+        break;
+    case RE_OP_END_OF_STRING:
+        status = try_match_END_OF_STRING(state, node, text_pos);
+        break;
+    case RE_OP_END_OF_STRING_LINE:
+        status = try_match_END_OF_STRING_LINE(state, node, text_pos);
+        break;
+    case RE_OP_END_OF_STRING_LINE_U:
+        status = try_match_END_OF_STRING_LINE_U(state, node, text_pos);
+        break;
+    case RE_OP_END_OF_WORD:
+        status = try_match_END_OF_WORD(state, node, text_pos);
+        break;
+    case RE_OP_START_OF_LINE:
+        status = try_match_START_OF_LINE(state, node, text_pos);
+        break;
+    case RE_OP_START_OF_LINE_U:
+        status = try_match_START_OF_LINE_U(state, node, text_pos);
+        break;
+    case RE_OP_START_OF_STRING:
+        status = try_match_START_OF_STRING(state, node, text_pos);
+        break;
+    case RE_OP_START_OF_WORD:
+        status = try_match_START_OF_WORD(state, node, text_pos);
+        break;
+    default:
+        status = RE_ERROR_FAILURE;
+        break;
+    }
 
-    best_groups = NULL;
+    return status == RE_ERROR_SUCCESS;
+}
 
-    best_match_pos = state->text_pos;
-    must_advance = state->must_advance;
+/* Gets the context of the lazy DFA at a position, which is the results of its
+ * program's assertions there.
+ */
+Py_LOCAL_INLINE(RE_UINT32) dfa_context(RE_State* state, RE_DFAProgram*
+  program, Py_ssize_t text_pos) {
+    RE_UINT32 context;
+    size_t i;
 
-    slice_start = state->slice_start;
-    slice_end = state->slice_end;
+    context = 0;
+    for (i = 0; i < program->assertion_count; i++) {
+        if (dfa_assertion(state, program->assertions[i], text_pos))
+            context |= (RE_UINT32)1 << i;
+    }
 
-    for (;;) {
-        /* If there's a better match, it won't start earlier in the string than
-         * the current best match, so there's no need to start earlier than
-         * that match.
-         */
-        state->text_pos = best_match_pos;
-        state->must_advance = must_advance;
+    return context;
+}
 
-        /* Initialise the state. */
-        init_match(state);
+/* Gets the class of a character for the lazy DFA. */
+Py_LOCAL_INLINE(RE_UINT8) dfa_char_class(RE_State* state, RE_DFAProgram*
+  program, Py_UCS4 ch) {
+    RE_UINT8 char_class;
 
-        status = RE_ERROR_SUCCESS;
-        if (state->max_cost == 0 && state->partial_side == RE_PARTIAL_NONE) {
-            /* An exact match, and partial matches not permitted. */
-            if (available < state->min_width || (available == 0 &&
-              state->must_advance))
-                status = RE_ERROR_FAILURE;
-        }
+    char_class = 0;
+    if ((program->classes & RE_DFA_CLASS_WORD) &&
+      state->encoding->has_property(state->locale_info, RE_PROP_WORD, ch))
+        char_class |= RE_DFA_CLASS_WORD;
 
-        if (status == RE_ERROR_SUCCESS)
-            status = basic_match(safe_state, search);
+    if (ch == 0x0A)
+        char_class |= RE_DFA_CLASS_LINE_FEED;
+    else if (ch == 0x0D)
+        char_class |= RE_DFA_CLASS_CARRIAGE_RETURN;
 
-        /* Has an error occurred, or is it a partial match? */
-        if (status < 0)
-            break;
+    if (state->encoding->is_line_sep(ch))
+        char_class |= RE_DFA_CLASS_LINE_SEP;
 
-        if (status == RE_ERROR_SUCCESS)
-            upper_cost = state->total_cost;
-        else if (enhance_match)
-            lower_cost = state->max_cost + 1;
-        else
-            break;
+    return char_class & program->classes;
+}
 
-        if (lower_cost >= upper_cost)
-            break;
+/* Gets the entry in the table of the lazy DFA's transitions for a state, a
+ * character and a context. The entry might be for a different transition.
+ */
+Py_LOCAL_INLINE(RE_DFATransition*) dfa_transition(RE_DFACache* cache,
+  RE_DFAState* from, Py_UCS4 ch, RE_UINT32 context) {
+    size_t hash;
 
-        if (!get_best && !enhance_match)
-            break;
+    hash = (((size_t)from >> 4) * 31 + ch) * 31 + context;
+    hash ^= hash >> 10;
 
-        if (status == RE_ERROR_SUCCESS) {
-            save_fuzzy_counts(state, best_fuzzy_counts);
+    return &cache->transitions[hash & (RE_DFA_TRANSITIONS - 1)];
+}
 
-            if (!get_best && state->text_pos == state->match_pos)
-                /* We want the first match. The match is already zero-width, so
-                 * the cost can't get any lower (because the fit can't get any
-                 * better).
-                 */
-                break;
+/* Gets the states of the lazy DFA, allocating them if necessary. */
+Py_LOCAL_INLINE(RE_DFACache*) get_dfa_cache(RE_SafeState* safe_state, int
+  direction) {
+    RE_State* state;
+    RE_DFACache* cache;
+    Py_ssize_t count;
+    size_t size;
 
-            if (best_groups) {
-                BOOL same;
-                size_t g;
+    state = safe_state->re_state;
+    cache = state->dfa_caches[direction];
+    if (cache)
+        return cache;
+
+    /* The cache and its work areas are allocated together. */
+    count = state->pattern->dfa_programs[direction]->count;
+    size = sizeof(RE_DFACache) + (size_t)count * (5 * sizeof(Py_ssize_t) +
+      sizeof(RE_UINT32));
+    cache = (RE_DFACache*)safe_alloc(safe_state, size);
+    if (!cache)
+        return NULL;
 
-                /* Did we get the same match as the best so far? */
-                same = state->match_pos == best_match_pos && state->text_pos ==
-                  best_text_pos;
-                for (g = 0; same && g < pattern->public_group_count; g++) {
-                    same = state->groups[g].span.start ==
-                      best_groups[g].span.start && state->groups[g].span.end ==
-                      best_groups[g].span.end;
-                }
+    memset(cache, 0, size);
+    cache->program = state->pattern->dfa_programs[direction];
+    cache->forward = direction == 0;
+    cache->kernel = (Py_ssize_t*)(cache + 1);
+    cache->threads = cache->kernel + count;
+    cache->stack = cache->threads + count;
+    cache->marks = (RE_UINT32*)(cache->stack + 3 * count);
 
-                if (same && !enhance_match)
-                    break;
-            }
+    state->dfa_caches[direction] = cache;
 
-            /* Save the best result so far. */
-            best_groups = save_groups(safe_state, best_groups);
-            if (!best_groups) {
-                status = RE_ERROR_MEMORY;
-                break;
-            }
+    return cache;
+}
 
-            best_match_pos = state->match_pos;
-            best_text_pos = state->text_pos;
+/* Discards the states of the lazy DFA. The GIL should be held. */
+Py_LOCAL_INLINE(void) discard_dfa_states(RE_DFACache* cache) {
+    size_t i;
 
-            if (state->max_cost == 0)
-                break;
+    for (i = 0; i < RE_DFA_BUCKETS; i++) {
+        RE_DFAState* dfa_state;
 
-            if (enhance_match) {
-                if (state->reverse) {
-                    state->slice_start = state->text_pos;
-                    state->slice_end = state->match_pos;
-                } else {
-                    state->slice_start = state->match_pos;
-                    state->slice_end = state->text_pos;
-                }
-            }
+        dfa_state = cache->buckets[i];
+        while (dfa_state) {
+            RE_DFAState* next;
+
+            next = dfa_state->hash_next;
+            re_dealloc(dfa_state);
+            dfa_state = next;
         }
 
-        /* Reduce the maximum permitted cost and try again. */
-        if (enhance_match)
-            state->max_cost = (lower_cost + upper_cost) / 2;
-        else
-            state->max_cost = state->total_cost - 1;
+        cache->buckets[i] = NULL;
     }
 
-    state->slice_start = slice_start;
-    state->slice_end = slice_end;
+    memset(cache->start, 0, sizeof(cache->start));
+    memset(cache->transitions, 0, sizeof(cache->transitions));
+    cache->state_count = 0;
+    ++cache->generation;
+}
 
-    if (best_groups) {
-        if (status == RE_ERROR_SUCCESS && state->total_cost == 0)
-            /* We have a perfect match, so the previous best match. */
-            discard_groups(safe_state, best_groups);
-        else {
-            /* Restore the previous best match. */
-            status = RE_ERROR_SUCCESS;
+/* Deallocates the states of the lazy DFA. */
+Py_LOCAL_INLINE(void) dealloc_dfa_cache(RE_DFACache* cache) {
+    if (!cache)
+        return;
 
-            state->match_pos = best_match_pos;
-            state->text_pos = best_text_pos;
+    discard_dfa_states(cache);
+    re_dealloc(cache);
+}
 
-            restore_groups(safe_state, best_groups);
-            restore_fuzzy_counts(state, best_fuzzy_counts);
-        }
+/* Deallocates a program of the lazy DFA. */
+Py_LOCAL_INLINE(void) dealloc_dfa_program(RE_DFAProgram* program) {
+    if (!program)
+        return;
+
+    re_dealloc(program->instrs);
+    re_dealloc(program);
+}
+
+/* Starts a new visit of the instructions of the lazy DFA's program. */
+Py_LOCAL_INLINE(void) next_dfa_mark(RE_DFACache* cache) {
+    ++cache->mark;
+    if (cache->mark == 0) {
+        memset(cache->marks, 0, (size_t)cache->program->count *
+          sizeof(RE_UINT32));
+        cache->mark = 1;
     }
+}
 
-    if (status == RE_ERROR_SUCCESS || status == RE_ERROR_PARTIAL) {
-        Py_ssize_t max_end_index;
-        RE_GroupInfo* group_info;
-        size_t g;
+/* Follows the instructions of the lazy DFA's program which don't consume a
+ * character, starting from those in the kernel and in order of priority. The
+ * instructions which test a character are put in 'threads'. The assertions
+ * are looked up in the context.
+ *
+ * When looking for the first match, the threads of lower priority than a
+ * match can't produce a better match, so they're dropped.
+ *
+ * Returns the number of threads.
+ */
+Py_LOCAL_INLINE(Py_ssize_t) dfa_closure(RE_DFACache* cache, Py_ssize_t
+  kernel_count, RE_UINT32 context, BOOL* is_match, BOOL* positional) {
+    RE_DFAInstr* instrs;
+    Py_ssize_t count;
+    Py_ssize_t stack_count;
+    Py_ssize_t i;
 
-        /* Store the results. */
-        state->lastindex = -1;
-        state->lastgroup = -1;
-        max_end_index = -1;
+    instrs = cache->program->instrs;
+    count = 0;
+    stack_count = 0;
+    *is_match = FALSE;
+    *positional = FALSE;
 
-        if (status == RE_ERROR_PARTIAL) {
-            /* We've matched up to the limit of the slice. */
-            if (state->reverse)
-                state->text_pos = state->slice_start;
-            else
-                state->text_pos = state->slice_end;
-        }
+    next_dfa_mark(cache);
 
-        /* Store the capture groups. */
-        group_info = pattern->group_info;
+    for (i = kernel_count; i > 0; i--)
+        cache->stack[stack_count++] = cache->kernel[i - 1];
 
-        for (g = 0; g < pattern->public_group_count; g++) {
-            RE_GroupSpan* span;
+    while (stack_count > 0) {
+        Py_ssize_t index;
+        RE_DFAInstr* instr;
 
-            span = &state->groups[g].span;
-            /* The string positions are of type Py_ssize_t, so the format needs
-             * to specify that.
-             */
-            TRACE(("group %d from %" PY_FORMAT_SIZE_T "d to %" PY_FORMAT_SIZE_T
-              "d\n", g + 1, span->start, span->end))
+        index = cache->stack[--stack_count];
+        if (cache->marks[index] == cache->mark)
+            continue;
 
-            if (span->start >= 0 && span->end >= 0 && group_info[g].end_index >
-              max_end_index) {
-                max_end_index = group_info[g].end_index;
-                state->lastindex = (Py_ssize_t)g + 1;
-                if (group_info[g].has_name)
-                    state->lastgroup = (Py_ssize_t)g + 1;
-            }
+        cache->marks[index] = cache->mark;
+        instr = &instrs[index];
+
+        switch (instr->kind) {
+        case RE_DFA_TEST:
+            cache->threads[count++] = index;
+            break;
+        case RE_DFA_ASSERT:
+            /* The result depends on where we are in the text. */
+            *positional = TRUE;
+            if (context & instr->context_bit)
+                cache->stack[stack_count++] = instr->next_1;
+            break;
+        case RE_DFA_SPLIT:
+            cache->stack[stack_count++] = instr->next_2;
+            cache->stack[stack_count++] = instr->next_1;
+            break;
+        case RE_DFA_MATCH:
+            *is_match = TRUE;
+            if (cache->forward)
+                return count;
+            break;
         }
     }
 
-    /* Re-acquire the GIL. */
-    acquire_GIL(safe_state);
-
-    if (status < 0 && status != RE_ERROR_PARTIAL && !PyErr_Occurred())
-        set_error(status, NULL);
-
-    return status;
+    return count;
 }
 
-/* Gets a string from a Python object.
- *
- * If the function returns true and str_info->should_release is true then it's
- * the responsibility of the caller to release the buffer when it's no longer
- * needed.
+/* Gets the state of the lazy DFA which has the threads in the kernel, creating
+ * it if necessary.
  */
-Py_LOCAL_INLINE(BOOL) get_string(PyObject* string, RE_StringInfo* str_info) {
-    /* Given a Python object, return a data pointer, a length (in characters),
-     * and a character size. Return FALSE if the object is not a string (or not
-     * compatible).
-     */
-    PyBufferProcs* buffer;
-    Py_ssize_t bytes;
-    Py_ssize_t size;
-
-    /* Unicode objects do not support the buffer API. So, get the data directly
-     * instead.
-     */
-    if (PyUnicode_Check(string)) {
-        /* Unicode strings doesn't always support the buffer interface. */
-#if PY_VERSION_HEX >= 0x03030000
-        if (PyUnicode_READY(string) == -1)
-            return FALSE;
+Py_LOCAL_INLINE(RE_DFAState*) get_dfa_state(RE_SafeState* safe_state,
+  RE_DFACache* cache, Py_ssize_t count, RE_UINT8 char_class, BOOL matched) {
+    size_t hash;
+    Py_ssize_t i;
+    RE_DFAState** bucket;
+    RE_DFAState* dfa_state;
 
-        str_info->characters = (void*)PyUnicode_DATA(string);
-        str_info->length = PyUnicode_GET_LENGTH(string);
-        str_info->charsize = PyUnicode_KIND(string);
-#else
-        str_info->characters = (void*)PyUnicode_AS_DATA(string);
-        str_info->length = PyUnicode_GET_SIZE(string);
-        str_info->charsize = sizeof(Py_UNICODE);
-#endif
-        str_info->is_unicode = TRUE;
-        str_info->should_release = FALSE;
-        return TRUE;
-    }
+    hash = (size_t)char_class * 2 + (size_t)matched;
+    for (i = 0; i < count; i++)
+        hash = hash * 31 + (size_t)cache->kernel[i];
 
-    /* Get pointer to string buffer. */
-    buffer = Py_TYPE(string)->tp_as_buffer;
-    str_info->view.len = -1;
+    bucket = &cache->buckets[hash % RE_DFA_BUCKETS];
 
-    if (!buffer) {
-        PyErr_SetString(PyExc_TypeError, "expected string or buffer");
-        return FALSE;
+    for (dfa_state = *bucket; dfa_state; dfa_state = dfa_state->hash_next) {
+        if (dfa_state->hash == hash && dfa_state->count == count &&
+          dfa_state->char_class == char_class && dfa_state->matched == matched
+          && memcmp(dfa_state->threads, cache->kernel, (size_t)count *
+          sizeof(Py_ssize_t)) == 0)
+            return dfa_state;
     }
 
-    if (!buffer->bf_getbuffer || (*buffer->bf_getbuffer)(string,
-      &str_info->view, PyBUF_SIMPLE) < 0) {
-        PyErr_SetString(PyExc_TypeError, "expected string or buffer");
-        return FALSE;
+    if (cache->state_count >= RE_DFA_MAX_STATES) {
+        /* There are too many states, so start again. */
+        acquire_GIL(safe_state);
+        discard_dfa_states(cache);
+        release_GIL(safe_state);
     }
 
-    str_info->should_release = TRUE;
+    dfa_state = (RE_DFAState*)safe_alloc(safe_state, sizeof(RE_DFAState) +
+      (size_t)count * sizeof(Py_ssize_t));
+    if (!dfa_state)
+        return NULL;
 
-    /* Determine buffer size. */
-    bytes = str_info->view.len;
-    str_info->characters = str_info->view.buf;
+    memset(dfa_state->next, 0, sizeof(dfa_state->next));
+    dfa_state->hash = hash;
+    dfa_state->count = count;
+    dfa_state->matched = matched;
+    dfa_state->is_start = cache->forward && count == 1 && cache->kernel[0] ==
+      cache->program->entry && !matched;
+    dfa_state->char_class = char_class;
+    Py_MEMCPY(dfa_state->threads, cache->kernel, (size_t)count *
+      sizeof(Py_ssize_t));
 
-    if (str_info->characters == NULL) {
-        PyBuffer_Release(&str_info->view);
-        PyErr_SetString(PyExc_ValueError, "buffer is NULL");
-        return FALSE;
-    }
+    dfa_state->hash_next = *bucket;
+    *bucket = dfa_state;
+    ++cache->state_count;
 
-    if (bytes < 0) {
-        PyBuffer_Release(&str_info->view);
-        PyErr_SetString(PyExc_TypeError, "buffer has negative size");
-        return FALSE;
-    }
+    return dfa_state;
+}
 
-    /* Determine character size. */
-    size = PyObject_Size(string);
+/* Gets the start state of the lazy DFA at a position. */
+Py_LOCAL_INLINE(RE_DFAState*) dfa_start_state(RE_SafeState* safe_state,
+  RE_DFACache* cache, Py_ssize_t text_pos) {
+    RE_State* state;
+    RE_DFAProgram* program;
+    RE_UINT8 char_class;
+    RE_DFAState* dfa_state;
 
-    if (PyBytes_Check(string) || bytes == size)
-        str_info->charsize = 1;
-    else {
-        PyBuffer_Release(&str_info->view);
-        PyErr_SetString(PyExc_TypeError, "buffer size mismatch");
-        return FALSE;
-    }
+    state = safe_state->re_state;
+    program = cache->program;
 
-    str_info->length = size;
-    str_info->is_unicode = FALSE;
+    /* The class of the character next to the start. */
+    if (cache->forward) {
+        if (text_pos <= 0)
+            char_class = RE_DFA_CLASS_NONE;
+        else
+            char_class = dfa_char_class(state, program,
+              state->char_at(state->text, text_pos - 1));
+    } else {
+        if (text_pos >= state->text_length)
+            char_class = RE_DFA_CLASS_NONE;
+        else
+            char_class = dfa_char_class(state, program,
+              state->char_at(state->text, text_pos));
 
-    return TRUE;
-}
+        if (text_pos >= state->slice_end)
+            char_class |= RE_DFA_CLASS_SLICE_END;
+    }
 
-/* Deallocates the groups storage. */
-Py_LOCAL_INLINE(void) dealloc_groups(RE_GroupData* groups, size_t group_count)
-  {
-    size_t g;
+    char_class &= program->classes;
 
-    if (!groups)
-        return;
+    if (cache->start[char_class])
+        return cache->start[char_class];
 
-    for (g = 0; g < group_count; g++)
-        re_dealloc(groups[g].captures);
+    cache->kernel[0] = program->entry;
+    dfa_state = get_dfa_state(safe_state, cache, 1, char_class, FALSE);
+    cache->start[char_class] = dfa_state;
 
-    re_dealloc(groups);
+    return dfa_state;
 }
 
-/* Initialises a state object. */
-Py_LOCAL_INLINE(BOOL) state_init_2(RE_State* state, PatternObject* pattern,
-  PyObject* string, RE_StringInfo* str_info, Py_ssize_t start, Py_ssize_t end,
-  BOOL overlapped, int concurrent, BOOL partial, BOOL use_lock, BOOL
-  visible_captures, BOOL match_all) {
-    int i;
-    Py_ssize_t final_pos;
+/* Gets the state of the lazy DFA after a character. The state is at
+ * 'text_pos' and the character is at 'test_pos'.
+ */
+Py_LOCAL_INLINE(RE_DFAState*) dfa_next_state(RE_SafeState* safe_state,
+  RE_DFACache* cache, RE_DFAState* dfa_state, Py_UCS4 ch, Py_ssize_t test_pos,
+  Py_ssize_t text_pos) {
+    RE_State* state;
+    RE_DFAProgram* program;
+    RE_UINT32 context;
+    RE_DFATransition* transition;
+    Py_ssize_t count;
+    Py_ssize_t kernel_count;
+    Py_ssize_t i;
+    BOOL is_match;
+    BOOL positional;
+    RE_UINT8 char_class;
+    RE_UINT8 right_class;
+    size_t generation;
+    RE_DFAState* next;
 
-    state->groups = NULL;
-    state->best_match_groups = NULL;
-    state->repeats = NULL;
-    state->visible_captures = visible_captures;
-    state->match_all = match_all;
-    state->backtrack_block.previous = NULL;
-    state->backtrack_block.next = NULL;
-    state->backtrack_block.capacity = RE_BACKTRACK_BLOCK_SIZE;
-    state->backtrack_allocated = RE_BACKTRACK_BLOCK_SIZE;
-    state->current_atomic_block = NULL;
-    state->first_saved_groups = NULL;
-    state->current_saved_groups = NULL;
-    state->first_saved_repeats = NULL;
-    state->current_saved_repeats = NULL;
-    state->lock = NULL;
-    state->fuzzy_guards = NULL;
-    state->first_group_call_frame = NULL;
-    state->current_group_call_frame = NULL;
-    state->group_call_guard_list = NULL;
-    state->req_pos = -1;
+    state = safe_state->re_state;
+    program = cache->program;
 
-    /* The call guards used by recursive patterns. */
-    if (pattern->call_ref_info_count > 0) {
-        state->group_call_guard_list =
-          (RE_GuardList*)re_alloc(pattern->call_ref_info_count *
-          sizeof(RE_GuardList));
-        if (!state->group_call_guard_list)
-            goto error;
-        memset(state->group_call_guard_list, 0, pattern->call_ref_info_count *
-          sizeof(RE_GuardList));
-    }
+    context = dfa_context(state, program, text_pos);
+    transition = dfa_transition(cache, dfa_state, ch, context);
+    if (transition->to && transition->from == dfa_state && transition->ch ==
+      ch && transition->context == context)
+        return transition->to;
 
-    /* The capture groups. */
-    if (pattern->true_group_count) {
-        size_t g;
+    Py_MEMCPY(cache->kernel, dfa_state->threads, (size_t)dfa_state->count *
+      sizeof(Py_ssize_t));
+    count = dfa_closure(cache, dfa_state->count, context, &is_match,
+      &positional);
 
-        if (pattern->groups_storage) {
-            state->groups = pattern->groups_storage;
-            pattern->groups_storage = NULL;
-        } else {
-            state->groups = (RE_GroupData*)re_alloc(pattern->true_group_count *
-              sizeof(RE_GroupData));
-            if (!state->groups)
-                goto error;
-            memset(state->groups, 0, pattern->true_group_count *
-              sizeof(RE_GroupData));
+    /* The threads which match the character become the kernel of the next
+     * state.
+     */
+    next_dfa_mark(cache);
+    kernel_count = 0;
+    for (i = 0; i < count; i++) {
+        RE_DFAInstr* instr;
 
-            for (g = 0; g < pattern->true_group_count; g++) {
-                RE_GroupSpan* captures;
+        instr = &program->instrs[cache->threads[i]];
+        if (cache->marks[instr->next_1] != cache->mark &&
+          match_one(state, instr->node, test_pos) == RE_ERROR_SUCCESS) {
+            cache->marks[instr->next_1] = cache->mark;
+            cache->kernel[kernel_count++] = instr->next_1;
+        }
+    }
 
-                captures = (RE_GroupSpan*)re_alloc(sizeof(RE_GroupSpan));
-                if (!captures) {
-                    size_t i;
+    char_class = dfa_char_class(state, program, ch);
 
-                    for (i = 0; i < g; i++)
-                        re_dealloc(state->groups[i].captures);
+    generation = cache->generation;
+    next = get_dfa_state(safe_state, cache, kernel_count, char_class,
+      is_match);
 
-                    goto error;
-                }
+    /* The transition can be cached if the current state still exists. It's
+     * cached in the state if it depends only on a Latin-1 character and the
+     * classes of the characters on either side of the position, else in the
+     * table.
+     */
+    if (next && cache->generation == generation) {
+        right_class = cache->forward ? char_class : dfa_state->char_class;
 
-                state->groups[g].captures = captures;
-                state->groups[g].capture_capacity = 1;
-            }
+        if (ch < 256 && (!positional || (program->local &&
+          !(program->at_final_line_sep && (right_class &
+          RE_DFA_CLASS_LINE_SEP)))))
+            dfa_state->next[ch] = next;
+        else {
+            transition->from = dfa_state;
+            transition->to = next;
+            transition->ch = ch;
+            transition->context = context;
         }
     }
 
-    /* Adjust boundaries. */
-    if (start < 0)
-        start += str_info->length;
-    if (start < 0)
-        start = 0;
-    else if (start > str_info->length)
-        start = str_info->length;
-
-    if (end < 0)
-        end += str_info->length;
-    if (end < 0)
-        end = 0;
-    else if (end > str_info->length)
-        end = str_info->length;
+    return next;
+}
 
-    state->overlapped = overlapped;
-    state->min_width = pattern->min_width;
+/* Checks whether a match finishes at the position of a state of the lazy DFA
+ * where there are no more characters to test.
+ */
+Py_LOCAL_INLINE(BOOL) dfa_final_match(RE_State* state, RE_DFACache* cache,
+  RE_DFAState* dfa_state, Py_ssize_t text_pos) {
+    RE_UINT32 context;
+    BOOL is_match;
+    BOOL positional;
 
-    /* Initialise the getters and setters for the character size. */
-    state->charsize = str_info->charsize;
-    state->is_unicode = str_info->is_unicode;
+    context = dfa_context(state, cache->program, text_pos);
+    Py_MEMCPY(cache->kernel, dfa_state->threads, (size_t)dfa_state->count *
+      sizeof(Py_ssize_t));
+    dfa_closure(cache, dfa_state->count, context, &is_match, &positional);
 
-    /* Are we using a buffer object? If so, we need to copy the info. */
-    state->should_release = str_info->should_release;
-    if (state->should_release)
-        state->view = str_info->view;
+    return is_match;
+}
 
-    switch (state->charsize) {
-    case 1:
-        state->char_at = bytes1_char_at;
-        state->set_char_at = bytes1_set_char_at;
-        state->point_to = bytes1_point_to;
-        break;
-    case 2:
-        state->char_at = bytes2_char_at;
-        state->set_char_at = bytes2_set_char_at;
-        state->point_to = bytes2_point_to;
-        break;
-    case 4:
-        state->char_at = bytes4_char_at;
-        state->set_char_at = bytes4_set_char_at;
-        state->point_to = bytes4_point_to;
-        break;
-    default:
-        goto error;
+/* Finds where the lazy DFA could next start a match, which is where the test
+ * at the start of the pattern matches, or the limit if there's no such place.
+ * If the test isn't a simple one, it's the position itself.
+ */
+Py_LOCAL_INLINE(Py_ssize_t) dfa_skip_to_start(RE_State* state, RE_Node* test,
+  Py_ssize_t text_pos, Py_ssize_t limit) {
+    switch (test->op) {
+    case RE_OP_CHARACTER:
+        return match_many_CHARACTER(state, test, text_pos, limit, FALSE);
+    case RE_OP_CHARACTER_IGN:
+        return match_many_CHARACTER_IGN(state, test, text_pos, limit, FALSE);
+    case RE_OP_PROPERTY:
+        return match_many_PROPERTY(state, test, text_pos, limit, FALSE);
+    case RE_OP_PROPERTY_IGN:
+        return match_many_PROPERTY_IGN(state, test, text_pos, limit, FALSE);
+    case RE_OP_RANGE:
+        return match_many_RANGE(state, test, text_pos, limit, FALSE);
+    case RE_OP_RANGE_IGN:
+        return match_many_RANGE_IGN(state, test, text_pos, limit, FALSE);
+    case RE_OP_SET_DIFF:
+    case RE_OP_SET_INTER:
+    case RE_OP_SET_SYM_DIFF:
+    case RE_OP_SET_UNION:
+        return match_many_SET(state, test, text_pos, limit, FALSE);
+    case RE_OP_SET_DIFF_IGN:
+    case RE_OP_SET_INTER_IGN:
+    case RE_OP_SET_SYM_DIFF_IGN:
+    case RE_OP_SET_UNION_IGN:
+        return match_many_SET_IGN(state, test, text_pos, limit, FALSE);
     }
 
-    state->encoding = pattern->encoding;
-    state->locale_info = pattern->locale_info;
+    return text_pos;
+}
 
-    /* The state object contains a reference to the string and also a pointer
-     * to its contents.
-     *
-     * The documentation says that the end of the slice behaves like the end of
-     * the string.
-     */
-    state->text = str_info->characters;
-    state->text_length = end;
+/* Scans forwards with the lazy DFA for the end of the first match which starts
+ * at or after a position.
+ */
+Py_LOCAL_INLINE(int) dfa_scan_forwards(RE_SafeState* safe_state, Py_ssize_t
+  text_pos, Py_ssize_t* match_end) {
+    RE_State* state;
+    RE_DFACache* cache;
+    RE_DFAState* dfa_state;
+    Py_UCS4 (*char_at)(void* text, Py_ssize_t pos);
+    Py_ssize_t slice_end;
+    Py_ssize_t end_pos;
+    RE_Node* test;
+    Py_ssize_t skip_credit;
 
-    state->reverse = (pattern->flags & RE_FLAG_REVERSE) != 0;
-    if (partial)
-        state->partial_side = state->reverse ? RE_PARTIAL_LEFT :
-          RE_PARTIAL_RIGHT;
-    else
-        state->partial_side = RE_PARTIAL_NONE;
+    state = safe_state->re_state;
+    test = state->pattern->start_test;
+    skip_credit = RE_DFA_SKIP_CREDIT;
 
-    state->slice_start = start;
-    state->slice_end = state->text_length;
-    state->text_pos = state->reverse ? state->slice_end : state->slice_start;
+    cache = get_dfa_cache(safe_state, 0);
+    if (!cache)
+        return RE_ERROR_MEMORY;
 
-    /* Point to the final newline and line separator if it's at the end of the
-     * string, otherwise just -1.
-     */
-    state->final_newline = -1;
-    state->final_line_sep = -1;
-    final_pos = state->text_length - 1;
-    if (final_pos >= 0) {
+    dfa_state = dfa_start_state(safe_state, cache, text_pos);
+    if (!dfa_state)
+        return RE_ERROR_MEMORY;
+
+    char_at = state->char_at;
+    slice_end = state->slice_end;
+    end_pos = -1;
+
+    while (dfa_state->count > 0 && text_pos < slice_end) {
         Py_UCS4 ch;
+        RE_DFAState* next;
 
-        ch = state->char_at(state->text, final_pos);
-        if (ch == 0x0A) {
-            /* The string ends with LF. */
-            state->final_newline = final_pos;
-            state->final_line_sep = final_pos;
+        /* Should we abort the matching? */
+        if (--state->iterations == 0) {
+            int status;
 
-            /* Does the string end with CR/LF? */
-            --final_pos;
-            if (final_pos >= 0 && state->char_at(state->text, final_pos) ==
-              0x0D)
-                state->final_line_sep = final_pos;
-        } else {
-            /* The string doesn't end with LF, but it could be another kind of
-             * line separator.
-             */
-            if (state->encoding->is_line_sep(ch))
-                state->final_line_sep = final_pos;
+            status = safe_check_limits(safe_state);
+            if (status < 0) {
+                state->text_pos = text_pos;
+                return status;
+            }
         }
-    }
 
-    /* If the 'new' behaviour is enabled then split correctly on zero-width
-     * matches.
-     */
-    state->version_0 = (pattern->flags & RE_FLAG_VERSION1) == 0;
-    state->must_advance = FALSE;
+        ch = char_at(state->text, text_pos);
+        next = ch < 256 ? dfa_state->next[ch] : NULL;
+        if (!next) {
+            /* If no match is in progress, skip to where one could start. The
+             * transitions on the characters which are skipped aren't built,
+             * so it'll skip them again the next time.
+             */
+            if (dfa_state->is_start && skip_credit > 0) {
+                Py_ssize_t found_pos;
+
+                found_pos = dfa_skip_to_start(state, test, text_pos,
+                  slice_end);
+                if (found_pos > text_pos) {
+                    skip_credit += found_pos - text_pos - RE_DFA_SKIP_COST;
+                    text_pos = found_pos;
+                    dfa_state = dfa_start_state(safe_state, cache, text_pos);
+                    if (!dfa_state)
+                        return RE_ERROR_MEMORY;
 
-    state->pattern = pattern;
-    state->string = string;
+                    continue;
+                }
+            }
 
-    if (pattern->repeat_count) {
-        if (pattern->repeats_storage) {
-            state->repeats = pattern->repeats_storage;
-            pattern->repeats_storage = NULL;
-        } else {
-            state->repeats = (RE_RepeatData*)re_alloc(pattern->repeat_count *
-              sizeof(RE_RepeatData));
-            if (!state->repeats)
-                goto error;
-            memset(state->repeats, 0, pattern->repeat_count *
-              sizeof(RE_RepeatData));
+            next = dfa_next_state(safe_state, cache, dfa_state, ch, text_pos,
+              text_pos);
+            if (!next)
+                return RE_ERROR_MEMORY;
         }
-    }
 
-    if (pattern->fuzzy_count) {
-        state->fuzzy_guards = (RE_FuzzyGuards*)re_alloc(pattern->fuzzy_count *
-          sizeof(RE_FuzzyGuards));
-        if (!state->fuzzy_guards)
-            goto error;
-        memset(state->fuzzy_guards, 0, pattern->fuzzy_count *
-          sizeof(RE_FuzzyGuards));
-    }
+        dfa_state = next;
 
-    Py_INCREF(state->pattern);
-    Py_INCREF(state->string);
+        if (dfa_state->matched)
+            end_pos = text_pos;
 
-    /* Multithreading is allowed during matching when explicitly enabled or on
-     * immutable strings.
-     */
-    switch (concurrent) {
-    case RE_CONC_NO:
-        state->is_multithreaded = FALSE;
-        break;
-    case RE_CONC_YES:
-        state->is_multithreaded = TRUE;
-        break;
-    default:
-        state->is_multithreaded = PyUnicode_Check(string) ||
-          PyBytes_Check(string);
-        break;
+        ++text_pos;
     }
 
-    /* A state struct can sometimes be shared across threads. In such
-     * instances, if multithreading is enabled we need to protect the state
-     * with a lock (mutex) during matching.
-     */
-    if (state->is_multithreaded && use_lock)
-        state->lock = PyThread_allocate_lock();
+    if (dfa_state->count > 0 && dfa_final_match(state, cache, dfa_state,
+      text_pos))
+        end_pos = text_pos;
 
-    for (i = 0; i < MAX_SEARCH_POSITIONS; i++)
-        state->search_positions[i].start_pos = -1;
+    if (end_pos < 0)
+        return RE_ERROR_FAILURE;
 
-    return TRUE;
+    *match_end = end_pos;
 
-error:
-    re_dealloc(state->group_call_guard_list);
-    re_dealloc(state->repeats);
-    dealloc_groups(state->groups, pattern->true_group_count);
-    re_dealloc(state->fuzzy_guards);
-    state->repeats = NULL;
-    state->groups = NULL;
-    state->fuzzy_guards = NULL;
-    return FALSE;
+    return RE_ERROR_SUCCESS;
 }
 
-/* Checks that the string has the same charsize as the pattern. */
-Py_LOCAL_INLINE(BOOL) check_compatible(PatternObject* pattern, BOOL unicode) {
-    if (PyBytes_Check(pattern->pattern)) {
-        if (unicode) {
-            PyErr_SetString(PyExc_TypeError,
-              "cannot use a bytes pattern on a string-like object");
-            return FALSE;
-        }
-    } else {
-        if (!unicode) {
-            PyErr_SetString(PyExc_TypeError,
-              "cannot use a string pattern on a bytes-like object");
-            return FALSE;
-        }
-    }
+/* Scans backwards with the lazy DFA from the end of a match for its start,
+ * which is the furthest back that the pattern matches, but no further back
+ * than a limit.
+ */
+Py_LOCAL_INLINE(int) dfa_scan_backwards(RE_SafeState* safe_state, Py_ssize_t
+  text_pos, Py_ssize_t limit, Py_ssize_t* match_start) {
+    RE_State* state;
+    RE_DFACache* cache;
+    RE_DFAState* dfa_state;
+    Py_UCS4 (*char_at)(void* text, Py_ssize_t pos);
+    Py_ssize_t start_pos;
 
-    return TRUE;
-}
+    state = safe_state->re_state;
 
-/* Releases the string's buffer, if necessary. */
-Py_LOCAL_INLINE(void) release_buffer(RE_StringInfo* str_info) {
-    if (str_info->should_release)
-        PyBuffer_Release(&str_info->view);
-}
+    cache = get_dfa_cache(safe_state, 1);
+    if (!cache)
+        return RE_ERROR_MEMORY;
 
-/* Initialises a state object. */
-Py_LOCAL_INLINE(BOOL) state_init(RE_State* state, PatternObject* pattern,
-  PyObject* string, Py_ssize_t start, Py_ssize_t end, BOOL overlapped, int
-  concurrent, BOOL partial, BOOL use_lock, BOOL visible_captures, BOOL
-  match_all) {
-    RE_StringInfo str_info;
+    dfa_state = dfa_start_state(safe_state, cache, text_pos);
+    if (!dfa_state)
+        return RE_ERROR_MEMORY;
 
-    /* Get the string to search or match. */
-    if (!get_string(string, &str_info))
-        return FALSE;
+    char_at = state->char_at;
+    start_pos = -1;
 
-    /* If we fail to initialise the state then we need to release the buffer if
-     * the string is a buffer object.
-     */
-    if (!check_compatible(pattern, str_info.is_unicode)) {
-        release_buffer(&str_info);
-        return FALSE;
-    }
+    while (dfa_state->count > 0 && text_pos > limit) {
+        Py_UCS4 ch;
+        RE_DFAState* next;
 
-    if (!state_init_2(state, pattern, string, &str_info, start, end,
-      overlapped, concurrent, partial, use_lock, visible_captures, match_all))
-      {
-        release_buffer(&str_info);
+        /* Should we abort the matching? */
+        if (--state->iterations == 0) {
+            int status;
 
-        return FALSE;
-    }
+            status = safe_check_limits(safe_state);
+            if (status < 0) {
+                state->text_pos = text_pos;
+                return status;
+            }
+        }
 
-    /* The state has been initialised successfully, so now the state has the
-     * responsibility of releasing the buffer if the string is a buffer object.
-     */
-    return TRUE;
-}
+        ch = char_at(state->text, text_pos - 1);
+        next = ch < 256 ? dfa_state->next[ch] : NULL;
+        if (!next) {
+            next = dfa_next_state(safe_state, cache, dfa_state, ch, text_pos -
+              1, text_pos);
+            if (!next)
+                return RE_ERROR_MEMORY;
+        }
 
-/* Deallocates repeat data. */
-Py_LOCAL_INLINE(void) dealloc_repeats(RE_RepeatData* repeats, size_t
-  repeat_count) {
-    size_t i;
+        dfa_state = next;
 
-    if (!repeats)
-        return;
+        if (dfa_state->matched)
+            start_pos = text_pos;
 
-    for (i = 0; i < repeat_count; i++) {
-        re_dealloc(repeats[i].body_guard_list.spans);
-        re_dealloc(repeats[i].tail_guard_list.spans);
+        --text_pos;
     }
 
-    re_dealloc(repeats);
-}
-
-/* Deallocates fuzzy guards. */
-Py_LOCAL_INLINE(void) dealloc_fuzzy_guards(RE_FuzzyGuards* guards, size_t
-  fuzzy_count) {
-    size_t i;
+    if (dfa_state->count > 0 && dfa_final_match(state, cache, dfa_state,
+      text_pos))
+        start_pos = text_pos;
 
-    if (!guards)
-        return;
+    if (start_pos < 0)
+        return RE_ERROR_FAILURE;
 
-    for (i = 0; i < fuzzy_count; i++) {
-        re_dealloc(guards[i].body_guard_list.spans);
-        re_dealloc(guards[i].tail_guard_list.spans);
-    }
+    *match_start = start_pos;
 
-    re_dealloc(guards);
+    return RE_ERROR_SUCCESS;
 }
 
-/* Finalises a state object, discarding its contents. */
-Py_LOCAL_INLINE(void) state_fini(RE_State* state) {
-    RE_BacktrackBlock* current_backtrack;
-    RE_AtomicBlock* current_atomic;
+/* Searches with the lazy DFA, which takes time proportional to the length of
+ * the text. It finds the span of the first match, and then the backtracking
+ * engine, if it's needed for the capture groups, matches only there.
+ */
+Py_LOCAL_INLINE(int) dfa_search(RE_SafeState* safe_state) {
+    RE_State* state;
     PatternObject* pattern;
-    RE_SavedGroups* saved_groups;
-    RE_SavedRepeats* saved_repeats;
-    RE_GroupCallFrame* frame;
-    size_t i;
-
-    /* Discard the lock (mutex) if there's one. */
-    if (state->lock)
-        PyThread_free_lock(state->lock);
+    Py_ssize_t start_pos;
+    Py_ssize_t found_pos;
+    Py_ssize_t match_start;
+    Py_ssize_t match_end;
+    BOOL must_advance;
+    int status;
 
-    /* Deallocate the backtrack blocks. */
-    current_backtrack = state->backtrack_block.next;
-    while (current_backtrack) {
-        RE_BacktrackBlock* next;
+    state = safe_state->re_state;
+    pattern = state->pattern;
+    start_pos = state->text_pos;
+    must_advance = state->must_advance;
 
-        next = current_backtrack->next;
-        re_dealloc(current_backtrack);
-        state->backtrack_allocated -= RE_BACKTRACK_BLOCK_SIZE;
-        current_backtrack = next;
+    /* Skip to where a match could start. */
+    found_pos = start_pos;
+    if (pattern->req_string) {
+        found_pos = locate_required_string(safe_state, TRUE);
+        if (found_pos < 0)
+            return RE_ERROR_FAILURE;
     }
 
-    /* Deallocate the atomic blocks. */
-    current_atomic = state->current_atomic_block;
-    while (current_atomic) {
-        RE_AtomicBlock* next;
-
-        next = current_atomic->next;
-        re_dealloc(current_atomic);
-        current_atomic = next;
+    if (pattern->req_alts || pattern->req_following) {
+        found_pos = locate_other_required_strings(safe_state, found_pos);
+        if (found_pos < 0)
+            return RE_ERROR_FAILURE;
     }
 
-    state->current_atomic_block = NULL;
-
-    pattern = state->pattern;
+    status = dfa_scan_forwards(safe_state, found_pos, &match_end);
+    if (status != RE_ERROR_SUCCESS)
+        return status;
 
-    saved_groups = state->first_saved_groups;
-    while (saved_groups) {
-        RE_SavedGroups* next;
+    status = dfa_scan_backwards(safe_state, match_end, found_pos,
+      &match_start);
+    if (status < 0)
+        return status;
 
-        next = saved_groups->next;
-        re_dealloc(saved_groups->spans);
-        re_dealloc(saved_groups->counts);
-        re_dealloc(saved_groups);
-        saved_groups = next;
-    }
+    /* A match which doesn't advance past the start of the search isn't
+     * permitted, but the backtracking engine might find a longer one there.
+     */
+    if (status == RE_ERROR_SUCCESS && !(must_advance && match_end ==
+      start_pos)) {
+        if (pattern->true_group_count == 0) {
+            state->match_pos = match_start;
+            state->text_pos = match_end;
 
-    saved_repeats = state->first_saved_repeats;
-    while (saved_repeats) {
-        RE_SavedRepeats* next;
+            return RE_ERROR_SUCCESS;
+        }
 
-        next = saved_repeats->next;
+        /* Match at the start to get the capture groups. The match found by
+         * the DFA is permitted, even if it's zero-width.
+         */
+        state->text_pos = match_start;
+        init_match(state);
+        state->must_advance = FALSE;
 
-        dealloc_repeats(saved_repeats->repeats, pattern->repeat_count);
+        status = basic_match(safe_state, FALSE);
+        state->must_advance = must_advance;
+        if (status < 0)
+            return status;
 
-        re_dealloc(saved_repeats);
-        saved_repeats = next;
+        if (status == RE_ERROR_SUCCESS && state->match_pos == match_start &&
+          state->text_pos == match_end)
+            return status;
     }
 
-    if (state->best_match_groups)
-        dealloc_groups(state->best_match_groups, pattern->true_group_count);
-
-    if (pattern->groups_storage)
-        dealloc_groups(state->groups, pattern->true_group_count);
-    else
-        pattern->groups_storage = state->groups;
-
-    if (pattern->repeats_storage)
-        dealloc_repeats(state->repeats, pattern->repeat_count);
-    else
-        pattern->repeats_storage = state->repeats;
+    /* The DFA and the backtracking engine disagree, so search again with the
+     * backtracking engine.
+     */
+    state->text_pos = start_pos;
+    init_match(state);
 
-    frame = state->first_group_call_frame;
-    while (frame) {
-        RE_GroupCallFrame* next;
+    return basic_match(safe_state, TRUE);
+}
 
-        next = frame->next;
-
-        dealloc_groups(frame->groups, pattern->true_group_count);
-        dealloc_repeats(frame->repeats, pattern->repeat_count);
+/* Performs a match or search from the current text position.
+ *
+ * The state can sometimes be shared across threads. In such instances there's
+ * a lock (mutex) on it. The lock is held for the duration of matching.
+ */
+Py_LOCAL_INLINE(int) do_match(RE_SafeState* safe_state, BOOL search) {
+    RE_State* state;
+    PatternObject* pattern;
+    Py_ssize_t available;
+    BOOL get_best;
+    BOOL enhance_match;
+    size_t lower_cost;
+    size_t upper_cost;
+    RE_GroupData* best_groups;
+    Py_ssize_t best_match_pos;
+    BOOL must_advance;
+    BOOL use_dfa;
+    Py_ssize_t slice_start;
+    Py_ssize_t slice_end;
+    int status;
+    size_t best_fuzzy_counts[RE_FUZZY_COUNT];
+    Py_ssize_t best_text_pos = 0; /* Initialise to stop compiler warning. */
+    TRACE(("<<do_match>>\n"))
 
-        re_dealloc(frame);
-        frame = next;
-    }
+    state = safe_state->re_state;
+    pattern = state->pattern;
 
-    for (i = 0; i < pattern->call_ref_info_count; i++)
-        re_dealloc(state->group_call_guard_list[i].spans);
+    /* Release the GIL. */
+    release_GIL(safe_state);
 
-    if (state->group_call_guard_list)
-        re_dealloc(state->group_call_guard_list);
+    /* Is there enough to search? */
+    if (state->reverse) {
+        if (state->text_pos < state->slice_start) {
+            acquire_GIL(safe_state);
+            return FALSE;
+        }
 
-    if (state->fuzzy_guards)
-        dealloc_fuzzy_guards(state->fuzzy_guards, pattern->fuzzy_count);
+        available = state->text_pos - state->slice_start;
+    } else {
+        if (state->text_pos > state->slice_end) {
+            acquire_GIL(safe_state);
+            return FALSE;
+        }
 
-    Py_DECREF(state->pattern);
-    Py_DECREF(state->string);
+        available = state->slice_end - state->text_pos;
+    }
 
-    if (state->should_release)
-        PyBuffer_Release(&state->view);
-}
+    get_best = (pattern->flags & RE_FLAG_BESTMATCH) != 0;
+    enhance_match = (pattern->flags & RE_FLAG_ENHANCEMATCH) != 0 && !get_best;
 
-/* Converts a string index to an integer.
- *
- * If the index is None then the default will be returned.
- */
-Py_LOCAL_INLINE(Py_ssize_t) as_string_index(PyObject* obj, Py_ssize_t def) {
-    Py_ssize_t value;
+    /* The maximum permitted cost. */
+    state->max_cost = pattern->is_fuzzy ? PY_SSIZE_T_MAX : 0;
+    lower_cost = 0;
+    upper_cost = state->max_cost;
 
-    if (obj == Py_None)
-        return def;
+    best_groups = NULL;
 
-    value = PyLong_AsLong(obj);
-    if (value != -1 || !PyErr_Occurred())
-        return value;
+    best_match_pos = state->text_pos;
+    must_advance = state->must_advance;
 
-    set_error(RE_ERROR_INDEX, NULL);
-    return 0;
-}
+    /* Look for the best match in a single pass if possible, pruning any path
+     * that costs as much as the best match so far, instead of searching again
+     * after each match for a better one.
+     */
+    state->single_pass_best = get_best && pattern->single_pass_best &&
+      !must_advance && state->partial_side == RE_PARTIAL_NONE;
+    state->passes_avoided = 0;
 
-/* Deallocates a MatchObject. */
-static void match_dealloc(PyObject* self_) {
-    MatchObject* self;
+    slice_start = state->slice_start;
+    slice_end = state->slice_end;
 
-    self = (MatchObject*)self_;
+    /* The lazy DFA can search for an exact match, unless the pattern is
+     * anchored, in which case there's only one place to try.
+     */
+    use_dfa = search && pattern->dfa_programs[0] && !state->reverse &&
+      state->max_cost == 0 && state->partial_side == RE_PARTIAL_NONE &&
+      !state->match_all && pattern->start_test->op != RE_OP_START_OF_STRING;
 
-    Py_XDECREF(self->string);
-    Py_XDECREF(self->substring);
-    Py_DECREF(self->pattern);
-    if (self->groups)
-        re_dealloc(self->groups);
-    Py_XDECREF(self->regs);
-    PyObject_DEL(self);
-}
+    for (;;) {
+        /* If there's a better match, it won't start earlier in the string than
+         * the current best match, so there's no need to start earlier than
+         * that match.
+         */
+        state->text_pos = best_match_pos;
+        state->must_advance = must_advance;
 
-#if PY_VERSION_HEX >= 0x03040000
-/* Ensures that the string is the immutable Unicode string or bytestring.
- * DECREFs the original string if a copy is returned.
- */
-Py_LOCAL_INLINE(PyObject*) ensure_immutable(PyObject* string) {
-    PyObject* new_string;
+        /* Initialise the state. */
+        init_match(state);
 
-    if (PyUnicode_CheckExact(string) || PyBytes_CheckExact(string))
-        return string;
+        status = RE_ERROR_SUCCESS;
+        if (state->max_cost == 0 && state->partial_side == RE_PARTIAL_NONE) {
+            /* An exact match, and partial matches not permitted. */
+            if (available < state->min_width || (available == 0 &&
+              state->must_advance))
+                status = RE_ERROR_FAILURE;
+        }
 
-    if (PyUnicode_Check(string))
-        new_string = PyUnicode_FromObject(string);
-    else
-        new_string = PyBytes_FromObject(string);
+        if (status == RE_ERROR_SUCCESS) {
+            if (use_dfa)
+                status = dfa_search(safe_state);
+            else
+                status = basic_match(safe_state, search);
+        }
 
-    Py_DECREF(string);
+        if (state->single_pass_best) {
+            if (state->found_fuzzy_match && status == RE_ERROR_FAILURE) {
+                /* Restore the best match. */
+                status = RE_ERROR_SUCCESS;
 
-    return new_string;
-}
+                state->match_pos = state->best_fuzzy_match_pos;
+                state->text_pos = state->best_fuzzy_text_pos;
 
-#endif
-/* Restricts a value to a range. */
-Py_LOCAL_INLINE(Py_ssize_t) limited_range(Py_ssize_t value, Py_ssize_t lower,
-  Py_ssize_t upper) {
-    if (value < lower)
-        return lower;
+                restore_groups(safe_state, state->best_fuzzy_groups);
+                restore_fuzzy_counts(state, state->best_fuzzy_counts);
+            } else if (state->best_fuzzy_groups)
+                discard_groups(safe_state, state->best_fuzzy_groups);
 
-    if (value > upper)
-        return upper;
+            state->best_fuzzy_groups = NULL;
+            break;
+        }
 
-    return value;
-}
+        /* Has an error occurred, or is it a partial match? */
+        if (status < 0)
+            break;
 
-/* Gets a slice from a Unicode string. */
-Py_LOCAL_INLINE(PyObject*) unicode_slice(PyObject* string, Py_ssize_t start,
-  Py_ssize_t end) {
-    Py_ssize_t length;
-#if PY_VERSION_HEX < 0x03030000
-    Py_UNICODE* buffer;
-#endif
+        if (status == RE_ERROR_SUCCESS)
+            upper_cost = state->total_cost;
+        else if (enhance_match)
+            lower_cost = state->max_cost + 1;
+        else
+            break;
 
-    length = PyUnicode_GET_SIZE(string);
-    start = limited_range(start, 0, length);
-    end = limited_range(end, 0, length);
+        if (lower_cost >= upper_cost)
+            break;
 
-#if PY_VERSION_HEX >= 0x03030000
-    return PyUnicode_Substring(string, start, end);
-#else
-    buffer = PyUnicode_AsUnicode(string);
+        if (!get_best && !enhance_match)
+            break;
 
-    return PyUnicode_FromUnicode(buffer + start, end - start);
-#endif
-}
+        if (status == RE_ERROR_SUCCESS) {
+            save_fuzzy_counts(state, best_fuzzy_counts);
 
-/* Gets a slice from a bytestring. */
-Py_LOCAL_INLINE(PyObject*) bytes_slice(PyObject* string, Py_ssize_t start,
-  Py_ssize_t end) {
-    Py_ssize_t length;
-    char* buffer;
+            if (!get_best && state->text_pos == state->match_pos)
+                /* We want the first match. The match is already zero-width, so
+                 * the cost can't get any lower (because the fit can't get any
+                 * better).
+                 */
+                break;
 
-    length = PyBytes_GET_SIZE(string);
-    start = limited_range(start, 0, length);
-    end = limited_range(end, 0, length);
+            if (best_groups) {
+                BOOL same;
+                size_t g;
 
-    buffer = PyBytes_AsString(string);
+                /* Did we get the same match as the best so far? */
+                same = state->match_pos == best_match_pos && state->text_pos ==
+                  best_text_pos;
+                for (g = 0; same && g < pattern->public_group_count; g++) {
+                    same = state->groups[g].span.start ==
+                      best_groups[g].span.start && state->groups[g].span.end ==
+                      best_groups[g].span.end;
+                }
 
-    return PyBytes_FromStringAndSize(buffer + start, end - start);
-}
+                if (same && !enhance_match)
+                    break;
+            }
 
-/* Gets a slice from a string, returning either a Unicode string or a
- * bytestring.
- */
-Py_LOCAL_INLINE(PyObject*) get_slice(PyObject* string, Py_ssize_t start,
-  Py_ssize_t end) {
-    if (PyUnicode_Check(string))
-        return unicode_slice(string, start, end);
+            /* Save the best result so far. */
+            best_groups = save_groups(safe_state, best_groups);
+            if (!best_groups) {
+                status = RE_ERROR_MEMORY;
+                break;
+            }
 
-    if (PyBytes_Check(string))
-        return bytes_slice(string, start, end);
+            best_match_pos = state->match_pos;
+            best_text_pos = state->text_pos;
 
-#if PY_VERSION_HEX >= 0x03040000
-    return ensure_immutable(PySequence_GetSlice(string, start, end));
-#else
-    return PySequence_GetSlice(string, start, end);
-#endif
-}
+            if (state->max_cost == 0)
+                break;
 
-/* Gets a MatchObject's group by integer index. */
-static PyObject* match_get_group_by_index(MatchObject* self, Py_ssize_t index,
-  PyObject* def) {
-    RE_GroupSpan* span;
+            if (enhance_match) {
+                if (state->reverse) {
+                    state->slice_start = state->text_pos;
+                    state->slice_end = state->match_pos;
+                } else {
+                    state->slice_start = state->match_pos;
+                    state->slice_end = state->text_pos;
+                }
+            }
+        }
 
-    if (index < 0 || (size_t)index > self->group_count) {
-        /* Raise error if we were given a bad group number. */
-        set_error(RE_ERROR_NO_SUCH_GROUP, NULL);
-        return NULL;
+        /* Reduce the maximum permitted cost and try again. */
+        if (enhance_match)
+            state->max_cost = (lower_cost + upper_cost) / 2;
+        else
+            state->max_cost = state->total_cost - 1;
     }
 
-    if (index == 0)
-        return get_slice(self->substring, self->match_start -
-          self->substring_offset, self->match_end - self->substring_offset);
+    state->slice_start = slice_start;
+    state->slice_end = slice_end;
 
-    /* Capture group indexes are 1-based (excluding group 0, which is the
-     * entire matched string).
-     */
-    span = &self->groups[index - 1].span;
-
-    if (span->start < 0 || span->end < 0) {
-        /* Return default value if the string or group is undefined. */
-        Py_INCREF(def);
-        return def;
-    }
-
-    return get_slice(self->substring, span->start - self->substring_offset,
-      span->end - self->substring_offset);
-}
+    if (best_groups) {
+        if (status == RE_ERROR_SUCCESS && state->total_cost == 0)
+            /* We have a perfect match, so the previous best match. */
+            discard_groups(safe_state, best_groups);
+        else {
+            /* Restore the previous best match. */
+            status = RE_ERROR_SUCCESS;
 
-/* Gets a MatchObject's start by integer index. */
-static PyObject* match_get_start_by_index(MatchObject* self, Py_ssize_t index)
-  {
-    RE_GroupSpan* span;
+            state->match_pos = best_match_pos;
+            state->text_pos = best_text_pos;
 
-    if (index < 0 || (size_t)index > self->group_count) {
-        /* Raise error if we were given a bad group number. */
-        set_error(RE_ERROR_NO_SUCH_GROUP, NULL);
-        return NULL;
+            restore_groups(safe_state, best_groups);
+            restore_fuzzy_counts(state, best_fuzzy_counts);
+        }
     }
 
-    if (index == 0)
-        return Py_BuildValue("n", self->match_start);
+    if (status == RE_ERROR_SUCCESS || status == RE_ERROR_PARTIAL) {
+        Py_ssize_t max_end_index;
+        RE_GroupInfo* group_info;
+        size_t g;
 
-    /* Capture group indexes are 1-based (excluding group 0, which is the
-     * entire matched string).
-     */
-    span = &self->groups[index - 1].span;
-    return Py_BuildValue("n", span->start);
-}
+        /* Store the results. */
+        state->lastindex = -1;
+        state->lastgroup = -1;
+        max_end_index = -1;
 
-/* Gets a MatchObject's starts by integer index. */
-static PyObject* match_get_starts_by_index(MatchObject* self, Py_ssize_t index)
-  {
-    RE_GroupData* group;
-    PyObject* result;
-    PyObject* item;
-    size_t i;
+        if (status == RE_ERROR_PARTIAL) {
+            /* We've matched up to the limit of the slice. */
+            if (state->reverse)
+                state->text_pos = state->slice_start;
+            else
+                state->text_pos = state->slice_end;
 
-    if (index < 0 || (size_t)index > self->group_count) {
-        /* Raise error if we were given a bad group number. */
-        set_error(RE_ERROR_NO_SUCH_GROUP, NULL);
-        return NULL;
-    }
+            /* A group which the match was still in when it reached the limit
+             * ends there.
+             */
+            for (g = 0; g < pattern->true_group_count; g++) {
+                RE_GroupSpan* span;
 
-    if (index == 0) {
-        result = PyList_New(1);
-        if (!result)
-            return NULL;
+                span = &state->groups[g].span;
+                if (state->reverse) {
+                    if (span->end >= 0 && span->start < 0)
+                        span->start = state->text_pos;
+                } else {
+                    if (span->start >= 0 && span->end < 0)
+                        span->end = state->text_pos;
+                }
+            }
+        }
 
-        item = Py_BuildValue("n", self->match_start);
-        if (!item)
-            goto error;
+        /* Store the capture groups. */
+        group_info = pattern->group_info;
 
-        /* PyList_SET_ITEM borrows the reference. */
-        PyList_SET_ITEM(result, 0, item);
+        for (g = 0; g < pattern->public_group_count; g++) {
+            RE_GroupSpan* span;
 
-        return result;
-    }
+            span = &state->groups[g].span;
+            /* The string positions are of type Py_ssize_t, so the format needs
+             * to specify that.
+             */
+            TRACE(("group %d from %" PY_FORMAT_SIZE_T "d to %" PY_FORMAT_SIZE_T
+              "d\n", g + 1, span->start, span->end))
 
-    /* Capture group indexes are 1-based (excluding group 0, which is the
-     * entire matched string).
-     */
-    group = &self->groups[index - 1];
+            if (span->start >= 0 && span->end >= 0 && group_info[g].end_index >
+              max_end_index) {
+                max_end_index = group_info[g].end_index;
+                state->lastindex = (Py_ssize_t)g + 1;
+                if (group_info[g].has_name)
+                    state->lastgroup = (Py_ssize_t)g + 1;
+            }
+        }
+    }
 
-    result = PyList_New((Py_ssize_t)group->capture_count);
-    if (!result)
-        return NULL;
+    /* Re-acquire the GIL. */
+    acquire_GIL(safe_state);
 
-    for (i = 0; i < group->capture_count; i++) {
-        item = Py_BuildValue("n", group->captures[i].start);
-        if (!item)
-            goto error;
+    pattern->bestmatch_passes_avoided += (Py_ssize_t)state->passes_avoided;
 
-        /* PyList_SET_ITEM borrows the reference. */
-        PyList_SET_ITEM(result, i, item);
+    /* Matching which was stopped by the limit on memory fails with a specific
+     * error, even if it was reported as a plain failure to allocate.
+     */
+    if (state->memory_exceeded && status <= 0 && status != RE_ERROR_PARTIAL &&
+      status != RE_ERROR_INTERRUPTED) {
+        PyErr_Clear();
+        status = RE_ERROR_MAX_MEMORY;
     }
 
-    return result;
+    if (status < 0 && status != RE_ERROR_PARTIAL && !PyErr_Occurred()) {
+        if (status == RE_ERROR_TIMEOUT || status == RE_ERROR_MAX_STEPS ||
+          status == RE_ERROR_CANCELLED)
+            set_timeout_error(status, state->text_pos);
+        else
+            set_error(status, NULL);
+    }
 
-error:
-    Py_DECREF(result);
-    return NULL;
+    return status;
 }
 
-/* Gets a MatchObject's end by integer index. */
-static PyObject* match_get_end_by_index(MatchObject* self, Py_ssize_t index) {
-    RE_GroupSpan* span;
-
-    if (index < 0 || (size_t)index > self->group_count) {
-        /* Raise error if we were given a bad group number. */
-        set_error(RE_ERROR_NO_SUCH_GROUP, NULL);
-        return NULL;
-    }
-
-    if (index == 0)
-        return Py_BuildValue("n", self->match_end);
+/* Gets a string from a Python object.
+ *
+ * If the function returns true and str_info->should_release is true then it's
+ * the responsibility of the caller to release the buffer when it's no longer
+ * needed.
+ */
+Py_LOCAL_INLINE(BOOL) get_string(PyObject* string, RE_StringInfo* str_info) {
+    /* Given a Python object, return a data pointer, a length (in characters),
+     * and a character size. Return FALSE if the object is not a string (or not
+     * compatible).
+     */
+    PyBufferProcs* buffer;
+    Py_ssize_t bytes;
+    Py_ssize_t size;
 
-    /* Capture group indexes are 1-based (excluding group 0, which is the
-     * entire matched string).
+    /* Unicode objects do not support the buffer API. So, get the data directly
+     * instead.
      */
-    span = &self->groups[index - 1].span;
-    return Py_BuildValue("n", span->end);
-}
+    if (PyUnicode_Check(string)) {
+        /* Unicode strings doesn't always support the buffer interface. */
+#if PY_VERSION_HEX >= 0x03030000
+        if (PyUnicode_READY(string) == -1)
+            return FALSE;
 
-/* Gets a MatchObject's ends by integer index. */
-static PyObject* match_get_ends_by_index(MatchObject* self, Py_ssize_t index) {
-    RE_GroupData* group;
-    PyObject* result;
-    PyObject* item;
-    size_t i;
+        str_info->characters = (void*)PyUnicode_DATA(string);
+        str_info->length = PyUnicode_GET_LENGTH(string);
+        str_info->charsize = PyUnicode_KIND(string);
+#else
+        str_info->characters = (void*)PyUnicode_AS_DATA(string);
+        str_info->length = PyUnicode_GET_SIZE(string);
+        str_info->charsize = sizeof(Py_UNICODE);
+#endif
+        str_info->is_unicode = TRUE;
+        str_info->should_release = FALSE;
+        return TRUE;
+    }
 
-    if (index < 0 || (size_t)index > self->group_count) {
-        /* Raise error if we were given a bad group number. */
-        set_error(RE_ERROR_NO_SUCH_GROUP, NULL);
-        return NULL;
+    /* Get pointer to string buffer. */
+    buffer = Py_TYPE(string)->tp_as_buffer;
+    str_info->view.len = -1;
+
+    if (!buffer) {
+        PyErr_SetString(PyExc_TypeError, "expected string or buffer");
+        return FALSE;
     }
 
-    if (index == 0) {
-        result = PyList_New(1);
-        if (!result)
-            return NULL;
+    if (!buffer->bf_getbuffer || (*buffer->bf_getbuffer)(string,
+      &str_info->view, PyBUF_SIMPLE) < 0) {
+        PyErr_SetString(PyExc_TypeError, "expected string or buffer");
+        return FALSE;
+    }
 
-        item = Py_BuildValue("n", self->match_end);
-        if (!item)
-            goto error;
+    str_info->should_release = TRUE;
 
-        /* PyList_SET_ITEM borrows the reference. */
-        PyList_SET_ITEM(result, 0, item);
+    /* Determine buffer size. */
+    bytes = str_info->view.len;
+    str_info->characters = str_info->view.buf;
 
-        return result;
+    if (str_info->characters == NULL) {
+        PyBuffer_Release(&str_info->view);
+        PyErr_SetString(PyExc_ValueError, "buffer is NULL");
+        return FALSE;
     }
 
-    /* Capture group indexes are 1-based (excluding group 0, which is the
-     * entire matched string).
-     */
-    group = &self->groups[index - 1];
-
-    result = PyList_New((Py_ssize_t)group->capture_count);
-    if (!result)
-        return NULL;
+    if (bytes < 0) {
+        PyBuffer_Release(&str_info->view);
+        PyErr_SetString(PyExc_TypeError, "buffer has negative size");
+        return FALSE;
+    }
 
-    for (i = 0; i < group->capture_count; i++) {
-        item = Py_BuildValue("n", group->captures[i].end);
-        if (!item)
-            goto error;
+    /* Determine character size. */
+    size = PyObject_Size(string);
 
-        /* PyList_SET_ITEM borrows the reference. */
-        PyList_SET_ITEM(result, i, item);
+    if (PyBytes_Check(string) || bytes == size)
+        str_info->charsize = 1;
+    else {
+        PyBuffer_Release(&str_info->view);
+        PyErr_SetString(PyExc_TypeError, "buffer size mismatch");
+        return FALSE;
     }
 
-    return result;
+    str_info->length = size;
+    str_info->is_unicode = FALSE;
 
-error:
-    Py_DECREF(result);
-    return NULL;
+    return TRUE;
 }
 
-/* Gets a MatchObject's span by integer index. */
-static PyObject* match_get_span_by_index(MatchObject* self, Py_ssize_t index) {
-    RE_GroupSpan* span;
+/* Deallocates the groups storage. */
+Py_LOCAL_INLINE(void) dealloc_groups(RE_GroupData* groups, size_t group_count)
+  {
+    size_t g;
 
-    if (index < 0 || (size_t)index > self->group_count) {
-        /* Raise error if we were given a bad group number. */
-        set_error(RE_ERROR_NO_SUCH_GROUP, NULL);
-        return NULL;
-    }
+    if (!groups)
+        return;
 
-    if (index == 0)
-        return Py_BuildValue("nn", self->match_start, self->match_end);
+    for (g = 0; g < group_count; g++)
+        re_dealloc(groups[g].captures);
 
-    /* Capture group indexes are 1-based (excluding group 0, which is the
-     * entire matched string).
-     */
-    span = &self->groups[index - 1].span;
-    return Py_BuildValue("nn", span->start, span->end);
+    re_dealloc(groups);
 }
 
-/* Gets a MatchObject's spans by integer index. */
-static PyObject* match_get_spans_by_index(MatchObject* self, Py_ssize_t index)
-  {
-    PyObject* result;
-    PyObject* item;
-    RE_GroupData* group;
+/* Deallocates repeat data. */
+Py_LOCAL_INLINE(void) dealloc_repeats(RE_RepeatData* repeats, size_t
+  repeat_count) {
     size_t i;
 
-    if (index < 0 || (size_t)index > self->group_count) {
-        /* Raise error if we were given a bad group number. */
-        set_error(RE_ERROR_NO_SUCH_GROUP, NULL);
-        return NULL;
-    }
-
-    if (index == 0) {
-        result = PyList_New(1);
-        if (!result)
-            return NULL;
-
-        item = Py_BuildValue("nn", self->match_start, self->match_end);
-        if (!item)
-            goto error;
-
-        /* PyList_SET_ITEM borrows the reference. */
-        PyList_SET_ITEM(result, 0, item);
+    if (!repeats)
+        return;
 
-        return result;
+    for (i = 0; i < repeat_count; i++) {
+        re_dealloc(repeats[i].body_guard_list.spans);
+        re_dealloc(repeats[i].tail_guard_list.spans);
     }
 
-    /* Capture group indexes are 1-based (excluding group 0, which is the
-     * entire matched string).
-     */
-    group = &self->groups[index - 1];
+    re_dealloc(repeats);
+}
 
-    result = PyList_New((Py_ssize_t)group->capture_count);
-    if (!result)
-        return NULL;
+/* Deallocates fuzzy guards. */
+Py_LOCAL_INLINE(void) dealloc_fuzzy_guards(RE_FuzzyGuards* guards, size_t
+  fuzzy_count) {
+    size_t i;
 
-    for (i = 0; i < group->capture_count; i++) {
-        item = Py_BuildValue("nn", group->captures[i].start,
-          group->captures[i].end);
-        if (!item)
-            goto error;
+    if (!guards)
+        return;
 
-        /* PyList_SET_ITEM borrows the reference. */
-        PyList_SET_ITEM(result, i, item);
+    for (i = 0; i < fuzzy_count; i++) {
+        re_dealloc(guards[i].body_guard_list.spans);
+        re_dealloc(guards[i].tail_guard_list.spans);
     }
 
-    return result;
-
-error:
-    Py_DECREF(result);
-    return NULL;
+    re_dealloc(guards);
 }
 
-/* Gets a MatchObject's captures by integer index. */
-static PyObject* match_get_captures_by_index(MatchObject* self, Py_ssize_t
-  index) {
-    PyObject* result;
-    PyObject* slice;
-    RE_GroupData* group;
+/* Deallocates the call guards. */
+Py_LOCAL_INLINE(void) dealloc_call_guards(RE_GuardList* guard_list, size_t
+  count) {
     size_t i;
 
-    if (index < 0 || (size_t)index > self->group_count) {
-        /* Raise error if we were given a bad group number. */
-        set_error(RE_ERROR_NO_SUCH_GROUP, NULL);
-        return NULL;
-    }
+    if (!guard_list)
+        return;
 
-    if (index == 0) {
-        result = PyList_New(1);
-        if (!result)
-            return NULL;
+    for (i = 0; i < count; i++)
+        re_dealloc(guard_list[i].spans);
 
-        slice = get_slice(self->substring, self->match_start -
-          self->substring_offset, self->match_end - self->substring_offset);
-        if (!slice)
-            goto error;
+    re_dealloc(guard_list);
+}
 
-        /* PyList_SET_ITEM borrows the reference. */
-        PyList_SET_ITEM(result, 0, slice);
+/* Deallocates a chain of backtrack blocks. */
+Py_LOCAL_INLINE(void) dealloc_backtrack_blocks(RE_BacktrackBlock* block) {
+    while (block) {
+        RE_BacktrackBlock* next;
 
-        return result;
+        next = block->next;
+        re_dealloc(block);
+        block = next;
     }
+}
 
-    /* Capture group indexes are 1-based (excluding group 0, which is the
-     * entire matched string).
-     */
-    group = &self->groups[index - 1];
+/* Deallocates a set of storage for a state. */
+Py_LOCAL_INLINE(void) dealloc_state_storage(PatternObject* pattern,
+  RE_StateStorage* storage) {
+    dealloc_groups(storage->groups, pattern->true_group_count);
+    dealloc_repeats(storage->repeats, pattern->repeat_count);
+    dealloc_fuzzy_guards(storage->fuzzy_guards, pattern->fuzzy_count);
+    dealloc_call_guards(storage->group_call_guard_list,
+      pattern->call_ref_info_count);
+    dealloc_backtrack_blocks(storage->backtrack_blocks);
+}
 
-    result = PyList_New((Py_ssize_t)group->capture_count);
-    if (!result)
-        return NULL;
+/* Sets the string which a state will match.
+ *
+ * The state must already have its direction and encoding.
+ */
+Py_LOCAL_INLINE(BOOL) state_set_string(RE_State* state, PyObject* string,
+  RE_StringInfo* str_info, Py_ssize_t start, Py_ssize_t end) {
+    int i;
+    Py_ssize_t final_pos;
 
-    for (i = 0; i < group->capture_count; i++) {
-        slice = get_slice(self->substring, group->captures[i].start -
-          self->substring_offset, group->captures[i].end -
-          self->substring_offset);
-        if (!slice)
-            goto error;
+    /* Adjust boundaries. */
+    if (start < 0)
+        start += str_info->length;
+    if (start < 0)
+        start = 0;
+    else if (start > str_info->length)
+        start = str_info->length;
 
-        /* PyList_SET_ITEM borrows the reference. */
-        PyList_SET_ITEM(result, i, slice);
-    }
+    if (end < 0)
+        end += str_info->length;
+    if (end < 0)
+        end = 0;
+    else if (end > str_info->length)
+        end = str_info->length;
 
-    return result;
+    /* Initialise the getters and setters for the character size. */
+    state->charsize = str_info->charsize;
+    state->is_unicode = str_info->is_unicode;
 
-error:
-    Py_DECREF(result);
-    return NULL;
-}
+    /* Are we using a buffer object? If so, we need to copy the info. */
+    state->should_release = str_info->should_release;
+    if (state->should_release)
+        state->view = str_info->view;
 
-/* Converts a group index to an integer. */
-Py_LOCAL_INLINE(Py_ssize_t) as_group_index(PyObject* obj) {
-    Py_ssize_t value;
+    switch (state->charsize) {
+    case 1:
+        state->char_at = bytes1_char_at;
+        state->set_char_at = bytes1_set_char_at;
+        state->point_to = bytes1_point_to;
+        break;
+    case 2:
+        state->char_at = bytes2_char_at;
+        state->set_char_at = bytes2_set_char_at;
+        state->point_to = bytes2_point_to;
+        break;
+    case 4:
+        state->char_at = bytes4_char_at;
+        state->set_char_at = bytes4_set_char_at;
+        state->point_to = bytes4_point_to;
+        break;
+    default:
+        return FALSE;
+    }
 
-    value = PyLong_AsLong(obj);
-    if (value != -1 || !PyErr_Occurred())
-        return value;
+    /* The state object contains a reference to the string and also a pointer
+     * to its contents.
+     *
+     * The documentation says that the end of the slice behaves like the end of
+     * the string.
+     */
+    state->text = str_info->characters;
+    state->text_length = end;
 
-    set_error(RE_ERROR_INDEX, NULL);
-    return -1;
-}
+    state->slice_start = start;
+    state->slice_end = state->text_length;
+    state->text_pos = state->reverse ? state->slice_end : state->slice_start;
 
-/* Gets a MatchObject's group index.
- *
- * The supplied index can be an integer or a string (group name) object.
- */
-Py_LOCAL_INLINE(Py_ssize_t) match_get_group_index(MatchObject* self, PyObject*
-  index, BOOL allow_neg) {
-    Py_ssize_t group;
+    /* Point to the final newline and line separator if it's at the end of the
+     * string, otherwise just -1.
+     */
+    state->final_newline = -1;
+    state->final_line_sep = -1;
+    final_pos = state->text_length - 1;
+    if (final_pos >= 0) {
+        Py_UCS4 ch;
 
-    /* Is the index an integer? */
-    group = as_group_index(index);
-    if (group != -1 || !PyErr_Occurred()) {
-        Py_ssize_t min_group = 0;
+        ch = state->char_at(state->text, final_pos);
+        if (ch == 0x0A) {
+            /* The string ends with LF. */
+            state->final_newline = final_pos;
+            state->final_line_sep = final_pos;
 
-        /* Adjust negative indices where valid and allowed. */
-        if (group < 0 && allow_neg) {
-            group += (Py_ssize_t)self->group_count + 1;
-            min_group = 1;
+            /* Does the string end with CR/LF? */
+            --final_pos;
+            if (final_pos >= 0 && state->char_at(state->text, final_pos) ==
+              0x0D)
+                state->final_line_sep = final_pos;
+        } else {
+            /* The string doesn't end with LF, but it could be another kind of
+             * line separator.
+             */
+            if (state->encoding->is_line_sep(ch))
+                state->final_line_sep = final_pos;
         }
-
-        if (min_group <= group && (size_t)group <= self->group_count)
-            return group;
-
-        return -1;
     }
 
-    /* The index might be a group name. */
-    if (self->pattern->groupindex) {
-        /* Look up the name. */
-        PyErr_Clear();
+    state->must_advance = FALSE;
+    state->string = string;
 
-        index = PyObject_GetItem(self->pattern->groupindex, index);
-        if (index) {
-            /* Check that we have an integer. */
-            group = as_group_index(index);
-            Py_DECREF(index);
-            if (group != -1 || !PyErr_Occurred())
-                return group;
-        }
-    }
+    /* Forget where things were found in any previous string. */
+    state->req_pos = -1;
+    state->req_alt_pos = -1;
+    for (i = 0; i < RE_MAX_REQ_FOLLOWING; i++)
+        state->req_following_pos[i] = -1;
 
-    PyErr_Clear();
-    return -1;
-}
+    for (i = 0; i < MAX_SEARCH_POSITIONS; i++)
+        state->search_positions[i].start_pos = -1;
 
-/* Gets a MatchObject's group by object index. */
-Py_LOCAL_INLINE(PyObject*) match_get_group(MatchObject* self, PyObject* index,
-  PyObject* def, BOOL allow_neg) {
-    /* Check that the index is an integer or a string. */
-    if (PyLong_Check(index) || PyUnicode_Check(index) || PyBytes_Check(index))
-        return match_get_group_by_index(self, match_get_group_index(self,
-          index, allow_neg), def);
-
-    set_error(RE_ERROR_GROUP_INDEX_TYPE, index);
-    return NULL;
-}
-
-/* Gets info from a MatchObject by object index. */
-Py_LOCAL_INLINE(PyObject*) get_by_arg(MatchObject* self, PyObject* index,
-  RE_GetByIndexFunc get_by_index) {
-    /* Check that the index is an integer or a string. */
-    if (PyLong_Check(index) || PyUnicode_Check(index) || PyBytes_Check(index))
-        return get_by_index(self, match_get_group_index(self, index, FALSE));
-
-    set_error(RE_ERROR_GROUP_INDEX_TYPE, index);
-    return NULL;
+    return TRUE;
 }
 
-/* MatchObject's 'group' method. */
-static PyObject* match_group(MatchObject* self, PyObject* args) {
-    Py_ssize_t size;
-    PyObject* result;
-    Py_ssize_t i;
+/* Initialises a state object. */
+Py_LOCAL_INLINE(BOOL) state_init_2(RE_State* state, PatternObject* pattern,
+  PyObject* string, RE_StringInfo* str_info, Py_ssize_t start, Py_ssize_t end,
+  BOOL overlapped, int concurrent, BOOL partial, BOOL use_lock, BOOL
+  visible_captures, BOOL match_all) {
+    int i;
 
-    size = PyTuple_GET_SIZE(args);
+    state->groups = NULL;
+    state->best_match_groups = NULL;
+    state->best_fuzzy_groups = NULL;
+    state->passes_avoided = 0;
+    state->single_pass_best = FALSE;
+    state->repeats = NULL;
+    state->visible_captures = visible_captures;
+    state->match_all = match_all;
+    state->backtrack_block.previous = NULL;
+    state->backtrack_block.next = NULL;
+    state->backtrack_block.capacity = RE_BACKTRACK_BLOCK_SIZE;
+    state->backtrack_allocated = RE_BACKTRACK_BLOCK_SIZE;
+    state->current_atomic_block = NULL;
+    state->first_saved_groups = NULL;
+    state->current_saved_groups = NULL;
+    state->first_saved_repeats = NULL;
+    state->current_saved_repeats = NULL;
+    state->lock = NULL;
+    state->waiters = 0;
+    state->busy = FALSE;
+    state->gate_open = FALSE;
+    state->fuzzy_guards = NULL;
+    state->first_group_call_frame = NULL;
+    state->current_group_call_frame = NULL;
+    state->group_call_guard_list = NULL;
 
-    switch (size) {
-    case 0:
-        /* group() */
-        result = match_get_group_by_index(self, 0, Py_None);
-        break;
-    case 1:
-        /* group(x). PyTuple_GET_ITEM borrows the reference. */
-        result = match_get_group(self, PyTuple_GET_ITEM(args, 0), Py_None,
-          FALSE);
-        break;
-    default:
-        /* group(x, y, z, ...) */
-        /* Fetch multiple items. */
-        result = PyTuple_New(size);
-        if (!result)
-            return NULL;
+    /* Take a set of storage from the pool if there is one. It's protected by
+     * the GIL.
+     */
+    if (pattern->state_pool_count > 0) {
+        RE_StateStorage* storage;
+        RE_BacktrackBlock* block;
 
-        for (i = 0; i < size; i++) {
-            PyObject* item;
+        storage = &pattern->state_pool[--pattern->state_pool_count];
+        ++pattern->state_pool_hits;
 
-            /* PyTuple_GET_ITEM borrows the reference. */
-            item = match_get_group(self, PyTuple_GET_ITEM(args, i), Py_None,
-              FALSE);
-            if (!item) {
-                Py_DECREF(result);
-                return NULL;
-            }
+        state->groups = storage->groups;
+        state->repeats = storage->repeats;
+        state->fuzzy_guards = storage->fuzzy_guards;
+        state->group_call_guard_list = storage->group_call_guard_list;
 
-            /* PyTuple_SET_ITEM borrows the reference. */
-            PyTuple_SET_ITEM(result, i, item);
+        block = storage->backtrack_blocks;
+        if (block) {
+            block->previous = &state->backtrack_block;
+            state->backtrack_block.next = block;
+            state->backtrack_allocated += storage->backtrack_block_count *
+              RE_BACKTRACK_BLOCK_SIZE;
         }
-        break;
+    } else
+        ++pattern->state_pool_misses;
+
+    /* The call guards used by recursive patterns. */
+    if (pattern->call_ref_info_count > 0 && !state->group_call_guard_list) {
+        state->group_call_guard_list =
+          (RE_GuardList*)re_alloc(pattern->call_ref_info_count *
+          sizeof(RE_GuardList));
+        if (!state->group_call_guard_list)
+            goto error;
+        memset(state->group_call_guard_list, 0, pattern->call_ref_info_count *
+          sizeof(RE_GuardList));
     }
 
-    return result;
-}
+    /* The capture groups. */
+    if (pattern->true_group_count && !state->groups) {
+        size_t g;
 
-/* Generic method for getting info from a MatchObject. */
-Py_LOCAL_INLINE(PyObject*) get_from_match(MatchObject* self, PyObject* args,
-  RE_GetByIndexFunc get_by_index) {
-    Py_ssize_t size;
-    PyObject* result;
-    Py_ssize_t i;
+        state->groups = (RE_GroupData*)re_alloc(pattern->true_group_count *
+          sizeof(RE_GroupData));
+        if (!state->groups)
+            goto error;
+        memset(state->groups, 0, pattern->true_group_count *
+          sizeof(RE_GroupData));
 
-    size = PyTuple_GET_SIZE(args);
+        for (g = 0; g < pattern->true_group_count; g++) {
+            RE_GroupSpan* captures;
 
-    switch (size) {
-    case 0:
-        /* get() */
-        result = get_by_index(self, 0);
-        break;
-    case 1:
-        /* get(x). PyTuple_GET_ITEM borrows the reference. */
-        result = get_by_arg(self, PyTuple_GET_ITEM(args, 0), get_by_index);
-        break;
-    default:
-        /* get(x, y, z, ...) */
-        /* Fetch multiple items. */
-        result = PyTuple_New(size);
-        if (!result)
-            return NULL;
+            captures = (RE_GroupSpan*)re_alloc(sizeof(RE_GroupSpan));
+            if (!captures) {
+                size_t i;
 
-        for (i = 0; i < size; i++) {
-            PyObject* item;
+                for (i = 0; i < g; i++)
+                    re_dealloc(state->groups[i].captures);
 
-            /* PyTuple_GET_ITEM borrows the reference. */
-            item = get_by_arg(self, PyTuple_GET_ITEM(args, i), get_by_index);
-            if (!item) {
-                Py_DECREF(result);
-                return NULL;
+                re_dealloc(state->groups);
+                state->groups = NULL;
+
+                goto error;
             }
 
-            /* PyTuple_SET_ITEM borrows the reference. */
-            PyTuple_SET_ITEM(result, i, item);
+            state->groups[g].captures = captures;
+            state->groups[g].capture_capacity = 1;
         }
-        break;
     }
 
-    return result;
-}
-
-/* MatchObject's 'start' method. */
-static PyObject* match_start(MatchObject* self, PyObject* args) {
-    return get_from_match(self, args, match_get_start_by_index);
-}
+    state->overlapped = overlapped;
+    state->min_width = pattern->min_width;
 
-/* MatchObject's 'starts' method. */
-static PyObject* match_starts(MatchObject* self, PyObject* args) {
-    return get_from_match(self, args, match_get_starts_by_index);
-}
+    state->encoding = pattern->encoding;
+    state->locale_info = pattern->locale_info;
 
-/* MatchObject's 'end' method. */
-static PyObject* match_end(MatchObject* self, PyObject* args) {
-    return get_from_match(self, args, match_get_end_by_index);
-}
+    state->reverse = (pattern->flags & RE_FLAG_REVERSE) != 0;
+    if (partial)
+        state->partial_side = state->reverse ? RE_PARTIAL_LEFT :
+          RE_PARTIAL_RIGHT;
+    else
+        state->partial_side = RE_PARTIAL_NONE;
 
-/* MatchObject's 'ends' method. */
-static PyObject* match_ends(MatchObject* self, PyObject* args) {
-    return get_from_match(self, args, match_get_ends_by_index);
-}
+    /* If the 'new' behaviour is enabled then split correctly on zero-width
+     * matches.
+     */
+    state->version_0 = (pattern->flags & RE_FLAG_VERSION1) == 0;
 
-/* MatchObject's 'span' method. */
-static PyObject* match_span(MatchObject* self, PyObject* args) {
-    return get_from_match(self, args, match_get_span_by_index);
-}
+    /* There's no limit on the time, steps or memory unless it's set later. */
+    state->limits.timeout = -1.0;
+    state->limits.max_steps = -1;
+    state->limits.max_memory = -1;
+    reset_limits(state);
 
-/* MatchObject's 'spans' method. */
-static PyObject* match_spans(MatchObject* self, PyObject* args) {
-    return get_from_match(self, args, match_get_spans_by_index);
-}
+    if (!state_set_string(state, string, str_info, start, end))
+        goto error;
 
-/* MatchObject's 'captures' method. */
-static PyObject* match_captures(MatchObject* self, PyObject* args) {
-    return get_from_match(self, args, match_get_captures_by_index);
-}
+    state->pattern = pattern;
 
-/* MatchObject's 'groups' method. */
-static PyObject* match_groups(MatchObject* self, PyObject* args, PyObject*
-  kwargs) {
-    PyObject* result;
-    size_t g;
+    if (pattern->repeat_count && !state->repeats) {
+        state->repeats = (RE_RepeatData*)re_alloc(pattern->repeat_count *
+          sizeof(RE_RepeatData));
+        if (!state->repeats)
+            goto error;
+        memset(state->repeats, 0, pattern->repeat_count *
+          sizeof(RE_RepeatData));
+    }
 
-    PyObject* def = Py_None;
-    static char* kwlist[] = { "default", NULL };
-    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "|O:groups", kwlist, &def))
-        return NULL;
+    if (pattern->fuzzy_count && !state->fuzzy_guards) {
+        state->fuzzy_guards = (RE_FuzzyGuards*)re_alloc(pattern->fuzzy_count *
+          sizeof(RE_FuzzyGuards));
+        if (!state->fuzzy_guards)
+            goto error;
+        memset(state->fuzzy_guards, 0, pattern->fuzzy_count *
+          sizeof(RE_FuzzyGuards));
+    }
 
-    result = PyTuple_New((Py_ssize_t)self->group_count);
-    if (!result)
-        return NULL;
+    Py_INCREF(state->pattern);
+    Py_INCREF(state->string);
 
-    /* Group 0 is the entire matched portion of the string. */
-    for (g = 0; g < self->group_count; g++) {
-        PyObject* item;
+    /* Multithreading is allowed during matching when explicitly enabled or on
+     * immutable strings.
+     */
+    switch (concurrent) {
+    case RE_CONC_NO:
+        state->is_multithreaded = FALSE;
+        break;
+    case RE_CONC_YES:
+        state->is_multithreaded = TRUE;
+        break;
+    default:
+        state->is_multithreaded = PyUnicode_Check(string) ||
+          PyBytes_Check(string);
+        break;
+    }
 
-        item = match_get_group_by_index(self, (Py_ssize_t)g + 1, def);
-        if (!item)
-            goto error;
+    /* A state struct can sometimes be shared across threads. In such
+     * instances, if multithreading is enabled we need to stop more than one
+     * thread from using the state at a time. The lock (mutex) on which a
+     * thread waits is allocated only when there's contention.
+     */
+    state->use_lock = state->is_multithreaded && use_lock;
 
-        /* PyTuple_SET_ITEM borrows the reference. */
-        PyTuple_SET_ITEM(result, g, item);
+    /* The states of the lazy DFA are kept by the pattern between matches. */
+    for (i = 0; i < 2; i++) {
+        state->dfa_caches[i] = pattern->dfa_storage[i];
+        pattern->dfa_storage[i] = NULL;
     }
 
-    return result;
+    state->fuzzy_scan.start = -1;
+
+    return TRUE;
 
 error:
-    Py_DECREF(result);
-    return NULL;
+    dealloc_call_guards(state->group_call_guard_list,
+      pattern->call_ref_info_count);
+    dealloc_repeats(state->repeats, pattern->repeat_count);
+    dealloc_groups(state->groups, pattern->true_group_count);
+    dealloc_fuzzy_guards(state->fuzzy_guards, pattern->fuzzy_count);
+    dealloc_backtrack_blocks(state->backtrack_block.next);
+    state->group_call_guard_list = NULL;
+    state->repeats = NULL;
+    state->groups = NULL;
+    state->fuzzy_guards = NULL;
+    state->backtrack_block.next = NULL;
+    return FALSE;
 }
 
-/* MatchObject's 'groupdict' method. */
-static PyObject* match_groupdict(MatchObject* self, PyObject* args, PyObject*
-  kwargs) {
-    PyObject* result;
-    PyObject* keys;
-    Py_ssize_t g;
-
-    PyObject* def = Py_None;
-    static char* kwlist[] = { "default", NULL };
-    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "|O:groupdict", kwlist,
-      &def))
-        return NULL;
-
-    result = PyDict_New();
-    if (!result || !self->pattern->groupindex)
-        return result;
+/* Checks that the string has the same charsize as the pattern. */
+Py_LOCAL_INLINE(BOOL) check_compatible(PatternObject* pattern, BOOL unicode) {
+    if (PyBytes_Check(pattern->pattern)) {
+        if (unicode) {
+            PyErr_SetString(PyExc_TypeError,
+              "cannot use a bytes pattern on a string-like object");
+            return FALSE;
+        }
+    } else {
+        if (!unicode) {
+            PyErr_SetString(PyExc_TypeError,
+              "cannot use a string pattern on a bytes-like object");
+            return FALSE;
+        }
+    }
 
-    keys = PyMapping_Keys(self->pattern->groupindex);
-    if (!keys)
-        goto failed;
+    return TRUE;
+}
 
-    for (g = 0; g < PyList_GET_SIZE(keys); g++) {
-        PyObject* key;
-        PyObject* value;
-        int status;
+/* Releases the string's buffer, if necessary. */
+Py_LOCAL_INLINE(void) release_buffer(RE_StringInfo* str_info) {
+    if (str_info->should_release)
+        PyBuffer_Release(&str_info->view);
+}
 
-        /* PyList_GET_ITEM borrows a reference. */
-        key = PyList_GET_ITEM(keys, g);
-        if (!key)
-            goto failed;
+/* Initialises a state object. */
+Py_LOCAL_INLINE(BOOL) state_init(RE_State* state, PatternObject* pattern,
+  PyObject* string, Py_ssize_t start, Py_ssize_t end, BOOL overlapped, int
+  concurrent, BOOL partial, BOOL use_lock, BOOL visible_captures, BOOL
+  match_all) {
+    RE_StringInfo str_info;
 
-        value = match_get_group(self, key, def, FALSE);
-        if (!value)
-            goto failed;
+    /* Get the string to search or match. */
+    if (!get_string(string, &str_info))
+        return FALSE;
 
-        status = PyDict_SetItem(result, key, value);
-        Py_DECREF(value);
-        if (status < 0)
-            goto failed;
+    /* If we fail to initialise the state then we need to release the buffer if
+     * the string is a buffer object.
+     */
+    if (!check_compatible(pattern, str_info.is_unicode)) {
+        release_buffer(&str_info);
+        return FALSE;
     }
 
-    Py_DECREF(keys);
+    if (!state_init_2(state, pattern, string, &str_info, start, end,
+      overlapped, concurrent, partial, use_lock, visible_captures, match_all))
+      {
+        release_buffer(&str_info);
 
-    return result;
+        return FALSE;
+    }
 
-failed:
-    Py_XDECREF(keys);
-    Py_DECREF(result);
-    return NULL;
+    /* The state has been initialised successfully, so now the state has the
+     * responsibility of releasing the buffer if the string is a buffer object.
+     */
+    return TRUE;
 }
 
-/* MatchObject's 'capturesdict' method. */
-static PyObject* match_capturesdict(MatchObject* self) {
-    PyObject* result;
-    PyObject* keys;
-    Py_ssize_t g;
+/* Finalises a state object, discarding its contents. */
+Py_LOCAL_INLINE(void) state_fini(RE_State* state) {
+    RE_BacktrackBlock* current_backtrack;
+    RE_AtomicBlock* current_atomic;
+    PatternObject* pattern;
+    RE_SavedGroups* saved_groups;
+    RE_SavedRepeats* saved_repeats;
+    RE_GroupCallFrame* frame;
+    RE_StateStorage storage;
+    size_t i;
 
-    result = PyDict_New();
-    if (!result || !self->pattern->groupindex)
-        return result;
+    /* Discard the lock (mutex) if there's one. */
+    if (state->lock)
+        PyThread_free_lock(state->lock);
 
-    keys = PyMapping_Keys(self->pattern->groupindex);
-    if (!keys)
-        goto failed;
+    pattern = state->pattern;
 
-    for (g = 0; g < PyList_GET_SIZE(keys); g++) {
-        PyObject* key;
-        Py_ssize_t group;
-        PyObject* captures;
-        int status;
+    /* Keep the first few backtrack blocks for reuse and deallocate the rest.
+     */
+    storage.backtrack_blocks = state->backtrack_block.next;
+    storage.backtrack_block_count = 0;
+    current_backtrack = storage.backtrack_blocks;
+    while (current_backtrack && storage.backtrack_block_count <
+      RE_POOL_BACKTRACK_BLOCKS) {
+        ++storage.backtrack_block_count;
+        if (storage.backtrack_block_count == RE_POOL_BACKTRACK_BLOCKS) {
+            dealloc_backtrack_blocks(current_backtrack->next);
+            current_backtrack->next = NULL;
+        }
 
-        /* PyList_GET_ITEM borrows a reference. */
-        key = PyList_GET_ITEM(keys, g);
-        if (!key)
-            goto failed;
+        current_backtrack = current_backtrack->next;
+    }
 
-        group = match_get_group_index(self, key, FALSE);
-        if (group < 0)
-            goto failed;
+    state->backtrack_block.next = NULL;
+    state->backtrack_allocated = RE_BACKTRACK_BLOCK_SIZE;
 
-        captures = match_get_captures_by_index(self, group);
-        if (!captures)
-            goto failed;
+    /* Deallocate the atomic blocks. */
+    current_atomic = state->current_atomic_block;
+    while (current_atomic) {
+        RE_AtomicBlock* next;
 
-        status = PyDict_SetItem(result, key, captures);
-        Py_DECREF(captures);
-        if (status < 0)
-            goto failed;
+        next = current_atomic->next;
+        re_dealloc(current_atomic);
+        current_atomic = next;
     }
 
-    Py_DECREF(keys);
+    state->current_atomic_block = NULL;
 
-    return result;
+    saved_groups = state->first_saved_groups;
+    while (saved_groups) {
+        RE_SavedGroups* next;
 
-failed:
-    Py_XDECREF(keys);
-    Py_DECREF(result);
-    return NULL;
-}
+        next = saved_groups->next;
+        re_dealloc(saved_groups->spans);
+        re_dealloc(saved_groups->counts);
+        re_dealloc(saved_groups);
+        saved_groups = next;
+    }
 
-/* Gets a Python object by name from a named module. */
-Py_LOCAL_INLINE(PyObject*) get_object(char* module_name, char* object_name) {
-    PyObject* module;
-    PyObject* object;
+    saved_repeats = state->first_saved_repeats;
+    while (saved_repeats) {
+        RE_SavedRepeats* next;
 
-    module = PyImport_ImportModule(module_name);
-    if (!module)
-        return NULL;
+        next = saved_repeats->next;
 
-    object = PyObject_GetAttrString(module, object_name);
-    Py_DECREF(module);
+        dealloc_repeats(saved_repeats->repeats, pattern->repeat_count);
 
-    return object;
-}
+        re_dealloc(saved_repeats);
+        saved_repeats = next;
+    }
 
-/* Calls a function in a module. */
-Py_LOCAL_INLINE(PyObject*) call(char* module_name, char* function_name,
-  PyObject* args) {
-    PyObject* function;
-    PyObject* result;
+    if (state->best_match_groups)
+        dealloc_groups(state->best_match_groups, pattern->true_group_count);
 
-    if (!args)
-        return NULL;
+    if (state->best_fuzzy_groups)
+        dealloc_groups(state->best_fuzzy_groups, pattern->true_group_count);
 
-    function = get_object(module_name, function_name);
-    if (!function)
-        return NULL;
+    /* Return the storage to the pool if there's room, otherwise discard it.
+     * It's protected by the GIL.
+     */
+    storage.groups = state->groups;
+    storage.repeats = state->repeats;
+    storage.fuzzy_guards = state->fuzzy_guards;
+    storage.group_call_guard_list = state->group_call_guard_list;
 
-    result = PyObject_CallObject(function, args);
-    Py_DECREF(function);
-    Py_DECREF(args);
+    if (pattern->state_pool_count < RE_STATE_POOL_SIZE)
+        pattern->state_pool[pattern->state_pool_count++] = storage;
+    else
+        dealloc_state_storage(pattern, &storage);
 
-    return result;
+    for (i = 0; i < 2; i++) {
+        if (pattern->dfa_storage[i])
+            dealloc_dfa_cache(state->dfa_caches[i]);
+        else
+            pattern->dfa_storage[i] = state->dfa_caches[i];
+    }
+
+    frame = state->first_group_call_frame;
+    while (frame) {
+        RE_GroupCallFrame* next;
+
+        next = frame->next;
+
+        dealloc_groups(frame->groups, pattern->true_group_count);
+        dealloc_repeats(frame->repeats, pattern->repeat_count);
+
+        re_dealloc(frame);
+        frame = next;
+    }
+
+    Py_DECREF(state->pattern);
+    Py_DECREF(state->string);
+
+    if (state->should_release)
+        PyBuffer_Release(&state->view);
 }
 
-/* Gets a replacement item from the replacement list.
+/* Converts a string index to an integer.
  *
- * The replacement item could be a string literal or a group.
+ * If the index is None then the default will be returned.
  */
-Py_LOCAL_INLINE(PyObject*) get_match_replacement(MatchObject* self, PyObject*
-  item, size_t group_count) {
-    Py_ssize_t index;
+Py_LOCAL_INLINE(Py_ssize_t) as_string_index(PyObject* obj, Py_ssize_t def) {
+    Py_ssize_t value;
 
-    if (PyUnicode_Check(item) || PyBytes_Check(item)) {
-        /* It's a literal, which can be added directly to the list. */
-#if PY_VERSION_HEX >= 0x03040000
+    if (obj == Py_None)
+        return def;
 
-        /* ensure_immutable will DECREF the original item if it has to make an
-         * immutable copy, but that original item might have a borrowed
-         * reference, so we must INCREF it first in order to ensure it won't be
-         * destroyed.
-         */
-        Py_INCREF(item);
-        item = ensure_immutable(item);
-#else
-        Py_INCREF(item);
-#endif
-        return item;
-    }
+    value = PyLong_AsLong(obj);
+    if (value != -1 || !PyErr_Occurred())
+        return value;
 
-    /* Is it a group reference? */
-    index = as_group_index(item);
-    if (index == -1 && PyErr_Occurred()) {
-        /* Not a group either! */
-        set_error(RE_ERROR_REPLACEMENT, NULL);
-        return NULL;
-    }
+    set_error(RE_ERROR_INDEX, NULL);
+    return 0;
+}
 
-    if (index == 0) {
-        /* The entire matched portion of the string. */
-        return get_slice(self->substring, self->match_start -
-          self->substring_offset, self->match_end - self->substring_offset);
-    } else if (index >= 1 && (size_t)index <= group_count) {
-        /* A group. If it didn't match then return None instead. */
-        RE_GroupData* group;
+/* Deallocates a MatchObject. */
+static void match_dealloc(PyObject* self_) {
+    MatchObject* self;
 
-        group = &self->groups[index - 1];
+    self = (MatchObject*)self_;
 
-        if (group->capture_count > 0)
-            return get_slice(self->substring, group->span.start -
-              self->substring_offset, group->span.end -
-              self->substring_offset);
-        else {
-            Py_INCREF(Py_None);
-            return Py_None;
-        }
-    } else {
-        /* No such group. */
-        set_error(RE_ERROR_NO_SUCH_GROUP, NULL);
-        return NULL;
-    }
-}
-
-/* Initialises the join list. */
-Py_LOCAL_INLINE(void) init_join_list(JoinInfo* join_info, BOOL reversed, BOOL
-  is_unicode) {
-    join_info->list = NULL;
-    join_info->item = NULL;
-    join_info->reversed = reversed;
-    join_info->is_unicode = is_unicode;
+    Py_XDECREF(self->string);
+    Py_XDECREF(self->substring);
+    Py_DECREF(self->pattern);
+    if (self->groups)
+        re_dealloc(self->groups);
+    Py_XDECREF(self->regs);
+    PyObject_DEL(self);
 }
 
-/* Adds an item to the join list. */
-Py_LOCAL_INLINE(int) add_to_join_list(JoinInfo* join_info, PyObject* item) {
-    PyObject* new_item;
-    int status;
-
-    if (join_info->is_unicode) {
-#if PY_VERSION_HEX >= 0x03040000
-        if (PyUnicode_CheckExact(item)) {
-#else
-        if (PyUnicode_Check(item)) {
-#endif
-            new_item = item;
-            Py_INCREF(new_item);
-        } else {
-            new_item = PyUnicode_FromObject(item);
-            if (!new_item) {
-                set_error(RE_ERROR_NOT_UNICODE, item);
-                return RE_ERROR_NOT_UNICODE;
-            }
-        }
-    } else {
 #if PY_VERSION_HEX >= 0x03040000
-        if (PyBytes_CheckExact(item)) {
-#else
-        if (PyBytes_Check(item)) {
-#endif
-            new_item = item;
-            Py_INCREF(new_item);
-        } else {
-            new_item = PyBytes_FromObject(item);
-            if (!new_item) {
-                set_error(RE_ERROR_NOT_BYTES, item);
-                return RE_ERROR_NOT_BYTES;
-            }
-        }
-    }
-
-    /* If the list already exists then just add the item to it. */
-    if (join_info->list) {
-        status = PyList_Append(join_info->list, new_item);
-        if (status < 0)
-            goto error;
-
-        Py_DECREF(new_item);
-        return status;
-    }
+/* Ensures that the string is the immutable Unicode string or bytestring.
+ * DECREFs the original string if a copy is returned.
+ */
+Py_LOCAL_INLINE(PyObject*) ensure_immutable(PyObject* string) {
+    PyObject* new_string;
 
-    /* If we already have an item then we now have 2(!) and we need to put them
-     * into a list.
-     */
-    if (join_info->item) {
-        join_info->list = PyList_New(2);
-        if (!join_info->list) {
-            status = RE_ERROR_MEMORY;
-            goto error;
-        }
+    if (PyUnicode_CheckExact(string) || PyBytes_CheckExact(string))
+        return string;
 
-        /* PyList_SET_ITEM borrows the reference. */
-        PyList_SET_ITEM(join_info->list, 0, join_info->item);
-        join_info->item = NULL;
+    if (PyUnicode_Check(string))
+        new_string = PyUnicode_FromObject(string);
+    else
+        new_string = PyBytes_FromObject(string);
 
-        /* PyList_SET_ITEM borrows the reference. */
-        PyList_SET_ITEM(join_info->list, 1, new_item);
-        return 0;
-    }
+    Py_DECREF(string);
 
-    /* This is the first item. */
-    join_info->item = new_item;
+    return new_string;
+}
 
-    return 0;
+#endif
+/* Restricts a value to a range. */
+Py_LOCAL_INLINE(Py_ssize_t) limited_range(Py_ssize_t value, Py_ssize_t lower,
+  Py_ssize_t upper) {
+    if (value < lower)
+        return lower;
 
-error:
-    Py_DECREF(new_item);
-    set_error(status, NULL);
-    return status;
-}
+    if (value > upper)
+        return upper;
 
-/* Clears the join list. */
-Py_LOCAL_INLINE(void) clear_join_list(JoinInfo* join_info) {
-    Py_XDECREF(join_info->list);
-    Py_XDECREF(join_info->item);
+    return value;
 }
 
-/* Joins together a list of strings for pattern_subx. */
-Py_LOCAL_INLINE(PyObject*) join_list_info(JoinInfo* join_info) {
-    /* If the list already exists then just do the join. */
-    if (join_info->list) {
-        PyObject* joiner;
-        PyObject* result;
-
-        if (join_info->reversed)
-            /* The list needs to be reversed before being joined. */
-            PyList_Reverse(join_info->list);
+/* Gets a slice from a Unicode string. */
+Py_LOCAL_INLINE(PyObject*) unicode_slice(PyObject* string, Py_ssize_t start,
+  Py_ssize_t end) {
+    Py_ssize_t length;
+#if PY_VERSION_HEX < 0x03030000
+    Py_UNICODE* buffer;
+#endif
 
-        if (join_info->is_unicode) {
-            /* Concatenate the Unicode strings. */
-            joiner = PyUnicode_FromUnicode(NULL, 0);
-            if (!joiner) {
-                clear_join_list(join_info);
-                return NULL;
-            }
+    length = PyUnicode_GET_SIZE(string);
+    start = limited_range(start, 0, length);
+    end = limited_range(end, 0, length);
 
-            result = PyUnicode_Join(joiner, join_info->list);
-        } else {
-            joiner = PyBytes_FromString("");
-            if (!joiner) {
-                clear_join_list(join_info);
-                return NULL;
-            }
+#if PY_VERSION_HEX >= 0x03030000
+    return PyUnicode_Substring(string, start, end);
+#else
+    buffer = PyUnicode_AsUnicode(string);
 
-            /* Concatenate the bytestrings. */
-            result = _PyBytes_Join(joiner, join_info->list);
-        }
+    return PyUnicode_FromUnicode(buffer + start, end - start);
+#endif
+}
 
-        Py_DECREF(joiner);
-        clear_join_list(join_info);
+/* Gets a slice from a bytestring. */
+Py_LOCAL_INLINE(PyObject*) bytes_slice(PyObject* string, Py_ssize_t start,
+  Py_ssize_t end) {
+    Py_ssize_t length;
+    char* buffer;
 
-        return result;
-    }
+    length = PyBytes_GET_SIZE(string);
+    start = limited_range(start, 0, length);
+    end = limited_range(end, 0, length);
 
-    /* If we have only 1 item, so we'll just return it. */
-    if (join_info->item)
-        return join_info->item;
+    buffer = PyBytes_AsString(string);
 
-    /* There are no items, so return an empty string. */
-    if (join_info->is_unicode)
-        return PyUnicode_FromUnicode(NULL, 0);
-    else
-        return PyBytes_FromString("");
+    return PyBytes_FromStringAndSize(buffer + start, end - start);
 }
 
-/* Checks whether a string replacement is a literal.
- *
- * To keep it simple we'll say that a literal is a string which can be used
- * as-is.
- *
- * Returns its length if it is a literal, otherwise -1.
+/* Gets a slice from a string, returning either a Unicode string or a
+ * bytestring.
  */
-Py_LOCAL_INLINE(Py_ssize_t) check_replacement_string(PyObject* str_replacement,
-  unsigned char special_char) {
-    RE_StringInfo str_info;
-    Py_UCS4 (*char_at)(void* text, Py_ssize_t pos);
-    Py_ssize_t pos;
+Py_LOCAL_INLINE(PyObject*) get_slice(PyObject* string, Py_ssize_t start,
+  Py_ssize_t end) {
+    if (PyUnicode_Check(string))
+        return unicode_slice(string, start, end);
 
-    if (!get_string(str_replacement, &str_info))
-        return -1;
+    if (PyBytes_Check(string))
+        return bytes_slice(string, start, end);
 
-    switch (str_info.charsize) {
-    case 1:
-        char_at = bytes1_char_at;
-        break;
-    case 2:
-        char_at = bytes2_char_at;
-        break;
-    case 4:
-        char_at = bytes4_char_at;
-        break;
-    default:
-        release_buffer(&str_info);
-        return -1;
-    }
+#if PY_VERSION_HEX >= 0x03040000
+    return ensure_immutable(PySequence_GetSlice(string, start, end));
+#else
+    return PySequence_GetSlice(string, start, end);
+#endif
+}
 
-    for (pos = 0; pos < str_info.length; pos++) {
-        if (char_at(str_info.characters, pos) == special_char) {
-            release_buffer(&str_info);
+/* Gets a MatchObject's group by integer index. */
+static PyObject* match_get_group_by_index(MatchObject* self, Py_ssize_t index,
+  PyObject* def) {
+    RE_GroupSpan* span;
 
-            return -1;
-        }
+    if (index < 0 || (size_t)index > self->group_count) {
+        /* Raise error if we were given a bad group number. */
+        set_error(RE_ERROR_NO_SUCH_GROUP, NULL);
+        return NULL;
     }
 
-    release_buffer(&str_info);
+    if (index == 0)
+        return get_slice(self->substring, self->match_start -
+          self->substring_offset, self->match_end - self->substring_offset);
 
-    return str_info.length;
-}
+    /* Capture group indexes are 1-based (excluding group 0, which is the
+     * entire matched string).
+     */
+    span = &self->groups[index - 1].span;
 
-/* MatchObject's 'expand' method. */
-static PyObject* match_expand(MatchObject* self, PyObject* str_template) {
-    Py_ssize_t literal_length;
-    PyObject* replacement;
-    JoinInfo join_info;
-    Py_ssize_t size;
-    Py_ssize_t i;
-
-    /* Is the template just a literal? */
-    literal_length = check_replacement_string(str_template, '\\');
-    if (literal_length >= 0) {
-        /* It's a literal. */
-        Py_INCREF(str_template);
-        return str_template;
+    if (span->start < 0 || span->end < 0) {
+        /* Return default value if the string or group is undefined. */
+        Py_INCREF(def);
+        return def;
     }
 
-    /* Hand the template to the template compiler. */
-    replacement = call(RE_MODULE, "_compile_replacement_helper",
-      PyTuple_Pack(2, self->pattern, str_template));
-    if (!replacement)
-        return NULL;
+    return get_slice(self->substring, span->start - self->substring_offset,
+      span->end - self->substring_offset);
+}
 
-    init_join_list(&join_info, FALSE, PyUnicode_Check(self->string));
+/* Gets a MatchObject's start by integer index. */
+static PyObject* match_get_start_by_index(MatchObject* self, Py_ssize_t index)
+  {
+    RE_GroupSpan* span;
 
-    /* Add each part of the template to the list. */
-    size = PyList_GET_SIZE(replacement);
-    for (i = 0; i < size; i++) {
-        PyObject* item;
-        PyObject* str_item;
+    if (index < 0 || (size_t)index > self->group_count) {
+        /* Raise error if we were given a bad group number. */
+        set_error(RE_ERROR_NO_SUCH_GROUP, NULL);
+        return NULL;
+    }
 
-        /* PyList_GET_ITEM borrows a reference. */
-        item = PyList_GET_ITEM(replacement, i);
-        str_item = get_match_replacement(self, item, self->group_count);
-        if (!str_item)
-            goto error;
+    if (index == 0)
+        return Py_BuildValue("n", self->match_start);
 
-        /* Add to the list. */
-        if (str_item == Py_None)
-            Py_DECREF(str_item);
-        else {
-            int status;
+    /* Capture group indexes are 1-based (excluding group 0, which is the
+     * entire matched string).
+     */
+    span = &self->groups[index - 1].span;
+    return Py_BuildValue("n", span->start);
+}
 
-            status = add_to_join_list(&join_info, str_item);
-            Py_DECREF(str_item);
-            if (status < 0)
-                goto error;
-        }
-    }
+/* Gets a MatchObject's starts by integer index. */
+static PyObject* match_get_starts_by_index(MatchObject* self, Py_ssize_t index)
+  {
+    RE_GroupData* group;
+    PyObject* result;
+    PyObject* item;
+    size_t i;
 
-    Py_DECREF(replacement);
+    if (index < 0 || (size_t)index > self->group_count) {
+        /* Raise error if we were given a bad group number. */
+        set_error(RE_ERROR_NO_SUCH_GROUP, NULL);
+        return NULL;
+    }
 
-    /* Convert the list to a single string (also cleans up join_info). */
-    return join_list_info(&join_info);
+    if (index == 0) {
+        result = PyList_New(1);
+        if (!result)
+            return NULL;
 
-error:
-    clear_join_list(&join_info);
-    Py_DECREF(replacement);
-    return NULL;
-}
+        item = Py_BuildValue("n", self->match_start);
+        if (!item)
+            goto error;
 
-/* Gets a MatchObject's group dictionary. */
-Py_LOCAL_INLINE(PyObject*) match_get_group_dict(MatchObject* self) {
-    PyObject* result;
-    PyObject* keys;
-    Py_ssize_t g;
+        /* PyList_SET_ITEM borrows the reference. */
+        PyList_SET_ITEM(result, 0, item);
 
-    result = PyDict_New();
-    if (!result || !self->pattern->groupindex)
         return result;
+    }
 
-    keys = PyMapping_Keys(self->pattern->groupindex);
-    if (!keys)
-        goto failed;
-
-    for (g = 0; g < PyList_GET_SIZE(keys); g++) {
-        PyObject* key;
-        PyObject* value;
-        int status;
+    /* Capture group indexes are 1-based (excluding group 0, which is the
+     * entire matched string).
+     */
+    group = &self->groups[index - 1];
 
-        /* PyList_GET_ITEM borrows a reference. */
-        key = PyList_GET_ITEM(keys, g);
-        if (!key)
-            goto failed;
+    result = PyList_New((Py_ssize_t)group->capture_count);
+    if (!result)
+        return NULL;
 
-        value = match_get_group(self, key, Py_None, FALSE);
-        if (!value)
-            goto failed;
+    for (i = 0; i < group->capture_count; i++) {
+        item = Py_BuildValue("n", group->captures[i].start);
+        if (!item)
+            goto error;
 
-        status = PyDict_SetItem(result, key, value);
-        Py_DECREF(value);
-        if (status < 0)
-            goto failed;
+        /* PyList_SET_ITEM borrows the reference. */
+        PyList_SET_ITEM(result, i, item);
     }
 
-    Py_DECREF(keys);
-
     return result;
 
-failed:
-    Py_XDECREF(keys);
+error:
     Py_DECREF(result);
     return NULL;
 }
 
-static PyTypeObject Capture_Type = {
-    PyVarObject_HEAD_INIT(NULL,0)
-    "_" RE_MODULE "." "Capture",
-    sizeof(MatchObject)
-};
-
-/* Creates a new CaptureObject. */
-Py_LOCAL_INLINE(PyObject*) make_capture_object(MatchObject** match_indirect,
-  Py_ssize_t index) {
-    CaptureObject* capture;
+/* Gets a MatchObject's end by integer index. */
+static PyObject* match_get_end_by_index(MatchObject* self, Py_ssize_t index) {
+    RE_GroupSpan* span;
 
-    capture = PyObject_NEW(CaptureObject, &Capture_Type);
-    if (!capture)
+    if (index < 0 || (size_t)index > self->group_count) {
+        /* Raise error if we were given a bad group number. */
+        set_error(RE_ERROR_NO_SUCH_GROUP, NULL);
         return NULL;
+    }
 
-    capture->group_index = index;
-    capture->match_indirect = match_indirect;
+    if (index == 0)
+        return Py_BuildValue("n", self->match_end);
 
-    return (PyObject*)capture;
+    /* Capture group indexes are 1-based (excluding group 0, which is the
+     * entire matched string).
+     */
+    span = &self->groups[index - 1].span;
+    return Py_BuildValue("n", span->end);
 }
 
-/* Makes a MatchObject's capture dictionary. */
-Py_LOCAL_INLINE(PyObject*) make_capture_dict(MatchObject* match, MatchObject**
-  match_indirect) {
+/* Gets a MatchObject's ends by integer index. */
+static PyObject* match_get_ends_by_index(MatchObject* self, Py_ssize_t index) {
+    RE_GroupData* group;
     PyObject* result;
-    PyObject* keys;
-    PyObject* values = NULL;
-    Py_ssize_t g;
+    PyObject* item;
+    size_t i;
 
-    result = PyDict_New();
-    if (!result)
-        return result;
+    if (index < 0 || (size_t)index > self->group_count) {
+        /* Raise error if we were given a bad group number. */
+        set_error(RE_ERROR_NO_SUCH_GROUP, NULL);
+        return NULL;
+    }
 
-    keys = PyMapping_Keys(match->pattern->groupindex);
-    if (!keys)
-        goto failed;
+    if (index == 0) {
+        result = PyList_New(1);
+        if (!result)
+            return NULL;
 
-    values = PyMapping_Values(match->pattern->groupindex);
-    if (!values)
-        goto failed;
+        item = Py_BuildValue("n", self->match_end);
+        if (!item)
+            goto error;
 
-    for (g = 0; g < PyList_GET_SIZE(keys); g++) {
-        PyObject* key;
-        PyObject* value;
-        Py_ssize_t v;
-        int status;
+        /* PyList_SET_ITEM borrows the reference. */
+        PyList_SET_ITEM(result, 0, item);
 
-        /* PyList_GET_ITEM borrows a reference. */
-        key = PyList_GET_ITEM(keys, g);
-        if (!key)
-            goto failed;
+        return result;
+    }
 
-        /* PyList_GET_ITEM borrows a reference. */
-        value = PyList_GET_ITEM(values, g);
-        if (!value)
-            goto failed;
+    /* Capture group indexes are 1-based (excluding group 0, which is the
+     * entire matched string).
+     */
+    group = &self->groups[index - 1];
 
-        v = PyLong_AsLong(value);
-        if (v == -1 && PyErr_Occurred())
-            goto failed;
+    result = PyList_New((Py_ssize_t)group->capture_count);
+    if (!result)
+        return NULL;
 
-        value = make_capture_object(match_indirect, v);
-        if (!value)
-            goto failed;
+    for (i = 0; i < group->capture_count; i++) {
+        item = Py_BuildValue("n", group->captures[i].end);
+        if (!item)
+            goto error;
 
-        status = PyDict_SetItem(result, key, value);
-        Py_DECREF(value);
-        if (status < 0)
-            goto failed;
+        /* PyList_SET_ITEM borrows the reference. */
+        PyList_SET_ITEM(result, i, item);
     }
 
-    Py_DECREF(values);
-    Py_DECREF(keys);
-
     return result;
 
-failed:
-    Py_XDECREF(values);
-    Py_XDECREF(keys);
+error:
     Py_DECREF(result);
     return NULL;
 }
 
-/* MatchObject's 'expandf' method. */
-static PyObject* match_expandf(MatchObject* self, PyObject* str_template) {
-    PyObject* format_func;
-    PyObject* args = NULL;
-    size_t g;
-    PyObject* kwargs = NULL;
-    PyObject* result;
+/* Gets a MatchObject's span by integer index. */
+static PyObject* match_get_span_by_index(MatchObject* self, Py_ssize_t index) {
+    RE_GroupSpan* span;
 
-    format_func = PyObject_GetAttrString(str_template, "format");
-    if (!format_func)
+    if (index < 0 || (size_t)index > self->group_count) {
+        /* Raise error if we were given a bad group number. */
+        set_error(RE_ERROR_NO_SUCH_GROUP, NULL);
         return NULL;
+    }
 
-    args = PyTuple_New((Py_ssize_t)self->group_count + 1);
-    if (!args)
-        goto error;
-
-    for (g = 0; g < self->group_count + 1; g++)
-        /* PyTuple_SetItem borrows the reference. */
-        PyTuple_SetItem(args, (Py_ssize_t)g, make_capture_object(&self,
-          (Py_ssize_t)g));
-
-    kwargs = make_capture_dict(self, &self);
-    if (!kwargs)
-        goto error;
-
-    result = PyObject_Call(format_func, args, kwargs);
-
-    Py_DECREF(kwargs);
-    Py_DECREF(args);
-    Py_DECREF(format_func);
-
-    return result;
+    if (index == 0)
+        return Py_BuildValue("nn", self->match_start, self->match_end);
 
-error:
-    Py_XDECREF(args);
-    Py_DECREF(format_func);
-    return NULL;
+    /* Capture group indexes are 1-based (excluding group 0, which is the
+     * entire matched string).
+     */
+    span = &self->groups[index - 1].span;
+    return Py_BuildValue("nn", span->start, span->end);
 }
 
-Py_LOCAL_INLINE(PyObject*) make_match_copy(MatchObject* self);
+/* Gets a MatchObject's spans by integer index. */
+static PyObject* match_get_spans_by_index(MatchObject* self, Py_ssize_t index)
+  {
+    PyObject* result;
+    PyObject* item;
+    RE_GroupData* group;
+    size_t i;
 
-/* MatchObject's '__copy__' method. */
-static PyObject* match_copy(MatchObject* self, PyObject *unused) {
-    return make_match_copy(self);
-}
+    if (index < 0 || (size_t)index > self->group_count) {
+        /* Raise error if we were given a bad group number. */
+        set_error(RE_ERROR_NO_SUCH_GROUP, NULL);
+        return NULL;
+    }
 
-/* MatchObject's '__deepcopy__' method. */
-static PyObject* match_deepcopy(MatchObject* self, PyObject* memo) {
-    return make_match_copy(self);
-}
+    if (index == 0) {
+        result = PyList_New(1);
+        if (!result)
+            return NULL;
 
-/* MatchObject's 'regs' attribute. */
-static PyObject* match_regs(MatchObject* self) {
-    PyObject* regs;
-    PyObject* item;
-    size_t g;
+        item = Py_BuildValue("nn", self->match_start, self->match_end);
+        if (!item)
+            goto error;
 
-    regs = PyTuple_New((Py_ssize_t)self->group_count + 1);
-    if (!regs)
-        return NULL;
+        /* PyList_SET_ITEM borrows the reference. */
+        PyList_SET_ITEM(result, 0, item);
 
-    item = Py_BuildValue("nn", self->match_start, self->match_end);
-    if (!item)
-        goto error;
+        return result;
+    }
 
-    /* PyTuple_SET_ITEM borrows the reference. */
-    PyTuple_SET_ITEM(regs, 0, item);
+    /* Capture group indexes are 1-based (excluding group 0, which is the
+     * entire matched string).
+     */
+    group = &self->groups[index - 1];
 
-    for (g = 0; g < self->group_count; g++) {
-        RE_GroupSpan* span;
+    result = PyList_New((Py_ssize_t)group->capture_count);
+    if (!result)
+        return NULL;
 
-        span = &self->groups[g].span;
-        item = Py_BuildValue("nn", span->start, span->end);
+    for (i = 0; i < group->capture_count; i++) {
+        item = Py_BuildValue("nn", group->captures[i].start,
+          group->captures[i].end);
         if (!item)
             goto error;
 
-        /* PyTuple_SET_ITEM borrows the reference. */
-        PyTuple_SET_ITEM(regs, g + 1, item);
+        /* PyList_SET_ITEM borrows the reference. */
+        PyList_SET_ITEM(result, i, item);
     }
 
-    Py_INCREF(regs);
-    self->regs = regs;
-
-    return regs;
+    return result;
 
 error:
-    Py_DECREF(regs);
+    Py_DECREF(result);
     return NULL;
 }
 
-/* MatchObject's slice method. */
-Py_LOCAL_INLINE(PyObject*) match_get_group_slice(MatchObject* self, PyObject*
-  slice) {
-    Py_ssize_t start;
-    Py_ssize_t end;
-    Py_ssize_t step;
-    Py_ssize_t slice_length;
+/* Gets a MatchObject's captures by integer index. */
+static PyObject* match_get_captures_by_index(MatchObject* self, Py_ssize_t
+  index) {
+    PyObject* result;
+    PyObject* slice;
+    RE_GroupData* group;
+    size_t i;
 
-#if PY_VERSION_HEX >= 0x03020000
-    if (PySlice_GetIndicesEx(slice, (Py_ssize_t)self->group_count + 1, &start,
-      &end, &step, &slice_length) < 0)
-#else
-    if (PySlice_GetIndicesEx((PySliceObject*)slice,
-      (Py_ssize_t)self->group_count + 1, &start, &end, &step, &slice_length) <
-      0)
-#endif
+    if (index < 0 || (size_t)index > self->group_count) {
+        /* Raise error if we were given a bad group number. */
+        set_error(RE_ERROR_NO_SUCH_GROUP, NULL);
         return NULL;
+    }
 
-    if (slice_length <= 0)
-        return PyTuple_New(0);
-    else {
-        PyObject* result;
-        Py_ssize_t cur;
-        Py_ssize_t i;
-
-        result = PyTuple_New(slice_length);
+    if (index == 0) {
+        result = PyList_New(1);
         if (!result)
             return NULL;
 
-        cur = start;
-        for (i = 0; i < slice_length; i++) {
-            /* PyTuple_SetItem borrows the reference. */
-            PyTuple_SetItem(result, i, match_get_group_by_index(self, cur,
-              Py_None));
-            cur += step;
-        }
+        slice = get_slice(self->substring, self->match_start -
+          self->substring_offset, self->match_end - self->substring_offset);
+        if (!slice)
+            goto error;
+
+        /* PyList_SET_ITEM borrows the reference. */
+        PyList_SET_ITEM(result, 0, slice);
 
         return result;
     }
-}
 
-/* MatchObject's length method. */
-Py_LOCAL_INLINE(Py_ssize_t) match_length(MatchObject* self) {
-    return (Py_ssize_t)self->group_count + 1;
+    /* Capture group indexes are 1-based (excluding group 0, which is the
+     * entire matched string).
+     */
+    group = &self->groups[index - 1];
+
+    result = PyList_New((Py_ssize_t)group->capture_count);
+    if (!result)
+        return NULL;
+
+    for (i = 0; i < group->capture_count; i++) {
+        slice = get_slice(self->substring, group->captures[i].start -
+          self->substring_offset, group->captures[i].end -
+          self->substring_offset);
+        if (!slice)
+            goto error;
+
+        /* PyList_SET_ITEM borrows the reference. */
+        PyList_SET_ITEM(result, i, slice);
+    }
+
+    return result;
+
+error:
+    Py_DECREF(result);
+    return NULL;
 }
 
-/* MatchObject's '__getitem__' method. */
-static PyObject* match_getitem(MatchObject* self, PyObject* item) {
-    if (PySlice_Check(item))
-        return match_get_group_slice(self, item);
+/* Converts a group index to an integer. */
+Py_LOCAL_INLINE(Py_ssize_t) as_group_index(PyObject* obj) {
+    Py_ssize_t value;
 
-    return match_get_group(self, item, Py_None, TRUE);
+    value = PyLong_AsLong(obj);
+    if (value != -1 || !PyErr_Occurred())
+        return value;
+
+    set_error(RE_ERROR_INDEX, NULL);
+    return -1;
 }
 
-/* Determines the portion of the target string which is covered by the group
- * captures.
+/* Gets a MatchObject's group index.
+ *
+ * The supplied index can be an integer or a string (group name) object.
  */
-Py_LOCAL_INLINE(void) determine_target_substring(MatchObject* match,
-  Py_ssize_t* slice_start, Py_ssize_t* slice_end) {
-    Py_ssize_t start;
-    Py_ssize_t end;
-    size_t g;
+Py_LOCAL_INLINE(Py_ssize_t) match_get_group_index(MatchObject* self, PyObject*
+  index, BOOL allow_neg) {
+    Py_ssize_t group;
 
-    start = match->pos;
-    end = match->endpos;
+    /* Is the index an integer? */
+    group = as_group_index(index);
+    if (group != -1 || !PyErr_Occurred()) {
+        Py_ssize_t min_group = 0;
 
-    for (g = 0; g < match->group_count; g++) {
-        RE_GroupSpan* span;
-        size_t c;
+        /* Adjust negative indices where valid and allowed. */
+        if (group < 0 && allow_neg) {
+            group += (Py_ssize_t)self->group_count + 1;
+            min_group = 1;
+        }
 
-        span = &match->groups[g].span;
-        if (span->start >= 0 && span->start < start)
-            start = span->start;
-        if (span->end >= 0 && span->end > end)
-            end = span->end;
+        if (min_group <= group && (size_t)group <= self->group_count)
+            return group;
 
-        for (c = 0; c < match->groups[g].capture_count; c++) {
-            RE_GroupSpan* span;
+        return -1;
+    }
 
-            span = match->groups[g].captures;
-            if (span->start >= 0 && span->start < start)
-                start = span->start;
-            if (span->end >= 0 && span->end > end)
-                end = span->end;
+    /* The index might be a group name. */
+    if (self->pattern->groupindex) {
+        /* Look up the name. */
+        PyErr_Clear();
+
+        index = PyObject_GetItem(self->pattern->groupindex, index);
+        if (index) {
+            /* Check that we have an integer. */
+            group = as_group_index(index);
+            Py_DECREF(index);
+            if (group != -1 || !PyErr_Occurred())
+                return group;
         }
     }
 
-    *slice_start = start;
-    *slice_end = end;
+    PyErr_Clear();
+    return -1;
 }
 
-/* MatchObject's 'detach_string' method. */
-static PyObject* match_detach_string(MatchObject* self, PyObject* unused) {
-    if (self->string) {
-        Py_ssize_t start;
-        Py_ssize_t end;
-        PyObject* substring;
+/* Gets a MatchObject's group by object index. */
+Py_LOCAL_INLINE(PyObject*) match_get_group(MatchObject* self, PyObject* index,
+  PyObject* def, BOOL allow_neg) {
+    /* Check that the index is an integer or a string. */
+    if (PyLong_Check(index) || PyUnicode_Check(index) || PyBytes_Check(index))
+        return match_get_group_by_index(self, match_get_group_index(self,
+          index, allow_neg), def);
 
-        determine_target_substring(self, &start, &end);
+    set_error(RE_ERROR_GROUP_INDEX_TYPE, index);
+    return NULL;
+}
 
-        substring = get_slice(self->string, start, end);
-        if (substring) {
-            Py_XDECREF(self->substring);
-            self->substring = substring;
-            self->substring_offset = start;
+/* Gets info from a MatchObject by object index. */
+Py_LOCAL_INLINE(PyObject*) get_by_arg(MatchObject* self, PyObject* index,
+  RE_GetByIndexFunc get_by_index) {
+    /* Check that the index is an integer or a string. */
+    if (PyLong_Check(index) || PyUnicode_Check(index) || PyBytes_Check(index))
+        return get_by_index(self, match_get_group_index(self, index, FALSE));
 
-            Py_DECREF(self->string);
-            self->string = NULL;
+    set_error(RE_ERROR_GROUP_INDEX_TYPE, index);
+    return NULL;
+}
+
+/* MatchObject's 'group' method. */
+static PyObject* match_group(MatchObject* self, PyObject* args) {
+    Py_ssize_t size;
+    PyObject* result;
+    Py_ssize_t i;
+
+    size = PyTuple_GET_SIZE(args);
+
+    switch (size) {
+    case 0:
+        /* group() */
+        result = match_get_group_by_index(self, 0, Py_None);
+        break;
+    case 1:
+        /* group(x). PyTuple_GET_ITEM borrows the reference. */
+        result = match_get_group(self, PyTuple_GET_ITEM(args, 0), Py_None,
+          FALSE);
+        break;
+    default:
+        /* group(x, y, z, ...) */
+        /* Fetch multiple items. */
+        result = PyTuple_New(size);
+        if (!result)
+            return NULL;
+
+        for (i = 0; i < size; i++) {
+            PyObject* item;
+
+            /* PyTuple_GET_ITEM borrows the reference. */
+            item = match_get_group(self, PyTuple_GET_ITEM(args, i), Py_None,
+              FALSE);
+            if (!item) {
+                Py_DECREF(result);
+                return NULL;
+            }
+
+            /* PyTuple_SET_ITEM borrows the reference. */
+            PyTuple_SET_ITEM(result, i, item);
         }
+        break;
     }
 
-    Py_INCREF(Py_None);
-    return Py_None;
+    return result;
 }
 
-/* The documentation of a MatchObject. */
-PyDoc_STRVAR(match_group_doc,
-    "group([group1, ...]) --> string or tuple of strings.\n\
-    Return one or more subgroups of the match.  If there is a single argument,\n\
-    the result is a single string, or None if the group did not contribute to\n\
-    the match; if there are multiple arguments, the result is a tuple with one\n\
-    item per argument; if there are no arguments, the whole match is returned.\n\
-    Group 0 is the whole match.");
+/* Generic method for getting info from a MatchObject. */
+Py_LOCAL_INLINE(PyObject*) get_from_match(MatchObject* self, PyObject* args,
+  RE_GetByIndexFunc get_by_index) {
+    Py_ssize_t size;
+    PyObject* result;
+    Py_ssize_t i;
 
-PyDoc_STRVAR(match_start_doc,
-    "start([group1, ...]) --> int or tuple of ints.\n\
-    Return the index of the start of one or more subgroups of the match.  If\n\
-    there is a single argument, the result is an index, or -1 if the group did\n\
-    not contribute to the match; if there are multiple arguments, the result is\n\
-    a tuple with one item per argument; if there are no arguments, the index of\n\
-    the start of the whole match is returned.  Group 0 is the whole match.");
+    size = PyTuple_GET_SIZE(args);
 
-PyDoc_STRVAR(match_end_doc,
-    "end([group1, ...]) --> int or tuple of ints.\n\
-    Return the index of the end of one or more subgroups of the match.  If there\n\
-    is a single argument, the result is an index, or -1 if the group did not\n\
-    contribute to the match; if there are multiple arguments, the result is a\n\
-    tuple with one item per argument; if there are no arguments, the index of\n\
-    the end of the whole match is returned.  Group 0 is the whole match.");
+    switch (size) {
+    case 0:
+        /* get() */
+        result = get_by_index(self, 0);
+        break;
+    case 1:
+        /* get(x). PyTuple_GET_ITEM borrows the reference. */
+        result = get_by_arg(self, PyTuple_GET_ITEM(args, 0), get_by_index);
+        break;
+    default:
+        /* get(x, y, z, ...) */
+        /* Fetch multiple items. */
+        result = PyTuple_New(size);
+        if (!result)
+            return NULL;
 
-PyDoc_STRVAR(match_span_doc,
-    "span([group1, ...]) --> 2-tuple of int or tuple of 2-tuple of ints.\n\
-    Return the span (a 2-tuple of the indices of the start and end) of one or\n\
-    more subgroups of the match.  If there is a single argument, the result is a\n\
-    span, or (-1, -1) if the group did not contribute to the match; if there are\n\
-    multiple arguments, the result is a tuple with one item per argument; if\n\
-    there are no arguments, the span of the whole match is returned.  Group 0 is\n\
-    the whole match.");
+        for (i = 0; i < size; i++) {
+            PyObject* item;
 
-PyDoc_STRVAR(match_groups_doc,
-    "groups(default=None) --> tuple of strings.\n\
-    Return a tuple containing all the subgroups of the match.  The argument is\n\
-    the default for groups that did not participate in the match.");
+            /* PyTuple_GET_ITEM borrows the reference. */
+            item = get_by_arg(self, PyTuple_GET_ITEM(args, i), get_by_index);
+            if (!item) {
+                Py_DECREF(result);
+                return NULL;
+            }
 
-PyDoc_STRVAR(match_groupdict_doc,
-    "groupdict(default=None) --> dict.\n\
-    Return a dictionary containing all the named subgroups of the match, keyed\n\
-    by the subgroup name.  The argument is the value to be given for groups that\n\
-    did not participate in the match.");
+            /* PyTuple_SET_ITEM borrows the reference. */
+            PyTuple_SET_ITEM(result, i, item);
+        }
+        break;
+    }
 
-PyDoc_STRVAR(match_capturesdict_doc,
-    "capturesdict() --> dict.\n\
-    Return a dictionary containing the captures of all the named subgroups of the\n\
-    match, keyed by the subgroup name.");
+    return result;
+}
 
-PyDoc_STRVAR(match_expand_doc,
-    "expand(template) --> string.\n\
-    Return the string obtained by doing backslash substitution on the template,\n\
-    as done by the sub() method.");
+/* Gets a MatchObject's group by integer index as a memoryview. */
+static PyObject* match_get_group_view_by_index(MatchObject* self, Py_ssize_t
+  index) {
+    Py_ssize_t start;
+    Py_ssize_t end;
+    PyObject* view;
+    PyObject* result;
 
-PyDoc_STRVAR(match_expandf_doc,
-    "expandf(format) --> string.\n\
-    Return the string obtained by using the format, as done by the subf()\n\
-    method.");
+    if (index < 0 || (size_t)index > self->group_count) {
+        /* Raise error if we were given a bad group number. */
+        set_error(RE_ERROR_NO_SUCH_GROUP, NULL);
+        return NULL;
+    }
 
-PyDoc_STRVAR(match_captures_doc,
-    "captures([group1, ...]) --> list of strings or tuple of list of strings.\n\
-    Return the captures of one or more subgroups of the match.  If there is a\n\
-    single argument, the result is a list of strings; if there are multiple\n\
-    arguments, the result is a tuple of lists with one item per argument; if\n\
-    there are no arguments, the captures of the whole match is returned.  Group\n\
-    0 is the whole match.");
+    if (index == 0) {
+        start = self->match_start;
+        end = self->match_end;
+    } else {
+        RE_GroupSpan* span;
 
-PyDoc_STRVAR(match_starts_doc,
-    "starts([group1, ...]) --> list of ints or tuple of list of ints.\n\
-    Return the indices of the starts of the captures of one or more subgroups of\n\
-    the match.  If there is a single argument, the result is a list of indices;\n\
-    if there are multiple arguments, the result is a tuple of lists with one\n\
-    item per argument; if there are no arguments, the indices of the starts of\n\
-    the captures of the whole match is returned.  Group 0 is the whole match.");
+        span = &self->groups[index - 1].span;
 
-PyDoc_STRVAR(match_ends_doc,
-    "ends([group1, ...]) --> list of ints or tuple of list of ints.\n\
-    Return the indices of the ends of the captures of one or more subgroups of\n\
-    the match.  If there is a single argument, the result is a list of indices;\n\
-    if there are multiple arguments, the result is a tuple of lists with one\n\
-    item per argument; if there are no arguments, the indices of the ends of the\n\
-    captures of the whole match is returned.  Group 0 is the whole match.");
+        if (span->start < 0 || span->end < 0) {
+            /* The group is undefined. */
+            Py_INCREF(Py_None);
+            return Py_None;
+        }
 
-PyDoc_STRVAR(match_spans_doc,
-    "spans([group1, ...]) --> list of 2-tuple of ints or tuple of list of 2-tuple of ints.\n\
-    Return the spans (a 2-tuple of the indices of the start and end) of the\n\
-    captures of one or more subgroups of the match.  If there is a single\n\
-    argument, the result is a list of spans; if there are multiple arguments,\n\
-    the result is a tuple of lists with one item per argument; if there are no\n\
-    arguments, the spans of the captures of the whole match is returned.  Group\n\
-    0 is the whole match.");
+        start = span->start;
+        end = span->end;
+    }
 
-PyDoc_STRVAR(match_detach_string_doc,
-    "detach_string()\n\
-    Detaches the target string from the match object. The 'string' attribute\n\
-    will become None.");
+    /* A str has no buffer that's indexed by codepoint. */
+    if (PyUnicode_Check(self->substring)) {
+        PyErr_SetString(PyExc_TypeError,
+          "group_view() requires a bytes-like string");
+        return NULL;
+    }
 
-/* MatchObject's methods. */
-static PyMethodDef match_methods[] = {
-    {"group", (PyCFunction)match_group, METH_VARARGS, match_group_doc},
-    {"start", (PyCFunction)match_start, METH_VARARGS, match_start_doc},
-    {"end", (PyCFunction)match_end, METH_VARARGS, match_end_doc},
-    {"span", (PyCFunction)match_span, METH_VARARGS, match_span_doc},
-    {"groups", (PyCFunction)match_groups, METH_VARARGS|METH_KEYWORDS,
-      match_groups_doc},
-    {"groupdict", (PyCFunction)match_groupdict, METH_VARARGS|METH_KEYWORDS,
-      match_groupdict_doc},
-    {"capturesdict", (PyCFunction)match_capturesdict, METH_NOARGS,
-      match_capturesdict_doc},
-    {"expand", (PyCFunction)match_expand, METH_O, match_expand_doc},
-    {"expandf", (PyCFunction)match_expandf, METH_O, match_expandf_doc},
-    {"captures", (PyCFunction)match_captures, METH_VARARGS,
-      match_captures_doc},
-    {"starts", (PyCFunction)match_starts, METH_VARARGS, match_starts_doc},
-    {"ends", (PyCFunction)match_ends, METH_VARARGS, match_ends_doc},
-    {"spans", (PyCFunction)match_spans, METH_VARARGS, match_spans_doc},
-    {"detach_string", (PyCFunction)match_detach_string, METH_NOARGS,
-      match_detach_string_doc},
-    {"__copy__", (PyCFunction)match_copy, METH_NOARGS},
-    {"__deepcopy__", (PyCFunction)match_deepcopy, METH_O},
-    {"__getitem__", (PyCFunction)match_getitem, METH_O|METH_COEXIST},
-    {NULL, NULL}
-};
+    view = PyMemoryView_FromObject(self->substring);
+    if (!view)
+        return NULL;
 
-PyDoc_STRVAR(match_doc, "Match object");
+    result = PySequence_GetSlice(view, start - self->substring_offset, end -
+      self->substring_offset);
+    Py_DECREF(view);
 
-/* MatchObject's 'lastindex' attribute. */
-static PyObject* match_lastindex(PyObject* self_) {
-    MatchObject* self;
+    return result;
+}
 
-    self = (MatchObject*)self_;
+/* MatchObject's 'group_view' method. */
+static PyObject* match_group_view(MatchObject* self, PyObject* args) {
+    return get_from_match(self, args, match_get_group_view_by_index);
+}
 
-    if (self->lastindex >= 0)
-        return Py_BuildValue("n", self->lastindex);
-
-    Py_INCREF(Py_None);
-    return Py_None;
+/* MatchObject's 'start' method. */
+static PyObject* match_start(MatchObject* self, PyObject* args) {
+    return get_from_match(self, args, match_get_start_by_index);
 }
 
-/* MatchObject's 'lastgroup' attribute. */
-static PyObject* match_lastgroup(PyObject* self_) {
-    MatchObject* self;
-
-    self = (MatchObject*)self_;
-
-    if (self->pattern->indexgroup && self->lastgroup >= 0) {
-        PyObject* index;
-        PyObject* result;
-
-        index = Py_BuildValue("n", self->lastgroup);
+/* MatchObject's 'starts' method. */
+static PyObject* match_starts(MatchObject* self, PyObject* args) {
+    return get_from_match(self, args, match_get_starts_by_index);
+}
 
-        /* PyDict_GetItem returns borrows a reference. */
-        result = PyDict_GetItem(self->pattern->indexgroup, index);
-        Py_DECREF(index);
-        if (result) {
-            Py_INCREF(result);
-            return result;
-        }
-        PyErr_Clear();
-    }
+/* MatchObject's 'end' method. */
+static PyObject* match_end(MatchObject* self, PyObject* args) {
+    return get_from_match(self, args, match_get_end_by_index);
+}
 
-    Py_INCREF(Py_None);
-    return Py_None;
+/* MatchObject's 'ends' method. */
+static PyObject* match_ends(MatchObject* self, PyObject* args) {
+    return get_from_match(self, args, match_get_ends_by_index);
 }
 
-/* MatchObject's 'string' attribute. */
-static PyObject* match_string(PyObject* self_) {
-    MatchObject* self;
+/* MatchObject's 'span' method. */
+static PyObject* match_span(MatchObject* self, PyObject* args) {
+    return get_from_match(self, args, match_get_span_by_index);
+}
 
-    self = (MatchObject*)self_;
+/* MatchObject's 'spans' method. */
+static PyObject* match_spans(MatchObject* self, PyObject* args) {
+    return get_from_match(self, args, match_get_spans_by_index);
+}
 
-    if (self->string) {
-        Py_INCREF(self->string);
-        return self->string;
-    } else {
-        Py_INCREF(Py_None);
-        return Py_None;
-    }
+/* MatchObject's 'captures' method. */
+static PyObject* match_captures(MatchObject* self, PyObject* args) {
+    return get_from_match(self, args, match_get_captures_by_index);
 }
 
-/* MatchObject's 'fuzzy_counts' attribute. */
-static PyObject* match_fuzzy_counts(PyObject* self_) {
-    MatchObject* self;
+/* MatchObject's 'groups' method. */
+static PyObject* match_groups(MatchObject* self, PyObject* args, PyObject*
+  kwargs) {
+    PyObject* result;
+    size_t g;
 
-    self = (MatchObject*)self_;
+    PyObject* def = Py_None;
+    static char* kwlist[] = { "default", NULL };
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "|O:groups", kwlist, &def))
+        return NULL;
 
-    return Py_BuildValue("nnn", self->fuzzy_counts[RE_FUZZY_SUB],
-      self->fuzzy_counts[RE_FUZZY_INS], self->fuzzy_counts[RE_FUZZY_DEL]);
-}
+    result = PyTuple_New((Py_ssize_t)self->group_count);
+    if (!result)
+        return NULL;
 
-static PyGetSetDef match_getset[] = {
-    {"lastindex", (getter)match_lastindex, (setter)NULL,
-      "The group number of the last matched capturing group, or None."},
-    {"lastgroup", (getter)match_lastgroup, (setter)NULL,
-      "The name of the last matched capturing group, or None."},
-    {"regs", (getter)match_regs, (setter)NULL,
-      "A tuple of the spans of the capturing groups."},
-    {"string", (getter)match_string, (setter)NULL,
-      "The string that was searched, or None if it has been detached."},
-    {"fuzzy_counts", (getter)match_fuzzy_counts, (setter)NULL,
-      "A tuple of the number of substitutions, insertions and deletions."},
-    {NULL}  /* Sentinel */
-};
+    /* Group 0 is the entire matched portion of the string. */
+    for (g = 0; g < self->group_count; g++) {
+        PyObject* item;
 
-static PyMemberDef match_members[] = {
-    {"re", T_OBJECT, offsetof(MatchObject, pattern), READONLY,
-      "The regex object that produced this match object."},
-    {"pos", T_PYSSIZET, offsetof(MatchObject, pos), READONLY,
-      "The position at which the regex engine starting searching."},
-    {"endpos", T_PYSSIZET, offsetof(MatchObject, endpos), READONLY,
-      "The final position beyond which the regex engine won't search."},
-    {"partial", T_BOOL, offsetof(MatchObject, partial), READONLY,
-      "Whether it's a partial match."},
-    {NULL}  /* Sentinel */
-};
+        item = match_get_group_by_index(self, (Py_ssize_t)g + 1, def);
+        if (!item)
+            goto error;
 
-static PyMappingMethods match_as_mapping = {
-    (lenfunc)match_length,       /* mp_length */
-    (binaryfunc)match_getitem,   /* mp_subscript */
-    0,                           /* mp_ass_subscript */
-};
+        /* PyTuple_SET_ITEM borrows the reference. */
+        PyTuple_SET_ITEM(result, g, item);
+    }
 
-static PyTypeObject Match_Type = {
-    PyVarObject_HEAD_INIT(NULL,0)
-    "_" RE_MODULE "." "Match",
-    sizeof(MatchObject)
-};
+    return result;
 
-/* Copies the groups. */
-Py_LOCAL_INLINE(RE_GroupData*) copy_groups(RE_GroupData* groups, size_t
-  group_count) {
-    size_t span_count;
-    size_t g;
-    RE_GroupData* groups_copy;
-    RE_GroupSpan* spans_copy;
-    size_t offset;
+error:
+    Py_DECREF(result);
+    return NULL;
+}
 
-    /* Calculate the total size of the group info. */
-    span_count = 0;
-    for (g = 0; g < group_count; g++)
-        span_count += groups[g].capture_count;
+/* MatchObject's 'groupdict' method. */
+static PyObject* match_groupdict(MatchObject* self, PyObject* args, PyObject*
+  kwargs) {
+    PyObject* result;
+    PyObject* keys;
+    Py_ssize_t g;
 
-    /* Allocate the storage for the group info in a single block. */
-    groups_copy = (RE_GroupData*)re_alloc(group_count * sizeof(RE_GroupData) +
-      span_count * sizeof(RE_GroupSpan));
-    if (!groups_copy)
+    PyObject* def = Py_None;
+    static char* kwlist[] = { "default", NULL };
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "|O:groupdict", kwlist,
+      &def))
         return NULL;
 
-    /* The storage for the spans comes after the other group info. */
-    spans_copy = (RE_GroupSpan*)&groups_copy[group_count];
+    result = PyDict_New();
+    if (!result || !self->pattern->groupindex)
+        return result;
 
-    /* There's no need to initialise the spans info. */
-    memset(groups_copy, 0, group_count * sizeof(RE_GroupData));
+    keys = PyMapping_Keys(self->pattern->groupindex);
+    if (!keys)
+        goto failed;
 
-    offset = 0;
-    for (g = 0; g < group_count; g++) {
-        RE_GroupData* orig;
-        RE_GroupData* copy;
+    for (g = 0; g < PyList_GET_SIZE(keys); g++) {
+        PyObject* key;
+        PyObject* value;
+        int status;
 
-        orig = &groups[g];
-        copy = &groups_copy[g];
-        copy->span = orig->span;
+        /* PyList_GET_ITEM borrows a reference. */
+        key = PyList_GET_ITEM(keys, g);
+        if (!key)
+            goto failed;
 
-        copy->captures = &spans_copy[offset];
-        offset += orig->capture_count;
+        value = match_get_group(self, key, def, FALSE);
+        if (!value)
+            goto failed;
 
-        if (orig->capture_count > 0) {
-            Py_MEMCPY(copy->captures, orig->captures, orig->capture_count *
-              sizeof(RE_GroupSpan));
-            copy->capture_capacity = orig->capture_count;
-            copy->capture_count = orig->capture_count;
-        }
+        status = PyDict_SetItem(result, key, value);
+        Py_DECREF(value);
+        if (status < 0)
+            goto failed;
     }
 
-    return groups_copy;
-}
+    Py_DECREF(keys);
 
-/* Makes a copy of a MatchObject. */
-Py_LOCAL_INLINE(PyObject*) make_match_copy(MatchObject* self) {
-    MatchObject* match;
+    return result;
 
-    if (!self->string) {
-        /* The target string has been detached, so the MatchObject is now
-         * immutable.
-         */
-        Py_INCREF(self);
-        return (PyObject*)self;
-    }
+failed:
+    Py_XDECREF(keys);
+    Py_DECREF(result);
+    return NULL;
+}
 
-    /* Create a MatchObject. */
-    match = PyObject_NEW(MatchObject, &Match_Type);
-    if (!match)
-        return NULL;
+/* MatchObject's 'capturesdict' method. */
+static PyObject* match_capturesdict(MatchObject* self) {
+    PyObject* result;
+    PyObject* keys;
+    Py_ssize_t g;
 
-    Py_MEMCPY(match, self, sizeof(MatchObject));
+    result = PyDict_New();
+    if (!result || !self->pattern->groupindex)
+        return result;
 
-    Py_INCREF(match->string);
-    Py_INCREF(match->substring);
-    Py_INCREF(match->pattern);
+    keys = PyMapping_Keys(self->pattern->groupindex);
+    if (!keys)
+        goto failed;
 
-    /* Copy the groups to the MatchObject. */
-    if (self->group_count > 0) {
-        match->groups = copy_groups(self->groups, self->group_count);
-        if (!match->groups) {
-            Py_DECREF(match);
-            return NULL;
-        }
-    }
+    for (g = 0; g < PyList_GET_SIZE(keys); g++) {
+        PyObject* key;
+        Py_ssize_t group;
+        PyObject* captures;
+        int status;
 
-    return (PyObject*)match;
-}
+        /* PyList_GET_ITEM borrows a reference. */
+        key = PyList_GET_ITEM(keys, g);
+        if (!key)
+            goto failed;
 
-/* Creates a new MatchObject. */
-Py_LOCAL_INLINE(PyObject*) pattern_new_match(PatternObject* pattern, RE_State*
-  state, int status) {
-    /* Create MatchObject (from state object). */
-    if (status > 0 || status == RE_ERROR_PARTIAL) {
-        MatchObject* match;
-
-        /* Create a MatchObject. */
-        match = PyObject_NEW(MatchObject, &Match_Type);
-        if (!match)
-            return NULL;
+        group = match_get_group_index(self, key, FALSE);
+        if (group < 0)
+            goto failed;
 
-        match->string = state->string;
-        match->substring = state->string;
-        match->substring_offset = 0;
-        match->pattern = pattern;
-        match->regs = NULL;
+        captures = match_get_captures_by_index(self, group);
+        if (!captures)
+            goto failed;
 
-        if (pattern->is_fuzzy) {
-            match->fuzzy_counts[RE_FUZZY_SUB] =
-              state->total_fuzzy_counts[RE_FUZZY_SUB];
-            match->fuzzy_counts[RE_FUZZY_INS] =
-              state->total_fuzzy_counts[RE_FUZZY_INS];
-            match->fuzzy_counts[RE_FUZZY_DEL] =
-              state->total_fuzzy_counts[RE_FUZZY_DEL];
-        } else
-            memset(match->fuzzy_counts, 0, sizeof(match->fuzzy_counts));
+        status = PyDict_SetItem(result, key, captures);
+        Py_DECREF(captures);
+        if (status < 0)
+            goto failed;
+    }
 
-        match->partial = status == RE_ERROR_PARTIAL;
-        Py_INCREF(match->string);
-        Py_INCREF(match->substring);
-        Py_INCREF(match->pattern);
+    Py_DECREF(keys);
 
-        /* Copy the groups to the MatchObject. */
-        if (pattern->public_group_count > 0) {
-            match->groups = copy_groups(state->groups,
-              pattern->public_group_count);
-            if (!match->groups) {
-                Py_DECREF(match);
-                return NULL;
-            }
-        } else
-            match->groups = NULL;
+    return result;
 
-        match->group_count = pattern->public_group_count;
+failed:
+    Py_XDECREF(keys);
+    Py_DECREF(result);
+    return NULL;
+}
 
-        match->pos = state->slice_start;
-        match->endpos = state->slice_end;
+/* Gets a Python object by name from a named module. */
+Py_LOCAL_INLINE(PyObject*) get_object(char* module_name, char* object_name) {
+    PyObject* module;
+    PyObject* object;
 
-        if (state->reverse) {
-            match->match_start = state->text_pos;
-            match->match_end = state->match_pos;
-        } else {
-            match->match_start = state->match_pos;
-            match->match_end = state->text_pos;
-        }
+    module = PyImport_ImportModule(module_name);
+    if (!module)
+        return NULL;
 
-        match->lastindex = state->lastindex;
-        match->lastgroup = state->lastgroup;
+    object = PyObject_GetAttrString(module, object_name);
+    Py_DECREF(module);
 
-        return (PyObject*)match;
-    } else if (status == 0) {
-        /* No match. */
-        Py_INCREF(Py_None);
-        return Py_None;
-    } else {
-        /* Internal error. */
-        set_error(status, NULL);
-        return NULL;
-    }
+    return object;
 }
 
-/* Gets the text of a capture group from a state. */
-Py_LOCAL_INLINE(PyObject*) state_get_group(RE_State* state, Py_ssize_t index,
-  PyObject* string, BOOL empty) {
-    RE_GroupData* group;
-    Py_ssize_t start;
-    Py_ssize_t end;
+/* Calls a function in a module. */
+Py_LOCAL_INLINE(PyObject*) call(char* module_name, char* function_name,
+  PyObject* args) {
+    PyObject* function;
+    PyObject* result;
 
-    group = &state->groups[index - 1];
+    if (!args)
+        return NULL;
 
-    if (string != Py_None && index >= 1 && (size_t)index <=
-      state->pattern->public_group_count && group->capture_count > 0) {
-        start = group->span.start;
-        end = group->span.end;
-    } else {
-        if (empty)
-            /* Want an empty string. */
-            start = end = 0;
-        else {
-            Py_INCREF(Py_None);
-            return Py_None;
-        }
-    }
+    function = get_object(module_name, function_name);
+    if (!function)
+        return NULL;
 
-    return get_slice(string, start, end);
+    result = PyObject_CallObject(function, args);
+    Py_DECREF(function);
+    Py_DECREF(args);
+
+    return result;
 }
 
-/* Acquires the lock (mutex) on the state if there's one.
+/* Gets a replacement item from the replacement list.
  *
- * It also increments the owner's refcount just to ensure that it won't be
- * destroyed by another thread.
+ * The replacement item could be a string literal or a group.
  */
-Py_LOCAL_INLINE(void) acquire_state_lock(PyObject* owner, RE_SafeState*
-  safe_state) {
-    RE_State* state;
+Py_LOCAL_INLINE(PyObject*) get_match_replacement(MatchObject* self, PyObject*
+  item, size_t group_count) {
+    Py_ssize_t index;
 
-    state = safe_state->re_state;
+    if (PyUnicode_Check(item) || PyBytes_Check(item)) {
+        /* It's a literal, which can be added directly to the list. */
+#if PY_VERSION_HEX >= 0x03040000
 
-    if (state->lock) {
-        /* In order to avoid deadlock we need to release the GIL while trying
-         * to acquire the lock.
+        /* ensure_immutable will DECREF the original item if it has to make an
+         * immutable copy, but that original item might have a borrowed
+         * reference, so we must INCREF it first in order to ensure it won't be
+         * destroyed.
          */
-        Py_INCREF(owner);
-        if (!PyThread_acquire_lock(state->lock, 0)) {
-            release_GIL(safe_state);
-            PyThread_acquire_lock(state->lock, 1);
-            acquire_GIL(safe_state);
-        }
+        Py_INCREF(item);
+        item = ensure_immutable(item);
+#else
+        Py_INCREF(item);
+#endif
+        return item;
     }
-}
-
-/* Releases the lock (mutex) on the state if there's one.
- *
- * It also decrements the owner's refcount, which was incremented when the lock
- * was acquired.
- */
-Py_LOCAL_INLINE(void) release_state_lock(PyObject* owner, RE_SafeState*
-  safe_state) {
-    RE_State* state;
-
-    state = safe_state->re_state;
 
-    if (state->lock) {
-        PyThread_release_lock(state->lock);
-        Py_DECREF(owner);
+    /* Is it a group reference? */
+    index = as_group_index(item);
+    if (index == -1 && PyErr_Occurred()) {
+        /* Not a group either! */
+        set_error(RE_ERROR_REPLACEMENT, NULL);
+        return NULL;
     }
-}
-
-/* Implements the functionality of ScanObject's search and match methods. */
-Py_LOCAL_INLINE(PyObject*) scanner_search_or_match(ScannerObject* self, BOOL
-  search) {
-    RE_State* state;
-    RE_SafeState safe_state;
-    PyObject* match;
-
-    state = &self->state;
 
-    /* Initialise the "safe state" structure. */
-    safe_state.re_state = state;
-    safe_state.thread_state = NULL;
+    if (index == 0) {
+        /* The entire matched portion of the string. */
+        return get_slice(self->substring, self->match_start -
+          self->substring_offset, self->match_end - self->substring_offset);
+    } else if (index >= 1 && (size_t)index <= group_count) {
+        /* A group. If it didn't match then return None instead. */
+        RE_GroupData* group;
 
-    /* Acquire the state lock in case we're sharing the scanner object across
-     * threads.
-     */
-    acquire_state_lock((PyObject*)self, &safe_state);
+        group = &self->groups[index - 1];
 
-    if (self->status == RE_ERROR_FAILURE || self->status == RE_ERROR_PARTIAL) {
-        /* No or partial match. */
-        release_state_lock((PyObject*)self, &safe_state);
-        Py_INCREF(Py_None);
-        return Py_None;
-    } else if (self->status < 0) {
-        /* Internal error. */
-        release_state_lock((PyObject*)self, &safe_state);
-        set_error(self->status, NULL);
+        if (group->capture_count > 0)
+            return get_slice(self->substring, group->span.start -
+              self->substring_offset, group->span.end -
+              self->substring_offset);
+        else {
+            Py_INCREF(Py_None);
+            return Py_None;
+        }
+    } else {
+        /* No such group. */
+        set_error(RE_ERROR_NO_SUCH_GROUP, NULL);
         return NULL;
     }
-
-    /* Look for another match. */
-    self->status = do_match(&safe_state, search);
-    if (self->status >= 0 || self->status == RE_ERROR_PARTIAL) {
-        /* Create the match object. */
-        match = pattern_new_match(self->pattern, state, self->status);
-
-        if (search && state->overlapped) {
-            /* Advance one character. */
-            Py_ssize_t step;
-
-            step = state->reverse ? -1 : 1;
-            state->text_pos = state->match_pos + step;
-            state->must_advance = FALSE;
-        } else
-            /* Continue from where we left off, but don't allow 2 contiguous
-             * zero-width matches.
-             */
-            state->must_advance = state->text_pos == state->match_pos;
-    } else
-        /* Internal error. */
-        match = NULL;
-
-    /* Release the state lock. */
-    release_state_lock((PyObject*)self, &safe_state);
-
-    return match;
 }
 
-/* ScannerObject's 'match' method. */
-static PyObject* scanner_match(ScannerObject* self, PyObject* unused) {
-    return scanner_search_or_match(self, FALSE);
+/* Initialises the join list. */
+Py_LOCAL_INLINE(void) init_join_list(JoinInfo* join_info, BOOL reversed, BOOL
+  is_unicode) {
+    join_info->list = NULL;
+    join_info->item = NULL;
+    join_info->reversed = reversed;
+    join_info->is_unicode = is_unicode;
 }
 
-/* ScannerObject's 'search' method. */
-static PyObject* scanner_search(ScannerObject* self, PyObject *unused) {
-    return scanner_search_or_match(self, TRUE);
-}
+/* Adds an item to the join list. */
+Py_LOCAL_INLINE(int) add_to_join_list(JoinInfo* join_info, PyObject* item) {
+    PyObject* new_item;
+    int status;
 
-/* Returns an iterator for a ScannerObject.
- *
- * The iterator is actually the ScannerObject itself.
- */
-static PyObject* scanner_iter(PyObject* self) {
-    Py_INCREF(self);
-    return self;
-}
+    if (join_info->is_unicode) {
+#if PY_VERSION_HEX >= 0x03040000
+        if (PyUnicode_CheckExact(item)) {
+#else
+        if (PyUnicode_Check(item)) {
+#endif
+            new_item = item;
+            Py_INCREF(new_item);
+        } else {
+            new_item = PyUnicode_FromObject(item);
+            if (!new_item) {
+                set_error(RE_ERROR_NOT_UNICODE, item);
+                return RE_ERROR_NOT_UNICODE;
+            }
+        }
+    } else {
+#if PY_VERSION_HEX >= 0x03040000
+        if (PyBytes_CheckExact(item)) {
+#else
+        if (PyBytes_Check(item)) {
+#endif
+            new_item = item;
+            Py_INCREF(new_item);
+        } else {
+            new_item = PyBytes_FromObject(item);
+            if (!new_item) {
+                set_error(RE_ERROR_NOT_BYTES, item);
+                return RE_ERROR_NOT_BYTES;
+            }
+        }
+    }
 
-/* Gets the next result from a scanner iterator. */
-static PyObject* scanner_iternext(PyObject* self) {
-    PyObject* match;
+    /* If the list already exists then just add the item to it. */
+    if (join_info->list) {
+        status = PyList_Append(join_info->list, new_item);
+        if (status < 0)
+            goto error;
 
-    match = scanner_search((ScannerObject*)self, NULL);
+        Py_DECREF(new_item);
+        return status;
+    }
 
-    if (match == Py_None) {
-        /* No match. */
-        Py_DECREF(match);
-        return NULL;
+    /* If we already have an item then we now have 2(!) and we need to put them
+     * into a list.
+     */
+    if (join_info->item) {
+        join_info->list = PyList_New(2);
+        if (!join_info->list) {
+            status = RE_ERROR_MEMORY;
+            goto error;
+        }
+
+        /* PyList_SET_ITEM borrows the reference. */
+        PyList_SET_ITEM(join_info->list, 0, join_info->item);
+        join_info->item = NULL;
+
+        /* PyList_SET_ITEM borrows the reference. */
+        PyList_SET_ITEM(join_info->list, 1, new_item);
+        return 0;
     }
 
-    return match;
-}
+    /* This is the first item. */
+    join_info->item = new_item;
 
-/* Makes a copy of a ScannerObject.
- *
- * It actually doesn't make a copy, just returns the original object.
- */
-Py_LOCAL_INLINE(PyObject*) make_scanner_copy(ScannerObject* self) {
-    Py_INCREF(self);
-    return (PyObject*)self;
-}
+    return 0;
 
-/* ScannerObject's '__copy__' method. */
-static PyObject* scanner_copy(ScannerObject* self, PyObject *unused) {
-    return make_scanner_copy(self);
+error:
+    Py_DECREF(new_item);
+    set_error(status, NULL);
+    return status;
 }
 
-/* ScannerObject's '__deepcopy__' method. */
-static PyObject* scanner_deepcopy(ScannerObject* self, PyObject* memo) {
-    return make_scanner_copy(self);
+/* Clears the join list. */
+Py_LOCAL_INLINE(void) clear_join_list(JoinInfo* join_info) {
+    Py_XDECREF(join_info->list);
+    Py_XDECREF(join_info->item);
 }
 
-/* The documentation of a ScannerObject. */
-PyDoc_STRVAR(scanner_match_doc,
-    "match() --> MatchObject or None.\n\
-    Match at the current position in the string.");
+/* Joins together a list of strings for pattern_subx. */
+Py_LOCAL_INLINE(PyObject*) join_list_info(JoinInfo* join_info) {
+    /* If the list already exists then just do the join. */
+    if (join_info->list) {
+        PyObject* joiner;
+        PyObject* result;
 
-PyDoc_STRVAR(scanner_search_doc,
-    "search() --> MatchObject or None.\n\
-    Search from the current position in the string.");
+        if (join_info->reversed)
+            /* The list needs to be reversed before being joined. */
+            PyList_Reverse(join_info->list);
 
-/* ScannerObject's methods. */
-static PyMethodDef scanner_methods[] = {
-    {"match", (PyCFunction)scanner_match, METH_NOARGS, scanner_match_doc},
-    {"search", (PyCFunction)scanner_search, METH_NOARGS, scanner_search_doc},
-    {"__copy__", (PyCFunction)scanner_copy, METH_NOARGS},
-    {"__deepcopy__", (PyCFunction)scanner_deepcopy, METH_O},
-    {NULL, NULL}
-};
+        if (join_info->is_unicode) {
+            /* Concatenate the Unicode strings. */
+            joiner = PyUnicode_FromUnicode(NULL, 0);
+            if (!joiner) {
+                clear_join_list(join_info);
+                return NULL;
+            }
 
-PyDoc_STRVAR(scanner_doc, "Scanner object");
+            result = PyUnicode_Join(joiner, join_info->list);
+        } else {
+            joiner = PyBytes_FromString("");
+            if (!joiner) {
+                clear_join_list(join_info);
+                return NULL;
+            }
 
-/* Deallocates a ScannerObject. */
-static void scanner_dealloc(PyObject* self_) {
-    ScannerObject* self;
+            /* Concatenate the bytestrings. */
+            result = _PyBytes_Join(joiner, join_info->list);
+        }
 
-    self = (ScannerObject*)self_;
+        Py_DECREF(joiner);
+        clear_join_list(join_info);
 
-    state_fini(&self->state);
-    Py_DECREF(self->pattern);
-    PyObject_DEL(self);
-}
+        return result;
+    }
 
-static PyMemberDef scanner_members[] = {
-    {"pattern", T_OBJECT, offsetof(ScannerObject, pattern), READONLY,
-      "The regex object that produced this scanner object."},
-    {NULL}  /* Sentinel */
-};
+    /* If we have only 1 item, so we'll just return it. */
+    if (join_info->item)
+        return join_info->item;
 
-static PyTypeObject Scanner_Type = {
-    PyVarObject_HEAD_INIT(NULL, 0)
-    "_" RE_MODULE "." "Scanner",
-    sizeof(ScannerObject)
-};
+    /* There are no items, so return an empty string. */
+    if (join_info->is_unicode)
+        return PyUnicode_FromUnicode(NULL, 0);
+    else
+        return PyBytes_FromString("");
+}
 
-/* Decodes a 'concurrent' argument. */
-Py_LOCAL_INLINE(int) decode_concurrent(PyObject* concurrent) {
-    Py_ssize_t value;
+/* Checks whether a string replacement is a literal.
+ *
+ * To keep it simple we'll say that a literal is a string which can be used
+ * as-is.
+ *
+ * Returns its length if it is a literal, otherwise -1.
+ */
+Py_LOCAL_INLINE(Py_ssize_t) check_replacement_string(PyObject* str_replacement,
+  unsigned char special_char) {
+    RE_StringInfo str_info;
+    Py_UCS4 (*char_at)(void* text, Py_ssize_t pos);
+    Py_ssize_t pos;
 
-    if (concurrent == Py_None)
-        return RE_CONC_DEFAULT;
+    if (!get_string(str_replacement, &str_info))
+        return -1;
 
-    value = PyLong_AsLong(concurrent);
-    if (value == -1 && PyErr_Occurred()) {
-        set_error(RE_ERROR_CONCURRENT, NULL);
+    switch (str_info.charsize) {
+    case 1:
+        char_at = bytes1_char_at;
+        break;
+    case 2:
+        char_at = bytes2_char_at;
+        break;
+    case 4:
+        char_at = bytes4_char_at;
+        break;
+    default:
+        release_buffer(&str_info);
         return -1;
     }
 
-    return value ? RE_CONC_YES : RE_CONC_NO;
-}
+    for (pos = 0; pos < str_info.length; pos++) {
+        if (char_at(str_info.characters, pos) == special_char) {
+            release_buffer(&str_info);
 
-/* Decodes a 'partial' argument. */
-Py_LOCAL_INLINE(BOOL) decode_partial(PyObject* partial) {
-    Py_ssize_t value;
+            return -1;
+        }
+    }
 
-    if (partial == Py_False)
-        return FALSE;
+    release_buffer(&str_info);
 
-    if (partial == Py_True)
-        return TRUE;
+    return str_info.length;
+}
 
-    value = PyLong_AsLong(partial);
-    if (value == -1 && PyErr_Occurred()) {
-        PyErr_Clear();
-        return TRUE;
+/* MatchObject's 'expand' method. */
+static PyObject* match_expand(MatchObject* self, PyObject* str_template) {
+    Py_ssize_t literal_length;
+    PyObject* replacement;
+    JoinInfo join_info;
+    Py_ssize_t size;
+    Py_ssize_t i;
+
+    /* Is the template just a literal? */
+    literal_length = check_replacement_string(str_template, '\\');
+    if (literal_length >= 0) {
+        /* It's a literal. */
+        Py_INCREF(str_template);
+        return str_template;
     }
 
-    return value != 0;
-}
+    /* Hand the template to the template compiler. */
+    replacement = call(RE_MODULE, "_compile_replacement_helper",
+      PyTuple_Pack(2, self->pattern, str_template));
+    if (!replacement)
+        return NULL;
 
-/* Creates a new ScannerObject. */
-static PyObject* pattern_scanner(PatternObject* pattern, PyObject* args,
-  PyObject* kwargs) {
-    /* Create search state object. */
-    ScannerObject* self;
-    Py_ssize_t start;
-    Py_ssize_t end;
-    int conc;
-    BOOL part;
+    init_join_list(&join_info, FALSE, PyUnicode_Check(self->string));
 
-    PyObject* string;
-    PyObject* pos = Py_None;
-    PyObject* endpos = Py_None;
-    Py_ssize_t overlapped = FALSE;
-    PyObject* concurrent = Py_None;
-    PyObject* partial = Py_False;
-    static char* kwlist[] = { "string", "pos", "endpos", "overlapped",
-      "concurrent", "partial", NULL };
-    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|OOnOO:scanner", kwlist,
-      &string, &pos, &endpos, &overlapped, &concurrent, &partial))
-        return NULL;
-
-    start = as_string_index(pos, 0);
-    if (start == -1 && PyErr_Occurred())
-        return NULL;
-
-    end = as_string_index(endpos, PY_SSIZE_T_MAX);
-    if (end == -1 && PyErr_Occurred())
-        return NULL;
-
-    conc = decode_concurrent(concurrent);
-    if (conc < 0)
-        return NULL;
-
-    part = decode_partial(partial);
+    /* Add each part of the template to the list. */
+    size = PyList_GET_SIZE(replacement);
+    for (i = 0; i < size; i++) {
+        PyObject* item;
+        PyObject* str_item;
 
-    /* Create a scanner object. */
-    self = PyObject_NEW(ScannerObject, &Scanner_Type);
-    if (!self)
-        return NULL;
+        /* PyList_GET_ITEM borrows a reference. */
+        item = PyList_GET_ITEM(replacement, i);
+        str_item = get_match_replacement(self, item, self->group_count);
+        if (!str_item)
+            goto error;
 
-    self->pattern = pattern;
-    Py_INCREF(self->pattern);
+        /* Add to the list. */
+        if (str_item == Py_None)
+            Py_DECREF(str_item);
+        else {
+            int status;
 
-    /* The MatchObject, and therefore repeated captures, will be visible. */
-    if (!state_init(&self->state, pattern, string, start, end, overlapped != 0,
-      conc, part, TRUE, TRUE, FALSE)) {
-        PyObject_DEL(self);
-        return NULL;
+            status = add_to_join_list(&join_info, str_item);
+            Py_DECREF(str_item);
+            if (status < 0)
+                goto error;
+        }
     }
 
-    self->status = RE_ERROR_SUCCESS;
-
-    return (PyObject*) self;
-}
-
-/* Performs the split for the SplitterObject. */
-Py_LOCAL_INLINE(PyObject*) next_split_part(SplitterObject* self) {
-    RE_State* state;
-    RE_SafeState safe_state;
-    PyObject* result = NULL; /* Initialise to stop compiler warning. */
+    Py_DECREF(replacement);
 
-    state = &self->state;
+    /* Convert the list to a single string (also cleans up join_info). */
+    return join_list_info(&join_info);
 
-    /* Initialise the "safe state" structure. */
-    safe_state.re_state = state;
-    safe_state.thread_state = NULL;
+error:
+    clear_join_list(&join_info);
+    Py_DECREF(replacement);
+    return NULL;
+}
 
-    /* Acquire the state lock in case we're sharing the splitter object across
-     * threads.
-     */
-    acquire_state_lock((PyObject*)self, &safe_state);
+/* Gets a MatchObject's group dictionary. */
+Py_LOCAL_INLINE(PyObject*) match_get_group_dict(MatchObject* self) {
+    PyObject* result;
+    PyObject* keys;
+    Py_ssize_t g;
 
-    if (self->status == RE_ERROR_FAILURE || self->status == RE_ERROR_PARTIAL) {
-        /* Finished. */
-        release_state_lock((PyObject*)self, &safe_state);
-        result = Py_False;
-        Py_INCREF(result);
+    result = PyDict_New();
+    if (!result || !self->pattern->groupindex)
         return result;
-    } else if (self->status < 0) {
-        /* Internal error. */
-        release_state_lock((PyObject*)self, &safe_state);
-        set_error(self->status, NULL);
-        return NULL;
-    }
-
-    if (self->index == 0) {
-        if (self->split_count < self->maxsplit) {
-            Py_ssize_t step;
-            Py_ssize_t end_pos;
-
-            if (state->reverse) {
-                step = -1;
-                end_pos = state->slice_start;
-            } else {
-                step = 1;
-                end_pos = state->slice_end;
-            }
-
-retry:
-            self->status = do_match(&safe_state, TRUE);
-            if (self->status < 0)
-                goto error;
-
-            if (self->status == RE_ERROR_SUCCESS) {
-                if (state->version_0) {
-                    /* Version 0 behaviour is to advance one character if the
-                     * split was zero-width. Unfortunately, this can give an
-                     * incorrect result. GvR wants this behaviour to be
-                     * retained so as not to break any existing software which
-                     * might rely on it.
-                     */
-                    if (state->text_pos == state->match_pos) {
-                        if (self->last_pos == end_pos)
-                            goto no_match;
-
-                        /* Advance one character. */
-                        state->text_pos += step;
-                        state->must_advance = FALSE;
-                        goto retry;
-                    }
-                }
-
-                ++self->split_count;
 
-                /* Get segment before this match. */
-                if (state->reverse)
-                    result = get_slice(state->string, state->match_pos,
-                      self->last_pos);
-                else
-                    result = get_slice(state->string, self->last_pos,
-                      state->match_pos);
-                if (!result)
-                    goto error;
+    keys = PyMapping_Keys(self->pattern->groupindex);
+    if (!keys)
+        goto failed;
 
-                self->last_pos = state->text_pos;
+    for (g = 0; g < PyList_GET_SIZE(keys); g++) {
+        PyObject* key;
+        PyObject* value;
+        int status;
 
-                /* Version 0 behaviour is to advance one character if the match
-                 * was zero-width. Unfortunately, this can give an incorrect
-                 * result. GvR wants this behaviour to be retained so as not to
-                 * break any existing software which might rely on it.
-                 */
-                if (state->version_0) {
-                    if (state->text_pos == state->match_pos)
-                        /* Advance one character. */
-                        state->text_pos += step;
+        /* PyList_GET_ITEM borrows a reference. */
+        key = PyList_GET_ITEM(keys, g);
+        if (!key)
+            goto failed;
 
-                    state->must_advance = FALSE;
-                } else
-                    /* Continue from where we left off, but don't allow a
-                     * contiguous zero-width match.
-                     */
-                    state->must_advance = TRUE;
-            }
-        } else
-            goto no_match;
+        value = match_get_group(self, key, Py_None, FALSE);
+        if (!value)
+            goto failed;
 
-        if (self->status == RE_ERROR_FAILURE || self->status ==
-          RE_ERROR_PARTIAL) {
-no_match:
-            /* Get segment following last match (even if empty). */
-            if (state->reverse)
-                result = get_slice(state->string, 0, self->last_pos);
-            else
-                result = get_slice(state->string, self->last_pos,
-                  state->text_length);
-            if (!result)
-                goto error;
-        }
-    } else {
-        /* Add group. */
-        result = state_get_group(state, self->index, state->string, FALSE);
-        if (!result)
-            goto error;
+        status = PyDict_SetItem(result, key, value);
+        Py_DECREF(value);
+        if (status < 0)
+            goto failed;
     }
 
-    ++self->index;
-    if ((size_t)self->index > state->pattern->public_group_count)
-        self->index = 0;
-
-    /* Release the state lock. */
-    release_state_lock((PyObject*)self, &safe_state);
+    Py_DECREF(keys);
 
     return result;
 
-error:
-    /* Release the state lock. */
-    release_state_lock((PyObject*)self, &safe_state);
-
+failed:
+    Py_XDECREF(keys);
+    Py_DECREF(result);
     return NULL;
 }
 
-/* SplitterObject's 'split' method. */
-static PyObject* splitter_split(SplitterObject* self, PyObject *unused) {
-    PyObject* result;
+static PyTypeObject Capture_Type = {
+    PyVarObject_HEAD_INIT(NULL,0)
+    "_" RE_MODULE "." "Capture",
+    sizeof(MatchObject)
+};
 
-    result = next_split_part(self);
+/* Creates a new CaptureObject. */
+Py_LOCAL_INLINE(PyObject*) make_capture_object(MatchObject** match_indirect,
+  Py_ssize_t index) {
+    CaptureObject* capture;
 
-    if (result == Py_False) {
-        /* The sentinel. */
-        Py_DECREF(Py_False);
-        Py_INCREF(Py_None);
-        return Py_None;
-    }
+    capture = PyObject_NEW(CaptureObject, &Capture_Type);
+    if (!capture)
+        return NULL;
 
-    return result;
-}
+    capture->group_index = index;
+    capture->match_indirect = match_indirect;
 
-/* Returns an iterator for a SplitterObject.
- *
- * The iterator is actually the SplitterObject itself.
- */
-static PyObject* splitter_iter(PyObject* self) {
-    Py_INCREF(self);
-    return self;
+    return (PyObject*)capture;
 }
 
-/* Gets the next result from a splitter iterator. */
-static PyObject* splitter_iternext(PyObject* self) {
+/* Makes a MatchObject's capture dictionary. */
+Py_LOCAL_INLINE(PyObject*) make_capture_dict(MatchObject* match, MatchObject**
+  match_indirect) {
     PyObject* result;
+    PyObject* keys;
+    PyObject* values = NULL;
+    Py_ssize_t g;
 
-    result = next_split_part((SplitterObject*)self);
-
-    if (result == Py_False) {
-        /* No match. */
-        Py_DECREF(result);
-        return NULL;
-    }
+    result = PyDict_New();
+    if (!result)
+        return result;
 
-    return result;
-}
+    keys = PyMapping_Keys(match->pattern->groupindex);
+    if (!keys)
+        goto failed;
 
-/* Makes a copy of a SplitterObject.
- *
- * It actually doesn't make a copy, just returns the original object.
- */
-Py_LOCAL_INLINE(PyObject*) make_splitter_copy(SplitterObject* self) {
-    Py_INCREF(self);
-    return (PyObject*)self;
-}
+    values = PyMapping_Values(match->pattern->groupindex);
+    if (!values)
+        goto failed;
 
-/* SplitterObject's '__copy__' method. */
-static PyObject* splitter_copy(SplitterObject* self, PyObject *unused) {
-    return make_splitter_copy(self);
-}
+    for (g = 0; g < PyList_GET_SIZE(keys); g++) {
+        PyObject* key;
+        PyObject* value;
+        Py_ssize_t v;
+        int status;
 
-/* SplitterObject's '__deepcopy__' method. */
-static PyObject* splitter_deepcopy(SplitterObject* self, PyObject* memo) {
-    return make_splitter_copy(self);
-}
+        /* PyList_GET_ITEM borrows a reference. */
+        key = PyList_GET_ITEM(keys, g);
+        if (!key)
+            goto failed;
 
-/* The documentation of a SplitterObject. */
-PyDoc_STRVAR(splitter_split_doc,
-    "split() --> string or None.\n\
-    Return the next part of the split string.");
+        /* PyList_GET_ITEM borrows a reference. */
+        value = PyList_GET_ITEM(values, g);
+        if (!value)
+            goto failed;
 
-/* SplitterObject's methods. */
-static PyMethodDef splitter_methods[] = {
-    {"split", (PyCFunction)splitter_split, METH_NOARGS, splitter_split_doc},
-    {"__copy__", (PyCFunction)splitter_copy, METH_NOARGS},
-    {"__deepcopy__", (PyCFunction)splitter_deepcopy, METH_O},
-    {NULL, NULL}
-};
+        v = PyLong_AsLong(value);
+        if (v == -1 && PyErr_Occurred())
+            goto failed;
 
-PyDoc_STRVAR(splitter_doc, "Splitter object");
+        value = make_capture_object(match_indirect, v);
+        if (!value)
+            goto failed;
 
-/* Deallocates a SplitterObject. */
-static void splitter_dealloc(PyObject* self_) {
-    SplitterObject* self;
+        status = PyDict_SetItem(result, key, value);
+        Py_DECREF(value);
+        if (status < 0)
+            goto failed;
+    }
 
-    self = (SplitterObject*)self_;
+    Py_DECREF(values);
+    Py_DECREF(keys);
 
-    state_fini(&self->state);
-    Py_DECREF(self->pattern);
-    PyObject_DEL(self);
+    return result;
+
+failed:
+    Py_XDECREF(values);
+    Py_XDECREF(keys);
+    Py_DECREF(result);
+    return NULL;
 }
 
-/* Converts a captures index to an integer.
- *
- * A negative capture index in 'expandf' and 'subf' is passed as a string
- * because negative indexes are not supported by 'str.format'.
- */
-Py_LOCAL_INLINE(Py_ssize_t) index_to_integer(PyObject* item) {
-    Py_ssize_t value;
+/* MatchObject's 'expandf' method. */
+static PyObject* match_expandf(MatchObject* self, PyObject* str_template) {
+    PyObject* format_func;
+    PyObject* args = NULL;
+    size_t g;
+    PyObject* kwargs = NULL;
+    PyObject* result;
 
-    value = PyLong_AsLong(item);
-    if (value != -1 || !PyErr_Occurred())
-        return value;
+    format_func = PyObject_GetAttrString(str_template, "format");
+    if (!format_func)
+        return NULL;
 
-    PyErr_Clear();
+    args = PyTuple_New((Py_ssize_t)self->group_count + 1);
+    if (!args)
+        goto error;
 
-    /* Is the index a string representation of an integer? */
-    if (PyUnicode_Check(item)) {
-        PyObject* int_obj;
-#if PY_VERSION_HEX < 0x03030000
-        Py_UNICODE* characters;
-        Py_ssize_t length;
-#endif
+    for (g = 0; g < self->group_count + 1; g++)
+        /* PyTuple_SetItem borrows the reference. */
+        PyTuple_SetItem(args, (Py_ssize_t)g, make_capture_object(&self,
+          (Py_ssize_t)g));
 
-#if PY_VERSION_HEX >= 0x03030000
-        int_obj = PyLong_FromUnicodeObject(item, 0);
-#else
-        characters = (Py_UNICODE*)PyUnicode_AS_DATA(item);
-        length = PyUnicode_GET_SIZE(item);
-        int_obj = PyLong_FromUnicode(characters, length, 0);
-#endif
-        if (!int_obj)
-            goto error;
+    kwargs = make_capture_dict(self, &self);
+    if (!kwargs)
+        goto error;
 
-        value = PyLong_AsLong(int_obj);
-        Py_DECREF(int_obj);
-        if (!PyErr_Occurred())
-            return value;
-    } else if (PyBytes_Check(item)) {
-        char* characters;
-        PyObject* int_obj;
+    result = PyObject_Call(format_func, args, kwargs);
 
-        characters = PyBytes_AsString(item);
-        int_obj = PyLong_FromString(characters, NULL, 0);
-        if (!int_obj)
-            goto error;
+    Py_DECREF(kwargs);
+    Py_DECREF(args);
+    Py_DECREF(format_func);
 
-        value = PyLong_AsLong(int_obj);
-        Py_DECREF(int_obj);
-        if (!PyErr_Occurred())
-            return value;
-    }
+    return result;
 
 error:
-    PyErr_Format(PyExc_TypeError, "list indices must be integers, not %.200s",
-      item->ob_type->tp_name);
-
-    return -1;
+    Py_XDECREF(args);
+    Py_DECREF(format_func);
+    return NULL;
 }
 
-/* CaptureObject's length method. */
-Py_LOCAL_INLINE(Py_ssize_t) capture_length(CaptureObject* self) {
-    MatchObject* match;
-    RE_GroupData* group;
-
-    if (self->group_index == 0)
-        return 1;
+Py_LOCAL_INLINE(PyObject*) make_match_copy(MatchObject* self);
 
-    match = *self->match_indirect;
-    group = &match->groups[self->group_index - 1];
+/* MatchObject's '__copy__' method. */
+static PyObject* match_copy(MatchObject* self, PyObject *unused) {
+    return make_match_copy(self);
+}
 
-    return (Py_ssize_t)group->capture_count;
+/* MatchObject's '__deepcopy__' method. */
+static PyObject* match_deepcopy(MatchObject* self, PyObject* memo) {
+    return make_match_copy(self);
 }
 
-/* CaptureObject's '__getitem__' method. */
-static PyObject* capture_getitem(CaptureObject* self, PyObject* item) {
-    Py_ssize_t index;
-    MatchObject* match;
-    Py_ssize_t start;
-    Py_ssize_t end;
+/* MatchObject's 'regs' attribute. */
+static PyObject* match_regs(MatchObject* self) {
+    PyObject* regs;
+    PyObject* item;
+    size_t g;
 
-    index = index_to_integer(item);
-    if (index == -1 && PyErr_Occurred())
+    regs = PyTuple_New((Py_ssize_t)self->group_count + 1);
+    if (!regs)
         return NULL;
 
-    match = *self->match_indirect;
-
-    if (self->group_index == 0) {
-        if (index < 0)
-            index += 1;
+    item = Py_BuildValue("nn", self->match_start, self->match_end);
+    if (!item)
+        goto error;
 
-        if (index != 0) {
-            PyErr_SetString(PyExc_IndexError, "list index out of range");
-            return NULL;
-        }
+    /* PyTuple_SET_ITEM borrows the reference. */
+    PyTuple_SET_ITEM(regs, 0, item);
 
-        start = match->match_start;
-        end = match->match_end;
-    } else {
-        RE_GroupData* group;
+    for (g = 0; g < self->group_count; g++) {
         RE_GroupSpan* span;
 
-        group = &match->groups[self->group_index - 1];
-
-        if (index < 0)
-            index += group->capture_count;
-
-        if (index < 0 || index >= (Py_ssize_t)group->capture_count) {
-            PyErr_SetString(PyExc_IndexError, "list index out of range");
-            return NULL;
-        }
-
-        span = &group->captures[index];
+        span = &self->groups[g].span;
+        item = Py_BuildValue("nn", span->start, span->end);
+        if (!item)
+            goto error;
 
-        start = span->start;
-        end = span->end;
+        /* PyTuple_SET_ITEM borrows the reference. */
+        PyTuple_SET_ITEM(regs, g + 1, item);
     }
 
-    return get_slice(match->substring, start - match->substring_offset, end -
-      match->substring_offset);
-}
-
-static PyMappingMethods capture_as_mapping = {
-    (lenfunc)capture_length,       /* mp_length */
-    (binaryfunc)capture_getitem,   /* mp_subscript */
-    0,                           /* mp_ass_subscript */
-};
-
-/* CaptureObject's methods. */
-static PyMethodDef capture_methods[] = {
-    {"__getitem__", (PyCFunction)capture_getitem, METH_O|METH_COEXIST},
-    {NULL, NULL}
-};
+    Py_INCREF(regs);
+    self->regs = regs;
 
-/* Deallocates a CaptureObject. */
-static void capture_dealloc(PyObject* self_) {
-    CaptureObject* self;
+    return regs;
 
-    self = (CaptureObject*)self_;
-    PyObject_DEL(self);
+error:
+    Py_DECREF(regs);
+    return NULL;
 }
 
-/* CaptureObject's 'str' method. */
-static PyObject* capture_str(PyObject* self_) {
-    CaptureObject* self;
-    MatchObject* match;
-
-    self = (CaptureObject*)self_;
-    match = *self->match_indirect;
-
-    return match_get_group_by_index(match, self->group_index, Py_None);
-}
-
-static PyMemberDef splitter_members[] = {
-    {"pattern", T_OBJECT, offsetof(SplitterObject, pattern), READONLY,
-      "The regex object that produced this splitter object."},
-    {NULL}  /* Sentinel */
-};
-
-static PyTypeObject Splitter_Type = {
-    PyVarObject_HEAD_INIT(NULL, 0)
-    "_" RE_MODULE "." "Splitter",
-    sizeof(SplitterObject)
-};
-
-/* Creates a new SplitterObject. */
-Py_LOCAL_INLINE(PyObject*) pattern_splitter(PatternObject* pattern, PyObject*
-  args, PyObject* kwargs) {
-    /* Create split state object. */
-    int conc;
-    SplitterObject* self;
-    RE_State* state;
-
-    PyObject* string;
-    Py_ssize_t maxsplit = 0;
-    PyObject* concurrent = Py_None;
-    static char* kwlist[] = { "string", "maxsplit", "concurrent", NULL };
-    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|nO:splitter", kwlist,
-      &string, &maxsplit, &concurrent))
-        return NULL;
-
-    conc = decode_concurrent(concurrent);
-    if (conc < 0)
-        return NULL;
+/* MatchObject's slice method. */
+Py_LOCAL_INLINE(PyObject*) match_get_group_slice(MatchObject* self, PyObject*
+  slice) {
+    Py_ssize_t start;
+    Py_ssize_t end;
+    Py_ssize_t step;
+    Py_ssize_t slice_length;
 
-    /* Create a splitter object. */
-    self = PyObject_NEW(SplitterObject, &Splitter_Type);
-    if (!self)
+#if PY_VERSION_HEX >= 0x03020000
+    if (PySlice_GetIndicesEx(slice, (Py_ssize_t)self->group_count + 1, &start,
+      &end, &step, &slice_length) < 0)
+#else
+    if (PySlice_GetIndicesEx((PySliceObject*)slice,
+      (Py_ssize_t)self->group_count + 1, &start, &end, &step, &slice_length) <
+      0)
+#endif
         return NULL;
 
-    self->pattern = pattern;
-    Py_INCREF(self->pattern);
+    if (slice_length <= 0)
+        return PyTuple_New(0);
+    else {
+        PyObject* result;
+        Py_ssize_t cur;
+        Py_ssize_t i;
 
-    if (maxsplit == 0)
-        maxsplit = PY_SSIZE_T_MAX;
+        result = PyTuple_New(slice_length);
+        if (!result)
+            return NULL;
 
-    state = &self->state;
+        cur = start;
+        for (i = 0; i < slice_length; i++) {
+            /* PyTuple_SetItem borrows the reference. */
+            PyTuple_SetItem(result, i, match_get_group_by_index(self, cur,
+              Py_None));
+            cur += step;
+        }
 
-    /* The MatchObject, and therefore repeated captures, will not be visible.
-     */
-    if (!state_init(state, pattern, string, 0, PY_SSIZE_T_MAX, FALSE, conc,
-      FALSE, TRUE, FALSE, FALSE)) {
-        PyObject_DEL(self);
-        return NULL;
+        return result;
     }
+}
 
-    self->maxsplit = maxsplit;
-    self->last_pos = state->reverse ? state->text_length : 0;
-    self->split_count = 0;
-    self->index = 0;
-    self->status = 1;
+/* MatchObject's length method. */
+Py_LOCAL_INLINE(Py_ssize_t) match_length(MatchObject* self) {
+    return (Py_ssize_t)self->group_count + 1;
+}
 
-    return (PyObject*) self;
+/* MatchObject's '__getitem__' method. */
+static PyObject* match_getitem(MatchObject* self, PyObject* item) {
+    if (PySlice_Check(item))
+        return match_get_group_slice(self, item);
+
+    return match_get_group(self, item, Py_None, TRUE);
 }
 
-/* Implements the functionality of PatternObject's search and match methods. */
-Py_LOCAL_INLINE(PyObject*) pattern_search_or_match(PatternObject* self,
-  PyObject* args, PyObject* kwargs, char* args_desc, BOOL search, BOOL
-  match_all) {
+/* Determines the portion of the target string which is covered by the group
+ * captures.
+ */
+Py_LOCAL_INLINE(void) determine_target_substring(MatchObject* match,
+  Py_ssize_t* slice_start, Py_ssize_t* slice_end) {
     Py_ssize_t start;
     Py_ssize_t end;
-    int conc;
-    BOOL part;
-    RE_State state;
-    RE_SafeState safe_state;
-    int status;
-    PyObject* match;
-
-    PyObject* string;
-    PyObject* pos = Py_None;
-    PyObject* endpos = Py_None;
-    PyObject* concurrent = Py_None;
-    PyObject* partial = Py_False;
-    static char* kwlist[] = { "string", "pos", "endpos", "concurrent",
-      "partial", NULL };
-    /* When working with a short string, such as a line from a file, the
-     * relative cost of PyArg_ParseTupleAndKeywords can be significant, and
-     * it's worth not using it when there are only positional arguments.
-     */
-    Py_ssize_t arg_count;
-    if (args && !kwargs && PyTuple_CheckExact(args))
-        arg_count = PyTuple_GET_SIZE(args);
-    else
-        arg_count = -1;
-
-    if (1 <= arg_count && arg_count <= 5) {
-        /* PyTuple_GET_ITEM borrows the reference. */
-        string = PyTuple_GET_ITEM(args, 0);
-        if (arg_count >= 2)
-            pos = PyTuple_GET_ITEM(args, 1);
-        if (arg_count >= 3)
-            endpos = PyTuple_GET_ITEM(args, 2);
-        if (arg_count >= 4)
-            concurrent = PyTuple_GET_ITEM(args, 3);
-        if (arg_count >= 5)
-            partial = PyTuple_GET_ITEM(args, 4);
-    } else if (!PyArg_ParseTupleAndKeywords(args, kwargs, args_desc, kwlist,
-      &string, &pos, &endpos, &concurrent, &partial))
-        return NULL;
+    size_t g;
 
-    start = as_string_index(pos, 0);
-    if (start == -1 && PyErr_Occurred())
-        return NULL;
+    start = match->pos;
+    end = match->endpos;
 
-    end = as_string_index(endpos, PY_SSIZE_T_MAX);
-    if (end == -1 && PyErr_Occurred())
-        return NULL;
+    for (g = 0; g < match->group_count; g++) {
+        RE_GroupSpan* span;
+        size_t c;
 
-    conc = decode_concurrent(concurrent);
-    if (conc < 0)
-        return NULL;
+        span = &match->groups[g].span;
+        if (span->start >= 0 && span->start < start)
+            start = span->start;
+        if (span->end >= 0 && span->end > end)
+            end = span->end;
 
-    part = decode_partial(partial);
+        for (c = 0; c < match->groups[g].capture_count; c++) {
+            RE_GroupSpan* span;
 
-    /* The MatchObject, and therefore repeated captures, will be visible. */
-    if (!state_init(&state, self, string, start, end, FALSE, conc, part, FALSE,
-      TRUE, match_all))
-        return NULL;
+            span = match->groups[g].captures;
+            if (span->start >= 0 && span->start < start)
+                start = span->start;
+            if (span->end >= 0 && span->end > end)
+                end = span->end;
+        }
+    }
 
-    /* Initialise the "safe state" structure. */
-    safe_state.re_state = &state;
-    safe_state.thread_state = NULL;
+    *slice_start = start;
+    *slice_end = end;
+}
 
-    status = do_match(&safe_state, search);
+/* MatchObject's 'detach_string' method. */
+static PyObject* match_detach_string(MatchObject* self, PyObject* unused) {
+    if (self->string) {
+        Py_ssize_t start;
+        Py_ssize_t end;
+        PyObject* substring;
 
-    if (status >= 0 || status == RE_ERROR_PARTIAL)
-        /* Create the match object. */
-        match = pattern_new_match(self, &state, status);
-    else
-        match = NULL;
+        determine_target_substring(self, &start, &end);
 
-    state_fini(&state);
+        substring = get_slice(self->string, start, end);
+        if (substring) {
+            Py_XDECREF(self->substring);
+            self->substring = substring;
+            self->substring_offset = start;
 
-    return match;
-}
+            Py_DECREF(self->string);
+            self->string = NULL;
+        }
+    }
 
-/* PatternObject's 'match' method. */
-static PyObject* pattern_match(PatternObject* self, PyObject* args, PyObject*
-  kwargs) {
-    return pattern_search_or_match(self, args, kwargs, "O|OOOO:match", FALSE,
-      FALSE);
+    Py_INCREF(Py_None);
+    return Py_None;
 }
 
-/* PatternObject's 'fullmatch' method. */
-static PyObject* pattern_fullmatch(PatternObject* self, PyObject* args,
-  PyObject* kwargs) {
-    return pattern_search_or_match(self, args, kwargs, "O|OOOO:fullmatch",
-      FALSE, TRUE);
-}
+/* The documentation of a MatchObject. */
+PyDoc_STRVAR(match_group_doc,
+    "group([group1, ...]) --> string or tuple of strings.\n\
+    Return one or more subgroups of the match.  If there is a single argument,\n\
+    the result is a single string, or None if the group did not contribute to\n\
+    the match; if there are multiple arguments, the result is a tuple with one\n\
+    item per argument; if there are no arguments, the whole match is returned.\n\
+    Group 0 is the whole match.");
 
-/* PatternObject's 'search' method. */
-static PyObject* pattern_search(PatternObject* self, PyObject* args, PyObject*
-  kwargs) {
-    return pattern_search_or_match(self, args, kwargs, "O|OOOO:search", TRUE,
-      FALSE);
-}
+PyDoc_STRVAR(match_group_view_doc,
+    "group_view([group1, ...]) --> memoryview or tuple of memoryviews.\n\
+    Like group(), but return memoryviews of the subgroups that share the buffer\n\
+    of the searched string instead of copying them.  The string must support\n\
+    the buffer protocol.");
 
-/* Gets the limits of the matching. */
-Py_LOCAL_INLINE(BOOL) get_limits(PyObject* pos, PyObject* endpos, Py_ssize_t
-  length, Py_ssize_t* start, Py_ssize_t* end) {
-    Py_ssize_t s;
-    Py_ssize_t e;
+PyDoc_STRVAR(match_start_doc,
+    "start([group1, ...]) --> int or tuple of ints.\n\
+    Return the index of the start of one or more subgroups of the match.  If\n\
+    there is a single argument, the result is an index, or -1 if the group did\n\
+    not contribute to the match; if there are multiple arguments, the result is\n\
+    a tuple with one item per argument; if there are no arguments, the index of\n\
+    the start of the whole match is returned.  Group 0 is the whole match.");
 
-    s = as_string_index(pos, 0);
-    if (s == -1 && PyErr_Occurred())
-        return FALSE;
+PyDoc_STRVAR(match_end_doc,
+    "end([group1, ...]) --> int or tuple of ints.\n\
+    Return the index of the end of one or more subgroups of the match.  If there\n\
+    is a single argument, the result is an index, or -1 if the group did not\n\
+    contribute to the match; if there are multiple arguments, the result is a\n\
+    tuple with one item per argument; if there are no arguments, the index of\n\
+    the end of the whole match is returned.  Group 0 is the whole match.");
 
-    e = as_string_index(endpos, PY_SSIZE_T_MAX);
-    if (e == -1 && PyErr_Occurred())
-        return FALSE;
+PyDoc_STRVAR(match_span_doc,
+    "span([group1, ...]) --> 2-tuple of int or tuple of 2-tuple of ints.\n\
+    Return the span (a 2-tuple of the indices of the start and end) of one or\n\
+    more subgroups of the match.  If there is a single argument, the result is a\n\
+    span, or (-1, -1) if the group did not contribute to the match; if there are\n\
+    multiple arguments, the result is a tuple with one item per argument; if\n\
+    there are no arguments, the span of the whole match is returned.  Group 0 is\n\
+    the whole match.");
 
-    /* Adjust boundaries. */
-    if (s < 0)
-        s += length;
-    if (s < 0)
-        s = 0;
-    else if (s > length)
-        s = length;
+PyDoc_STRVAR(match_groups_doc,
+    "groups(default=None) --> tuple of strings.\n\
+    Return a tuple containing all the subgroups of the match.  The argument is\n\
+    the default for groups that did not participate in the match.");
 
-    if (e < 0)
-        e += length;
-    if (e < 0)
-        e = 0;
-    else if (e > length)
-        e = length;
+PyDoc_STRVAR(match_groupdict_doc,
+    "groupdict(default=None) --> dict.\n\
+    Return a dictionary containing all the named subgroups of the match, keyed\n\
+    by the subgroup name.  The argument is the value to be given for groups that\n\
+    did not participate in the match.");
 
-    *start = s;
-    *end = e;
+PyDoc_STRVAR(match_capturesdict_doc,
+    "capturesdict() --> dict.\n\
+    Return a dictionary containing the captures of all the named subgroups of the\n\
+    match, keyed by the subgroup name.");
 
-    return TRUE;
-}
+PyDoc_STRVAR(match_expand_doc,
+    "expand(template) --> string.\n\
+    Return the string obtained by doing backslash substitution on the template,\n\
+    as done by the sub() method.");
 
-/* Gets a replacement item from the replacement list.
- *
- * The replacement item could be a string literal or a group.
- *
- * It can return None to represent an empty string.
- */
-Py_LOCAL_INLINE(PyObject*) get_sub_replacement(PyObject* item, PyObject*
-  string, RE_State* state, size_t group_count) {
-    Py_ssize_t index;
+PyDoc_STRVAR(match_expandf_doc,
+    "expandf(format) --> string.\n\
+    Return the string obtained by using the format, as done by the subf()\n\
+    method.");
 
-    if (PyUnicode_CheckExact(item) || PyBytes_CheckExact(item)) {
-        /* It's a literal, which can be added directly to the list. */
-#if PY_VERSION_HEX >= 0x03040000
+PyDoc_STRVAR(match_captures_doc,
+    "captures([group1, ...]) --> list of strings or tuple of list of strings.\n\
+    Return the captures of one or more subgroups of the match.  If there is a\n\
+    single argument, the result is a list of strings; if there are multiple\n\
+    arguments, the result is a tuple of lists with one item per argument; if\n\
+    there are no arguments, the captures of the whole match is returned.  Group\n\
+    0 is the whole match.");
 
-        /* ensure_immutable will DECREF the original item if it has to make an
-         * immutable copy, but that original item might have a borrowed
-         * reference, so we must INCREF it first in order to ensure it won't be
-         * destroyed.
-         */
-        Py_INCREF(item);
-        item = ensure_immutable(item);
-#else
-        Py_INCREF(item);
-#endif
-        return item;
-    }
+PyDoc_STRVAR(match_starts_doc,
+    "starts([group1, ...]) --> list of ints or tuple of list of ints.\n\
+    Return the indices of the starts of the captures of one or more subgroups of\n\
+    the match.  If there is a single argument, the result is a list of indices;\n\
+    if there are multiple arguments, the result is a tuple of lists with one\n\
+    item per argument; if there are no arguments, the indices of the starts of\n\
+    the captures of the whole match is returned.  Group 0 is the whole match.");
 
-    /* Is it a group reference? */
-    index = as_group_index(item);
-    if (index == -1 && PyErr_Occurred()) {
-        /* Not a group either! */
-        set_error(RE_ERROR_REPLACEMENT, NULL);
-        return NULL;
-    }
+PyDoc_STRVAR(match_ends_doc,
+    "ends([group1, ...]) --> list of ints or tuple of list of ints.\n\
+    Return the indices of the ends of the captures of one or more subgroups of\n\
+    the match.  If there is a single argument, the result is a list of indices;\n\
+    if there are multiple arguments, the result is a tuple of lists with one\n\
+    item per argument; if there are no arguments, the indices of the ends of the\n\
+    captures of the whole match is returned.  Group 0 is the whole match.");
 
-    if (index == 0) {
-        /* The entire matched portion of the string. */
-        if (state->match_pos == state->text_pos) {
-            /* Return None for "". */
-            Py_INCREF(Py_None);
-            return Py_None;
-        }
+PyDoc_STRVAR(match_spans_doc,
+    "spans([group1, ...]) --> list of 2-tuple of ints or tuple of list of 2-tuple of ints.\n\
+    Return the spans (a 2-tuple of the indices of the start and end) of the\n\
+    captures of one or more subgroups of the match.  If there is a single\n\
+    argument, the result is a list of spans; if there are multiple arguments,\n\
+    the result is a tuple of lists with one item per argument; if there are no\n\
+    arguments, the spans of the captures of the whole match is returned.  Group\n\
+    0 is the whole match.");
 
-        if (state->reverse)
-            return get_slice(string, state->text_pos, state->match_pos);
-        else
-            return get_slice(string, state->match_pos, state->text_pos);
-    } else if (1 <= index && (size_t)index <= group_count) {
-        /* A group. */
-        RE_GroupData* group;
+PyDoc_STRVAR(match_detach_string_doc,
+    "detach_string()\n\
+    Detaches the target string from the match object. The 'string' attribute\n\
+    will become None.");
 
-        group = &state->groups[index - 1];
+/* MatchObject's methods. */
+static PyMethodDef match_methods[] = {
+    {"group", (PyCFunction)match_group, METH_VARARGS, match_group_doc},
+    {"group_view", (PyCFunction)match_group_view, METH_VARARGS,
+      match_group_view_doc},
+    {"start", (PyCFunction)match_start, METH_VARARGS, match_start_doc},
+    {"end", (PyCFunction)match_end, METH_VARARGS, match_end_doc},
+    {"span", (PyCFunction)match_span, METH_VARARGS, match_span_doc},
+    {"groups", (PyCFunction)match_groups, METH_VARARGS|METH_KEYWORDS,
+      match_groups_doc},
+    {"groupdict", (PyCFunction)match_groupdict, METH_VARARGS|METH_KEYWORDS,
+      match_groupdict_doc},
+    {"capturesdict", (PyCFunction)match_capturesdict, METH_NOARGS,
+      match_capturesdict_doc},
+    {"expand", (PyCFunction)match_expand, METH_O, match_expand_doc},
+    {"expandf", (PyCFunction)match_expandf, METH_O, match_expandf_doc},
+    {"captures", (PyCFunction)match_captures, METH_VARARGS,
+      match_captures_doc},
+    {"starts", (PyCFunction)match_starts, METH_VARARGS, match_starts_doc},
+    {"ends", (PyCFunction)match_ends, METH_VARARGS, match_ends_doc},
+    {"spans", (PyCFunction)match_spans, METH_VARARGS, match_spans_doc},
+    {"detach_string", (PyCFunction)match_detach_string, METH_NOARGS,
+      match_detach_string_doc},
+    {"__copy__", (PyCFunction)match_copy, METH_NOARGS},
+    {"__deepcopy__", (PyCFunction)match_deepcopy, METH_O},
+    {"__getitem__", (PyCFunction)match_getitem, METH_O|METH_COEXIST},
+    {NULL, NULL}
+};
 
-        if (group->capture_count == 0 && group->span.start != group->span.end)
-          {
-            /* The group didn't match or is "", so return None for "". */
-            Py_INCREF(Py_None);
-            return Py_None;
-        }
+PyDoc_STRVAR(match_doc, "Match object");
 
-        return get_slice(string, group->span.start, group->span.end);
-    } else {
-        /* No such group. */
-        set_error(RE_ERROR_INVALID_GROUP_REF, NULL);
-        return NULL;
-    }
-}
+/* MatchObject's 'lastindex' attribute. */
+static PyObject* match_lastindex(PyObject* self_) {
+    MatchObject* self;
 
-/* PatternObject's 'subx' method. */
-Py_LOCAL_INLINE(PyObject*) pattern_subx(PatternObject* self, PyObject*
-  str_template, PyObject* string, Py_ssize_t maxsub, int sub_type, PyObject*
-  pos, PyObject* endpos, int concurrent) {
-    RE_StringInfo str_info;
-    Py_ssize_t start;
-    Py_ssize_t end;
-    BOOL is_callable = FALSE;
-    PyObject* replacement = NULL;
-    BOOL is_literal = FALSE;
-    BOOL is_format = FALSE;
-    BOOL is_template = FALSE;
-    RE_State state;
-    RE_SafeState safe_state;
-    JoinInfo join_info;
-    Py_ssize_t sub_count;
-    Py_ssize_t last_pos;
-    Py_ssize_t step;
-    PyObject* item;
-    MatchObject* match;
-    BOOL built_capture = FALSE;
-    PyObject* args;
-    PyObject* kwargs;
-    Py_ssize_t end_pos;
+    self = (MatchObject*)self_;
 
-    /* Get the string. */
-    if (!get_string(string, &str_info))
-        return NULL;
+    if (self->lastindex >= 0)
+        return Py_BuildValue("n", self->lastindex);
 
-    if (!check_compatible(self, str_info.is_unicode)) {
-        release_buffer(&str_info);
-        return NULL;
-    }
+    Py_INCREF(Py_None);
+    return Py_None;
+}
 
-    /* Get the limits of the search. */
-    if (!get_limits(pos, endpos, str_info.length, &start, &end)) {
-        release_buffer(&str_info);
+/* MatchObject's 'lastgroup' attribute. */
+static PyObject* match_lastgroup(PyObject* self_) {
+    MatchObject* self;
 
-        return NULL;
-    }
+    self = (MatchObject*)self_;
 
-    /* If the pattern is too long for the string, then take a shortcut, unless
-     * it's a fuzzy pattern.
-     */
-    if (!self->is_fuzzy && self->min_width > end - start) {
+    if (self->pattern->indexgroup && self->lastgroup >= 0) {
+        PyObject* index;
         PyObject* result;
 
-        Py_INCREF(string);
-
-        if (sub_type & RE_SUBN)
-            result = Py_BuildValue("Nn", string, 0);
-        else
-            result = string;
-
-        release_buffer(&str_info);
+        index = Py_BuildValue("n", self->lastgroup);
 
-        return result;
+        /* PyDict_GetItem returns borrows a reference. */
+        result = PyDict_GetItem(self->pattern->indexgroup, index);
+        Py_DECREF(index);
+        if (result) {
+            Py_INCREF(result);
+            return result;
+        }
+        PyErr_Clear();
     }
 
-    if (maxsub == 0)
-        maxsub = PY_SSIZE_T_MAX;
+    Py_INCREF(Py_None);
+    return Py_None;
+}
 
-    /* sub/subn takes either a function or a string template. */
-    if (PyCallable_Check(str_template)) {
-        /* It's callable. */
-        is_callable = TRUE;
+/* MatchObject's 'string' attribute. */
+static PyObject* match_string(PyObject* self_) {
+    MatchObject* self;
 
-        replacement = str_template;
-        Py_INCREF(replacement);
-    } else if (sub_type & RE_SUBF) {
-        /* Is it a literal format?
-         *
-         * To keep it simple we'll say that a literal is a string which can be
-         * used as-is, so no placeholders.
-         */
-        Py_ssize_t literal_length;
+    self = (MatchObject*)self_;
 
-        literal_length = check_replacement_string(str_template, '{');
-        if (literal_length > 0) {
-            /* It's a literal. */
-            is_literal = TRUE;
+    if (self->string) {
+        Py_INCREF(self->string);
+        return self->string;
+    } else {
+        Py_INCREF(Py_None);
+        return Py_None;
+    }
+}
 
-            replacement = str_template;
-            Py_INCREF(replacement);
-        } else if (literal_length < 0) {
-            /* It isn't a literal, so get the 'format' method. */
-            is_format = TRUE;
+/* MatchObject's 'fuzzy_counts' attribute. */
+static PyObject* match_fuzzy_counts(PyObject* self_) {
+    MatchObject* self;
 
-            replacement = PyObject_GetAttrString(str_template, "format");
-            if (!replacement) {
-                release_buffer(&str_info);
-                return NULL;
-            }
-        }
-    } else {
-        /* Is it a literal template?
-         *
-         * To keep it simple we'll say that a literal is a string which can be
-         * used as-is, so no backslashes.
-         */
-        Py_ssize_t literal_length;
+    self = (MatchObject*)self_;
 
-        literal_length = check_replacement_string(str_template, '\\');
-        if (literal_length > 0) {
-            /* It's a literal. */
-            is_literal = TRUE;
+    return Py_BuildValue("nnn", self->fuzzy_counts[RE_FUZZY_SUB],
+      self->fuzzy_counts[RE_FUZZY_INS], self->fuzzy_counts[RE_FUZZY_DEL]);
+}
 
-            replacement = str_template;
-            Py_INCREF(replacement);
-        } else if (literal_length < 0 ) {
-            /* It isn't a literal, so hand it over to the template compiler. */
-            is_template = TRUE;
+static PyGetSetDef match_getset[] = {
+    {"lastindex", (getter)match_lastindex, (setter)NULL,
+      "The group number of the last matched capturing group, or None."},
+    {"lastgroup", (getter)match_lastgroup, (setter)NULL,
+      "The name of the last matched capturing group, or None."},
+    {"regs", (getter)match_regs, (setter)NULL,
+      "A tuple of the spans of the capturing groups."},
+    {"string", (getter)match_string, (setter)NULL,
+      "The string that was searched, or None if it has been detached."},
+    {"fuzzy_counts", (getter)match_fuzzy_counts, (setter)NULL,
+      "A tuple of the number of substitutions, insertions and deletions."},
+    {NULL}  /* Sentinel */
+};
 
-            replacement = call(RE_MODULE, "_compile_replacement_helper",
-              PyTuple_Pack(2, self, str_template));
-            if (!replacement) {
-                release_buffer(&str_info);
+static PyMemberDef match_members[] = {
+    {"re", T_OBJECT, offsetof(MatchObject, pattern), READONLY,
+      "The regex object that produced this match object."},
+    {"pos", T_PYSSIZET, offsetof(MatchObject, pos), READONLY,
+      "The position at which the regex engine starting searching."},
+    {"endpos", T_PYSSIZET, offsetof(MatchObject, endpos), READONLY,
+      "The final position beyond which the regex engine won't search."},
+    {"partial", T_BOOL, offsetof(MatchObject, partial), READONLY,
+      "Whether it's a partial match."},
+    {NULL}  /* Sentinel */
+};
 
-                return NULL;
-            }
-        }
-    }
+static PyMappingMethods match_as_mapping = {
+    (lenfunc)match_length,       /* mp_length */
+    (binaryfunc)match_getitem,   /* mp_subscript */
+    0,                           /* mp_ass_subscript */
+};
 
-    /* The MatchObject, and therefore repeated captures, will be visible only
-     * if the replacement is callable or subf is used.
-     */
-    if (!state_init_2(&state, self, string, &str_info, start, end, FALSE,
-      concurrent, FALSE, FALSE, is_callable || (sub_type & RE_SUBF) != 0,
-      FALSE)) {
-        release_buffer(&str_info);
+static PyTypeObject Match_Type = {
+    PyVarObject_HEAD_INIT(NULL,0)
+    "_" RE_MODULE "." "Match",
+    sizeof(MatchObject)
+};
 
-        Py_XDECREF(replacement);
-        return NULL;
-    }
+/* Copies the groups. */
+Py_LOCAL_INLINE(RE_GroupData*) copy_groups(RE_GroupData* groups, size_t
+  group_count) {
+    size_t span_count;
+    size_t g;
+    RE_GroupData* groups_copy;
+    RE_GroupSpan* spans_copy;
+    size_t offset;
 
-    /* Initialise the "safe state" structure. */
-    safe_state.re_state = &state;
-    safe_state.thread_state = NULL;
+    /* Calculate the total size of the group info. */
+    span_count = 0;
+    for (g = 0; g < group_count; g++)
+        span_count += groups[g].capture_count;
 
-    init_join_list(&join_info, state.reverse, PyUnicode_Check(string));
+    /* Allocate the storage for the group info in a single block. */
+    groups_copy = (RE_GroupData*)re_alloc(group_count * sizeof(RE_GroupData) +
+      span_count * sizeof(RE_GroupSpan));
+    if (!groups_copy)
+        return NULL;
 
-    sub_count = 0;
-    last_pos = state.reverse ? state.text_length : 0;
-    step = state.reverse ? -1 : 1;
-    while (sub_count < maxsub) {
-        int status;
+    /* The storage for the spans comes after the other group info. */
+    spans_copy = (RE_GroupSpan*)&groups_copy[group_count];
 
-        status = do_match(&safe_state, TRUE);
-        if (status < 0)
-            goto error;
+    /* There's no need to initialise the spans info. */
+    memset(groups_copy, 0, group_count * sizeof(RE_GroupData));
 
-        if (status == 0)
-            break;
+    offset = 0;
+    for (g = 0; g < group_count; g++) {
+        RE_GroupData* orig;
+        RE_GroupData* copy;
 
-        /* Append the segment before this match. */
-        if (state.match_pos != last_pos) {
-            if (state.reverse)
-                item = get_slice(string, state.match_pos, last_pos);
-            else
-                item = get_slice(string, last_pos, state.match_pos);
-            if (!item)
-                goto error;
+        orig = &groups[g];
+        copy = &groups_copy[g];
+        copy->span = orig->span;
 
-            /* Add to the list. */
-            status = add_to_join_list(&join_info, item);
-            Py_DECREF(item);
-            if (status < 0)
-                goto error;
-        }
+        copy->captures = &spans_copy[offset];
+        offset += orig->capture_count;
 
-        /* Add this match. */
-        if (is_literal) {
-            /* The replacement is a literal string. */
-            status = add_to_join_list(&join_info, replacement);
-            if (status < 0)
-                goto error;
-        } else if (is_format) {
-            /* The replacement is a format string. */
-            size_t g;
+        if (orig->capture_count > 0) {
+            Py_MEMCPY(copy->captures, orig->captures, orig->capture_count *
+              sizeof(RE_GroupSpan));
+            copy->capture_capacity = orig->capture_count;
+            copy->capture_count = orig->capture_count;
+        }
+    }
 
-            /* We need to create the arguments for the 'format' method. We'll
-             * start by creating a MatchObject.
-             */
-            match = (MatchObject*)pattern_new_match(self, &state, 1);
-            if (!match)
-                goto error;
+    return groups_copy;
+}
 
-            /* We'll build the args and kwargs the first time. They'll be using
-             * capture objects which refer to the match object indirectly; this
-             * means that args and kwargs can be reused with different match
-             * objects.
-             */
-            if (!built_capture) {
-                /* The args are a tuple of the capture group matches. */
-                args = PyTuple_New(match->group_count + 1);
-                if (!args) {
-                    Py_DECREF(match);
-                    goto error;
-                }
+/* Makes a copy of a MatchObject. */
+Py_LOCAL_INLINE(PyObject*) make_match_copy(MatchObject* self) {
+    MatchObject* match;
 
-                for (g = 0; g < match->group_count + 1; g++)
-                    /* PyTuple_SetItem borrows the reference. */
-                    PyTuple_SetItem(args, (Py_ssize_t)g,
-                      make_capture_object(&match, (Py_ssize_t)g));
+    if (!self->string) {
+        /* The target string has been detached, so the MatchObject is now
+         * immutable.
+         */
+        Py_INCREF(self);
+        return (PyObject*)self;
+    }
 
-                /* The kwargs are a dict of the named capture group matches. */
-                kwargs = make_capture_dict(match, &match);
-                if (!kwargs) {
-                    Py_DECREF(args);
-                    Py_DECREF(match);
-                    goto error;
-                }
+    /* Create a MatchObject. */
+    match = PyObject_NEW(MatchObject, &Match_Type);
+    if (!match)
+        return NULL;
 
-                built_capture = TRUE;
-            }
+    Py_MEMCPY(match, self, sizeof(MatchObject));
 
-            /* Call the 'format' method. */
-            item = PyObject_Call(replacement, args, kwargs);
+    Py_INCREF(match->string);
+    Py_INCREF(match->substring);
+    Py_INCREF(match->pattern);
 
+    /* Copy the groups to the MatchObject. */
+    if (self->group_count > 0) {
+        match->groups = copy_groups(self->groups, self->group_count);
+        if (!match->groups) {
             Py_DECREF(match);
-            if (!item)
-                goto error;
+            return NULL;
+        }
+    }
 
-            /* Add the result to the list. */
-            status = add_to_join_list(&join_info, item);
-            Py_DECREF(item);
-            if (status < 0)
-                goto error;
-        } else if (is_template) {
-            /* The replacement is a list template. */
-            Py_ssize_t count;
-            Py_ssize_t index;
-            Py_ssize_t step;
+    return (PyObject*)match;
+}
 
-            /* Add each part of the template to the list. */
-            count = PyList_GET_SIZE(replacement);
-            if (join_info.reversed) {
-                /* We're searching backwards, so we'll be reversing the list
-                 * when it's complete. Therefore, we need to add the items of
-                 * the template in reverse order for them to be in the correct
-                 * order after the reversal.
-                 */
-                index = count - 1;
-                step = -1;
-            } else {
-                /* We're searching forwards. */
-                index = 0;
-                step = 1;
-            }
-
-            while (count > 0) {
-                PyObject* item;
-                PyObject* str_item;
+/* Creates a new MatchObject. */
+Py_LOCAL_INLINE(PyObject*) pattern_new_match(PatternObject* pattern, RE_State*
+  state, int status) {
+    /* Create MatchObject (from state object). */
+    if (status > 0 || status == RE_ERROR_PARTIAL) {
+        MatchObject* match;
 
-                /* PyList_GET_ITEM borrows a reference. */
-                item = PyList_GET_ITEM(replacement, index);
-                str_item = get_sub_replacement(item, string, &state,
-                  self->public_group_count);
-                if (!str_item)
-                    goto error;
+        /* Create a MatchObject. */
+        match = PyObject_NEW(MatchObject, &Match_Type);
+        if (!match)
+            return NULL;
 
-                /* Add the result to the list. */
-                if (str_item == Py_None)
-                    /* None for "". */
-                    Py_DECREF(str_item);
-                else {
-                    status = add_to_join_list(&join_info, str_item);
-                    Py_DECREF(str_item);
-                    if (status < 0)
-                        goto error;
-                }
+        match->string = state->string;
+        match->substring = state->string;
+        match->substring_offset = 0;
+        match->pattern = pattern;
+        match->regs = NULL;
 
-                --count;
-                index += step;
-            }
-        } else if (is_callable) {
-            /* Pass a MatchObject to the replacement function. */
-            PyObject* match;
-            PyObject* args;
+        if (pattern->is_fuzzy) {
+            match->fuzzy_counts[RE_FUZZY_SUB] =
+              state->total_fuzzy_counts[RE_FUZZY_SUB];
+            match->fuzzy_counts[RE_FUZZY_INS] =
+              state->total_fuzzy_counts[RE_FUZZY_INS];
+            match->fuzzy_counts[RE_FUZZY_DEL] =
+              state->total_fuzzy_counts[RE_FUZZY_DEL];
+        } else
+            memset(match->fuzzy_counts, 0, sizeof(match->fuzzy_counts));
 
-            /* We need to create a MatchObject to pass to the replacement
-             * function.
-             */
-            match = pattern_new_match(self, &state, 1);
-            if (!match)
-                goto error;
+        match->partial = status == RE_ERROR_PARTIAL;
+        Py_INCREF(match->string);
+        Py_INCREF(match->substring);
+        Py_INCREF(match->pattern);
 
-            /* The args for the replacement function. */
-            args = PyTuple_Pack(1, match);
-            if (!args) {
+        /* Copy the groups to the MatchObject. */
+        if (pattern->public_group_count > 0) {
+            match->groups = copy_groups(state->groups,
+              pattern->public_group_count);
+            if (!match->groups) {
                 Py_DECREF(match);
-                goto error;
+                return NULL;
             }
+        } else
+            match->groups = NULL;
 
-            /* Call the replacement function. */
-            item = PyObject_CallObject(replacement, args);
-            Py_DECREF(args);
-            Py_DECREF(match);
-            if (!item)
-                goto error;
+        match->group_count = pattern->public_group_count;
 
-            /* Add the result to the list. */
-            status = add_to_join_list(&join_info, item);
-            Py_DECREF(item);
-            if (status < 0)
-                goto error;
-        }
+        match->pos = state->slice_start;
+        match->endpos = state->slice_end;
 
-        ++sub_count;
+        if (state->reverse) {
+            match->match_start = state->text_pos;
+            match->match_end = state->match_pos;
+        } else {
+            match->match_start = state->match_pos;
+            match->match_end = state->text_pos;
+        }
 
-        last_pos = state.text_pos;
+        match->lastindex = state->lastindex;
+        match->lastgroup = state->lastgroup;
 
-        if (state.version_0) {
-            /* Always advance after a zero-width match. */
-            if (state.match_pos == state.text_pos) {
-                state.text_pos += step;
-                state.must_advance = FALSE;
-            } else
-                state.must_advance = TRUE;
-        } else
-            /* Continue from where we left off, but don't allow a contiguous
-             * zero-width match.
-             */
-            state.must_advance = state.match_pos == state.text_pos;
+        return (PyObject*)match;
+    } else if (status == 0) {
+        /* No match. */
+        Py_INCREF(Py_None);
+        return Py_None;
+    } else {
+        /* Internal error. */
+        set_error(status, NULL);
+        return NULL;
     }
+}
 
-    /* Get the segment following the last match. We use 'length' instead of
-     * 'text_length' because the latter is truncated to 'slice_end', a
-     * documented idiosyncracy of the 're' module.
-     */
-    end_pos = state.reverse ? 0 : str_info.length;
-    if (last_pos != end_pos) {
-        int status;
+/* Gets the text of a capture group from a state. */
+Py_LOCAL_INLINE(PyObject*) state_get_group(RE_State* state, Py_ssize_t index,
+  PyObject* string, BOOL empty) {
+    RE_GroupData* group;
+    Py_ssize_t start;
+    Py_ssize_t end;
 
-        /* The segment is part of the original string. */
-        if (state.reverse)
-            item = get_slice(string, 0, last_pos);
-        else
-            item = get_slice(string, last_pos, str_info.length);
-        if (!item)
-            goto error;
+    group = &state->groups[index - 1];
 
-        status = add_to_join_list(&join_info, item);
-        Py_DECREF(item);
-        if (status < 0)
-            goto error;
+    if (string != Py_None && index >= 1 && (size_t)index <=
+      state->pattern->public_group_count && group->capture_count > 0) {
+        start = group->span.start;
+        end = group->span.end;
+    } else {
+        if (empty)
+            /* Want an empty string. */
+            start = end = 0;
+        else {
+            Py_INCREF(Py_None);
+            return Py_None;
+        }
     }
 
-    Py_XDECREF(replacement);
+    return get_slice(string, start, end);
+}
 
-    /* Convert the list to a single string (also cleans up join_info). */
-    item = join_list_info(&join_info);
+/* Gets the span of a capture group from a state.
+ *
+ * Index 0 is the entire match. A group that didn't participate has the span
+ * (-1, -1).
+ */
+Py_LOCAL_INLINE(PyObject*) state_get_group_span(RE_State* state, Py_ssize_t
+  index) {
+    RE_GroupData* group;
 
-    state_fini(&state);
+    if (index == 0) {
+        if (state->reverse)
+            return Py_BuildValue("nn", state->text_pos, state->match_pos);
 
-    if (built_capture) {
-        Py_DECREF(kwargs);
-        Py_DECREF(args);
+        return Py_BuildValue("nn", state->match_pos, state->text_pos);
     }
 
-    if (!item)
-        return NULL;
-
-    if (sub_type & RE_SUBN)
-        return Py_BuildValue("Nn", item, sub_count);
-
-    return item;
+    group = &state->groups[index - 1];
 
-error:
-    if (built_capture) {
-        Py_DECREF(kwargs);
-        Py_DECREF(args);
-    }
+    if (group->capture_count == 0)
+        return Py_BuildValue("nn", (Py_ssize_t)-1, (Py_ssize_t)-1);
 
-    clear_join_list(&join_info);
-    state_fini(&state);
-    Py_XDECREF(replacement);
-    return NULL;
+    return Py_BuildValue("nn", group->span.start, group->span.end);
 }
 
-/* PatternObject's 'sub' method. */
-static PyObject* pattern_sub(PatternObject* self, PyObject* args, PyObject*
-  kwargs) {
-    int conc;
+/* Acquires the state if it might be shared across threads.
+ *
+ * The GIL is held, so the 'busy' flag is enough when there's no contention.
+ * Only when another thread is using the state does this thread wait on a lock
+ * (mutex), which acts as a gate that the other thread opens when it has
+ * finished.
+ *
+ * It also increments the owner's refcount just to ensure that it won't be
+ * destroyed by another thread.
+ */
+Py_LOCAL_INLINE(void) acquire_state_lock(PyObject* owner, RE_SafeState*
+  safe_state) {
+    RE_State* state;
 
-    PyObject* replacement;
-    PyObject* string;
-    Py_ssize_t count = 0;
-    PyObject* pos = Py_None;
-    PyObject* endpos = Py_None;
-    PyObject* concurrent = Py_None;
-    static char* kwlist[] = { "repl", "string", "count", "pos", "endpos",
-      "concurrent", NULL };
-    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "OO|nOOO:sub", kwlist,
-      &replacement, &string, &count, &pos, &endpos, &concurrent))
-        return NULL;
+    state = safe_state->re_state;
 
-    conc = decode_concurrent(concurrent);
-    if (conc < 0)
-        return NULL;
+    if (!state->use_lock)
+        return;
 
-    return pattern_subx(self, replacement, string, count, RE_SUB, pos, endpos,
-      conc);
-}
+    Py_INCREF(owner);
 
-/* PatternObject's 'subf' method. */
-static PyObject* pattern_subf(PatternObject* self, PyObject* args, PyObject*
-  kwargs) {
-    int conc;
+    if (state->busy && !state->lock) {
+        /* The gate starts closed. */
+        state->lock = PyThread_allocate_lock();
+        if (state->lock)
+            PyThread_acquire_lock(state->lock, 1);
+    }
 
-    PyObject* format;
-    PyObject* string;
-    Py_ssize_t count = 0;
-    PyObject* pos = Py_None;
-    PyObject* endpos = Py_None;
-    PyObject* concurrent = Py_None;
-    static char* kwlist[] = { "format", "string", "count", "pos", "endpos",
-      "concurrent", NULL };
-    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "OO|nOOO:sub", kwlist,
-      &format, &string, &count, &pos, &endpos, &concurrent))
-        return NULL;
+    ++state->waiters;
 
-    conc = decode_concurrent(concurrent);
-    if (conc < 0)
-        return NULL;
+    while (state->busy) {
+        /* In order to avoid deadlock we need to release the GIL while waiting
+         * at the gate.
+         */
+        release_GIL(safe_state);
+        if (state->lock)
+            PyThread_acquire_lock(state->lock, 1);
+        acquire_GIL(safe_state);
 
-    return pattern_subx(self, format, string, count, RE_SUBF, pos, endpos,
-      conc);
+        state->gate_open = FALSE;
+    }
+
+    --state->waiters;
+    state->busy = TRUE;
 }
 
-/* PatternObject's 'subn' method. */
-static PyObject* pattern_subn(PatternObject* self, PyObject* args, PyObject*
-  kwargs) {
-    int conc;
-
-    PyObject* replacement;
-    PyObject* string;
-    Py_ssize_t count = 0;
-    PyObject* pos = Py_None;
-    PyObject* endpos = Py_None;
-    PyObject* concurrent = Py_None;
-    static char* kwlist[] = { "repl", "string", "count", "pos", "endpos",
-      "concurrent", NULL };
-    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "OO|nOOO:subn", kwlist,
-      &replacement, &string, &count, &pos, &endpos, &concurrent))
-        return NULL;
-
-    conc = decode_concurrent(concurrent);
-    if (conc < 0)
-        return NULL;
+/* Releases the state if it might be shared across threads, opening the gate
+ * if another thread is waiting for it.
+ *
+ * It also decrements the owner's refcount, which was incremented when the
+ * state was acquired.
+ */
+Py_LOCAL_INLINE(void) release_state_lock(PyObject* owner, RE_SafeState*
+  safe_state) {
+    RE_State* state;
 
-    return pattern_subx(self, replacement, string, count, RE_SUBN, pos, endpos,
-      conc);
-}
+    state = safe_state->re_state;
 
-/* PatternObject's 'subfn' method. */
-static PyObject* pattern_subfn(PatternObject* self, PyObject* args, PyObject*
-  kwargs) {
-    int conc;
+    if (!state->use_lock)
+        return;
 
-    PyObject* format;
-    PyObject* string;
-    Py_ssize_t count = 0;
-    PyObject* pos = Py_None;
-    PyObject* endpos = Py_None;
-    PyObject* concurrent = Py_None;
-    static char* kwlist[] = { "format", "string", "count", "pos", "endpos",
-      "concurrent", NULL };
-    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "OO|nOOO:subn", kwlist,
-      &format, &string, &count, &pos, &endpos, &concurrent))
-        return NULL;
+    state->busy = FALSE;
 
-    conc = decode_concurrent(concurrent);
-    if (conc < 0)
-        return NULL;
+    if (state->waiters > 0 && state->lock && !state->gate_open) {
+        state->gate_open = TRUE;
+        PyThread_release_lock(state->lock);
+    }
 
-    return pattern_subx(self, format, string, count, RE_SUBF | RE_SUBN, pos,
-      endpos, conc);
+    Py_DECREF(owner);
 }
 
-/* PatternObject's 'split' method. */
-static PyObject* pattern_split(PatternObject* self, PyObject* args, PyObject*
-  kwargs) {
-    int conc;
-
-    RE_State state;
+/* Implements the functionality of ScanObject's search and match methods. */
+Py_LOCAL_INLINE(PyObject*) scanner_search_or_match(ScannerObject* self, BOOL
+  search) {
+    RE_State* state;
     RE_SafeState safe_state;
-    PyObject* list;
-    PyObject* item;
-    int status;
-    Py_ssize_t split_count;
-    size_t g;
-    Py_ssize_t start_pos;
-    Py_ssize_t end_pos;
-    Py_ssize_t step;
-    Py_ssize_t last_pos;
-
-    PyObject* string;
-    Py_ssize_t maxsplit = 0;
-    PyObject* concurrent = Py_None;
-    static char* kwlist[] = { "string", "maxsplit", "concurrent", NULL };
-    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|nO:split", kwlist,
-      &string, &maxsplit, &concurrent))
-        return NULL;
-
-    if (maxsplit == 0)
-        maxsplit = PY_SSIZE_T_MAX;
-
-    conc = decode_concurrent(concurrent);
-    if (conc < 0)
-        return NULL;
+    PyObject* match;
 
-    /* The MatchObject, and therefore repeated captures, will not be visible.
-     */
-    if (!state_init(&state, self, string, 0, PY_SSIZE_T_MAX, FALSE, conc,
-      FALSE, FALSE, FALSE, FALSE))
-        return NULL;
+    state = &self->state;
 
     /* Initialise the "safe state" structure. */
-    safe_state.re_state = &state;
+    safe_state.re_state = state;
     safe_state.thread_state = NULL;
 
-    list = PyList_New(0);
-    if (!list) {
-        state_fini(&state);
+    /* Acquire the state lock in case we're sharing the scanner object across
+     * threads.
+     */
+    acquire_state_lock((PyObject*)self, &safe_state);
+
+    if (self->status == RE_ERROR_FAILURE || self->status == RE_ERROR_PARTIAL) {
+        /* No or partial match. */
+        release_state_lock((PyObject*)self, &safe_state);
+        Py_INCREF(Py_None);
+        return Py_None;
+    } else if (self->status < 0) {
+        /* Internal error. */
+        release_state_lock((PyObject*)self, &safe_state);
+        set_error(self->status, NULL);
         return NULL;
     }
 
-    split_count = 0;
-    if (state.reverse) {
-        start_pos = state.text_length;
-        end_pos = 0;
-        step = -1;
-    } else {
-        start_pos = 0;
-        end_pos = state.text_length;
-        step = 1;
+    /* Look for another match. */
+    if (!reset_limits(state)) {
+        release_state_lock((PyObject*)self, &safe_state);
+        return NULL;
     }
 
-    last_pos = start_pos;
-    while (split_count < maxsplit) {
-        status = do_match(&safe_state, TRUE);
-        if (status < 0)
-            goto error;
+    self->status = do_match(&safe_state, search);
+    if (self->status >= 0 || self->status == RE_ERROR_PARTIAL) {
+        /* Create the match object, or just its span. */
+        if (self->spans_only && self->status != RE_ERROR_FAILURE)
+            match = state_get_group_span(state, 0);
+        else
+            match = pattern_new_match(self->pattern, state, self->status);
 
-        if (status == 0)
-            /* No more matches. */
-            break;
+        if (search && state->overlapped) {
+            /* Advance one character. */
+            Py_ssize_t step;
 
-        if (state.version_0) {
-            /* Version 0 behaviour is to advance one character if the split was
-             * zero-width. Unfortunately, this can give an incorrect result.
-             * GvR wants this behaviour to be retained so as not to break any
-             * existing software which might rely on it.
+            step = state->reverse ? -1 : 1;
+            state->text_pos = state->match_pos + step;
+            state->must_advance = FALSE;
+        } else
+            /* Continue from where we left off, but don't allow 2 contiguous
+             * zero-width matches.
              */
-            if (state.text_pos == state.match_pos) {
-                if (last_pos == end_pos)
-                    break;
+            state->must_advance = state->text_pos == state->match_pos;
+    } else
+        /* Internal error. */
+        match = NULL;
 
-                /* Advance one character. */
-                state.text_pos += step;
-                state.must_advance = FALSE;
-                continue;
-            }
-        }
+    /* Release the state lock. */
+    release_state_lock((PyObject*)self, &safe_state);
 
-        /* Get segment before this match. */
-        if (state.reverse)
-            item = get_slice(string, state.match_pos, last_pos);
-        else
-            item = get_slice(string, last_pos, state.match_pos);
-        if (!item)
-            goto error;
+    return match;
+}
 
-        status = PyList_Append(list, item);
-        Py_DECREF(item);
-        if (status < 0)
-            goto error;
+/* ScannerObject's 'match' method. */
+static PyObject* scanner_match(ScannerObject* self, PyObject* unused) {
+    return scanner_search_or_match(self, FALSE);
+}
 
-        /* Add groups (if any). */
-        for (g = 1; g <= self->public_group_count; g++) {
-            item = state_get_group(&state, (Py_ssize_t)g, string, FALSE);
-            if (!item)
-                goto error;
+/* ScannerObject's 'search' method. */
+static PyObject* scanner_search(ScannerObject* self, PyObject *unused) {
+    return scanner_search_or_match(self, TRUE);
+}
 
-            status = PyList_Append(list, item);
-            Py_DECREF(item);
-            if (status < 0)
-                goto error;
-        }
+/* Returns an iterator for a ScannerObject.
+ *
+ * The iterator is actually the ScannerObject itself.
+ */
+static PyObject* scanner_iter(PyObject* self) {
+    Py_INCREF(self);
+    return self;
+}
 
-        ++split_count;
-        last_pos = state.text_pos;
+/* Gets the next result from a scanner iterator. */
+static PyObject* scanner_iternext(PyObject* self) {
+    PyObject* match;
 
-        /* Version 0 behaviour is to advance one character if the match was
-         * zero-width. Unfortunately, this can give an incorrect result. GvR
-         * wants this behaviour to be retained so as not to break any existing
-         * software which might rely on it.
-         */
-        if (state.version_0) {
-            if (state.text_pos == state.match_pos)
-                /* Advance one character. */
-                state.text_pos += step;
+    match = scanner_search((ScannerObject*)self, NULL);
 
-            state.must_advance = FALSE;
-        } else
-            /* Continue from where we left off, but don't allow a contiguous
-             * zero-width match.
-             */
-            state.must_advance = TRUE;
+    if (match == Py_None) {
+        /* No match. */
+        Py_DECREF(match);
+        return NULL;
     }
 
-    /* Get segment following last match (even if empty). */
-    if (state.reverse)
-        item = get_slice(string, 0, last_pos);
-    else
-        item = get_slice(string, last_pos, state.text_length);
-    if (!item)
-        goto error;
-
-    status = PyList_Append(list, item);
-    Py_DECREF(item);
-    if (status < 0)
-        goto error;
-
-    state_fini(&state);
+    return match;
+}
 
-    return list;
+/* Makes a copy of a ScannerObject.
+ *
+ * It actually doesn't make a copy, just returns the original object.
+ */
+Py_LOCAL_INLINE(PyObject*) make_scanner_copy(ScannerObject* self) {
+    Py_INCREF(self);
+    return (PyObject*)self;
+}
 
-error:
-    Py_DECREF(list);
-    state_fini(&state);
-    return NULL;
+/* ScannerObject's '__copy__' method. */
+static PyObject* scanner_copy(ScannerObject* self, PyObject *unused) {
+    return make_scanner_copy(self);
 }
 
-/* PatternObject's 'splititer' method. */
-static PyObject* pattern_splititer(PatternObject* pattern, PyObject* args,
-  PyObject* kwargs) {
-    return pattern_splitter(pattern, args, kwargs);
+/* ScannerObject's '__deepcopy__' method. */
+static PyObject* scanner_deepcopy(ScannerObject* self, PyObject* memo) {
+    return make_scanner_copy(self);
 }
 
-/* PatternObject's 'findall' method. */
-static PyObject* pattern_findall(PatternObject* self, PyObject* args, PyObject*
-  kwargs) {
-    Py_ssize_t start;
-    Py_ssize_t end;
-    int conc;
-    RE_State state;
-    RE_SafeState safe_state;
-    PyObject* list;
-    Py_ssize_t step;
-    int status;
-    Py_ssize_t b;
-    Py_ssize_t e;
-    size_t g;
+/* The documentation of a ScannerObject. */
+PyDoc_STRVAR(scanner_match_doc,
+    "match() --> MatchObject or None.\n\
+    Match at the current position in the string.");
+
+PyDoc_STRVAR(scanner_search_doc,
+    "search() --> MatchObject or None.\n\
+    Search from the current position in the string.");
+
+/* ScannerObject's methods. */
+static PyMethodDef scanner_methods[] = {
+    {"match", (PyCFunction)scanner_match, METH_NOARGS, scanner_match_doc},
+    {"search", (PyCFunction)scanner_search, METH_NOARGS, scanner_search_doc},
+    {"__copy__", (PyCFunction)scanner_copy, METH_NOARGS},
+    {"__deepcopy__", (PyCFunction)scanner_deepcopy, METH_O},
+    {NULL, NULL}
+};
+
+PyDoc_STRVAR(scanner_doc, "Scanner object");
+
+/* Deallocates a ScannerObject. */
+static void scanner_dealloc(PyObject* self_) {
+    ScannerObject* self;
+
+    self = (ScannerObject*)self_;
+
+    state_fini(&self->state);
+    Py_DECREF(self->pattern);
+    PyObject_DEL(self);
+}
+
+static PyMemberDef scanner_members[] = {
+    {"pattern", T_OBJECT, offsetof(ScannerObject, pattern), READONLY,
+      "The regex object that produced this scanner object."},
+    {NULL}  /* Sentinel */
+};
+
+static PyTypeObject Scanner_Type = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "_" RE_MODULE "." "Scanner",
+    sizeof(ScannerObject)
+};
+
+/* Decodes a 'concurrent' argument. */
+Py_LOCAL_INLINE(int) decode_concurrent(PyObject* concurrent) {
+    Py_ssize_t value;
+
+    if (concurrent == Py_None)
+        return RE_CONC_DEFAULT;
+
+    value = PyLong_AsLong(concurrent);
+    if (value == -1 && PyErr_Occurred()) {
+        set_error(RE_ERROR_CONCURRENT, NULL);
+        return -1;
+    }
+
+    return value ? RE_CONC_YES : RE_CONC_NO;
+}
+
+/* Decodes a 'partial' argument. */
+Py_LOCAL_INLINE(BOOL) decode_partial(PyObject* partial) {
+    Py_ssize_t value;
+
+    if (partial == Py_False)
+        return FALSE;
+
+    if (partial == Py_True)
+        return TRUE;
+
+    value = PyLong_AsLong(partial);
+    if (value == -1 && PyErr_Occurred()) {
+        PyErr_Clear();
+        return TRUE;
+    }
+
+    return value != 0;
+}
+
+/* Decodes a limit which must be a non-negative integer or None. */
+Py_LOCAL_INLINE(BOOL) decode_size_limit(PyObject* value, char* name,
+  Py_ssize_t default_value, Py_ssize_t* limit) {
+    if (value == Py_None) {
+        *limit = default_value;
+        return TRUE;
+    }
+
+    *limit = PyLong_AsSsize_t(value);
+    if (*limit == -1 && PyErr_Occurred())
+        return FALSE;
+
+    if (*limit < 0) {
+        PyErr_Format(PyExc_ValueError, "%s must not be negative", name);
+        return FALSE;
+    }
+
+    return TRUE;
+}
+
+/* Decodes the 'timeout', 'max_steps' and 'max_memory' arguments. */
+Py_LOCAL_INLINE(BOOL) decode_limits(PyObject* timeout, PyObject* max_steps,
+  PyObject* max_memory, RE_Limits* limits) {
+    if (timeout == Py_None)
+        limits->timeout = -1.0;
+    else {
+        limits->timeout = PyFloat_AsDouble(timeout);
+        if (limits->timeout == -1.0 && PyErr_Occurred())
+            return FALSE;
+
+        if (limits->timeout < 0.0) {
+            PyErr_SetString(PyExc_ValueError, "timeout must not be negative");
+            return FALSE;
+        }
+    }
+
+    if (!decode_size_limit(max_steps, "max_steps", -1, &limits->max_steps))
+        return FALSE;
+
+    return decode_size_limit(max_memory, "max_memory", default_max_memory,
+      &limits->max_memory);
+}
+
+/* Sets the limits on matching. */
+Py_LOCAL_INLINE(BOOL) state_set_limits(RE_State* state, RE_Limits* limits) {
+    state->limits = *limits;
+
+    return reset_limits(state);
+}
+
+/* Creates a new ScannerObject. */
+static PyObject* pattern_scanner(PatternObject* pattern, PyObject* args,
+  PyObject* kwargs) {
+    /* Create search state object. */
+    ScannerObject* self;
+    Py_ssize_t start;
+    Py_ssize_t end;
+    int conc;
+    BOOL part;
+    RE_Limits limits;
 
     PyObject* string;
     PyObject* pos = Py_None;
     PyObject* endpos = Py_None;
     Py_ssize_t overlapped = FALSE;
     PyObject* concurrent = Py_None;
+    PyObject* partial = Py_False;
+    PyObject* timeout = Py_None;
+    PyObject* max_steps = Py_None;
+    PyObject* max_memory = Py_None;
+    Py_ssize_t spans_only = FALSE;
     static char* kwlist[] = { "string", "pos", "endpos", "overlapped",
-      "concurrent", NULL };
-    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|OOnO:findall", kwlist,
-      &string, &pos, &endpos, &overlapped, &concurrent))
+      "concurrent", "partial", "timeout", "max_steps", "max_memory",
+      "spans_only", NULL };
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|OOnOOOOOn:scanner",
+      kwlist, &string, &pos, &endpos, &overlapped, &concurrent, &partial,
+      &timeout, &max_steps, &max_memory, &spans_only))
         return NULL;
 
     start = as_string_index(pos, 0);
@@ -20447,2690 +21501,5487 @@ static PyObject* pattern_findall(PatternObject* self, PyObject* args, PyObject*
     if (conc < 0)
         return NULL;
 
-    /* The MatchObject, and therefore repeated captures, will not be visible.
-     */
-    if (!state_init(&state, self, string, start, end, overlapped != 0, conc,
-      FALSE, FALSE, FALSE, FALSE))
+    part = decode_partial(partial);
+
+    if (!decode_limits(timeout, max_steps, max_memory, &limits))
         return NULL;
 
-    /* Initialise the "safe state" structure. */
-    safe_state.re_state = &state;
-    safe_state.thread_state = NULL;
+    /* Create a scanner object. */
+    self = PyObject_NEW(ScannerObject, &Scanner_Type);
+    if (!self)
+        return NULL;
 
-    list = PyList_New(0);
-    if (!list) {
-        state_fini(&state);
+    self->pattern = pattern;
+    Py_INCREF(self->pattern);
+
+    /* The MatchObject, and therefore repeated captures, will be visible. */
+    if (!state_init(&self->state, pattern, string, start, end, overlapped != 0,
+      conc, part, TRUE, TRUE, FALSE)) {
+        PyObject_DEL(self);
         return NULL;
     }
 
-    step = state.reverse ? -1 : 1;
-    while (state.slice_start <= state.text_pos && state.text_pos <=
-      state.slice_end) {
-        PyObject* item;
-
-        status = do_match(&safe_state, TRUE);
-        if (status < 0)
-            goto error;
+    self->status = RE_ERROR_SUCCESS;
+    self->spans_only = spans_only != 0;
 
-        if (status == 0)
-            break;
+    /* The limits apply to each search, so they're restarted then. */
+    self->state.limits = limits;
 
-        /* Don't bother to build a MatchObject. */
-        switch (self->public_group_count) {
-        case 0:
-            if (state.reverse) {
-                b = state.text_pos;
-                e = state.match_pos;
-            } else {
-                b = state.match_pos;
-                e = state.text_pos;
-            }
-            item = get_slice(string, b, e);
-            if (!item)
-                goto error;
-            break;
-        case 1:
-            item = state_get_group(&state, 1, string, TRUE);
-            if (!item)
-                goto error;
-            break;
-        default:
-            item = PyTuple_New((Py_ssize_t)self->public_group_count);
-            if (!item)
-                goto error;
+    return (PyObject*) self;
+}
 
-            for (g = 0; g < self->public_group_count; g++) {
-                PyObject* o;
+/* Performs the split for the SplitterObject. */
+Py_LOCAL_INLINE(PyObject*) next_split_part(SplitterObject* self) {
+    RE_State* state;
+    RE_SafeState safe_state;
+    PyObject* result = NULL; /* Initialise to stop compiler warning. */
 
-                o = state_get_group(&state, (Py_ssize_t)g + 1, string, TRUE);
-                if (!o) {
-                    Py_DECREF(item);
-                    goto error;
-                }
+    state = &self->state;
 
-                /* PyTuple_SET_ITEM borrows the reference. */
-                PyTuple_SET_ITEM(item, g, o);
-            }
-            break;
-        }
+    /* Initialise the "safe state" structure. */
+    safe_state.re_state = state;
+    safe_state.thread_state = NULL;
 
-        status = PyList_Append(list, item);
-        Py_DECREF(item);
-        if (status < 0)
-            goto error;
+    /* Acquire the state lock in case we're sharing the splitter object across
+     * threads.
+     */
+    acquire_state_lock((PyObject*)self, &safe_state);
 
-        if (state.overlapped) {
-            /* Advance one character. */
-            state.text_pos = state.match_pos + step;
-            state.must_advance = FALSE;
-        } else
-            /* Continue from where we left off, but don't allow 2 contiguous
-             * zero-width matches.
-             */
-            state.must_advance = state.text_pos == state.match_pos;
+    if (self->status == RE_ERROR_FAILURE || self->status == RE_ERROR_PARTIAL) {
+        /* Finished. */
+        release_state_lock((PyObject*)self, &safe_state);
+        result = Py_False;
+        Py_INCREF(result);
+        return result;
+    } else if (self->status < 0) {
+        /* Internal error. */
+        release_state_lock((PyObject*)self, &safe_state);
+        set_error(self->status, NULL);
+        return NULL;
     }
 
-    state_fini(&state);
+    if (self->index == 0) {
+        if (self->split_count < self->maxsplit) {
+            Py_ssize_t step;
+            Py_ssize_t end_pos;
 
-    return list;
+            if (state->reverse) {
+                step = -1;
+                end_pos = state->slice_start;
+            } else {
+                step = 1;
+                end_pos = state->slice_end;
+            }
 
-error:
-    Py_DECREF(list);
-    state_fini(&state);
-    return NULL;
-}
+            if (!reset_limits(state)) {
+                release_state_lock((PyObject*)self, &safe_state);
+                return NULL;
+            }
 
-/* PatternObject's 'finditer' method. */
-static PyObject* pattern_finditer(PatternObject* pattern, PyObject* args,
-  PyObject* kwargs) {
-    return pattern_scanner(pattern, args, kwargs);
-}
+retry:
+            self->status = do_match(&safe_state, TRUE);
+            if (self->status < 0)
+                goto error;
 
-/* Makes a copy of a PatternObject. */
-Py_LOCAL_INLINE(PyObject*) make_pattern_copy(PatternObject* self) {
-    Py_INCREF(self);
-    return (PyObject*)self;
-}
+            if (self->status == RE_ERROR_SUCCESS) {
+                if (state->version_0) {
+                    /* Version 0 behaviour is to advance one character if the
+                     * split was zero-width. Unfortunately, this can give an
+                     * incorrect result. GvR wants this behaviour to be
+                     * retained so as not to break any existing software which
+                     * might rely on it.
+                     */
+                    if (state->text_pos == state->match_pos) {
+                        if (self->last_pos == end_pos)
+                            goto no_match;
 
-/* PatternObject's '__copy__' method. */
-static PyObject* pattern_copy(PatternObject* self, PyObject *unused) {
-    return make_pattern_copy(self);
-}
+                        /* Advance one character. */
+                        state->text_pos += step;
+                        state->must_advance = FALSE;
+                        goto retry;
+                    }
+                }
 
-/* PatternObject's '__deepcopy__' method. */
-static PyObject* pattern_deepcopy(PatternObject* self, PyObject* memo) {
-    return make_pattern_copy(self);
-}
+                ++self->split_count;
 
-/* The documentation of a PatternObject. */
-PyDoc_STRVAR(pattern_match_doc,
-    "match(string, pos=None, endpos=None, concurrent=None) --> MatchObject or None.\n\
-    Match zero or more characters at the beginning of the string.");
+                /* Get segment before this match. */
+                if (state->reverse)
+                    result = get_slice(state->string, state->match_pos,
+                      self->last_pos);
+                else
+                    result = get_slice(state->string, self->last_pos,
+                      state->match_pos);
+                if (!result)
+                    goto error;
 
-PyDoc_STRVAR(pattern_fullmatch_doc,
-    "fullmatch(string, pos=None, endpos=None, concurrent=None) --> MatchObject or None.\n\
-    Match zero or more characters against all of the string.");
+                self->last_pos = state->text_pos;
 
-PyDoc_STRVAR(pattern_search_doc,
-    "search(string, pos=None, endpos=None, concurrent=None) --> MatchObject or None.\n\
-    Search through string looking for a match, and return a corresponding\n\
-    match object instance.  Return None if no match is found.");
+                /* Version 0 behaviour is to advance one character if the match
+                 * was zero-width. Unfortunately, this can give an incorrect
+                 * result. GvR wants this behaviour to be retained so as not to
+                 * break any existing software which might rely on it.
+                 */
+                if (state->version_0) {
+                    if (state->text_pos == state->match_pos)
+                        /* Advance one character. */
+                        state->text_pos += step;
 
-PyDoc_STRVAR(pattern_sub_doc,
-    "sub(repl, string, count=0, flags=0, pos=None, endpos=None, concurrent=None) --> newstring\n\
-    Return the string obtained by replacing the leftmost (or rightmost with a\n\
-    reverse pattern) non-overlapping occurrences of pattern in string by the\n\
-    replacement repl.");
+                    state->must_advance = FALSE;
+                } else
+                    /* Continue from where we left off, but don't allow a
+                     * contiguous zero-width match.
+                     */
+                    state->must_advance = TRUE;
+            }
+        } else
+            goto no_match;
 
-PyDoc_STRVAR(pattern_subf_doc,
-    "subf(format, string, count=0, flags=0, pos=None, endpos=None, concurrent=None) --> newstring\n\
-    Return the string obtained by replacing the leftmost (or rightmost with a\n\
-    reverse pattern) non-overlapping occurrences of pattern in string by the\n\
-    replacement format.");
+        if (self->status == RE_ERROR_FAILURE || self->status ==
+          RE_ERROR_PARTIAL) {
+no_match:
+            /* Get segment following last match (even if empty). */
+            if (state->reverse)
+                result = get_slice(state->string, 0, self->last_pos);
+            else
+                result = get_slice(state->string, self->last_pos,
+                  state->text_length);
+            if (!result)
+                goto error;
+        }
+    } else {
+        /* Add group. */
+        result = state_get_group(state, self->index, state->string, FALSE);
+        if (!result)
+            goto error;
+    }
 
-PyDoc_STRVAR(pattern_subn_doc,
-    "subn(repl, string, count=0, flags=0, pos=None, endpos=None, concurrent=None) --> (newstring, number of subs)\n\
-    Return the tuple (new_string, number_of_subs_made) found by replacing the\n\
-    leftmost (or rightmost with a reverse pattern) non-overlapping occurrences\n\
-    of pattern with the replacement repl.");
+    ++self->index;
+    if ((size_t)self->index > state->pattern->public_group_count)
+        self->index = 0;
 
-PyDoc_STRVAR(pattern_subfn_doc,
-    "subfn(format, string, count=0, flags=0, pos=None, endpos=None, concurrent=None) --> (newstring, number of subs)\n\
-    Return the tuple (new_string, number_of_subs_made) found by replacing the\n\
-    leftmost (or rightmost with a reverse pattern) non-overlapping occurrences\n\
-    of pattern with the replacement format.");
+    /* Release the state lock. */
+    release_state_lock((PyObject*)self, &safe_state);
 
-PyDoc_STRVAR(pattern_split_doc,
-    "split(string, string, maxsplit=0, concurrent=None) --> list.\n\
-    Split string by the occurrences of pattern.");
+    return result;
 
-PyDoc_STRVAR(pattern_splititer_doc,
-    "splititer(string, maxsplit=0, concurrent=None) --> iterator.\n\
-    Return an iterator yielding the parts of a split string.");
+error:
+    /* Release the state lock. */
+    release_state_lock((PyObject*)self, &safe_state);
 
-PyDoc_STRVAR(pattern_findall_doc,
-    "findall(string, pos=None, endpos=None, overlapped=False, concurrent=None) --> list.\n\
-    Return a list of all matches of pattern in string.  The matches may be\n\
-    overlapped if overlapped is True.");
+    return NULL;
+}
 
-PyDoc_STRVAR(pattern_finditer_doc,
-    "finditer(string, pos=None, endpos=None, overlapped=False, concurrent=None) --> iterator.\n\
-    Return an iterator over all matches for the RE pattern in string.  The\n\
-    matches may be overlapped if overlapped is True.  For each match, the\n\
-    iterator returns a MatchObject.");
+/* SplitterObject's 'split' method. */
+static PyObject* splitter_split(SplitterObject* self, PyObject *unused) {
+    PyObject* result;
 
-PyDoc_STRVAR(pattern_scanner_doc,
-    "scanner(string, pos=None, endpos=None, overlapped=False, concurrent=None) --> scanner.\n\
-    Return an scanner for the RE pattern in string.  The matches may be overlapped\n\
-    if overlapped is True.");
+    result = next_split_part(self);
 
-/* The methods of a PatternObject. */
-static PyMethodDef pattern_methods[] = {
-    {"match", (PyCFunction)pattern_match, METH_VARARGS|METH_KEYWORDS,
-      pattern_match_doc},
-    {"fullmatch", (PyCFunction)pattern_fullmatch, METH_VARARGS|METH_KEYWORDS,
-      pattern_fullmatch_doc},
-    {"search", (PyCFunction)pattern_search, METH_VARARGS|METH_KEYWORDS,
-      pattern_search_doc},
-    {"sub", (PyCFunction)pattern_sub, METH_VARARGS|METH_KEYWORDS,
-      pattern_sub_doc},
-    {"subf", (PyCFunction)pattern_subf, METH_VARARGS|METH_KEYWORDS,
-      pattern_subf_doc},
-    {"subn", (PyCFunction)pattern_subn, METH_VARARGS|METH_KEYWORDS,
-      pattern_subn_doc},
-    {"subfn", (PyCFunction)pattern_subfn, METH_VARARGS|METH_KEYWORDS,
-      pattern_subfn_doc},
-    {"split", (PyCFunction)pattern_split, METH_VARARGS|METH_KEYWORDS,
-      pattern_split_doc},
-    {"splititer", (PyCFunction)pattern_splititer, METH_VARARGS|METH_KEYWORDS,
-      pattern_splititer_doc},
-    {"findall", (PyCFunction)pattern_findall, METH_VARARGS|METH_KEYWORDS,
-      pattern_findall_doc},
-    {"finditer", (PyCFunction)pattern_finditer, METH_VARARGS|METH_KEYWORDS,
-      pattern_finditer_doc},
-    {"scanner", (PyCFunction)pattern_scanner, METH_VARARGS|METH_KEYWORDS,
-      pattern_scanner_doc},
-    {"__copy__", (PyCFunction)pattern_copy, METH_NOARGS},
-    {"__deepcopy__", (PyCFunction)pattern_deepcopy, METH_O},
-    {NULL, NULL}
-};
+    if (result == Py_False) {
+        /* The sentinel. */
+        Py_DECREF(Py_False);
+        Py_INCREF(Py_None);
+        return Py_None;
+    }
 
-PyDoc_STRVAR(pattern_doc, "Compiled regex object");
+    return result;
+}
 
-/* Deallocates a PatternObject. */
-static void pattern_dealloc(PyObject* self_) {
-    PatternObject* self;
-    size_t i;
-    int partial_side;
+/* Returns an iterator for a SplitterObject.
+ *
+ * The iterator is actually the SplitterObject itself.
+ */
+static PyObject* splitter_iter(PyObject* self) {
+    Py_INCREF(self);
+    return self;
+}
 
-    self = (PatternObject*)self_;
+/* Gets the next result from a splitter iterator. */
+static PyObject* splitter_iternext(PyObject* self) {
+    PyObject* result;
 
-    /* Discard the nodes. */
-    for (i = 0; i < self->node_count; i++) {
-        RE_Node* node;
+    result = next_split_part((SplitterObject*)self);
 
-        node = self->node_list[i];
-        re_dealloc(node->values);
-        if (node->status & RE_STATUS_STRING) {
-            re_dealloc(node->string.bad_character_offset);
-            re_dealloc(node->string.good_suffix_offset);
-        }
-        re_dealloc(node);
+    if (result == Py_False) {
+        /* No match. */
+        Py_DECREF(result);
+        return NULL;
     }
-    re_dealloc(self->node_list);
 
-    /* Discard the group info. */
-    re_dealloc(self->group_info);
+    return result;
+}
 
-    /* Discard the call_ref info. */
-    re_dealloc(self->call_ref_info);
+/* Makes a copy of a SplitterObject.
+ *
+ * It actually doesn't make a copy, just returns the original object.
+ */
+Py_LOCAL_INLINE(PyObject*) make_splitter_copy(SplitterObject* self) {
+    Py_INCREF(self);
+    return (PyObject*)self;
+}
 
-    /* Discard the repeat info. */
-    re_dealloc(self->repeat_info);
+/* SplitterObject's '__copy__' method. */
+static PyObject* splitter_copy(SplitterObject* self, PyObject *unused) {
+    return make_splitter_copy(self);
+}
+
+/* SplitterObject's '__deepcopy__' method. */
+static PyObject* splitter_deepcopy(SplitterObject* self, PyObject* memo) {
+    return make_splitter_copy(self);
+}
 
-    dealloc_groups(self->groups_storage, self->true_group_count);
+/* The documentation of a SplitterObject. */
+PyDoc_STRVAR(splitter_split_doc,
+    "split() --> string or None.\n\
+    Return the next part of the split string.");
 
-    dealloc_repeats(self->repeats_storage, self->repeat_count);
+/* SplitterObject's methods. */
+static PyMethodDef splitter_methods[] = {
+    {"split", (PyCFunction)splitter_split, METH_NOARGS, splitter_split_doc},
+    {"__copy__", (PyCFunction)splitter_copy, METH_NOARGS},
+    {"__deepcopy__", (PyCFunction)splitter_deepcopy, METH_O},
+    {NULL, NULL}
+};
 
-    if (self->weakreflist)
-        PyObject_ClearWeakRefs((PyObject*)self);
-    Py_XDECREF(self->pattern);
-    Py_XDECREF(self->groupindex);
-    Py_XDECREF(self->indexgroup);
+PyDoc_STRVAR(splitter_doc, "Splitter object");
 
-    for (partial_side = 0; partial_side < 2; partial_side++) {
-        if (self->partial_named_lists[partial_side]) {
-            for (i = 0; i < self->named_lists_count; i++)
-                Py_XDECREF(self->partial_named_lists[partial_side][i]);
+/* Deallocates a SplitterObject. */
+static void splitter_dealloc(PyObject* self_) {
+    SplitterObject* self;
 
-            re_dealloc(self->partial_named_lists[partial_side]);
-        }
-    }
+    self = (SplitterObject*)self_;
 
-    Py_DECREF(self->named_lists);
-    Py_DECREF(self->named_list_indexes);
-    re_dealloc(self->locale_info);
+    state_fini(&self->state);
+    Py_DECREF(self->pattern);
     PyObject_DEL(self);
 }
 
-/* Info about the various flags that can be passed in. */
-typedef struct RE_FlagName {
-    char* name;
-    int value;
-} RE_FlagName;
-
-/* We won't bother about the U flag in Python 3. */
-static RE_FlagName flag_names[] = {
-    {"A", RE_FLAG_ASCII},
-    {"B", RE_FLAG_BESTMATCH},
-    {"D", RE_FLAG_DEBUG},
-    {"S", RE_FLAG_DOTALL},
-    {"F", RE_FLAG_FULLCASE},
-    {"I", RE_FLAG_IGNORECASE},
-    {"L", RE_FLAG_LOCALE},
-    {"M", RE_FLAG_MULTILINE},
-    {"R", RE_FLAG_REVERSE},
-    {"T", RE_FLAG_TEMPLATE},
-    {"X", RE_FLAG_VERBOSE},
-    {"V0", RE_FLAG_VERSION0},
-    {"V1", RE_FLAG_VERSION1},
-    {"W", RE_FLAG_WORD},
-};
+/* Converts a captures index to an integer.
+ *
+ * A negative capture index in 'expandf' and 'subf' is passed as a string
+ * because negative indexes are not supported by 'str.format'.
+ */
+Py_LOCAL_INLINE(Py_ssize_t) index_to_integer(PyObject* item) {
+    Py_ssize_t value;
 
-/* Appends a string to a list. */
-Py_LOCAL_INLINE(BOOL) append_string(PyObject* list, char* string) {
-    PyObject* item;
-    int status;
+    value = PyLong_AsLong(item);
+    if (value != -1 || !PyErr_Occurred())
+        return value;
 
-    item = Py_BuildValue("U", string);
-    if (!item)
-        return FALSE;
+    PyErr_Clear();
 
-    status = PyList_Append(list, item);
-    Py_DECREF(item);
-    if (status < 0)
-        return FALSE;
+    /* Is the index a string representation of an integer? */
+    if (PyUnicode_Check(item)) {
+        PyObject* int_obj;
+#if PY_VERSION_HEX < 0x03030000
+        Py_UNICODE* characters;
+        Py_ssize_t length;
+#endif
 
-    return TRUE;
-}
+#if PY_VERSION_HEX >= 0x03030000
+        int_obj = PyLong_FromUnicodeObject(item, 0);
+#else
+        characters = (Py_UNICODE*)PyUnicode_AS_DATA(item);
+        length = PyUnicode_GET_SIZE(item);
+        int_obj = PyLong_FromUnicode(characters, length, 0);
+#endif
+        if (!int_obj)
+            goto error;
 
-/* Appends a (decimal) integer to a list. */
-Py_LOCAL_INLINE(BOOL) append_integer(PyObject* list, Py_ssize_t value) {
-    PyObject* int_obj;
-    PyObject* repr_obj;
-    int status;
+        value = PyLong_AsLong(int_obj);
+        Py_DECREF(int_obj);
+        if (!PyErr_Occurred())
+            return value;
+    } else if (PyBytes_Check(item)) {
+        char* characters;
+        PyObject* int_obj;
 
-    int_obj = Py_BuildValue("n", value);
-    if (!int_obj)
-        return FALSE;
+        characters = PyBytes_AsString(item);
+        int_obj = PyLong_FromString(characters, NULL, 0);
+        if (!int_obj)
+            goto error;
 
-    repr_obj = PyObject_Repr(int_obj);
-    Py_DECREF(int_obj);
-    if (!repr_obj)
-        return FALSE;
+        value = PyLong_AsLong(int_obj);
+        Py_DECREF(int_obj);
+        if (!PyErr_Occurred())
+            return value;
+    }
 
-    status = PyList_Append(list, repr_obj);
-    Py_DECREF(repr_obj);
-    if (status < 0)
-        return FALSE;
+error:
+    PyErr_Format(PyExc_TypeError, "list indices must be integers, not %.200s",
+      item->ob_type->tp_name);
 
-    return TRUE;
+    return -1;
 }
 
-/* MatchObject's '__repr__' method. */
-static PyObject* match_repr(PyObject* self_) {
-    MatchObject* self;
-    PyObject* list;
-    PyObject* matched_substring;
-    PyObject* matched_repr;
-    int status;
-    PyObject* separator;
-    PyObject* result;
-
-    self = (MatchObject*)self_;
-
-    list = PyList_New(0);
-    if (!list)
-        return NULL;
-
-    if (!append_string(list, "<regex.Match object; span=("))
-        goto error;
+/* CaptureObject's length method. */
+Py_LOCAL_INLINE(Py_ssize_t) capture_length(CaptureObject* self) {
+    MatchObject* match;
+    RE_GroupData* group;
 
-    if (!append_integer(list, self->match_start))
-        goto error;
+    if (self->group_index == 0)
+        return 1;
 
-    if (! append_string(list, ", "))
-        goto error;
+    match = *self->match_indirect;
+    group = &match->groups[self->group_index - 1];
 
-    if (!append_integer(list, self->match_end))
-        goto error;
+    return (Py_ssize_t)group->capture_count;
+}
 
-    if (!append_string(list, "), match="))
-        goto error;
+/* CaptureObject's '__getitem__' method. */
+static PyObject* capture_getitem(CaptureObject* self, PyObject* item) {
+    Py_ssize_t index;
+    MatchObject* match;
+    Py_ssize_t start;
+    Py_ssize_t end;
 
-    matched_substring = get_slice(self->substring, self->match_start -
-      self->substring_offset, self->match_end - self->substring_offset);
-    if (!matched_substring)
-        goto error;
+    index = index_to_integer(item);
+    if (index == -1 && PyErr_Occurred())
+        return NULL;
 
-    matched_repr = PyObject_Repr(matched_substring);
-    Py_DECREF(matched_substring);
-    if (!matched_repr)
-        goto error;
+    match = *self->match_indirect;
 
-    status = PyList_Append(list, matched_repr);
-    Py_DECREF(matched_repr);
-    if (status < 0)
-        goto error;
+    if (self->group_index == 0) {
+        if (index < 0)
+            index += 1;
 
-    if (self->fuzzy_counts[RE_FUZZY_SUB] != 0 ||
-      self->fuzzy_counts[RE_FUZZY_INS] != 0 || self->fuzzy_counts[RE_FUZZY_DEL]
-      != 0) {
-        if (! append_string(list, ", fuzzy_counts=("))
-            goto error;
+        if (index != 0) {
+            PyErr_SetString(PyExc_IndexError, "list index out of range");
+            return NULL;
+        }
 
-        if (!append_integer(list,
-          (Py_ssize_t)self->fuzzy_counts[RE_FUZZY_SUB]))
-            goto error;
+        start = match->match_start;
+        end = match->match_end;
+    } else {
+        RE_GroupData* group;
+        RE_GroupSpan* span;
 
-        if (! append_string(list, ", "))
-            goto error;
+        group = &match->groups[self->group_index - 1];
 
-        if (!append_integer(list,
-          (Py_ssize_t)self->fuzzy_counts[RE_FUZZY_INS]))
-            goto error;
+        if (index < 0)
+            index += group->capture_count;
 
-        if (! append_string(list, ", "))
-            goto error;
-        if (!append_integer(list,
-          (Py_ssize_t)self->fuzzy_counts[RE_FUZZY_DEL]))
-            goto error;
+        if (index < 0 || index >= (Py_ssize_t)group->capture_count) {
+            PyErr_SetString(PyExc_IndexError, "list index out of range");
+            return NULL;
+        }
 
-        if (! append_string(list, ")"))
-            goto error;
-    }
+        span = &group->captures[index];
 
-    if (self->partial) {
-        if (!append_string(list, ", partial=True"))
-            goto error;
+        start = span->start;
+        end = span->end;
     }
 
-    if (! append_string(list, ">"))
-        goto error;
+    return get_slice(match->substring, start - match->substring_offset, end -
+      match->substring_offset);
+}
 
-    separator = Py_BuildValue("U", "");
-    if (!separator)
-        goto error;
+static PyMappingMethods capture_as_mapping = {
+    (lenfunc)capture_length,       /* mp_length */
+    (binaryfunc)capture_getitem,   /* mp_subscript */
+    0,                           /* mp_ass_subscript */
+};
 
-    result = PyUnicode_Join(separator, list);
-    Py_DECREF(separator);
-    Py_DECREF(list);
+/* CaptureObject's methods. */
+static PyMethodDef capture_methods[] = {
+    {"__getitem__", (PyCFunction)capture_getitem, METH_O|METH_COEXIST},
+    {NULL, NULL}
+};
 
-    return result;
+/* Deallocates a CaptureObject. */
+static void capture_dealloc(PyObject* self_) {
+    CaptureObject* self;
 
-error:
-    Py_DECREF(list);
-    return NULL;
+    self = (CaptureObject*)self_;
+    PyObject_DEL(self);
 }
 
-/* PatternObject's '__repr__' method. */
-static PyObject* pattern_repr(PyObject* self_) {
-    PatternObject* self;
-    PyObject* list;
-    PyObject* item;
-    int status;
-    int flag_count;
-    unsigned int i;
-    Py_ssize_t pos;
-    PyObject *key;
-    PyObject *value;
-    PyObject* separator;
-    PyObject* result;
+/* CaptureObject's 'str' method. */
+static PyObject* capture_str(PyObject* self_) {
+    CaptureObject* self;
+    MatchObject* match;
 
-    self = (PatternObject*)self_;
+    self = (CaptureObject*)self_;
+    match = *self->match_indirect;
 
-    list = PyList_New(0);
-    if (!list)
-        return NULL;
+    return match_get_group_by_index(match, self->group_index, Py_None);
+}
 
-    if (!append_string(list, "regex.Regex("))
-        goto error;
-
-    item = PyObject_Repr(self->pattern);
-    if (!item)
-        goto error;
+static PyMemberDef splitter_members[] = {
+    {"pattern", T_OBJECT, offsetof(SplitterObject, pattern), READONLY,
+      "The regex object that produced this splitter object."},
+    {NULL}  /* Sentinel */
+};
 
-    status = PyList_Append(list, item);
-    Py_DECREF(item);
-    if (status < 0)
-        goto error;
+static PyTypeObject Splitter_Type = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "_" RE_MODULE "." "Splitter",
+    sizeof(SplitterObject)
+};
 
-    flag_count = 0;
-    for (i = 0; i < sizeof(flag_names) / sizeof(flag_names[0]); i++) {
-        if (self->flags & flag_names[i].value) {
-            if (flag_count == 0) {
-                if (!append_string(list, ", flags="))
-                    goto error;
-            } else {
-                if (!append_string(list, " | "))
-                    goto error;
-            }
+/* Creates a new SplitterObject. */
+Py_LOCAL_INLINE(PyObject*) pattern_splitter(PatternObject* pattern, PyObject*
+  args, PyObject* kwargs) {
+    /* Create split state object. */
+    int conc;
+    RE_Limits limits;
+    SplitterObject* self;
+    RE_State* state;
 
-            if (!append_string(list, "regex."))
-                goto error;
+    PyObject* string;
+    Py_ssize_t maxsplit = 0;
+    PyObject* concurrent = Py_None;
+    PyObject* timeout = Py_None;
+    PyObject* max_steps = Py_None;
+    PyObject* max_memory = Py_None;
+    static char* kwlist[] = { "string", "maxsplit", "concurrent", "timeout",
+      "max_steps", "max_memory", NULL };
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|nOOOO:splitter", kwlist,
+      &string, &maxsplit, &concurrent, &timeout, &max_steps, &max_memory))
+        return NULL;
 
-            if (!append_string(list, flag_names[i].name))
-                goto error;
+    conc = decode_concurrent(concurrent);
+    if (conc < 0)
+        return NULL;
 
-            ++flag_count;
-        }
-    }
+    if (!decode_limits(timeout, max_steps, max_memory, &limits))
+        return NULL;
 
-    pos = 0;
-    /* PyDict_Next borrows references. */
-    while (PyDict_Next(self->named_lists, &pos, &key, &value)) {
-        if (!append_string(list, ", "))
-            goto error;
+    /* Create a splitter object. */
+    self = PyObject_NEW(SplitterObject, &Splitter_Type);
+    if (!self)
+        return NULL;
 
-        status = PyList_Append(list, key);
-        if (status < 0)
-            goto error;
+    self->pattern = pattern;
+    Py_INCREF(self->pattern);
 
-        if (!append_string(list, "="))
-            goto error;
+    if (maxsplit == 0)
+        maxsplit = PY_SSIZE_T_MAX;
 
-        item = PyObject_Repr(value);
-        if (!item)
-            goto error;
+    state = &self->state;
 
-        status = PyList_Append(list, item);
-        Py_DECREF(item);
-        if (status < 0)
-            goto error;
+    /* The MatchObject, and therefore repeated captures, will not be visible.
+     */
+    if (!state_init(state, pattern, string, 0, PY_SSIZE_T_MAX, FALSE, conc,
+      FALSE, TRUE, FALSE, FALSE)) {
+        PyObject_DEL(self);
+        return NULL;
     }
 
-    if (!append_string(list, ")"))
-        goto error;
+    self->maxsplit = maxsplit;
+    self->last_pos = state->reverse ? state->text_length : 0;
+    self->split_count = 0;
+    self->index = 0;
+    self->status = 1;
 
-    separator = Py_BuildValue("U", "");
-    if (!separator)
-        goto error;
+    /* The limits apply to each split, so they're restarted then. */
+    state->limits = limits;
 
-    result = PyUnicode_Join(separator, list);
-    Py_DECREF(separator);
-    Py_DECREF(list);
+    return (PyObject*) self;
+}
 
-    return result;
+/* Implements the functionality of PatternObject's search and match methods. */
+Py_LOCAL_INLINE(PyObject*) pattern_search_or_match(PatternObject* self,
+  PyObject* args, PyObject* kwargs, char* args_desc, BOOL search, BOOL
+  match_all) {
+    Py_ssize_t start;
+    Py_ssize_t end;
+    int conc;
+    BOOL part;
+    RE_Limits limits;
+    RE_State state;
+    RE_SafeState safe_state;
+    int status;
+    PyObject* match;
 
-error:
-    Py_DECREF(list);
-    return NULL;
-}
+    PyObject* string;
+    PyObject* pos = Py_None;
+    PyObject* endpos = Py_None;
+    PyObject* concurrent = Py_None;
+    PyObject* partial = Py_False;
+    PyObject* timeout = Py_None;
+    PyObject* max_steps = Py_None;
+    PyObject* max_memory = Py_None;
+    static char* kwlist[] = { "string", "pos", "endpos", "concurrent",
+      "partial", "timeout", "max_steps", "max_memory", NULL };
+    /* When working with a short string, such as a line from a file, the
+     * relative cost of PyArg_ParseTupleAndKeywords can be significant, and
+     * it's worth not using it when there are only positional arguments.
+     */
+    Py_ssize_t arg_count;
+    if (args && !kwargs && PyTuple_CheckExact(args))
+        arg_count = PyTuple_GET_SIZE(args);
+    else
+        arg_count = -1;
 
-/* PatternObject's 'groupindex' method. */
-static PyObject* pattern_groupindex(PyObject* self_) {
-    PatternObject* self;
+    if (1 <= arg_count && arg_count <= 8) {
+        /* PyTuple_GET_ITEM borrows the reference. */
+        string = PyTuple_GET_ITEM(args, 0);
+        if (arg_count >= 2)
+            pos = PyTuple_GET_ITEM(args, 1);
+        if (arg_count >= 3)
+            endpos = PyTuple_GET_ITEM(args, 2);
+        if (arg_count >= 4)
+            concurrent = PyTuple_GET_ITEM(args, 3);
+        if (arg_count >= 5)
+            partial = PyTuple_GET_ITEM(args, 4);
+        if (arg_count >= 6)
+            timeout = PyTuple_GET_ITEM(args, 5);
+        if (arg_count >= 7)
+            max_steps = PyTuple_GET_ITEM(args, 6);
+        if (arg_count >= 8)
+            max_memory = PyTuple_GET_ITEM(args, 7);
+    } else if (!PyArg_ParseTupleAndKeywords(args, kwargs, args_desc, kwlist,
+      &string, &pos, &endpos, &concurrent, &partial, &timeout, &max_steps,
+      &max_memory))
+        return NULL;
 
-    self = (PatternObject*)self_;
+    start = as_string_index(pos, 0);
+    if (start == -1 && PyErr_Occurred())
+        return NULL;
 
-    return PyDict_Copy(self->groupindex);
-}
+    end = as_string_index(endpos, PY_SSIZE_T_MAX);
+    if (end == -1 && PyErr_Occurred())
+        return NULL;
 
-static PyGetSetDef pattern_getset[] = {
-    {"groupindex", (getter)pattern_groupindex, (setter)NULL,
-      "A dictionary mapping group names to group numbers."},
-    {NULL}  /* Sentinel */
-};
+    conc = decode_concurrent(concurrent);
+    if (conc < 0)
+        return NULL;
 
-static PyMemberDef pattern_members[] = {
-    {"pattern", T_OBJECT, offsetof(PatternObject, pattern), READONLY,
-      "The pattern string from which the regex object was compiled."},
-    {"flags", T_PYSSIZET, offsetof(PatternObject, flags), READONLY,
-      "The regex matching flags."},
-    {"groups", T_PYSSIZET, offsetof(PatternObject, public_group_count),
-      READONLY, "The number of capturing groups in the pattern."},
-    {"named_lists", T_OBJECT, offsetof(PatternObject, named_lists), READONLY,
-      "The named lists used by the regex."},
-    {NULL}  /* Sentinel */
-};
+    part = decode_partial(partial);
 
-static PyTypeObject Pattern_Type = {
-    PyVarObject_HEAD_INIT(NULL, 0)
-    "_" RE_MODULE "." "Pattern",
-    sizeof(PatternObject)
-};
+    if (!decode_limits(timeout, max_steps, max_memory, &limits))
+        return NULL;
 
-/* Building the nodes is made simpler by allowing branches to have a single
- * exit. These need to be removed.
- */
-Py_LOCAL_INLINE(void) skip_one_way_branches(PatternObject* pattern) {
-    BOOL modified;
+    /* The MatchObject, and therefore repeated captures, will be visible. */
+    if (!state_init(&state, self, string, start, end, FALSE, conc, part, FALSE,
+      TRUE, match_all))
+        return NULL;
 
-    /* If a node refers to a 1-way branch then make the former refer to the
-     * latter's destination. Repeat until they're all done.
-     */
-    do {
-        size_t i;
+    if (!state_set_limits(&state, &limits)) {
+        state_fini(&state);
+        return NULL;
+    }
 
-        modified = FALSE;
+    /* Initialise the "safe state" structure. */
+    safe_state.re_state = &state;
+    safe_state.thread_state = NULL;
 
-        for (i = 0; i < pattern->node_count; i++) {
-            RE_Node* node;
-            RE_Node* next;
+    status = do_match(&safe_state, search);
 
-            node = pattern->node_list[i];
+    if (status >= 0 || status == RE_ERROR_PARTIAL)
+        /* Create the match object. */
+        match = pattern_new_match(self, &state, status);
+    else
+        match = NULL;
 
-            /* Check the first destination. */
-            next = node->next_1.node;
-            if (next && next->op == RE_OP_BRANCH &&
-              !next->nonstring.next_2.node) {
-                node->next_1.node = next->next_1.node;
-                modified = TRUE;
-            }
+    state_fini(&state);
 
-            /* Check the second destination. */
-            next = node->nonstring.next_2.node;
-            if (next && next->op == RE_OP_BRANCH &&
-              !next->nonstring.next_2.node) {
-                node->nonstring.next_2.node = next->next_1.node;
-                modified = TRUE;
-            }
-        }
-    } while (modified);
+    return match;
+}
 
-    /* The start node might be a 1-way branch. Skip over it because it'll be
-     * removed. It might even be the first in a chain.
-     */
-    while (pattern->start_node->op == RE_OP_BRANCH &&
-      !pattern->start_node->nonstring.next_2.node)
-        pattern->start_node = pattern->start_node->next_1.node;
+/* PatternObject's 'match' method. */
+static PyObject* pattern_match(PatternObject* self, PyObject* args, PyObject*
+  kwargs) {
+    return pattern_search_or_match(self, args, kwargs, "O|OOOOOOO:match",
+      FALSE, FALSE);
 }
 
-/* Adds guards to repeats which are followed by a reference to a group.
- *
- * Returns whether a guard was added for a node at or after the given node.
- */
-Py_LOCAL_INLINE(RE_STATUS_T) add_repeat_guards(PatternObject* pattern, RE_Node*
-  node) {
-    RE_STATUS_T result;
+/* PatternObject's 'fullmatch' method. */
+static PyObject* pattern_fullmatch(PatternObject* self, PyObject* args,
+  PyObject* kwargs) {
+    return pattern_search_or_match(self, args, kwargs, "O|OOOOOOO:fullmatch",
+      FALSE, TRUE);
+}
 
-    result = RE_STATUS_NEITHER;
+/* PatternObject's 'search' method. */
+static PyObject* pattern_search(PatternObject* self, PyObject* args, PyObject*
+  kwargs) {
+    return pattern_search_or_match(self, args, kwargs, "O|OOOOOOO:search",
+      TRUE, FALSE);
+}
 
-    for (;;) {
-        if (node->status & RE_STATUS_VISITED_AG)
-            return node->status & (RE_STATUS_REPEAT | RE_STATUS_REF);
+/* Gets a PatternObject's group index.
+ *
+ * The supplied index can be an integer or a string (group name) object.
+ */
+Py_LOCAL_INLINE(Py_ssize_t) pattern_get_group_index(PatternObject* self,
+  PyObject* index) {
+    Py_ssize_t group;
 
-        switch (node->op) {
-        case RE_OP_BRANCH:
-        {
-            RE_STATUS_T branch_1_result;
-            RE_STATUS_T branch_2_result;
-            RE_STATUS_T status;
+    /* Is the index an integer? */
+    group = as_group_index(index);
+    if (group != -1 || !PyErr_Occurred()) {
+        if (0 <= group && (size_t)group <= self->public_group_count)
+            return group;
+    } else if (self->groupindex) {
+        /* The index might be a group name. */
+        PyErr_Clear();
 
-            branch_1_result = add_repeat_guards(pattern, node->next_1.node);
-            branch_2_result = add_repeat_guards(pattern,
-              node->nonstring.next_2.node);
-            status = max_status_3(result, branch_1_result, branch_2_result);
-            node->status = RE_STATUS_VISITED_AG | status;
-            return status;
+        index = PyObject_GetItem(self->groupindex, index);
+        if (index) {
+            /* Check that we have an integer. */
+            group = as_group_index(index);
+            Py_DECREF(index);
+            if (group != -1 || !PyErr_Occurred())
+                return group;
         }
-        case RE_OP_END_GREEDY_REPEAT:
-        case RE_OP_END_LAZY_REPEAT:
-            node->status |= RE_STATUS_VISITED_AG;
-            return result;
-        case RE_OP_GREEDY_REPEAT:
-        case RE_OP_LAZY_REPEAT:
-        {
-            BOOL limited;
-            RE_STATUS_T body_result;
-            RE_STATUS_T tail_result;
-            RE_RepeatInfo* repeat_info;
-            RE_STATUS_T status;
-
-            limited = ~node->values[2] != 0;
-            if (limited)
-                body_result = RE_STATUS_LIMITED;
-            else
-                body_result = add_repeat_guards(pattern, node->next_1.node);
-            tail_result = add_repeat_guards(pattern,
-              node->nonstring.next_2.node);
+    }
 
-            repeat_info = &pattern->repeat_info[node->values[0]];
-            if (body_result != RE_STATUS_REF)
-                repeat_info->status |= RE_STATUS_BODY;
-            if (tail_result != RE_STATUS_REF)
-                repeat_info->status |= RE_STATUS_TAIL;
-            if (limited)
-                result = max_status_2(result, RE_STATUS_LIMITED);
-            else
-                result = max_status_2(result, RE_STATUS_REPEAT);
-            status = max_status_3(result, body_result, tail_result);
-            node->status |= RE_STATUS_VISITED_AG | status;
-            return status;
-        }
-        case RE_OP_GREEDY_REPEAT_ONE:
-        case RE_OP_LAZY_REPEAT_ONE:
-        {
-            BOOL limited;
-            RE_STATUS_T tail_result;
-            RE_RepeatInfo* repeat_info;
-            RE_STATUS_T status;
+    PyErr_Clear();
+    set_error(RE_ERROR_NO_SUCH_GROUP, NULL);
+    return -1;
+}
 
-            limited = ~node->values[2] != 0;
-            tail_result = add_repeat_guards(pattern, node->next_1.node);
+/* Gets the result of a batch search or match for a string. */
+Py_LOCAL_INLINE(PyObject*) get_batch_result(RE_State* state, int status,
+  PyObject* string, BOOL spans, Py_ssize_t* groups, Py_ssize_t group_count,
+  BOOL as_tuple) {
+    Py_ssize_t start;
+    Py_ssize_t end;
+    PyObject* result;
+    Py_ssize_t g;
 
-            repeat_info = &pattern->repeat_info[node->values[0]];
-            repeat_info->status |= RE_STATUS_BODY;
-            if (tail_result != RE_STATUS_REF)
-                repeat_info->status |= RE_STATUS_TAIL;
-            if (limited)
-                result = max_status_2(result, RE_STATUS_LIMITED);
-            else
-                result = max_status_2(result, RE_STATUS_REPEAT);
-            status = max_status_3(result, RE_STATUS_REPEAT, tail_result);
-            node->status = RE_STATUS_VISITED_AG | status;
-            return status;
-        }
-        case RE_OP_GROUP_EXISTS:
-        {
-            RE_STATUS_T branch_1_result;
-            RE_STATUS_T branch_2_result;
-            RE_STATUS_T status;
+    if (group_count == 0 && !spans)
+        return PyBool_FromLong(status);
 
-            branch_1_result = add_repeat_guards(pattern, node->next_1.node);
-            branch_2_result = add_repeat_guards(pattern,
-              node->nonstring.next_2.node);
-            status = max_status_4(result, branch_1_result, branch_2_result,
-              RE_STATUS_REF);
-            node->status = RE_STATUS_VISITED_AG | status;
-            return status;
-        }
-        case RE_OP_GROUP_CALL:
-        case RE_OP_REF_GROUP:
-        case RE_OP_REF_GROUP_FLD:
-        case RE_OP_REF_GROUP_FLD_REV:
-        case RE_OP_REF_GROUP_IGN:
-        case RE_OP_REF_GROUP_IGN_REV:
-        case RE_OP_REF_GROUP_REV:
-            result = RE_STATUS_REF;
-            node = node->next_1.node;
-            break;
-        case RE_OP_SUCCESS:
-            node->status = RE_STATUS_VISITED_AG | result;
-            return result;
-        default:
-            node = node->next_1.node;
-            break;
-        }
+    if (!status) {
+        Py_INCREF(Py_None);
+        return Py_None;
     }
-}
 
-/* Adds an index to a node's values unless it's already present.
- *
- * 'offset' is the offset of the index count within the values.
- */
-Py_LOCAL_INLINE(BOOL) add_index(RE_Node* node, size_t offset, size_t index) {
-    size_t index_count;
-    size_t first_index;
-    size_t i;
-    RE_CODE* new_values;
+    if (state->reverse) {
+        start = state->text_pos;
+        end = state->match_pos;
+    } else {
+        start = state->match_pos;
+        end = state->text_pos;
+    }
 
-    if (!node)
-        return TRUE;
+    if (spans)
+        return Py_BuildValue("nn", start, end);
 
-    index_count = node->values[offset];
-    first_index = offset + 1;
+    if (!as_tuple) {
+        if (groups[0] == 0)
+            return get_slice(string, start, end);
 
-    /* Is the index already present? */
-    for (i = 0; i < index_count; i++) {
-        if (node->values[first_index + i] == index)
-            return TRUE;
+        return state_get_group(state, groups[0], string, FALSE);
     }
 
-    /* Allocate more space for the new index. */
-    new_values = re_realloc(node->values, (node->value_count + 1) *
-      sizeof(RE_CODE));
-    if (!new_values)
-        return FALSE;
+    result = PyTuple_New(group_count);
+    if (!result)
+        return NULL;
 
-    ++node->value_count;
-    node->values = new_values;
+    for (g = 0; g < group_count; g++) {
+        PyObject* item;
 
-    node->values[first_index + node->values[offset]++] = (RE_CODE)index;
+        if (groups[g] == 0)
+            item = get_slice(string, start, end);
+        else
+            item = state_get_group(state, groups[g], string, FALSE);
+        if (!item) {
+            Py_DECREF(result);
+            return NULL;
+        }
 
-    return TRUE;
+        /* PyTuple_SET_ITEM borrows the reference. */
+        PyTuple_SET_ITEM(result, g, item);
+    }
+
+    return result;
 }
 
-/* Records the index of every repeat and fuzzy section within atomic
- * subpatterns and lookarounds.
+/* Implements the functionality of PatternObject's search_many and match_many
+ * methods.
  */
-Py_LOCAL_INLINE(BOOL) record_subpattern_repeats_and_fuzzy_sections(RE_Node*
-  parent_node, size_t offset, size_t repeat_count, RE_Node* node) {
-    while (node) {
-        if (node->status & RE_STATUS_VISITED_REP)
-            return TRUE;
+Py_LOCAL_INLINE(PyObject*) pattern_search_or_match_many(PatternObject* self,
+  PyObject* args, PyObject* kwargs, char* args_desc, BOOL search, BOOL
+  match_all) {
+    Py_ssize_t start;
+    Py_ssize_t end;
+    int conc;
+    int want_spans;
+    RE_Limits limits;
+    Py_ssize_t* groups;
+    Py_ssize_t group_count;
+    BOOL as_tuple;
+    PyObject* iterator;
+    PyObject* results;
+    RE_State state;
+    RE_SafeState safe_state;
+    BOOL initialised;
+    Py_ssize_t g;
 
-        node->status |= RE_STATUS_VISITED_REP;
+    PyObject* strings;
+    PyObject* pos = Py_None;
+    PyObject* endpos = Py_None;
+    PyObject* spans = Py_False;
+    PyObject* group = Py_None;
+    PyObject* concurrent = Py_None;
+    PyObject* timeout = Py_None;
+    PyObject* max_steps = Py_None;
+    PyObject* max_memory = Py_None;
+    static char* kwlist[] = { "strings", "pos", "endpos", "spans", "group",
+      "concurrent", "timeout", "max_steps", "max_memory", NULL };
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, args_desc, kwlist,
+      &strings, &pos, &endpos, &spans, &group, &concurrent, &timeout,
+      &max_steps, &max_memory))
+        return NULL;
 
-        switch (node->op) {
-        case RE_OP_BRANCH:
-            if (!record_subpattern_repeats_and_fuzzy_sections(parent_node,
-              offset, repeat_count, node->next_1.node))
-                return FALSE;
-            node = node->nonstring.next_2.node;
-            break;
-        case RE_OP_END_FUZZY:
-            node = node->next_1.node;
-            break;
-        case RE_OP_END_GREEDY_REPEAT:
-        case RE_OP_END_LAZY_REPEAT:
-            return TRUE;
-        case RE_OP_FUZZY:
-            /* Record the fuzzy index. */
-            if (!add_index(parent_node, offset, repeat_count +
-              node->values[0]))
-                return FALSE;
-            node = node->next_1.node;
-            break;
-        case RE_OP_GREEDY_REPEAT:
-        case RE_OP_LAZY_REPEAT:
-            /* Record the repeat index. */
-            if (!add_index(parent_node, offset, node->values[0]))
-                return FALSE;
-            if (!record_subpattern_repeats_and_fuzzy_sections(parent_node,
-              offset, repeat_count, node->next_1.node))
-                return FALSE;
-            node = node->nonstring.next_2.node;
-            break;
-        case RE_OP_GREEDY_REPEAT_ONE:
-        case RE_OP_LAZY_REPEAT_ONE:
-            /* Record the repeat index. */
-            if (!add_index(parent_node, offset, node->values[0]))
-                return FALSE;
-            node = node->next_1.node;
-            break;
-        case RE_OP_GROUP_EXISTS:
-            if (!record_subpattern_repeats_and_fuzzy_sections(parent_node,
-              offset, repeat_count, node->next_1.node))
-                return FALSE;
-            node = node->nonstring.next_2.node;
-            break;
-        default:
-            node = node->next_1.node;
-            break;
-        }
-    }
+    start = as_string_index(pos, 0);
+    if (start == -1 && PyErr_Occurred())
+        return NULL;
 
-    return TRUE;
-}
+    end = as_string_index(endpos, PY_SSIZE_T_MAX);
+    if (end == -1 && PyErr_Occurred())
+        return NULL;
 
-/* Marks nodes which are being used as used. */
-Py_LOCAL_INLINE(void) use_nodes(RE_Node* node) {
-    while (node && !(node->status & RE_STATUS_USED)) {
-        node->status |= RE_STATUS_USED;
-        if (!(node->status & RE_STATUS_STRING)) {
-            if (node->nonstring.next_2.node)
-                use_nodes(node->nonstring.next_2.node);
-        }
-        node = node->next_1.node;
-    }
-}
+    conc = decode_concurrent(concurrent);
+    if (conc < 0)
+        return NULL;
 
-/* Discards any unused nodes.
- *
- * Optimising the nodes might result in some nodes no longer being used.
- */
-Py_LOCAL_INLINE(void) discard_unused_nodes(PatternObject* pattern) {
-    size_t i;
-    size_t new_count;
+    want_spans = PyObject_IsTrue(spans);
+    if (want_spans < 0)
+        return NULL;
 
-    /* Mark the nodes which are being used. */
-    use_nodes(pattern->start_node);
+    if (!decode_limits(timeout, max_steps, max_memory, &limits))
+        return NULL;
 
-    for (i = 0; i < pattern->call_ref_info_capacity; i++)
-        use_nodes(pattern->call_ref_info[i].node);
+    /* Which groups to return, if any. */
+    as_tuple = PyTuple_Check(group);
+    if (group == Py_None)
+        group_count = 0;
+    else if (as_tuple)
+        group_count = PyTuple_GET_SIZE(group);
+    else
+        group_count = 1;
 
-    new_count = 0;
-    for (i = 0; i < pattern->node_count; i++) {
-        RE_Node* node;
+    groups = NULL;
+    if (group_count > 0) {
+        groups = (Py_ssize_t*)re_alloc((size_t)group_count *
+          sizeof(Py_ssize_t));
+        if (!groups)
+            return NULL;
 
-        node = pattern->node_list[i];
-        if (node->status & RE_STATUS_USED)
-            pattern->node_list[new_count++] = node;
-        else {
-            re_dealloc(node->values);
-            if (node->status & RE_STATUS_STRING) {
-                re_dealloc(node->string.bad_character_offset);
-                re_dealloc(node->string.good_suffix_offset);
+        for (g = 0; g < group_count; g++) {
+            groups[g] = pattern_get_group_index(self, as_tuple ?
+              PyTuple_GET_ITEM(group, g) : group);
+            if (groups[g] < 0) {
+                re_dealloc(groups);
+                return NULL;
             }
-            re_dealloc(node);
         }
     }
 
-    pattern->node_count = new_count;
-}
+    iterator = PyObject_GetIter(strings);
+    if (!iterator) {
+        re_dealloc(groups);
+        return NULL;
+    }
 
-/* Marks all the group which are named. Returns FALSE if there's an error. */
-Py_LOCAL_INLINE(BOOL) mark_named_groups(PatternObject* pattern) {
-    size_t i;
+    results = PyList_New(0);
+    if (!results) {
+        Py_DECREF(iterator);
+        re_dealloc(groups);
+        return NULL;
+    }
 
-    for (i = 0; i < pattern->public_group_count; i++) {
-        RE_GroupInfo* group_info;
-        PyObject* index;
+    /* A single state is used for all of the strings, so the limits apply to
+     * the whole batch.
+     */
+    initialised = FALSE;
+    safe_state.re_state = &state;
+    safe_state.thread_state = NULL;
+
+    for (;;) {
+        PyObject* string;
         int status;
+        PyObject* result;
 
-        group_info = &pattern->group_info[i];
-        index = Py_BuildValue("n", i + 1);
-        if (!index)
-            return FALSE;
+        string = PyIter_Next(iterator);
+        if (!string)
+            break;
 
-        status = PyDict_Contains(pattern->indexgroup, index);
-        Py_DECREF(index);
-        if (status < 0)
-            return FALSE;
+        if (!initialised) {
+            /* The MatchObject, and therefore repeated captures, will not be
+             * visible.
+             */
+            if (!state_init(&state, self, string, start, end, FALSE, conc,
+              FALSE, FALSE, FALSE, match_all)) {
+                Py_DECREF(string);
+                goto error;
+            }
 
-        group_info->has_name = status == 1;
-    }
+            initialised = TRUE;
 
-    return TRUE;
-}
+            if (!state_set_limits(&state, &limits)) {
+                Py_DECREF(string);
+                goto error;
+            }
+        } else {
+            RE_StringInfo str_info;
+            PyObject* old_string;
+            BOOL old_should_release;
+            Py_buffer old_view;
 
-/* Gets the test node.
- *
- * The test node lets the matcher look ahead in the pattern, allowing it to
- * avoid the cost of housekeeping, only to find that what follows doesn't match
- * anyway.
- */
-Py_LOCAL_INLINE(void) set_test_node(RE_NextNode* next) {
-    RE_Node* node = next->node;
-    RE_Node* test;
+            if (!get_string(string, &str_info)) {
+                Py_DECREF(string);
+                goto error;
+            }
 
-    next->test = node;
-    next->match_next = node;
-    next->match_step = 0;
+            if (!check_compatible(self, str_info.is_unicode)) {
+                release_buffer(&str_info);
+                Py_DECREF(string);
+                goto error;
+            }
 
-    if (!node)
-        return;
+            /* Replace the previous string. */
+            old_string = state.string;
+            old_should_release = state.should_release;
+            if (old_should_release)
+                old_view = state.view;
+
+            if (!state_set_string(&state, string, &str_info, start, end)) {
+                state.string = old_string;
+                state.should_release = old_should_release;
+                if (old_should_release)
+                    state.view = old_view;
+                release_buffer(&str_info);
+                Py_DECREF(string);
+                goto error;
+            }
 
-    test = node;
-    while (test->op == RE_OP_END_GROUP || test->op == RE_OP_START_GROUP)
-        test = test->next_1.node;
+            Py_INCREF(state.string);
+            if (old_should_release)
+                PyBuffer_Release(&old_view);
+            Py_DECREF(old_string);
 
-    next->test = test;
+            if (conc == RE_CONC_DEFAULT)
+                state.is_multithreaded = PyUnicode_Check(string) ||
+                  PyBytes_Check(string);
+        }
 
-    if (test != node)
-        return;
+        status = do_match(&safe_state, search);
+        if (status < 0) {
+            Py_DECREF(string);
+            goto error;
+        }
 
-    switch (test->op) {
-    case RE_OP_ANY:
-    case RE_OP_ANY_ALL:
-    case RE_OP_ANY_ALL_REV:
-    case RE_OP_ANY_REV:
-    case RE_OP_ANY_U:
-    case RE_OP_ANY_U_REV:
-    case RE_OP_BOUNDARY:
-    case RE_OP_CHARACTER:
-    case RE_OP_CHARACTER_IGN:
-    case RE_OP_CHARACTER_IGN_REV:
-    case RE_OP_CHARACTER_REV:
-    case RE_OP_DEFAULT_BOUNDARY:
-    case RE_OP_DEFAULT_END_OF_WORD:
-    case RE_OP_DEFAULT_START_OF_WORD:
-    case RE_OP_END_OF_LINE:
-    case RE_OP_END_OF_LINE_U:
-    case RE_OP_END_OF_STRING:
-    case RE_OP_END_OF_STRING_LINE:
-    case RE_OP_END_OF_STRING_LINE_U:
-    case RE_OP_END_OF_WORD:
-    case RE_OP_GRAPHEME_BOUNDARY:
-    case RE_OP_PROPERTY:
-    case RE_OP_PROPERTY_IGN:
-    case RE_OP_PROPERTY_IGN_REV:
-    case RE_OP_PROPERTY_REV:
-    case RE_OP_RANGE:
-    case RE_OP_RANGE_IGN:
-    case RE_OP_RANGE_IGN_REV:
-    case RE_OP_RANGE_REV:
-    case RE_OP_SEARCH_ANCHOR:
-    case RE_OP_SET_DIFF:
-    case RE_OP_SET_DIFF_IGN:
-    case RE_OP_SET_DIFF_IGN_REV:
-    case RE_OP_SET_DIFF_REV:
-    case RE_OP_SET_INTER:
-    case RE_OP_SET_INTER_IGN:
-    case RE_OP_SET_INTER_IGN_REV:
-    case RE_OP_SET_INTER_REV:
-    case RE_OP_SET_SYM_DIFF:
-    case RE_OP_SET_SYM_DIFF_IGN:
-    case RE_OP_SET_SYM_DIFF_IGN_REV:
-    case RE_OP_SET_SYM_DIFF_REV:
-    case RE_OP_SET_UNION:
-    case RE_OP_SET_UNION_IGN:
-    case RE_OP_SET_UNION_IGN_REV:
-    case RE_OP_SET_UNION_REV:
-    case RE_OP_START_OF_LINE:
-    case RE_OP_START_OF_LINE_U:
-    case RE_OP_START_OF_STRING:
-    case RE_OP_START_OF_WORD:
-    case RE_OP_STRING:
-    case RE_OP_STRING_FLD:
-    case RE_OP_STRING_FLD_REV:
-    case RE_OP_STRING_IGN:
-    case RE_OP_STRING_IGN_REV:
-    case RE_OP_STRING_REV:
-        next->match_next = test->next_1.node;
-        next->match_step = test->step;
-        break;
-    case RE_OP_GREEDY_REPEAT_ONE:
-    case RE_OP_LAZY_REPEAT_ONE:
-        if (test->values[1] > 0)
-            next->test = test;
-        break;
-    }
-}
+        result = get_batch_result(&state, status, string, want_spans, groups,
+          group_count, as_tuple);
+        Py_DECREF(string);
+        if (!result)
+            goto error;
 
-/* Sets the test nodes. */
-Py_LOCAL_INLINE(void) set_test_nodes(PatternObject* pattern) {
-    RE_Node** node_list;
-    size_t i;
+        status = PyList_Append(results, result);
+        Py_DECREF(result);
+        if (status < 0)
+            goto error;
+    }
 
-    node_list = pattern->node_list;
-    for (i = 0; i < pattern->node_count; i++) {
-        RE_Node* node;
+    if (PyErr_Occurred())
+        goto error;
 
-        node = node_list[i];
-        set_test_node(&node->next_1);
-        if (!(node->status & RE_STATUS_STRING))
-            set_test_node(&node->nonstring.next_2);
-    }
-}
+    if (initialised)
+        state_fini(&state);
 
-/* Optimises the pattern. */
-Py_LOCAL_INLINE(BOOL) optimise_pattern(PatternObject* pattern) {
-    size_t i;
+    Py_DECREF(iterator);
+    re_dealloc(groups);
 
-    /* Building the nodes is made simpler by allowing branches to have a single
-     * exit. These need to be removed.
-     */
-    skip_one_way_branches(pattern);
+    return results;
 
-    /* Add position guards for repeat bodies containing a reference to a group
-     * or repeat tails followed at some point by a reference to a group.
-     */
-    add_repeat_guards(pattern, pattern->start_node);
+error:
+    if (initialised)
+        state_fini(&state);
 
-    /* Record the index of repeats and fuzzy sections within the body of atomic
-     * and lookaround nodes.
-     */
-    if (!record_subpattern_repeats_and_fuzzy_sections(NULL, 0,
-      pattern->repeat_count, pattern->start_node))
-        return FALSE;
+    Py_DECREF(results);
+    Py_DECREF(iterator);
+    re_dealloc(groups);
+    return NULL;
+}
 
-    for (i = 0; i < pattern->call_ref_info_count; i++) {
-        RE_Node* node;
+/* PatternObject's 'match_many' method. */
+static PyObject* pattern_match_many(PatternObject* self, PyObject* args,
+  PyObject* kwargs) {
+    return pattern_search_or_match_many(self, args, kwargs,
+      "O|OOOOOOOO:match_many", FALSE, FALSE);
+}
 
-        node = pattern->call_ref_info[i].node;
-        if (!record_subpattern_repeats_and_fuzzy_sections(NULL, 0,
-          pattern->repeat_count, node))
-            return FALSE;
-    }
+/* PatternObject's 'fullmatch_many' method. */
+static PyObject* pattern_fullmatch_many(PatternObject* self, PyObject* args,
+  PyObject* kwargs) {
+    return pattern_search_or_match_many(self, args, kwargs,
+      "O|OOOOOOOO:fullmatch_many", FALSE, TRUE);
+}
 
-    /* Discard any unused nodes. */
-    discard_unused_nodes(pattern);
+/* PatternObject's 'search_many' method. */
+static PyObject* pattern_search_many(PatternObject* self, PyObject* args,
+  PyObject* kwargs) {
+    return pattern_search_or_match_many(self, args, kwargs,
+      "O|OOOOOOOO:search_many", TRUE, FALSE);
+}
 
-    /* Set the test nodes. */
-    set_test_nodes(pattern);
+/* Gets the limits of the matching. */
+Py_LOCAL_INLINE(BOOL) get_limits(PyObject* pos, PyObject* endpos, Py_ssize_t
+  length, Py_ssize_t* start, Py_ssize_t* end) {
+    Py_ssize_t s;
+    Py_ssize_t e;
 
-    /* Mark all the group that are named. */
-    if (!mark_named_groups(pattern))
+    s = as_string_index(pos, 0);
+    if (s == -1 && PyErr_Occurred())
         return FALSE;
 
-    return TRUE;
-}
+    e = as_string_index(endpos, PY_SSIZE_T_MAX);
+    if (e == -1 && PyErr_Occurred())
+        return FALSE;
 
-/* Creates a new pattern node. */
-Py_LOCAL_INLINE(RE_Node*) create_node(PatternObject* pattern, RE_UINT8 op,
-  RE_CODE flags, Py_ssize_t step, size_t value_count) {
-    RE_Node* node;
+    /* Adjust boundaries. */
+    if (s < 0)
+        s += length;
+    if (s < 0)
+        s = 0;
+    else if (s > length)
+        s = length;
 
-    node = (RE_Node*)re_alloc(sizeof(*node));
-    if (!node)
-        return NULL;
-    memset(node, 0, sizeof(RE_Node));
-
-    node->value_count = value_count;
-    if (node->value_count > 0) {
-        node->values = (RE_CODE*)re_alloc(node->value_count * sizeof(RE_CODE));
-        if (!node->values)
-            goto error;
-    } else
-        node->values = NULL;
-
-    node->op = op;
-    node->match = (flags & RE_POSITIVE_OP) != 0;
-    node->status = (RE_STATUS_T)(flags << RE_STATUS_SHIFT);
-    node->step = step;
-
-    /* Ensure that there's enough storage to record the new node. */
-    if (pattern->node_count >= pattern->node_capacity) {
-        RE_Node** new_node_list;
-
-        pattern->node_capacity *= 2;
-        if (pattern->node_capacity == 0)
-            pattern->node_capacity = RE_INIT_NODE_LIST_SIZE;
-        new_node_list = (RE_Node**)re_realloc(pattern->node_list,
-          pattern->node_capacity * sizeof(RE_Node*));
-        if (!new_node_list)
-            goto error;
-        pattern->node_list = new_node_list;
-    }
-
-    /* Record the new node. */
-    pattern->node_list[pattern->node_count++] = node;
-
-    return node;
+    if (e < 0)
+        e += length;
+    if (e < 0)
+        e = 0;
+    else if (e > length)
+        e = length;
 
-error:
-    re_dealloc(node->values);
-    re_dealloc(node);
-    return NULL;
-}
+    *start = s;
+    *end = e;
 
-/* Adds a node as a next node for another node. */
-Py_LOCAL_INLINE(void) add_node(RE_Node* node_1, RE_Node* node_2) {
-    if (!node_1->next_1.node)
-        node_1->next_1.node = node_2;
-    else
-        node_1->nonstring.next_2.node = node_2;
+    return TRUE;
 }
 
-/* Ensures that the entry for a group's details actually exists. */
-Py_LOCAL_INLINE(BOOL) ensure_group(PatternObject* pattern, size_t group) {
-    size_t old_capacity;
-    size_t new_capacity;
-    RE_GroupInfo* new_group_info;
-
-    if (group <= pattern->true_group_count)
-        /* We already have an entry for the group. */
-        return TRUE;
+/* Gets a replacement item from the replacement list.
+ *
+ * The replacement item could be a string literal or a group.
+ *
+ * It can return None to represent an empty string.
+ */
+Py_LOCAL_INLINE(PyObject*) get_sub_replacement(PyObject* item, PyObject*
+  string, RE_State* state, size_t group_count) {
+    Py_ssize_t index;
 
-    /* Increase the storage capacity to include the new entry if it's
-     * insufficient.
-     */
-    old_capacity = pattern->group_info_capacity;
-    new_capacity = pattern->group_info_capacity;
-    while (group > new_capacity)
-        new_capacity += RE_LIST_SIZE_INC;
+    if (PyUnicode_CheckExact(item) || PyBytes_CheckExact(item)) {
+        /* It's a literal, which can be added directly to the list. */
+#if PY_VERSION_HEX >= 0x03040000
 
-    if (new_capacity > old_capacity) {
-        new_group_info = (RE_GroupInfo*)re_realloc(pattern->group_info,
-          new_capacity * sizeof(RE_GroupInfo));
-        if (!new_group_info)
-            return FALSE;
-        memset(new_group_info + old_capacity, 0, (new_capacity - old_capacity)
-          * sizeof(RE_GroupInfo));
+        /* ensure_immutable will DECREF the original item if it has to make an
+         * immutable copy, but that original item might have a borrowed
+         * reference, so we must INCREF it first in order to ensure it won't be
+         * destroyed.
+         */
+        Py_INCREF(item);
+        item = ensure_immutable(item);
+#else
+        Py_INCREF(item);
+#endif
+        return item;
+    }
 
-        pattern->group_info = new_group_info;
-        pattern->group_info_capacity = new_capacity;
+    /* Is it a group reference? */
+    index = as_group_index(item);
+    if (index == -1 && PyErr_Occurred()) {
+        /* Not a group either! */
+        set_error(RE_ERROR_REPLACEMENT, NULL);
+        return NULL;
     }
 
-    pattern->true_group_count = group;
+    if (index == 0) {
+        /* The entire matched portion of the string. */
+        if (state->match_pos == state->text_pos) {
+            /* Return None for "". */
+            Py_INCREF(Py_None);
+            return Py_None;
+        }
 
-    return TRUE;
-}
+        if (state->reverse)
+            return get_slice(string, state->text_pos, state->match_pos);
+        else
+            return get_slice(string, state->match_pos, state->text_pos);
+    } else if (1 <= index && (size_t)index <= group_count) {
+        /* A group. */
+        RE_GroupData* group;
 
-/* Records that there's a reference to a group. */
-Py_LOCAL_INLINE(BOOL) record_ref_group(PatternObject* pattern, size_t group) {
-    if (!ensure_group(pattern, group))
-        return FALSE;
+        group = &state->groups[index - 1];
 
-    pattern->group_info[group - 1].referenced = TRUE;
+        if (group->capture_count == 0 && group->span.start != group->span.end)
+          {
+            /* The group didn't match or is "", so return None for "". */
+            Py_INCREF(Py_None);
+            return Py_None;
+        }
 
-    return TRUE;
+        return get_slice(string, group->span.start, group->span.end);
+    } else {
+        /* No such group. */
+        set_error(RE_ERROR_INVALID_GROUP_REF, NULL);
+        return NULL;
+    }
 }
 
-/* Records that there's a new group. */
-Py_LOCAL_INLINE(BOOL) record_group(PatternObject* pattern, size_t group,
-  RE_Node* node) {
-    if (!ensure_group(pattern, group))
-        return FALSE;
+/* PatternObject's 'subx' method. */
+Py_LOCAL_INLINE(PyObject*) pattern_subx(PatternObject* self, PyObject*
+  str_template, PyObject* string, Py_ssize_t maxsub, int sub_type, PyObject*
+  pos, PyObject* endpos, int concurrent, RE_Limits* limits) {
+    RE_StringInfo str_info;
+    Py_ssize_t start;
+    Py_ssize_t end;
+    BOOL is_callable = FALSE;
+    PyObject* replacement = NULL;
+    BOOL is_literal = FALSE;
+    BOOL is_format = FALSE;
+    BOOL is_template = FALSE;
+    RE_State state;
+    RE_SafeState safe_state;
+    JoinInfo join_info;
+    Py_ssize_t sub_count;
+    Py_ssize_t last_pos;
+    Py_ssize_t step;
+    PyObject* item;
+    MatchObject* match;
+    BOOL built_capture = FALSE;
+    PyObject* args;
+    PyObject* kwargs;
+    Py_ssize_t end_pos;
 
-    if (group >= 1) {
-        RE_GroupInfo* info;
+    /* Get the string. */
+    if (!get_string(string, &str_info))
+        return NULL;
 
-        info = &pattern->group_info[group - 1];
-        info->end_index = (Py_ssize_t)pattern->true_group_count;
-        info->node = node;
+    if (!check_compatible(self, str_info.is_unicode)) {
+        release_buffer(&str_info);
+        return NULL;
     }
 
-    return TRUE;
-}
-
-/* Records that a group has closed. */
-Py_LOCAL_INLINE(void) record_group_end(PatternObject* pattern, size_t group) {
-    if (group >= 1)
-        pattern->group_info[group - 1].end_index = ++pattern->group_end_index;
-}
-
-/* Ensures that the entry for a call_ref's details actually exists. */
-Py_LOCAL_INLINE(BOOL) ensure_call_ref(PatternObject* pattern, size_t call_ref)
-  {
-    size_t old_capacity;
-    size_t new_capacity;
-    RE_CallRefInfo* new_call_ref_info;
+    /* Get the limits of the search. */
+    if (!get_limits(pos, endpos, str_info.length, &start, &end)) {
+        release_buffer(&str_info);
 
-    if (call_ref < pattern->call_ref_info_count)
-        /* We already have an entry for the call_ref. */
-        return TRUE;
+        return NULL;
+    }
 
-    /* Increase the storage capacity to include the new entry if it's
-     * insufficient.
+    /* If the pattern is too long for the string, then take a shortcut, unless
+     * it's a fuzzy pattern.
      */
-    old_capacity = pattern->call_ref_info_capacity;
-    new_capacity = pattern->call_ref_info_capacity;
-    while (call_ref >= new_capacity)
-        new_capacity += RE_LIST_SIZE_INC;
-
-    if (new_capacity > old_capacity) {
-        new_call_ref_info = (RE_CallRefInfo*)re_realloc(pattern->call_ref_info,
-          new_capacity * sizeof(RE_CallRefInfo));
-        if (!new_call_ref_info)
-            return FALSE;
-        memset(new_call_ref_info + old_capacity, 0, (new_capacity -
-          old_capacity) * sizeof(RE_CallRefInfo));
+    if (!self->is_fuzzy && self->min_width > end - start) {
+        PyObject* result;
 
-        pattern->call_ref_info = new_call_ref_info;
-        pattern->call_ref_info_capacity = new_capacity;
-    }
+        Py_INCREF(string);
 
-    pattern->call_ref_info_count = 1 + call_ref;
+        if (sub_type & RE_SUBN)
+            result = Py_BuildValue("Nn", string, 0);
+        else
+            result = string;
 
-    return TRUE;
-}
+        release_buffer(&str_info);
 
-/* Records that a call_ref is defined. */
-Py_LOCAL_INLINE(BOOL) record_call_ref_defined(PatternObject* pattern, size_t
-  call_ref, RE_Node* node) {
-    if (!ensure_call_ref(pattern, call_ref))
-        return FALSE;
+        return result;
+    }
 
-    pattern->call_ref_info[call_ref].defined = TRUE;
-    pattern->call_ref_info[call_ref].node = node;
+    if (maxsub == 0)
+        maxsub = PY_SSIZE_T_MAX;
 
-    return TRUE;
-}
+    /* sub/subn takes either a function or a string template. */
+    if (PyCallable_Check(str_template)) {
+        /* It's callable. */
+        is_callable = TRUE;
 
-/* Records that a call_ref is used. */
-Py_LOCAL_INLINE(BOOL) record_call_ref_used(PatternObject* pattern, size_t
-  call_ref) {
-    if (!ensure_call_ref(pattern, call_ref))
-        return FALSE;
+        replacement = str_template;
+        Py_INCREF(replacement);
+    } else if (sub_type & RE_SUBF) {
+        /* Is it a literal format?
+         *
+         * To keep it simple we'll say that a literal is a string which can be
+         * used as-is, so no placeholders.
+         */
+        Py_ssize_t literal_length;
 
-    pattern->call_ref_info[call_ref].used = TRUE;
+        literal_length = check_replacement_string(str_template, '{');
+        if (literal_length > 0) {
+            /* It's a literal. */
+            is_literal = TRUE;
 
-    return TRUE;
-}
+            replacement = str_template;
+            Py_INCREF(replacement);
+        } else if (literal_length < 0) {
+            /* It isn't a literal, so get the 'format' method. */
+            is_format = TRUE;
 
-/* Checks whether a node matches one and only one character. */
-Py_LOCAL_INLINE(BOOL) sequence_matches_one(RE_Node* node) {
-    while (node->op == RE_OP_BRANCH && !node->nonstring.next_2.node)
-        node = node->next_1.node;
+            replacement = PyObject_GetAttrString(str_template, "format");
+            if (!replacement) {
+                release_buffer(&str_info);
+                return NULL;
+            }
+        }
+    } else {
+        /* Is it a literal template?
+         *
+         * To keep it simple we'll say that a literal is a string which can be
+         * used as-is, so no backslashes.
+         */
+        Py_ssize_t literal_length;
 
-    if (node->next_1.node || (node->status & RE_STATUS_FUZZY))
-        return FALSE;
+        literal_length = check_replacement_string(str_template, '\\');
+        if (literal_length > 0) {
+            /* It's a literal. */
+            is_literal = TRUE;
 
-    return node_matches_one_character(node);
-}
+            replacement = str_template;
+            Py_INCREF(replacement);
+        } else if (literal_length < 0 ) {
+            /* It isn't a literal, so hand it over to the template compiler. */
+            is_template = TRUE;
 
-/* Records a repeat. */
-Py_LOCAL_INLINE(BOOL) record_repeat(PatternObject* pattern, size_t index,
-  size_t repeat_depth) {
-    size_t old_capacity;
-    size_t new_capacity;
+            replacement = call(RE_MODULE, "_compile_replacement_helper",
+              PyTuple_Pack(2, self, str_template));
+            if (!replacement) {
+                release_buffer(&str_info);
 
-    /* Increase the storage capacity to include the new entry if it's
-     * insufficient.
-     */
-    old_capacity = pattern->repeat_info_capacity;
-    new_capacity = pattern->repeat_info_capacity;
-    while (index >= new_capacity)
-        new_capacity += RE_LIST_SIZE_INC;
+                return NULL;
+            }
+        }
+    }
 
-    if (new_capacity > old_capacity) {
-        RE_RepeatInfo* new_repeat_info;
+    /* The MatchObject, and therefore repeated captures, will be visible only
+     * if the replacement is callable or subf is used.
+     */
+    if (!state_init_2(&state, self, string, &str_info, start, end, FALSE,
+      concurrent, FALSE, FALSE, is_callable || (sub_type & RE_SUBF) != 0,
+      FALSE)) {
+        release_buffer(&str_info);
 
-        new_repeat_info = (RE_RepeatInfo*)re_realloc(pattern->repeat_info,
-          new_capacity * sizeof(RE_RepeatInfo));
-        if (!new_repeat_info)
-            return FALSE;
-        memset(new_repeat_info + old_capacity, 0, (new_capacity - old_capacity)
-          * sizeof(RE_RepeatInfo));
+        Py_XDECREF(replacement);
+        return NULL;
+    }
 
-        pattern->repeat_info = new_repeat_info;
-        pattern->repeat_info_capacity = new_capacity;
+    if (!state_set_limits(&state, limits)) {
+        state_fini(&state);
+        Py_XDECREF(replacement);
+        return NULL;
     }
 
-    if (index >= pattern->repeat_count)
-        pattern->repeat_count = index + 1;
+    /* Initialise the "safe state" structure. */
+    safe_state.re_state = &state;
+    safe_state.thread_state = NULL;
 
-    if (repeat_depth > 0)
-        pattern->repeat_info[index].status |= RE_STATUS_INNER;
+    init_join_list(&join_info, state.reverse, PyUnicode_Check(string));
 
-    return TRUE;
-}
+    sub_count = 0;
+    last_pos = state.reverse ? state.text_length : 0;
+    step = state.reverse ? -1 : 1;
+    while (sub_count < maxsub) {
+        int status;
 
-Py_LOCAL_INLINE(Py_ssize_t) get_step(RE_CODE op) {
-    switch (op) {
-    case RE_OP_ANY:
-    case RE_OP_ANY_ALL:
-    case RE_OP_ANY_U:
-    case RE_OP_CHARACTER:
-    case RE_OP_CHARACTER_IGN:
-    case RE_OP_PROPERTY:
-    case RE_OP_PROPERTY_IGN:
-    case RE_OP_RANGE:
-    case RE_OP_RANGE_IGN:
-    case RE_OP_SET_DIFF:
-    case RE_OP_SET_DIFF_IGN:
-    case RE_OP_SET_INTER:
-    case RE_OP_SET_INTER_IGN:
-    case RE_OP_SET_SYM_DIFF:
-    case RE_OP_SET_SYM_DIFF_IGN:
-    case RE_OP_SET_UNION:
-    case RE_OP_SET_UNION_IGN:
-    case RE_OP_STRING:
-    case RE_OP_STRING_FLD:
-    case RE_OP_STRING_IGN:
-        return 1;
-    case RE_OP_ANY_ALL_REV:
-    case RE_OP_ANY_REV:
-    case RE_OP_ANY_U_REV:
-    case RE_OP_CHARACTER_IGN_REV:
-    case RE_OP_CHARACTER_REV:
-    case RE_OP_PROPERTY_IGN_REV:
-    case RE_OP_PROPERTY_REV:
-    case RE_OP_RANGE_IGN_REV:
-    case RE_OP_RANGE_REV:
-    case RE_OP_SET_DIFF_IGN_REV:
-    case RE_OP_SET_DIFF_REV:
-    case RE_OP_SET_INTER_IGN_REV:
-    case RE_OP_SET_INTER_REV:
-    case RE_OP_SET_SYM_DIFF_IGN_REV:
-    case RE_OP_SET_SYM_DIFF_REV:
-    case RE_OP_SET_UNION_IGN_REV:
-    case RE_OP_SET_UNION_REV:
-    case RE_OP_STRING_FLD_REV:
-    case RE_OP_STRING_IGN_REV:
-    case RE_OP_STRING_REV:
-        return -1;
-    }
+        status = do_match(&safe_state, TRUE);
+        if (status < 0)
+            goto error;
 
-    return 0;
-}
+        if (status == 0)
+            break;
 
-Py_LOCAL_INLINE(int) build_sequence(RE_CompileArgs* args);
+        /* Append the segment before this match. */
+        if (state.match_pos != last_pos) {
+            if (state.reverse)
+                item = get_slice(string, state.match_pos, last_pos);
+            else
+                item = get_slice(string, last_pos, state.match_pos);
+            if (!item)
+                goto error;
 
-/* Builds an ANY node. */
-Py_LOCAL_INLINE(int) build_ANY(RE_CompileArgs* args) {
-    RE_UINT8 op;
-    RE_CODE flags;
-    Py_ssize_t step;
-    RE_Node* node;
+            /* Add to the list. */
+            status = add_to_join_list(&join_info, item);
+            Py_DECREF(item);
+            if (status < 0)
+                goto error;
+        }
 
-    /* codes: opcode, flags. */
-    if (args->code + 1 > args->end_code)
-        return RE_ERROR_ILLEGAL;
+        /* Add this match. */
+        if (is_literal) {
+            /* The replacement is a literal string. */
+            status = add_to_join_list(&join_info, replacement);
+            if (status < 0)
+                goto error;
+        } else if (is_format) {
+            /* The replacement is a format string. */
+            size_t g;
 
-    op = (RE_UINT8)args->code[0];
-    flags = args->code[1];
+            /* We need to create the arguments for the 'format' method. We'll
+             * start by creating a MatchObject.
+             */
+            match = (MatchObject*)pattern_new_match(self, &state, 1);
+            if (!match)
+                goto error;
 
-    step = get_step(op);
+            /* We'll build the args and kwargs the first time. They'll be using
+             * capture objects which refer to the match object indirectly; this
+             * means that args and kwargs can be reused with different match
+             * objects.
+             */
+            if (!built_capture) {
+                /* The args are a tuple of the capture group matches. */
+                args = PyTuple_New(match->group_count + 1);
+                if (!args) {
+                    Py_DECREF(match);
+                    goto error;
+                }
 
-    /* Create the node. */
-    node = create_node(args->pattern, op, flags, step, 0);
-    if (!node)
-        return RE_ERROR_MEMORY;
+                for (g = 0; g < match->group_count + 1; g++)
+                    /* PyTuple_SetItem borrows the reference. */
+                    PyTuple_SetItem(args, (Py_ssize_t)g,
+                      make_capture_object(&match, (Py_ssize_t)g));
 
-    args->code += 2;
+                /* The kwargs are a dict of the named capture group matches. */
+                kwargs = make_capture_dict(match, &match);
+                if (!kwargs) {
+                    Py_DECREF(args);
+                    Py_DECREF(match);
+                    goto error;
+                }
 
-    /* Append the node. */
-    add_node(args->end, node);
-    args->end = node;
+                built_capture = TRUE;
+            }
 
-    ++args->min_width;
+            /* Call the 'format' method. */
+            item = PyObject_Call(replacement, args, kwargs);
 
-    return RE_ERROR_SUCCESS;
-}
+            Py_DECREF(match);
+            if (!item)
+                goto error;
 
-/* Builds a FUZZY node. */
-Py_LOCAL_INLINE(int) build_FUZZY(RE_CompileArgs* args) {
-    RE_CODE flags;
-    RE_Node* start_node;
-    RE_Node* end_node;
-    RE_CODE index;
-    RE_CompileArgs subargs;
-    int status;
-
-    /* codes: opcode, flags, constraints, sequence, end. */
-    if (args->code + 13 > args->end_code)
-        return RE_ERROR_ILLEGAL;
-
-    flags = args->code[1];
-
-    /* Create nodes for the start and end of the fuzzy sequence. */
-    start_node = create_node(args->pattern, RE_OP_FUZZY, flags, 0, 9);
-    end_node = create_node(args->pattern, RE_OP_END_FUZZY, flags, 0, 5);
-    if (!start_node || !end_node)
-        return RE_ERROR_MEMORY;
+            /* Add the result to the list. */
+            status = add_to_join_list(&join_info, item);
+            Py_DECREF(item);
+            if (status < 0)
+                goto error;
+        } else if (is_template) {
+            /* The replacement is a list template. */
+            Py_ssize_t count;
+            Py_ssize_t index;
+            Py_ssize_t step;
 
-    index = (RE_CODE)args->pattern->fuzzy_count++;
-    start_node->values[0] = index;
-    end_node->values[0] = index;
+            /* Add each part of the template to the list. */
+            count = PyList_GET_SIZE(replacement);
+            if (join_info.reversed) {
+                /* We're searching backwards, so we'll be reversing the list
+                 * when it's complete. Therefore, we need to add the items of
+                 * the template in reverse order for them to be in the correct
+                 * order after the reversal.
+                 */
+                index = count - 1;
+                step = -1;
+            } else {
+                /* We're searching forwards. */
+                index = 0;
+                step = 1;
+            }
 
-    /* The constraints consist of 4 pairs of limits and the cost equation. */
-    end_node->values[RE_FUZZY_VAL_MIN_DEL] = args->code[2]; /* Deletion minimum. */
-    end_node->values[RE_FUZZY_VAL_MIN_INS] = args->code[4]; /* Insertion minimum. */
-    end_node->values[RE_FUZZY_VAL_MIN_SUB] = args->code[6]; /* Substitution minimum. */
-    end_node->values[RE_FUZZY_VAL_MIN_ERR] = args->code[8]; /* Error minimum. */
+            while (count > 0) {
+                PyObject* item;
+                PyObject* str_item;
 
-    start_node->values[RE_FUZZY_VAL_MAX_DEL] = args->code[3]; /* Deletion maximum. */
-    start_node->values[RE_FUZZY_VAL_MAX_INS] = args->code[5]; /* Insertion maximum. */
-    start_node->values[RE_FUZZY_VAL_MAX_SUB] = args->code[7]; /* Substitution maximum. */
-    start_node->values[RE_FUZZY_VAL_MAX_ERR] = args->code[9]; /* Error maximum. */
+                /* PyList_GET_ITEM borrows a reference. */
+                item = PyList_GET_ITEM(replacement, index);
+                str_item = get_sub_replacement(item, string, &state,
+                  self->public_group_count);
+                if (!str_item)
+                    goto error;
 
-    start_node->values[RE_FUZZY_VAL_DEL_COST] = args->code[10]; /* Deletion cost. */
-    start_node->values[RE_FUZZY_VAL_INS_COST] = args->code[11]; /* Insertion cost. */
-    start_node->values[RE_FUZZY_VAL_SUB_COST] = args->code[12]; /* Substitution cost. */
-    start_node->values[RE_FUZZY_VAL_MAX_COST] = args->code[13]; /* Total cost. */
+                /* Add the result to the list. */
+                if (str_item == Py_None)
+                    /* None for "". */
+                    Py_DECREF(str_item);
+                else {
+                    status = add_to_join_list(&join_info, str_item);
+                    Py_DECREF(str_item);
+                    if (status < 0)
+                        goto error;
+                }
 
-    args->code += 14;
+                --count;
+                index += step;
+            }
+        } else if (is_callable) {
+            /* Pass a MatchObject to the replacement function. */
+            PyObject* match;
+            PyObject* args;
 
-    subargs = *args;
-    subargs.has_captures = FALSE;
-    subargs.is_fuzzy = TRUE;
-    subargs.within_fuzzy = TRUE;
+            /* We need to create a MatchObject to pass to the replacement
+             * function.
+             */
+            match = pattern_new_match(self, &state, 1);
+            if (!match)
+                goto error;
 
-    /* Compile the sequence and check that we've reached the end of the
-     * subpattern.
-     */
-    status = build_sequence(&subargs);
-    if (status != RE_ERROR_SUCCESS)
-        return status;
+            /* The args for the replacement function. */
+            args = PyTuple_Pack(1, match);
+            if (!args) {
+                Py_DECREF(match);
+                goto error;
+            }
 
-    if (subargs.code[0] != RE_OP_END)
-        return RE_ERROR_ILLEGAL;
+            /* Call the replacement function. */
+            item = PyObject_CallObject(replacement, args);
+            Py_DECREF(args);
+            Py_DECREF(match);
+            if (!item)
+                goto error;
 
-    args->code = subargs.code;
-    args->min_width = subargs.min_width;
-    args->has_captures |= subargs.has_captures;
+            /* Add the result to the list. */
+            status = add_to_join_list(&join_info, item);
+            Py_DECREF(item);
+            if (status < 0)
+                goto error;
+        }
 
-    ++args->code;
+        ++sub_count;
 
-    /* Append the fuzzy sequence. */
-    add_node(args->end, start_node);
-    add_node(start_node, subargs.start);
-    add_node(subargs.end, end_node);
-    args->end = end_node;
+        last_pos = state.text_pos;
 
-    args->is_fuzzy = TRUE;
+        if (state.version_0) {
+            /* Always advance after a zero-width match. */
+            if (state.match_pos == state.text_pos) {
+                state.text_pos += step;
+                state.must_advance = FALSE;
+            } else
+                state.must_advance = TRUE;
+        } else
+            /* Continue from where we left off, but don't allow a contiguous
+             * zero-width match.
+             */
+            state.must_advance = state.match_pos == state.text_pos;
+    }
 
-    return RE_ERROR_SUCCESS;
-}
+    /* Get the segment following the last match. We use 'length' instead of
+     * 'text_length' because the latter is truncated to 'slice_end', a
+     * documented idiosyncracy of the 're' module.
+     */
+    end_pos = state.reverse ? 0 : str_info.length;
+    if (last_pos != end_pos) {
+        int status;
 
-/* Builds an ATOMIC node. */
-Py_LOCAL_INLINE(int) build_ATOMIC(RE_CompileArgs* args) {
-    RE_Node* atomic_node;
-    RE_CompileArgs subargs;
-    int status;
-    RE_Node* end_node;
+        /* The segment is part of the original string. */
+        if (state.reverse)
+            item = get_slice(string, 0, last_pos);
+        else
+            item = get_slice(string, last_pos, str_info.length);
+        if (!item)
+            goto error;
 
-    /* codes: opcode, sequence, end. */
-    if (args->code + 1 > args->end_code)
-        return RE_ERROR_ILLEGAL;
+        status = add_to_join_list(&join_info, item);
+        Py_DECREF(item);
+        if (status < 0)
+            goto error;
+    }
 
-    atomic_node = create_node(args->pattern, RE_OP_ATOMIC, 0, 0, 0);
-    if (!atomic_node)
-        return RE_ERROR_MEMORY;
+    Py_XDECREF(replacement);
 
-    ++args->code;
+    /* Convert the list to a single string (also cleans up join_info). */
+    item = join_list_info(&join_info);
 
-    /* Compile the sequence and check that we've reached the end of it. */
-    subargs = *args;
-    subargs.min_width = 0;
-    status = build_sequence(&subargs);
-    if (status != RE_ERROR_SUCCESS)
-        return status;
+    state_fini(&state);
 
-    if (subargs.code[0] != RE_OP_END)
-        return RE_ERROR_ILLEGAL;
+    if (built_capture) {
+        Py_DECREF(kwargs);
+        Py_DECREF(args);
+    }
 
-    args->code = subargs.code;
-    ++args->code;
+    if (!item)
+        return NULL;
 
-    /* Check the subpattern. */
-    args->min_width += subargs.min_width;
-    args->has_captures |= subargs.has_captures;
-    args->is_fuzzy |= subargs.is_fuzzy;
+    if (sub_type & RE_SUBN)
+        return Py_BuildValue("Nn", item, sub_count);
 
-    /* Create the node to terminate the subpattern. */
-    end_node = create_node(subargs.pattern, RE_OP_END_ATOMIC, 0, 0, 0);
-    if (!end_node)
-        return RE_ERROR_MEMORY;
+    return item;
 
-    /* Append the new sequence. */
-    add_node(args->end, atomic_node);
-    add_node(atomic_node, subargs.start);
-    add_node(subargs.end, end_node);
-    args->end = end_node;
+error:
+    if (built_capture) {
+        Py_DECREF(kwargs);
+        Py_DECREF(args);
+    }
 
-    return RE_ERROR_SUCCESS;
+    clear_join_list(&join_info);
+    state_fini(&state);
+    Py_XDECREF(replacement);
+    return NULL;
 }
 
-/* Builds a BOUNDARY node. */
-Py_LOCAL_INLINE(int) build_BOUNDARY(RE_CompileArgs* args) {
-    RE_UINT8 op;
-    RE_CODE flags;
-    RE_Node* node;
+/* PatternObject's 'sub' method. */
+static PyObject* pattern_sub(PatternObject* self, PyObject* args, PyObject*
+  kwargs) {
+    int conc;
+    RE_Limits limits;
 
-    /* codes: opcode, flags. */
-    if (args->code + 1 > args->end_code)
-        return RE_ERROR_ILLEGAL;
+    PyObject* replacement;
+    PyObject* string;
+    Py_ssize_t count = 0;
+    PyObject* pos = Py_None;
+    PyObject* endpos = Py_None;
+    PyObject* concurrent = Py_None;
+    PyObject* timeout = Py_None;
+    PyObject* max_steps = Py_None;
+    PyObject* max_memory = Py_None;
+    static char* kwlist[] = { "repl", "string", "count", "pos", "endpos",
+      "concurrent", "timeout", "max_steps", "max_memory", NULL };
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "OO|nOOOOOO:sub", kwlist,
+      &replacement, &string, &count, &pos, &endpos, &concurrent, &timeout,
+      &max_steps, &max_memory))
+        return NULL;
 
-    op = (RE_UINT8)args->code[0];
-    flags = args->code[1];
+    conc = decode_concurrent(concurrent);
+    if (conc < 0)
+        return NULL;
 
-    args->code += 2;
+    if (!decode_limits(timeout, max_steps, max_memory, &limits))
+        return NULL;
 
-    /* Create the node. */
-    node = create_node(args->pattern, op, flags, 0, 0);
-    if (!node)
-        return RE_ERROR_MEMORY;
+    return pattern_subx(self, replacement, string, count, RE_SUB, pos, endpos,
+      conc, &limits);
+}
 
-    /* Append the node. */
-    add_node(args->end, node);
-    args->end = node;
-
-    return RE_ERROR_SUCCESS;
-}
-
-/* Builds a BRANCH node. */
-Py_LOCAL_INLINE(int) build_BRANCH(RE_CompileArgs* args) {
-    RE_Node* branch_node;
-    RE_Node* join_node;
-    Py_ssize_t smallest_min_width;
-    RE_CompileArgs subargs;
-    int status;
-
-    /* codes: opcode, branch, next, branch, end. */
-    if (args->code + 2 > args->end_code)
-        return RE_ERROR_ILLEGAL;
-
-    /* Create nodes for the start and end of the branch sequence. */
-    branch_node = create_node(args->pattern, RE_OP_BRANCH, 0, 0, 0);
-    join_node = create_node(args->pattern, RE_OP_BRANCH, 0, 0, 0);
-    if (!branch_node || !join_node)
-        return RE_ERROR_MEMORY;
-
-    /* Append the node. */
-    add_node(args->end, branch_node);
-    args->end = join_node;
+/* PatternObject's 'subf' method. */
+static PyObject* pattern_subf(PatternObject* self, PyObject* args, PyObject*
+  kwargs) {
+    int conc;
+    RE_Limits limits;
 
-    smallest_min_width = PY_SSIZE_T_MAX;
+    PyObject* format;
+    PyObject* string;
+    Py_ssize_t count = 0;
+    PyObject* pos = Py_None;
+    PyObject* endpos = Py_None;
+    PyObject* concurrent = Py_None;
+    PyObject* timeout = Py_None;
+    PyObject* max_steps = Py_None;
+    PyObject* max_memory = Py_None;
+    static char* kwlist[] = { "format", "string", "count", "pos", "endpos",
+      "concurrent", "timeout", "max_steps", "max_memory", NULL };
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "OO|nOOOOOO:sub", kwlist,
+      &format, &string, &count, &pos, &endpos, &concurrent, &timeout,
+      &max_steps, &max_memory))
+        return NULL;
 
-    subargs = *args;
+    conc = decode_concurrent(concurrent);
+    if (conc < 0)
+        return NULL;
 
-    /* A branch in the regular expression is compiled into a series of 2-way
-     * branches.
-     */
-    do {
-        RE_Node* next_branch_node;
+    if (!decode_limits(timeout, max_steps, max_memory, &limits))
+        return NULL;
 
-        /* Skip over the 'BRANCH' or 'NEXT' opcode. */
-        ++subargs.code;
+    return pattern_subx(self, format, string, count, RE_SUBF, pos, endpos,
+      conc, &limits);
+}
 
-        /* Compile the sequence until the next 'BRANCH' or 'NEXT' opcode. */
-        subargs.min_width = 0;
-        subargs.has_captures = FALSE;
-        subargs.is_fuzzy = FALSE;
-        status = build_sequence(&subargs);
-        if (status != RE_ERROR_SUCCESS)
-            return status;
+/* PatternObject's 'subn' method. */
+static PyObject* pattern_subn(PatternObject* self, PyObject* args, PyObject*
+  kwargs) {
+    int conc;
+    RE_Limits limits;
 
-        smallest_min_width = min_ssize_t(smallest_min_width,
-          subargs.min_width);
+    PyObject* replacement;
+    PyObject* string;
+    Py_ssize_t count = 0;
+    PyObject* pos = Py_None;
+    PyObject* endpos = Py_None;
+    PyObject* concurrent = Py_None;
+    PyObject* timeout = Py_None;
+    PyObject* max_steps = Py_None;
+    PyObject* max_memory = Py_None;
+    static char* kwlist[] = { "repl", "string", "count", "pos", "endpos",
+      "concurrent", "timeout", "max_steps", "max_memory", NULL };
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "OO|nOOOOOO:subn", kwlist,
+      &replacement, &string, &count, &pos, &endpos, &concurrent, &timeout,
+      &max_steps, &max_memory))
+        return NULL;
 
-        args->has_captures |= subargs.has_captures;
-        args->is_fuzzy |= subargs.is_fuzzy;
+    conc = decode_concurrent(concurrent);
+    if (conc < 0)
+        return NULL;
 
-        /* Append the sequence. */
-        add_node(branch_node, subargs.start);
-        add_node(subargs.end, join_node);
+    if (!decode_limits(timeout, max_steps, max_memory, &limits))
+        return NULL;
 
-        /* Create a start node for the next sequence and append it. */
-        next_branch_node = create_node(subargs.pattern, RE_OP_BRANCH, 0, 0, 0);
-        if (!next_branch_node)
-            return RE_ERROR_MEMORY;
+    return pattern_subx(self, replacement, string, count, RE_SUBN, pos, endpos,
+      conc, &limits);
+}
 
-        add_node(branch_node, next_branch_node);
-        branch_node = next_branch_node;
-    } while (subargs.code < subargs.end_code && subargs.code[0] == RE_OP_NEXT);
+/* PatternObject's 'subfn' method. */
+static PyObject* pattern_subfn(PatternObject* self, PyObject* args, PyObject*
+  kwargs) {
+    int conc;
+    RE_Limits limits;
 
-    /* We should have reached the end of the branch. */
-    if (subargs.code[0] != RE_OP_END)
-        return RE_ERROR_ILLEGAL;
+    PyObject* format;
+    PyObject* string;
+    Py_ssize_t count = 0;
+    PyObject* pos = Py_None;
+    PyObject* endpos = Py_None;
+    PyObject* concurrent = Py_None;
+    PyObject* timeout = Py_None;
+    PyObject* max_steps = Py_None;
+    PyObject* max_memory = Py_None;
+    static char* kwlist[] = { "format", "string", "count", "pos", "endpos",
+      "concurrent", "timeout", "max_steps", "max_memory", NULL };
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "OO|nOOOOOO:subn", kwlist,
+      &format, &string, &count, &pos, &endpos, &concurrent, &timeout,
+      &max_steps, &max_memory))
+        return NULL;
 
-    args->code = subargs.code;
+    conc = decode_concurrent(concurrent);
+    if (conc < 0)
+        return NULL;
 
-    ++args->code;
-    args->min_width += smallest_min_width;
+    if (!decode_limits(timeout, max_steps, max_memory, &limits))
+        return NULL;
 
-    return RE_ERROR_SUCCESS;
+    return pattern_subx(self, format, string, count, RE_SUBF | RE_SUBN, pos,
+      endpos, conc, &limits);
 }
 
-/* Builds a CALL_REF node. */
-Py_LOCAL_INLINE(int) build_CALL_REF(RE_CompileArgs* args) {
-    RE_CODE call_ref;
-    RE_Node* start_node;
-    RE_Node* end_node;
-    RE_CompileArgs subargs;
-    int status;
+/* PatternObject's 'split' method. */
+static PyObject* pattern_split(PatternObject* self, PyObject* args, PyObject*
+  kwargs) {
+    int conc;
+    RE_Limits limits;
 
-    /* codes: opcode, call_ref. */
-    if (args->code + 1 > args->end_code)
-        return RE_ERROR_ILLEGAL;
+    RE_State state;
+    RE_SafeState safe_state;
+    PyObject* list;
+    PyObject* item;
+    int status;
+    Py_ssize_t split_count;
+    size_t g;
+    Py_ssize_t start_pos;
+    Py_ssize_t end_pos;
+    Py_ssize_t step;
+    Py_ssize_t last_pos;
 
-    call_ref = args->code[1];
+    PyObject* string;
+    Py_ssize_t maxsplit = 0;
+    PyObject* concurrent = Py_None;
+    PyObject* timeout = Py_None;
+    PyObject* max_steps = Py_None;
+    PyObject* max_memory = Py_None;
+    Py_ssize_t spans_only = FALSE;
+    static char* kwlist[] = { "string", "maxsplit", "concurrent", "timeout",
+      "max_steps", "max_memory", "spans_only", NULL };
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|nOOOOn:split", kwlist,
+      &string, &maxsplit, &concurrent, &timeout, &max_steps, &max_memory,
+      &spans_only))
+        return NULL;
 
-    args->code += 2;
+    if (maxsplit == 0)
+        maxsplit = PY_SSIZE_T_MAX;
 
-    /* Create nodes for the start and end of the subpattern. */
-    start_node = create_node(args->pattern, RE_OP_CALL_REF, 0, 0, 1);
-    end_node = create_node(args->pattern, RE_OP_GROUP_RETURN, 0, 0, 0);
-    if (!start_node || !end_node)
-        return RE_ERROR_MEMORY;
+    conc = decode_concurrent(concurrent);
+    if (conc < 0)
+        return NULL;
 
-    start_node->values[0] = call_ref;
+    if (!decode_limits(timeout, max_steps, max_memory, &limits))
+        return NULL;
 
-    /* Compile the sequence and check that we've reached the end of the
-     * subpattern.
+    /* The MatchObject, and therefore repeated captures, will not be visible.
      */
-    subargs = *args;
-    subargs.has_captures = FALSE;
-    subargs.is_fuzzy = FALSE;
-    status = build_sequence(&subargs);
-    if (status != RE_ERROR_SUCCESS)
-        return status;
+    if (!state_init(&state, self, string, 0, PY_SSIZE_T_MAX, FALSE, conc,
+      FALSE, FALSE, FALSE, FALSE))
+        return NULL;
 
-    if (subargs.code[0] != RE_OP_END)
-        return RE_ERROR_ILLEGAL;
+    if (!state_set_limits(&state, &limits)) {
+        state_fini(&state);
+        return NULL;
+    }
 
-    args->code = subargs.code;
-    args->min_width = subargs.min_width;
-    args->has_captures |= subargs.has_captures;
-    args->is_fuzzy |= subargs.is_fuzzy;
+    /* Initialise the "safe state" structure. */
+    safe_state.re_state = &state;
+    safe_state.thread_state = NULL;
 
-    ++args->code;
+    list = PyList_New(0);
+    if (!list) {
+        state_fini(&state);
+        return NULL;
+    }
 
-    /* Record that we defined a call_ref. */
-    if (!record_call_ref_defined(args->pattern, call_ref, start_node))
-        return RE_ERROR_MEMORY;
+    split_count = 0;
+    if (state.reverse) {
+        start_pos = state.text_length;
+        end_pos = 0;
+        step = -1;
+    } else {
+        start_pos = 0;
+        end_pos = state.text_length;
+        step = 1;
+    }
 
-    /* Append the node. */
-    add_node(args->end, start_node);
-    add_node(start_node, subargs.start);
-    add_node(subargs.end, end_node);
-    args->end = end_node;
+    last_pos = start_pos;
+    while (split_count < maxsplit) {
+        status = do_match(&safe_state, TRUE);
+        if (status < 0)
+            goto error;
 
-    return RE_ERROR_SUCCESS;
-}
+        if (status == 0)
+            /* No more matches. */
+            break;
 
-/* Builds a CHARACTER or PROPERTY node. */
-Py_LOCAL_INLINE(int) build_CHARACTER_or_PROPERTY(RE_CompileArgs* args) {
-    RE_UINT8 op;
-    RE_CODE flags;
-    Py_ssize_t step;
-    RE_Node* node;
+        if (state.version_0) {
+            /* Version 0 behaviour is to advance one character if the split was
+             * zero-width. Unfortunately, this can give an incorrect result.
+             * GvR wants this behaviour to be retained so as not to break any
+             * existing software which might rely on it.
+             */
+            if (state.text_pos == state.match_pos) {
+                if (last_pos == end_pos)
+                    break;
 
-    /* codes: opcode, flags, value. */
-    if (args->code + 2 > args->end_code)
-        return RE_ERROR_ILLEGAL;
+                /* Advance one character. */
+                state.text_pos += step;
+                state.must_advance = FALSE;
+                continue;
+            }
+        }
 
-    op = (RE_UINT8)args->code[0];
-    flags = args->code[1];
+        /* Get segment before this match. */
+        if (spans_only) {
+            if (state.reverse)
+                item = Py_BuildValue("nn", state.match_pos, last_pos);
+            else
+                item = Py_BuildValue("nn", last_pos, state.match_pos);
+        } else if (state.reverse)
+            item = get_slice(string, state.match_pos, last_pos);
+        else
+            item = get_slice(string, last_pos, state.match_pos);
+        if (!item)
+            goto error;
 
-    step = get_step(op);
+        status = PyList_Append(list, item);
+        Py_DECREF(item);
+        if (status < 0)
+            goto error;
 
-    if (flags & RE_ZEROWIDTH_OP)
-        step = 0;
+        /* Add groups (if any). */
+        for (g = 1; g <= self->public_group_count; g++) {
+            if (spans_only)
+                item = state_get_group_span(&state, (Py_ssize_t)g);
+            else
+                item = state_get_group(&state, (Py_ssize_t)g, string, FALSE);
+            if (!item)
+                goto error;
 
-    /* Create the node. */
-    node = create_node(args->pattern, op, flags, step, 1);
-    if (!node)
-        return RE_ERROR_MEMORY;
+            status = PyList_Append(list, item);
+            Py_DECREF(item);
+            if (status < 0)
+                goto error;
+        }
 
-    node->values[0] = args->code[2];
+        ++split_count;
+        last_pos = state.text_pos;
 
-    args->code += 3;
+        /* Version 0 behaviour is to advance one character if the match was
+         * zero-width. Unfortunately, this can give an incorrect result. GvR
+         * wants this behaviour to be retained so as not to break any existing
+         * software which might rely on it.
+         */
+        if (state.version_0) {
+            if (state.text_pos == state.match_pos)
+                /* Advance one character. */
+                state.text_pos += step;
 
-    /* Append the node. */
-    add_node(args->end, node);
-    args->end = node;
+            state.must_advance = FALSE;
+        } else
+            /* Continue from where we left off, but don't allow a contiguous
+             * zero-width match.
+             */
+            state.must_advance = TRUE;
+    }
 
-    if (step != 0)
-        ++args->min_width;
+    /* Get segment following last match (even if empty). */
+    if (spans_only) {
+        if (state.reverse)
+            item = Py_BuildValue("nn", (Py_ssize_t)0, last_pos);
+        else
+            item = Py_BuildValue("nn", last_pos, state.text_length);
+    } else if (state.reverse)
+        item = get_slice(string, 0, last_pos);
+    else
+        item = get_slice(string, last_pos, state.text_length);
+    if (!item)
+        goto error;
 
-    return RE_ERROR_SUCCESS;
-}
+    status = PyList_Append(list, item);
+    Py_DECREF(item);
+    if (status < 0)
+        goto error;
 
-/* Builds a GROUP node. */
-Py_LOCAL_INLINE(int) build_GROUP(RE_CompileArgs* args) {
-    RE_CODE private_group;
-    RE_CODE public_group;
-    RE_Node* start_node;
-    RE_Node* end_node;
-    RE_CompileArgs subargs;
-    int status;
+    state_fini(&state);
 
-    /* codes: opcode, private_group, public_group. */
-    if (args->code + 2 > args->end_code)
-        return RE_ERROR_ILLEGAL;
+    return list;
 
-    private_group = args->code[1];
-    public_group = args->code[2];
+error:
+    Py_DECREF(list);
+    state_fini(&state);
+    return NULL;
+}
 
-    args->code += 3;
+/* PatternObject's 'splititer' method. */
+static PyObject* pattern_splititer(PatternObject* pattern, PyObject* args,
+  PyObject* kwargs) {
+    return pattern_splitter(pattern, args, kwargs);
+}
 
-    /* Create nodes for the start and end of the capture group. */
-    start_node = create_node(args->pattern, args->forward ? RE_OP_START_GROUP :
-      RE_OP_END_GROUP, 0, 0, 3);
-    end_node = create_node(args->pattern, args->forward ? RE_OP_END_GROUP :
-      RE_OP_START_GROUP, 0, 0, 3);
-    if (!start_node || !end_node)
-        return RE_ERROR_MEMORY;
+/* PatternObject's 'findall' method. */
+static PyObject* pattern_findall(PatternObject* self, PyObject* args, PyObject*
+  kwargs) {
+    Py_ssize_t start;
+    Py_ssize_t end;
+    int conc;
+    RE_Limits limits;
+    RE_State state;
+    RE_SafeState safe_state;
+    PyObject* list;
+    Py_ssize_t step;
+    int status;
+    Py_ssize_t b;
+    Py_ssize_t e;
+    size_t g;
 
-    start_node->values[0] = private_group;
-    end_node->values[0] = private_group;
-    start_node->values[1] = public_group;
-    end_node->values[1] = public_group;
+    PyObject* string;
+    PyObject* pos = Py_None;
+    PyObject* endpos = Py_None;
+    Py_ssize_t overlapped = FALSE;
+    PyObject* concurrent = Py_None;
+    PyObject* timeout = Py_None;
+    PyObject* max_steps = Py_None;
+    PyObject* max_memory = Py_None;
+    Py_ssize_t spans_only = FALSE;
+    static char* kwlist[] = { "string", "pos", "endpos", "overlapped",
+      "concurrent", "timeout", "max_steps", "max_memory", "spans_only", NULL };
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|OOnOOOOn:findall",
+      kwlist, &string, &pos, &endpos, &overlapped, &concurrent, &timeout,
+      &max_steps, &max_memory, &spans_only))
+        return NULL;
 
-    /* Signal that the capture should be saved when it's complete. */
-    start_node->values[2] = 0;
-    end_node->values[2] = 1;
+    start = as_string_index(pos, 0);
+    if (start == -1 && PyErr_Occurred())
+        return NULL;
 
-    /* Record that we have a new capture group. */
-    if (!record_group(args->pattern, private_group, start_node))
-        return RE_ERROR_MEMORY;
+    end = as_string_index(endpos, PY_SSIZE_T_MAX);
+    if (end == -1 && PyErr_Occurred())
+        return NULL;
 
-    /* Compile the sequence and check that we've reached the end of the capture
-     * group.
+    conc = decode_concurrent(concurrent);
+    if (conc < 0)
+        return NULL;
+
+    if (!decode_limits(timeout, max_steps, max_memory, &limits))
+        return NULL;
+
+    /* The MatchObject, and therefore repeated captures, will not be visible.
      */
-    subargs = *args;
-    subargs.has_captures = FALSE;
-    subargs.is_fuzzy = FALSE;
-    status = build_sequence(&subargs);
-    if (status != RE_ERROR_SUCCESS)
-        return status;
+    if (!state_init(&state, self, string, start, end, overlapped != 0, conc,
+      FALSE, FALSE, FALSE, FALSE))
+        return NULL;
 
-    if (subargs.code[0] != RE_OP_END)
-        return RE_ERROR_ILLEGAL;
+    if (!state_set_limits(&state, &limits)) {
+        state_fini(&state);
+        return NULL;
+    }
 
-    args->code = subargs.code;
-    args->min_width = subargs.min_width;
-    if (subargs.has_captures || subargs.visible_captures)
-        args->has_captures = TRUE;
-    args->is_fuzzy |= subargs.is_fuzzy;
+    /* Initialise the "safe state" structure. */
+    safe_state.re_state = &state;
+    safe_state.thread_state = NULL;
 
-    ++args->code;
+    list = PyList_New(0);
+    if (!list) {
+        state_fini(&state);
+        return NULL;
+    }
 
-    /* Record that the capture group has closed. */
-    record_group_end(args->pattern, private_group);
+    step = state.reverse ? -1 : 1;
+    while (state.slice_start <= state.text_pos && state.text_pos <=
+      state.slice_end) {
+        PyObject* item;
 
-    /* Append the capture group. */
-    add_node(args->end, start_node);
-    add_node(start_node, subargs.start);
-    add_node(subargs.end, end_node);
-    args->end = end_node;
+        status = do_match(&safe_state, TRUE);
+        if (status < 0)
+            goto error;
 
-    return RE_ERROR_SUCCESS;
-}
+        if (status == 0)
+            break;
 
-/* Builds a GROUP_CALL node. */
-Py_LOCAL_INLINE(int) build_GROUP_CALL(RE_CompileArgs* args) {
-    RE_CODE call_ref;
-    RE_Node* node;
+        /* Don't bother to build a MatchObject. */
+        switch (self->public_group_count) {
+        case 0:
+            if (spans_only) {
+                item = state_get_group_span(&state, 0);
+                if (!item)
+                    goto error;
+                break;
+            }
 
-    /* codes: opcode, call_ref. */
-    if (args->code + 1 > args->end_code)
-        return RE_ERROR_ILLEGAL;
+            if (state.reverse) {
+                b = state.text_pos;
+                e = state.match_pos;
+            } else {
+                b = state.match_pos;
+                e = state.text_pos;
+            }
+            item = get_slice(string, b, e);
+            if (!item)
+                goto error;
+            break;
+        case 1:
+            if (spans_only)
+                item = state_get_group_span(&state, 1);
+            else
+                item = state_get_group(&state, 1, string, TRUE);
+            if (!item)
+                goto error;
+            break;
+        default:
+            item = PyTuple_New((Py_ssize_t)self->public_group_count);
+            if (!item)
+                goto error;
 
-    call_ref = args->code[1];
+            for (g = 0; g < self->public_group_count; g++) {
+                PyObject* o;
 
-    /* Create the node. */
-    node = create_node(args->pattern, RE_OP_GROUP_CALL, 0, 0, 1);
-    if (!node)
-        return RE_ERROR_MEMORY;
+                if (spans_only)
+                    o = state_get_group_span(&state, (Py_ssize_t)g + 1);
+                else
+                    o = state_get_group(&state, (Py_ssize_t)g + 1, string,
+                      TRUE);
+                if (!o) {
+                    Py_DECREF(item);
+                    goto error;
+                }
 
-    node->values[0] = call_ref;
+                /* PyTuple_SET_ITEM borrows the reference. */
+                PyTuple_SET_ITEM(item, g, o);
+            }
+            break;
+        }
 
-    args->code += 2;
+        status = PyList_Append(list, item);
+        Py_DECREF(item);
+        if (status < 0)
+            goto error;
 
-    /* Record that we used a call_ref. */
-    if (!record_call_ref_used(args->pattern, call_ref))
-        return RE_ERROR_MEMORY;
+        if (state.overlapped) {
+            /* Advance one character. */
+            state.text_pos = state.match_pos + step;
+            state.must_advance = FALSE;
+        } else
+            /* Continue from where we left off, but don't allow 2 contiguous
+             * zero-width matches.
+             */
+            state.must_advance = state.text_pos == state.match_pos;
+    }
 
-    /* Append the node. */
-    add_node(args->end, node);
-    args->end = node;
+    state_fini(&state);
 
-    return RE_ERROR_SUCCESS;
-}
+    return list;
 
-/* Builds a GROUP_EXISTS node. */
-Py_LOCAL_INLINE(int) build_GROUP_EXISTS(RE_CompileArgs* args) {
-    RE_CODE group;
-    RE_Node* start_node;
-    RE_Node* end_node;
-    RE_CompileArgs subargs;
-    int status;
-    Py_ssize_t min_width;
-
-    /* codes: opcode, sequence, next, sequence, end. */
-    if (args->code + 2 > args->end_code)
-        return RE_ERROR_ILLEGAL;
+error:
+    Py_DECREF(list);
+    state_fini(&state);
+    return NULL;
+}
 
-    group = args->code[1];
+/* PatternObject's 'finditer' method. */
+static PyObject* pattern_finditer(PatternObject* pattern, PyObject* args,
+  PyObject* kwargs) {
+    return pattern_scanner(pattern, args, kwargs);
+}
 
-    args->code += 2;
+/* PatternObject's 'finditer_stream' method. */
+static PyObject* pattern_finditer_stream(PatternObject* self, PyObject* args,
+  PyObject* kwargs) {
+    PyObject* source;
+    Py_ssize_t chunk_size = 0x10000;
+    PyObject* concurrent = Py_None;
+    PyObject* timeout = Py_None;
+    PyObject* max_steps = Py_None;
+    PyObject* max_memory = Py_None;
+    static char* kwlist[] = { "source", "chunk_size", "concurrent", "timeout",
+      "max_steps", "max_memory", NULL };
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|nOOOO:finditer_stream",
+      kwlist, &source, &chunk_size, &concurrent, &timeout, &max_steps,
+      &max_memory))
+        return NULL;
 
-    /* Record that we have a reference to a group. If group is 0, then we have
-     * a DEFINE and not a true group.
-     */
-    if (group > 0 && !record_ref_group(args->pattern, group))
-        return RE_ERROR_MEMORY;
+    /* The chunks are read and joined by the stream helper. */
+    return call(RE_MODULE, "_finditer_stream", Py_BuildValue("OOnOOOO", self,
+      source, chunk_size, concurrent, timeout, max_steps, max_memory));
+}
 
-    /* Create nodes for the start and end of the structure. */
-    start_node = create_node(args->pattern, RE_OP_GROUP_EXISTS, 0, 0, 1);
-    end_node = create_node(args->pattern, RE_OP_BRANCH, 0, 0, 0);
-    if (!start_node || !end_node)
-        return RE_ERROR_MEMORY;
+/* Calls a method of a PatternObject asynchronously.
+ *
+ * The method is run on a thread pool by the async helper, which returns an
+ * awaitable.
+ */
+Py_LOCAL_INLINE(PyObject*) call_async(PatternObject* self, char* name, PyObject*
+  args, PyObject* kwargs) {
+    return call(RE_MODULE, "_call_async", Py_BuildValue("OsOO", self, name,
+      args, kwargs ? kwargs : Py_None));
+}
 
-    start_node->values[0] = group;
+/* PatternObject's 'asearch' method. */
+static PyObject* pattern_asearch(PatternObject* self, PyObject* args, PyObject*
+  kwargs) {
+    return call_async(self, "search", args, kwargs);
+}
 
-    subargs = *args;
-    subargs.min_width = 0;
-    subargs.has_captures = FALSE;
-    subargs.is_fuzzy = FALSE;
-    status = build_sequence(&subargs);
-    if (status != RE_ERROR_SUCCESS)
-        return status;
+/* PatternObject's 'afinditer' method. */
+static PyObject* pattern_afinditer(PatternObject* self, PyObject* args,
+  PyObject* kwargs) {
+    return call_async(self, "finditer", args, kwargs);
+}
 
-    args->code = subargs.code;
-    args->has_captures |= subargs.has_captures;
-    args->is_fuzzy |= subargs.is_fuzzy;
+/* PatternObject's 'asub' method. */
+static PyObject* pattern_asub(PatternObject* self, PyObject* args, PyObject*
+  kwargs) {
+    return call_async(self, "sub", args, kwargs);
+}
 
-    min_width = subargs.min_width;
+/* Makes a copy of a PatternObject. */
+Py_LOCAL_INLINE(PyObject*) make_pattern_copy(PatternObject* self) {
+    Py_INCREF(self);
+    return (PyObject*)self;
+}
 
-    /* Append the start node. */
-    add_node(args->end, start_node);
-    add_node(start_node, subargs.start);
+/* PatternObject's 'pool_info' method. */
+static PyObject* pattern_pool_info(PatternObject* self, PyObject *unused) {
+    return Py_BuildValue("{s:n,s:n,s:n,s:n}", "hits",
+      (Py_ssize_t)self->state_pool_hits, "misses",
+      (Py_ssize_t)self->state_pool_misses, "size",
+      (Py_ssize_t)self->state_pool_count, "capacity",
+      (Py_ssize_t)RE_STATE_POOL_SIZE);
+}
 
-    if (args->code[0] == RE_OP_NEXT) {
-        RE_Node* true_branch_end;
+/* PatternObject's '__copy__' method. */
+static PyObject* pattern_copy(PatternObject* self, PyObject *unused) {
+    return make_pattern_copy(self);
+}
 
-        ++args->code;
+/* PatternObject's '__deepcopy__' method. */
+static PyObject* pattern_deepcopy(PatternObject* self, PyObject* memo) {
+    return make_pattern_copy(self);
+}
 
-        true_branch_end = subargs.end;
+/* The documentation of a PatternObject. */
+PyDoc_STRVAR(pattern_match_doc,
+    "match(string, pos=None, endpos=None, concurrent=None, timeout=None, max_steps=None, max_memory=None) --> MatchObject or None.\n\
+    Match zero or more characters at the beginning of the string.");
 
-        subargs.code = args->code;
-        subargs.min_width = 0;
-        subargs.has_captures = FALSE;
-        subargs.is_fuzzy = FALSE;
-        status = build_sequence(&subargs);
-        if (status != RE_ERROR_SUCCESS)
-            return status;
+PyDoc_STRVAR(pattern_fullmatch_doc,
+    "fullmatch(string, pos=None, endpos=None, concurrent=None, timeout=None, max_steps=None, max_memory=None) --> MatchObject or None.\n\
+    Match zero or more characters against all of the string.");
 
-        args->code = subargs.code;
-        args->has_captures |= subargs.has_captures;
-        args->is_fuzzy |= subargs.is_fuzzy;
+PyDoc_STRVAR(pattern_search_doc,
+    "search(string, pos=None, endpos=None, concurrent=None, timeout=None, max_steps=None, max_memory=None) --> MatchObject or None.\n\
+    Search through string looking for a match, and return a corresponding\n\
+    match object instance.  Return None if no match is found.");
 
-        if (group == 0) {
-            /* Join the 2 branches end-to-end and bypass it. The sequence
-             * itself will never be matched as a whole, so it doesn't matter.
-             */
-            min_width = 0;
+PyDoc_STRVAR(pattern_match_many_doc,
+    "match_many(strings, pos=None, endpos=None, spans=False, group=None, concurrent=None, timeout=None, max_steps=None, max_memory=None) --> list.\n\
+    Match zero or more characters at the beginning of each of the strings.\n\
+    Return a list of whether each one matched, of the spans of the matches if\n\
+    spans is True, or of the text of a group, or a tuple of groups, if group\n\
+    is provided.  No match gives None for spans and groups.");
 
-            add_node(start_node, end_node);
-            add_node(true_branch_end, subargs.start);
-        } else {
-            min_width = min_ssize_t(min_width, subargs.min_width);
+PyDoc_STRVAR(pattern_fullmatch_many_doc,
+    "fullmatch_many(strings, pos=None, endpos=None, spans=False, group=None, concurrent=None, timeout=None, max_steps=None, max_memory=None) --> list.\n\
+    Match all of each of the strings.  The results are as for match_many.");
 
-            add_node(start_node, subargs.start);
-            add_node(true_branch_end, end_node);
-        }
+PyDoc_STRVAR(pattern_search_many_doc,
+    "search_many(strings, pos=None, endpos=None, spans=False, group=None, concurrent=None, timeout=None, max_steps=None, max_memory=None) --> list.\n\
+    Search through each of the strings for a match.  The results are as for\n\
+    match_many.");
 
-        add_node(subargs.end, end_node);
-    } else {
-        add_node(start_node, end_node);
-        add_node(subargs.end, end_node);
+PyDoc_STRVAR(pattern_sub_doc,
+    "sub(repl, string, count=0, flags=0, pos=None, endpos=None, concurrent=None, timeout=None, max_steps=None, max_memory=None) --> newstring\n\
+    Return the string obtained by replacing the leftmost (or rightmost with a\n\
+    reverse pattern) non-overlapping occurrences of pattern in string by the\n\
+    replacement repl.");
 
-        min_width = 0;
-    }
+PyDoc_STRVAR(pattern_subf_doc,
+    "subf(format, string, count=0, flags=0, pos=None, endpos=None, concurrent=None, timeout=None, max_steps=None, max_memory=None) --> newstring\n\
+    Return the string obtained by replacing the leftmost (or rightmost with a\n\
+    reverse pattern) non-overlapping occurrences of pattern in string by the\n\
+    replacement format.");
 
-    args->min_width += min_width;
+PyDoc_STRVAR(pattern_subn_doc,
+    "subn(repl, string, count=0, flags=0, pos=None, endpos=None, concurrent=None, timeout=None, max_steps=None, max_memory=None) --> (newstring, number of subs)\n\
+    Return the tuple (new_string, number_of_subs_made) found by replacing the\n\
+    leftmost (or rightmost with a reverse pattern) non-overlapping occurrences\n\
+    of pattern with the replacement repl.");
 
-    if (args->code[0] != RE_OP_END)
-        return RE_ERROR_ILLEGAL;
+PyDoc_STRVAR(pattern_subfn_doc,
+    "subfn(format, string, count=0, flags=0, pos=None, endpos=None, concurrent=None, timeout=None, max_steps=None, max_memory=None) --> (newstring, number of subs)\n\
+    Return the tuple (new_string, number_of_subs_made) found by replacing the\n\
+    leftmost (or rightmost with a reverse pattern) non-overlapping occurrences\n\
+    of pattern with the replacement format.");
 
-    ++args->code;
+PyDoc_STRVAR(pattern_split_doc,
+    "split(string, string, maxsplit=0, concurrent=None, timeout=None, max_steps=None, max_memory=None, spans_only=False) --> list.\n\
+    Split string by the occurrences of pattern.  If spans_only is True, return\n\
+    the spans of the parts instead of the parts.");
 
-    args->end = end_node;
+PyDoc_STRVAR(pattern_splititer_doc,
+    "splititer(string, maxsplit=0, concurrent=None, timeout=None, max_steps=None, max_memory=None) --> iterator.\n\
+    Return an iterator yielding the parts of a split string.");
 
-    return RE_ERROR_SUCCESS;
-}
+PyDoc_STRVAR(pattern_findall_doc,
+    "findall(string, pos=None, endpos=None, overlapped=False, concurrent=None, timeout=None, max_steps=None, max_memory=None, spans_only=False) --> list.\n\
+    Return a list of all matches of pattern in string.  The matches may be\n\
+    overlapped if overlapped is True.  If spans_only is True, return the spans\n\
+    of the matches instead of the matched text.");
 
-/* Builds a LOOKAROUND node. */
-Py_LOCAL_INLINE(int) build_LOOKAROUND(RE_CompileArgs* args) {
-    RE_CODE flags;
-    BOOL forward;
-    RE_Node* lookaround_node;
-    RE_CompileArgs subargs;
-    int status;
-    RE_Node* end_node;
-    RE_Node* next_node;
+PyDoc_STRVAR(pattern_finditer_doc,
+    "finditer(string, pos=None, endpos=None, overlapped=False, concurrent=None, timeout=None, max_steps=None, max_memory=None, spans_only=False) --> iterator.\n\
+    Return an iterator over all matches for the RE pattern in string.  The\n\
+    matches may be overlapped if overlapped is True.  For each match, the\n\
+    iterator returns a MatchObject, or its span if spans_only is True.");
+
+PyDoc_STRVAR(pattern_finditer_stream_doc,
+    "finditer_stream(source, chunk_size=65536, concurrent=None, timeout=None, max_steps=None, max_memory=None) --> iterator.\n\
+    Return an iterator over all matches for the RE pattern in a file-like\n\
+    object or an iterable of chunks.  The spans of the matches are offsets\n\
+    from the start of the stream.");
+
+PyDoc_STRVAR(pattern_asearch_doc,
+    "asearch(string, pos=None, endpos=None, timeout=None, max_steps=None, max_memory=None) --> awaitable.\n\
+    Like search, but return an awaitable which runs the search on a thread pool\n\
+    with the GIL released.  If the awaiting task is cancelled, the search is\n\
+    stopped.");
+
+PyDoc_STRVAR(pattern_afinditer_doc,
+    "afinditer(string, pos=None, endpos=None, overlapped=False, timeout=None, max_steps=None, max_memory=None) --> async iterator.\n\
+    Like finditer, but return an asynchronous iterator which searches on a\n\
+    thread pool with the GIL released.");
+
+PyDoc_STRVAR(pattern_asub_doc,
+    "asub(repl, string, count=0, flags=0, pos=None, endpos=None, timeout=None, max_steps=None, max_memory=None) --> awaitable.\n\
+    Like sub, but return an awaitable which makes the replacements on a thread\n\
+    pool with the GIL released.  If the awaiting task is cancelled, the\n\
+    matching is stopped.");
 
-    /* codes: opcode, flags, forward, sequence, end. */
-    if (args->code + 3 > args->end_code)
-        return RE_ERROR_ILLEGAL;
+PyDoc_STRVAR(pattern_scanner_doc,
+    "scanner(string, pos=None, endpos=None, overlapped=False, concurrent=None, timeout=None, max_steps=None, max_memory=None, spans_only=False) --> scanner.\n\
+    Return an scanner for the RE pattern in string.  The matches may be overlapped\n\
+    if overlapped is True.");
 
-    flags = args->code[1];
-    forward = (BOOL)args->code[2];
+PyDoc_STRVAR(pattern_pool_info_doc,
+    "pool_info() --> dict.\n\
+    Return statistics about the storage that the pattern reuses between\n\
+    matches: 'hits', 'misses', 'size' and 'capacity'.");
 
-    /* Create a node for the lookaround. */
-    lookaround_node = create_node(args->pattern, RE_OP_LOOKAROUND, flags, 0,
-      0);
-    if (!lookaround_node)
-        return RE_ERROR_MEMORY;
+/* The methods of a PatternObject. */
+static PyMethodDef pattern_methods[] = {
+    {"match", (PyCFunction)pattern_match, METH_VARARGS|METH_KEYWORDS,
+      pattern_match_doc},
+    {"fullmatch", (PyCFunction)pattern_fullmatch, METH_VARARGS|METH_KEYWORDS,
+      pattern_fullmatch_doc},
+    {"search", (PyCFunction)pattern_search, METH_VARARGS|METH_KEYWORDS,
+      pattern_search_doc},
+    {"match_many", (PyCFunction)pattern_match_many,
+      METH_VARARGS|METH_KEYWORDS, pattern_match_many_doc},
+    {"fullmatch_many", (PyCFunction)pattern_fullmatch_many,
+      METH_VARARGS|METH_KEYWORDS, pattern_fullmatch_many_doc},
+    {"search_many", (PyCFunction)pattern_search_many,
+      METH_VARARGS|METH_KEYWORDS, pattern_search_many_doc},
+    {"sub", (PyCFunction)pattern_sub, METH_VARARGS|METH_KEYWORDS,
+      pattern_sub_doc},
+    {"subf", (PyCFunction)pattern_subf, METH_VARARGS|METH_KEYWORDS,
+      pattern_subf_doc},
+    {"subn", (PyCFunction)pattern_subn, METH_VARARGS|METH_KEYWORDS,
+      pattern_subn_doc},
+    {"subfn", (PyCFunction)pattern_subfn, METH_VARARGS|METH_KEYWORDS,
+      pattern_subfn_doc},
+    {"split", (PyCFunction)pattern_split, METH_VARARGS|METH_KEYWORDS,
+      pattern_split_doc},
+    {"splititer", (PyCFunction)pattern_splititer, METH_VARARGS|METH_KEYWORDS,
+      pattern_splititer_doc},
+    {"findall", (PyCFunction)pattern_findall, METH_VARARGS|METH_KEYWORDS,
+      pattern_findall_doc},
+    {"finditer", (PyCFunction)pattern_finditer, METH_VARARGS|METH_KEYWORDS,
+      pattern_finditer_doc},
+    {"finditer_stream", (PyCFunction)pattern_finditer_stream,
+      METH_VARARGS|METH_KEYWORDS, pattern_finditer_stream_doc},
+    {"asearch", (PyCFunction)pattern_asearch, METH_VARARGS|METH_KEYWORDS,
+      pattern_asearch_doc},
+    {"afinditer", (PyCFunction)pattern_afinditer, METH_VARARGS|METH_KEYWORDS,
+      pattern_afinditer_doc},
+    {"asub", (PyCFunction)pattern_asub, METH_VARARGS|METH_KEYWORDS,
+      pattern_asub_doc},
+    {"scanner", (PyCFunction)pattern_scanner, METH_VARARGS|METH_KEYWORDS,
+      pattern_scanner_doc},
+    {"pool_info", (PyCFunction)pattern_pool_info, METH_NOARGS,
+      pattern_pool_info_doc},
+    {"__copy__", (PyCFunction)pattern_copy, METH_NOARGS},
+    {"__deepcopy__", (PyCFunction)pattern_deepcopy, METH_O},
+    {NULL, NULL}
+};
 
-    args->code += 3;
+PyDoc_STRVAR(pattern_doc, "Compiled regex object");
 
-    /* Compile the sequence and check that we've reached the end of the
-     * subpattern.
-     */
-    subargs = *args;
-    subargs.forward = forward;
-    status = build_sequence(&subargs);
-    if (status != RE_ERROR_SUCCESS)
-        return status;
+/* Deallocates a PatternObject. */
+static void pattern_dealloc(PyObject* self_) {
+    PatternObject* self;
+    size_t i;
+    int reverse;
 
-    if (subargs.code[0] != RE_OP_END)
-        return RE_ERROR_ILLEGAL;
+    self = (PatternObject*)self_;
 
-    args->code = subargs.code;
-    ++args->code;
+    /* Discard the nodes. */
+    for (i = 0; i < self->node_count; i++) {
+        RE_Node* node;
 
-    /* Check the subpattern. */
-    args->has_captures |= subargs.has_captures;
-    args->is_fuzzy |= subargs.is_fuzzy;
+        node = self->node_list[i];
+        re_dealloc(node->values);
+        if (node->status & RE_STATUS_STRING) {
+            re_dealloc(node->string.bad_character_offset);
+            re_dealloc(node->string.good_suffix_offset);
+        }
+        re_dealloc(node);
+    }
+    re_dealloc(self->node_list);
 
-    /* Create the node to terminate the subpattern. */
-    end_node = create_node(args->pattern, RE_OP_END_LOOKAROUND, 0, 0, 0);
-    if (!end_node)
-        return RE_ERROR_MEMORY;
+    /* Discard the group info. */
+    re_dealloc(self->group_info);
 
-    /* Make a continuation node. */
-    next_node = create_node(args->pattern, RE_OP_BRANCH, 0, 0, 0);
-    if (!next_node)
-        return RE_ERROR_MEMORY;
+    /* Discard the call_ref info. */
+    re_dealloc(self->call_ref_info);
 
-    /* Append the new sequence. */
-    add_node(args->end, lookaround_node);
-    add_node(lookaround_node, subargs.start);
-    add_node(lookaround_node, next_node);
-    add_node(subargs.end, end_node);
-    add_node(end_node, next_node);
+    /* Discard the repeat info. */
+    re_dealloc(self->repeat_info);
 
-    args->end = next_node;
+    /* Discard the pooled storage for states. */
+    for (i = 0; i < self->state_pool_count; i++)
+        dealloc_state_storage(self, &self->state_pool[i]);
 
-    return RE_ERROR_SUCCESS;
-}
-
-/* Builds a RANGE node. */
-Py_LOCAL_INLINE(int) build_RANGE(RE_CompileArgs* args) {
-    RE_UINT8 op;
-    RE_CODE flags;
-    Py_ssize_t step;
-    RE_Node* node;
-
-    /* codes: opcode, flags, lower, upper. */
-    if (args->code + 3 > args->end_code)
-        return RE_ERROR_ILLEGAL;
+    if (self->weakreflist)
+        PyObject_ClearWeakRefs((PyObject*)self);
+    Py_XDECREF(self->pattern);
+    Py_XDECREF(self->groupindex);
+    Py_XDECREF(self->indexgroup);
 
-    op = (RE_UINT8)args->code[0];
-    flags = args->code[1];
+    for (reverse = 0; reverse < 2; reverse++) {
+        if (self->named_list_tries[reverse]) {
+            for (i = 0; i < self->named_lists_count; i++) {
+                re_dealloc(self->named_list_tries[reverse][i].nodes);
+                re_dealloc(self->named_list_tries[reverse][i].edges);
+            }
 
-    step = get_step(op);
+            re_dealloc(self->named_list_tries[reverse]);
+        }
+    }
 
-    if (flags & RE_ZEROWIDTH_OP)
-        step = 0;
+    Py_DECREF(self->named_lists);
+    Py_DECREF(self->named_list_indexes);
+    re_dealloc(self->req_alts);
+    re_dealloc(self->locale_info);
 
-    /* Create the node. */
-    node = create_node(args->pattern, op, flags, step, 2);
-    if (!node)
-        return RE_ERROR_MEMORY;
+    for (i = 0; i < 2; i++) {
+        dealloc_dfa_program(self->dfa_programs[i]);
+        dealloc_dfa_cache(self->dfa_storage[i]);
+    }
 
-    node->values[0] = args->code[2];
-    node->values[1] = args->code[3];
+    dealloc_fuzzy_literal(self->fuzzy_literal);
 
-    args->code += 4;
+    PyObject_DEL(self);
+}
 
-    /* Append the node. */
-    add_node(args->end, node);
-    args->end = node;
+/* Info about the various flags that can be passed in. */
+typedef struct RE_FlagName {
+    char* name;
+    int value;
+} RE_FlagName;
 
-    if (step != 0)
-        ++args->min_width;
+/* We won't bother about the U flag in Python 3. */
+static RE_FlagName flag_names[] = {
+    {"A", RE_FLAG_ASCII},
+    {"B", RE_FLAG_BESTMATCH},
+    {"D", RE_FLAG_DEBUG},
+    {"S", RE_FLAG_DOTALL},
+    {"F", RE_FLAG_FULLCASE},
+    {"I", RE_FLAG_IGNORECASE},
+    {"L", RE_FLAG_LOCALE},
+    {"M", RE_FLAG_MULTILINE},
+    {"R", RE_FLAG_REVERSE},
+    {"T", RE_FLAG_TEMPLATE},
+    {"X", RE_FLAG_VERBOSE},
+    {"V0", RE_FLAG_VERSION0},
+    {"V1", RE_FLAG_VERSION1},
+    {"W", RE_FLAG_WORD},
+};
 
-    return RE_ERROR_SUCCESS;
-}
+/* Appends a string to a list. */
+Py_LOCAL_INLINE(BOOL) append_string(PyObject* list, char* string) {
+    PyObject* item;
+    int status;
 
-/* Builds a REF_GROUP node. */
-Py_LOCAL_INLINE(int) build_REF_GROUP(RE_CompileArgs* args) {
-    RE_CODE flags;
-    RE_CODE group;
-    RE_Node* node;
+    item = Py_BuildValue("U", string);
+    if (!item)
+        return FALSE;
 
-    /* codes: opcode, flags, group. */
-    if (args->code + 2 > args->end_code)
-        return RE_ERROR_ILLEGAL;
+    status = PyList_Append(list, item);
+    Py_DECREF(item);
+    if (status < 0)
+        return FALSE;
 
-    flags = args->code[1];
-    group = args->code[2];
-    node = create_node(args->pattern, (RE_UINT8)args->code[0], flags, 0, 1);
-    if (!node)
-        return RE_ERROR_MEMORY;
+    return TRUE;
+}
 
-    node->values[0] = group;
+/* Appends a (decimal) integer to a list. */
+Py_LOCAL_INLINE(BOOL) append_integer(PyObject* list, Py_ssize_t value) {
+    PyObject* int_obj;
+    PyObject* repr_obj;
+    int status;
 
-    args->code += 3;
+    int_obj = Py_BuildValue("n", value);
+    if (!int_obj)
+        return FALSE;
 
-    /* Record that we have a reference to a group. */
-    if (!record_ref_group(args->pattern, group))
-        return RE_ERROR_MEMORY;
+    repr_obj = PyObject_Repr(int_obj);
+    Py_DECREF(int_obj);
+    if (!repr_obj)
+        return FALSE;
 
-    /* Append the reference. */
-    add_node(args->end, node);
-    args->end = node;
+    status = PyList_Append(list, repr_obj);
+    Py_DECREF(repr_obj);
+    if (status < 0)
+        return FALSE;
 
-    return RE_ERROR_SUCCESS;
+    return TRUE;
 }
 
-/* Builds a REPEAT node. */
-Py_LOCAL_INLINE(int) build_REPEAT(RE_CompileArgs* args) {
-    BOOL greedy;
-    RE_CODE min_count;
-    RE_CODE max_count;
+/* MatchObject's '__repr__' method. */
+static PyObject* match_repr(PyObject* self_) {
+    MatchObject* self;
+    PyObject* list;
+    PyObject* matched_substring;
+    PyObject* matched_repr;
     int status;
+    PyObject* separator;
+    PyObject* result;
 
-    /* codes: opcode, min_count, max_count, sequence, end. */
-    if (args->code + 3 > args->end_code)
-        return RE_ERROR_ILLEGAL;
+    self = (MatchObject*)self_;
 
-    greedy = args->code[0] == RE_OP_GREEDY_REPEAT;
-    min_count = args->code[1];
-    max_count = args->code[2];
-    if (args->code[1] > args->code[2])
-        return RE_ERROR_ILLEGAL;
+    list = PyList_New(0);
+    if (!list)
+        return NULL;
 
-    args->code += 3;
+    if (!append_string(list, "<regex.Match object; span=("))
+        goto error;
 
-    if (min_count == 1 && max_count == 1) {
-        /* Singly-repeated sequence. */
-        RE_CompileArgs subargs;
+    if (!append_integer(list, self->match_start))
+        goto error;
 
-        subargs = *args;
-        subargs.has_captures = FALSE;
-        subargs.is_fuzzy = FALSE;
-        status = build_sequence(&subargs);
-        if (status != RE_ERROR_SUCCESS)
-            return status;
+    if (! append_string(list, ", "))
+        goto error;
 
-        if (subargs.code[0] != RE_OP_END)
-            return RE_ERROR_ILLEGAL;
+    if (!append_integer(list, self->match_end))
+        goto error;
 
-        args->code = subargs.code;
-        args->min_width = subargs.min_width;
-        args->has_captures |= subargs.has_captures;
-        args->is_fuzzy |= subargs.is_fuzzy;
+    if (!append_string(list, "), match="))
+        goto error;
 
-        ++args->code;
+    matched_substring = get_slice(self->substring, self->match_start -
+      self->substring_offset, self->match_end - self->substring_offset);
+    if (!matched_substring)
+        goto error;
 
-        /* Append the sequence. */
-        add_node(args->end, subargs.start);
-        args->end = subargs.end;
-    } else {
-        size_t index;
-        RE_Node* repeat_node;
-        RE_CompileArgs subargs;
+    matched_repr = PyObject_Repr(matched_substring);
+    Py_DECREF(matched_substring);
+    if (!matched_repr)
+        goto error;
 
-        index = args->pattern->repeat_count;
+    status = PyList_Append(list, matched_repr);
+    Py_DECREF(matched_repr);
+    if (status < 0)
+        goto error;
 
-        /* Create the nodes for the repeat. */
-        repeat_node = create_node(args->pattern, greedy ? RE_OP_GREEDY_REPEAT :
-          RE_OP_LAZY_REPEAT, 0, args->forward ? 1 : -1, 4);
-        if (!repeat_node || !record_repeat(args->pattern, index,
-          args->repeat_depth))
-            return RE_ERROR_MEMORY;
+    if (self->fuzzy_counts[RE_FUZZY_SUB] != 0 ||
+      self->fuzzy_counts[RE_FUZZY_INS] != 0 || self->fuzzy_counts[RE_FUZZY_DEL]
+      != 0) {
+        if (! append_string(list, ", fuzzy_counts=("))
+            goto error;
 
-        repeat_node->values[0] = (RE_CODE)index;
-        repeat_node->values[1] = min_count;
-        repeat_node->values[2] = max_count;
-        repeat_node->values[3] = args->forward;
+        if (!append_integer(list,
+          (Py_ssize_t)self->fuzzy_counts[RE_FUZZY_SUB]))
+            goto error;
 
-        if (args->within_fuzzy)
-            args->pattern->repeat_info[index].status |= RE_STATUS_BODY;
+        if (! append_string(list, ", "))
+            goto error;
 
-        /* Compile the 'body' and check that we've reached the end of it. */
-        subargs = *args;
-        subargs.min_width = 0;
-        subargs.visible_captures = TRUE;
-        subargs.has_captures = FALSE;
-        subargs.is_fuzzy = FALSE;
-        ++subargs.repeat_depth;
-        status = build_sequence(&subargs);
-        if (status != RE_ERROR_SUCCESS)
-            return status;
+        if (!append_integer(list,
+          (Py_ssize_t)self->fuzzy_counts[RE_FUZZY_INS]))
+            goto error;
 
-        if (subargs.code[0] != RE_OP_END)
-            return RE_ERROR_ILLEGAL;
+        if (! append_string(list, ", "))
+            goto error;
+        if (!append_integer(list,
+          (Py_ssize_t)self->fuzzy_counts[RE_FUZZY_DEL]))
+            goto error;
 
-        args->code = subargs.code;
-        args->min_width += (Py_ssize_t)min_count * subargs.min_width;
-        args->has_captures |= subargs.has_captures;
-        args->is_fuzzy |= subargs.is_fuzzy;
+        if (! append_string(list, ")"))
+            goto error;
+    }
 
-        ++args->code;
+    if (self->partial) {
+        if (!append_string(list, ", partial=True"))
+            goto error;
+    }
 
-        /* Is it a repeat of something which will match a single character?
-         *
-         * If it's in a fuzzy section then it won't be optimised as a
-         * single-character repeat.
-         */
-        if (sequence_matches_one(subargs.start)) {
-            repeat_node->op = greedy ? RE_OP_GREEDY_REPEAT_ONE :
-              RE_OP_LAZY_REPEAT_ONE;
+    if (! append_string(list, ">"))
+        goto error;
 
-            /* Append the new sequence. */
-            add_node(args->end, repeat_node);
-            repeat_node->nonstring.next_2.node = subargs.start;
-            args->end = repeat_node;
-        } else {
-            RE_Node* end_repeat_node;
-            RE_Node* end_node;
-
-            end_repeat_node = create_node(args->pattern, greedy ?
-              RE_OP_END_GREEDY_REPEAT : RE_OP_END_LAZY_REPEAT, 0, args->forward
-              ? 1 : -1, 4);
-            if (!end_repeat_node)
-                return RE_ERROR_MEMORY;
-
-            end_repeat_node->values[0] = repeat_node->values[0];
-            end_repeat_node->values[1] = repeat_node->values[1];
-            end_repeat_node->values[2] = repeat_node->values[2];
-            end_repeat_node->values[3] = args->forward;
+    separator = Py_BuildValue("U", "");
+    if (!separator)
+        goto error;
 
-            end_node = create_node(args->pattern, RE_OP_BRANCH, 0, 0, 0);
-            if (!end_node)
-                return RE_ERROR_MEMORY;
+    result = PyUnicode_Join(separator, list);
+    Py_DECREF(separator);
+    Py_DECREF(list);
 
-            /* Append the new sequence. */
-            add_node(args->end, repeat_node);
-            add_node(repeat_node, subargs.start);
-            add_node(repeat_node, end_node);
-            add_node(subargs.end, end_repeat_node);
-            add_node(end_repeat_node, subargs.start);
-            add_node(end_repeat_node, end_node);
-            args->end = end_node;
-        }
-    }
+    return result;
 
-    return RE_ERROR_SUCCESS;
+error:
+    Py_DECREF(list);
+    return NULL;
 }
 
-/* Builds a STRING node. */
-Py_LOCAL_INLINE(int) build_STRING(RE_CompileArgs* args, BOOL is_charset) {
-    RE_CODE flags;
-    RE_CODE length;
-    RE_UINT8 op;
-    Py_ssize_t step;
-    RE_Node* node;
-    size_t i;
-
-    /* codes: opcode, flags, length, characters. */
-    flags = args->code[1];
-    length = args->code[2];
-    if (args->code + 3 + length > args->end_code)
-        return RE_ERROR_ILLEGAL;
-
-    op = (RE_UINT8)args->code[0];
+/* PatternObject's '__repr__' method. */
+static PyObject* pattern_repr(PyObject* self_) {
+    PatternObject* self;
+    PyObject* list;
+    PyObject* item;
+    int status;
+    int flag_count;
+    unsigned int i;
+    Py_ssize_t pos;
+    PyObject *key;
+    PyObject *value;
+    PyObject* separator;
+    PyObject* result;
 
-    step = get_step(op);
+    self = (PatternObject*)self_;
 
-    /* Create the node. */
-    node = create_node(args->pattern, op, flags, step * (Py_ssize_t)length,
-      length);
-    if (!node)
-        return RE_ERROR_MEMORY;
-    if (!is_charset)
-        node->status |= RE_STATUS_STRING;
+    list = PyList_New(0);
+    if (!list)
+        return NULL;
 
-    for (i = 0; i < length; i++)
-        node->values[i] = args->code[3 + i];
+    if (!append_string(list, "regex.Regex("))
+        goto error;
 
-    args->code += 3 + length;
+    item = PyObject_Repr(self->pattern);
+    if (!item)
+        goto error;
 
-    /* Append the node. */
-    add_node(args->end, node);
-    args->end = node;
+    status = PyList_Append(list, item);
+    Py_DECREF(item);
+    if (status < 0)
+        goto error;
 
-    /* Because of full case-folding, one character in the text could match
-     * multiple characters in the pattern.
-     */
-    if (op == RE_OP_STRING_FLD || op == RE_OP_STRING_FLD_REV)
-        args->min_width += possible_unfolded_length((Py_ssize_t)length);
-    else
-        args->min_width += (Py_ssize_t)length;
+    flag_count = 0;
+    for (i = 0; i < sizeof(flag_names) / sizeof(flag_names[0]); i++) {
+        if (self->flags & flag_names[i].value) {
+            if (flag_count == 0) {
+                if (!append_string(list, ", flags="))
+                    goto error;
+            } else {
+                if (!append_string(list, " | "))
+                    goto error;
+            }
 
-    return RE_ERROR_SUCCESS;
-}
+            if (!append_string(list, "regex."))
+                goto error;
 
-/* Builds a SET node. */
-Py_LOCAL_INLINE(int) build_SET(RE_CompileArgs* args) {
-    RE_UINT8 op;
-    RE_CODE flags;
-    Py_ssize_t step;
-    RE_Node* node;
-    Py_ssize_t saved_min_width;
-    int status;
+            if (!append_string(list, flag_names[i].name))
+                goto error;
 
-    /* codes: opcode, flags, members. */
-    op = (RE_UINT8)args->code[0];
-    flags = args->code[1];
+            ++flag_count;
+        }
+    }
 
-    step = get_step(op);
+    pos = 0;
+    /* PyDict_Next borrows references. */
+    while (PyDict_Next(self->named_lists, &pos, &key, &value)) {
+        if (!append_string(list, ", "))
+            goto error;
 
-    if (flags & RE_ZEROWIDTH_OP)
-        step = 0;
+        status = PyList_Append(list, key);
+        if (status < 0)
+            goto error;
 
-    node = create_node(args->pattern, op, flags, step, 0);
-    if (!node)
-        return RE_ERROR_MEMORY;
+        if (!append_string(list, "="))
+            goto error;
 
-    args->code += 2;
+        item = PyObject_Repr(value);
+        if (!item)
+            goto error;
 
-    /* Append the node. */
-    add_node(args->end, node);
-    args->end = node;
+        status = PyList_Append(list, item);
+        Py_DECREF(item);
+        if (status < 0)
+            goto error;
+    }
 
-    saved_min_width = args->min_width;
+    if (!append_string(list, ")"))
+        goto error;
 
-    /* Compile the character set. */
-    do {
-        switch (args->code[0]) {
-        case RE_OP_CHARACTER:
-        case RE_OP_PROPERTY:
-            status = build_CHARACTER_or_PROPERTY(args);
-            if (status != RE_ERROR_SUCCESS)
-                return status;
-            break;
-        case RE_OP_RANGE:
-            status = build_RANGE(args);
-            if (status != RE_ERROR_SUCCESS)
-                return status;
-            break;
-        case RE_OP_SET_DIFF:
-        case RE_OP_SET_INTER:
-        case RE_OP_SET_SYM_DIFF:
-        case RE_OP_SET_UNION:
-            status = build_SET(args);
-            if (status != RE_ERROR_SUCCESS)
-                return status;
-            break;
-        case RE_OP_STRING:
-            /* A set of characters. */
-            if (!build_STRING(args, TRUE))
-                return FALSE;
-            break;
-        default:
-            /* Illegal opcode for a character set. */
-            return RE_ERROR_ILLEGAL;
-        }
-    } while (args->code < args->end_code && args->code[0] != RE_OP_END);
+    separator = Py_BuildValue("U", "");
+    if (!separator)
+        goto error;
 
-    /* Check that we've reached the end correctly. (The last opcode should be
-     * 'END'.)
-     */
-    if (args->code >= args->end_code || args->code[0] != RE_OP_END)
-        return RE_ERROR_ILLEGAL;
+    result = PyUnicode_Join(separator, list);
+    Py_DECREF(separator);
+    Py_DECREF(list);
 
-    ++args->code;
+    return result;
 
-    /* At this point the set's members are in the main sequence. They need to
-     * be moved out-of-line.
-     */
-    node->nonstring.next_2.node = node->next_1.node;
-    node->next_1.node = NULL;
-    args->end = node;
+error:
+    Py_DECREF(list);
+    return NULL;
+}
 
-    args->min_width = saved_min_width;
+/* PatternObject's 'groupindex' method. */
+static PyObject* pattern_groupindex(PyObject* self_) {
+    PatternObject* self;
 
-    if (step != 0)
-        ++args->min_width;
+    self = (PatternObject*)self_;
 
-    return RE_ERROR_SUCCESS;
+    return PyDict_Copy(self->groupindex);
 }
 
-/* Builds a STRING_SET node. */
-Py_LOCAL_INLINE(int) build_STRING_SET(RE_CompileArgs* args) {
-    RE_CODE index;
-    RE_CODE min_len;
-    RE_CODE max_len;
-    RE_Node* node;
+static PyGetSetDef pattern_getset[] = {
+    {"groupindex", (getter)pattern_groupindex, (setter)NULL,
+      "A dictionary mapping group names to group numbers."},
+    {NULL}  /* Sentinel */
+};
 
-    /* codes: opcode, index, min_len, max_len. */
-    if (args->code + 3 > args->end_code)
-        return RE_ERROR_ILLEGAL;
+static PyMemberDef pattern_members[] = {
+    {"pattern", T_OBJECT, offsetof(PatternObject, pattern), READONLY,
+      "The pattern string from which the regex object was compiled."},
+    {"flags", T_PYSSIZET, offsetof(PatternObject, flags), READONLY,
+      "The regex matching flags."},
+    {"groups", T_PYSSIZET, offsetof(PatternObject, public_group_count),
+      READONLY, "The number of capturing groups in the pattern."},
+    {"named_lists", T_OBJECT, offsetof(PatternObject, named_lists), READONLY,
+      "The named lists used by the regex."},
+    {"bestmatch_passes_avoided", T_PYSSIZET, offsetof(PatternObject,
+      bestmatch_passes_avoided), READONLY,
+      "The number of passes that BESTMATCH didn't need to make."},
+    {NULL}  /* Sentinel */
+};
 
-    index = args->code[1];
-    min_len = args->code[2];
-    max_len = args->code[3];
-    node = create_node(args->pattern, (RE_UINT8)args->code[0], 0, 0, 3);
-    if (!node)
-        return RE_ERROR_MEMORY;
+static PyTypeObject Pattern_Type = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "_" RE_MODULE "." "Pattern",
+    sizeof(PatternObject)
+};
 
-    node->values[0] = index;
-    node->values[1] = min_len;
-    node->values[2] = max_len;
+/* Building the nodes is made simpler by allowing branches to have a single
+ * exit. These need to be removed.
+ */
+Py_LOCAL_INLINE(void) skip_one_way_branches(PatternObject* pattern) {
+    BOOL modified;
 
-    args->code += 4;
+    /* If a node refers to a 1-way branch then make the former refer to the
+     * latter's destination. Repeat until they're all done.
+     */
+    do {
+        size_t i;
 
-    /* Append the reference. */
-    add_node(args->end, node);
-    args->end = node;
+        modified = FALSE;
 
-    return RE_ERROR_SUCCESS;
+        for (i = 0; i < pattern->node_count; i++) {
+            RE_Node* node;
+            RE_Node* next;
+
+            node = pattern->node_list[i];
+
+            /* Check the first destination. */
+            next = node->next_1.node;
+            if (next && next->op == RE_OP_BRANCH &&
+              !next->nonstring.next_2.node) {
+                node->next_1.node = next->next_1.node;
+                modified = TRUE;
+            }
+
+            /* Check the second destination. */
+            next = node->nonstring.next_2.node;
+            if (next && next->op == RE_OP_BRANCH &&
+              !next->nonstring.next_2.node) {
+                node->nonstring.next_2.node = next->next_1.node;
+                modified = TRUE;
+            }
+        }
+    } while (modified);
+
+    /* The start node might be a 1-way branch. Skip over it because it'll be
+     * removed. It might even be the first in a chain.
+     */
+    while (pattern->start_node->op == RE_OP_BRANCH &&
+      !pattern->start_node->nonstring.next_2.node)
+        pattern->start_node = pattern->start_node->next_1.node;
 }
 
-/* Builds a SUCCESS node . */
-Py_LOCAL_INLINE(int) build_SUCCESS(RE_CompileArgs* args) {
-    RE_Node* node;
-    /* code: opcode. */
+/* Adds guards to repeats which are followed by a reference to a group.
+ *
+ * Returns whether a guard was added for a node at or after the given node.
+ */
+Py_LOCAL_INLINE(RE_STATUS_T) add_repeat_guards(PatternObject* pattern, RE_Node*
+  node) {
+    RE_STATUS_T result;
 
-    /* Create the node. */
-    node = create_node(args->pattern, args->code[0], 0, 0, 0);
-    if (!node)
-        return RE_ERROR_MEMORY;
+    result = RE_STATUS_NEITHER;
 
-    ++args->code;
+    for (;;) {
+        if (node->status & RE_STATUS_VISITED_AG)
+            return node->status & (RE_STATUS_REPEAT | RE_STATUS_REF);
 
-    /* Append the node. */
-    add_node(args->end, node);
-    args->end = node;
+        switch (node->op) {
+        case RE_OP_BRANCH:
+        {
+            RE_STATUS_T branch_1_result;
+            RE_STATUS_T branch_2_result;
+            RE_STATUS_T status;
 
-    return RE_ERROR_SUCCESS;
-}
+            branch_1_result = add_repeat_guards(pattern, node->next_1.node);
+            branch_2_result = add_repeat_guards(pattern,
+              node->nonstring.next_2.node);
+            status = max_status_3(result, branch_1_result, branch_2_result);
+            node->status = RE_STATUS_VISITED_AG | status;
+            return status;
+        }
+        case RE_OP_END_GREEDY_REPEAT:
+        case RE_OP_END_LAZY_REPEAT:
+            node->status |= RE_STATUS_VISITED_AG;
+            return result;
+        case RE_OP_GREEDY_REPEAT:
+        case RE_OP_LAZY_REPEAT:
+        {
+            BOOL limited;
+            RE_STATUS_T body_result;
+            RE_STATUS_T tail_result;
+            RE_RepeatInfo* repeat_info;
+            RE_STATUS_T status;
 
-/* Builds a zero-width node. */
-Py_LOCAL_INLINE(int) build_zerowidth(RE_CompileArgs* args) {
-    RE_CODE flags;
-    RE_Node* node;
+            limited = ~node->values[2] != 0;
+            if (limited)
+                body_result = RE_STATUS_LIMITED;
+            else
+                body_result = add_repeat_guards(pattern, node->next_1.node);
+            tail_result = add_repeat_guards(pattern,
+              node->nonstring.next_2.node);
 
-    /* codes: opcode, flags. */
-    if (args->code + 1 > args->end_code)
-        return RE_ERROR_ILLEGAL;
+            repeat_info = &pattern->repeat_info[node->values[0]];
+            if (body_result != RE_STATUS_REF)
+                repeat_info->status |= RE_STATUS_BODY;
+            if (tail_result != RE_STATUS_REF)
+                repeat_info->status |= RE_STATUS_TAIL;
+            if (limited)
+                result = max_status_2(result, RE_STATUS_LIMITED);
+            else
+                result = max_status_2(result, RE_STATUS_REPEAT);
+            status = max_status_3(result, body_result, tail_result);
+            node->status |= RE_STATUS_VISITED_AG | status;
+            return status;
+        }
+        case RE_OP_GREEDY_REPEAT_ONE:
+        case RE_OP_LAZY_REPEAT_ONE:
+        {
+            BOOL limited;
+            RE_STATUS_T tail_result;
+            RE_RepeatInfo* repeat_info;
+            RE_STATUS_T status;
 
-    flags = args->code[1];
+            limited = ~node->values[2] != 0;
+            tail_result = add_repeat_guards(pattern, node->next_1.node);
+
+            repeat_info = &pattern->repeat_info[node->values[0]];
+            repeat_info->status |= RE_STATUS_BODY;
+            if (tail_result != RE_STATUS_REF)
+                repeat_info->status |= RE_STATUS_TAIL;
+            if (limited)
+                result = max_status_2(result, RE_STATUS_LIMITED);
+            else
+                result = max_status_2(result, RE_STATUS_REPEAT);
+            status = max_status_3(result, RE_STATUS_REPEAT, tail_result);
+            node->status = RE_STATUS_VISITED_AG | status;
+            return status;
+        }
+        case RE_OP_GROUP_EXISTS:
+        {
+            RE_STATUS_T branch_1_result;
+            RE_STATUS_T branch_2_result;
+            RE_STATUS_T status;
+
+            branch_1_result = add_repeat_guards(pattern, node->next_1.node);
+            branch_2_result = add_repeat_guards(pattern,
+              node->nonstring.next_2.node);
+            status = max_status_4(result, branch_1_result, branch_2_result,
+              RE_STATUS_REF);
+            node->status = RE_STATUS_VISITED_AG | status;
+            return status;
+        }
+        case RE_OP_GROUP_CALL:
+        case RE_OP_REF_GROUP:
+        case RE_OP_REF_GROUP_FLD:
+        case RE_OP_REF_GROUP_FLD_REV:
+        case RE_OP_REF_GROUP_IGN:
+        case RE_OP_REF_GROUP_IGN_REV:
+        case RE_OP_REF_GROUP_REV:
+            result = RE_STATUS_REF;
+            node = node->next_1.node;
+            break;
+        case RE_OP_SUCCESS:
+            node->status = RE_STATUS_VISITED_AG | result;
+            return result;
+        default:
+            node = node->next_1.node;
+            break;
+        }
+    }
+}
+
+/* Adds an index to a node's values unless it's already present.
+ *
+ * 'offset' is the offset of the index count within the values.
+ */
+Py_LOCAL_INLINE(BOOL) add_index(RE_Node* node, size_t offset, size_t index) {
+    size_t index_count;
+    size_t first_index;
+    size_t i;
+    RE_CODE* new_values;
 
-    /* Create the node. */
-    node = create_node(args->pattern, (RE_UINT8)args->code[0], flags, 0, 0);
     if (!node)
-        return RE_ERROR_MEMORY;
+        return TRUE;
 
-    args->code += 2;
+    index_count = node->values[offset];
+    first_index = offset + 1;
 
-    /* Append the node. */
-    add_node(args->end, node);
-    args->end = node;
+    /* Is the index already present? */
+    for (i = 0; i < index_count; i++) {
+        if (node->values[first_index + i] == index)
+            return TRUE;
+    }
 
-    return RE_ERROR_SUCCESS;
+    /* Allocate more space for the new index. */
+    new_values = re_realloc(node->values, (node->value_count + 1) *
+      sizeof(RE_CODE));
+    if (!new_values)
+        return FALSE;
+
+    ++node->value_count;
+    node->values = new_values;
+
+    node->values[first_index + node->values[offset]++] = (RE_CODE)index;
+
+    return TRUE;
 }
 
-/* Builds a sequence of nodes from regular expression code. */
-Py_LOCAL_INLINE(int) build_sequence(RE_CompileArgs* args) {
-    int status;
+/* Records the index of every repeat and fuzzy section within atomic
+ * subpatterns and lookarounds.
+ */
+Py_LOCAL_INLINE(BOOL) record_subpattern_repeats_and_fuzzy_sections(RE_Node*
+  parent_node, size_t offset, size_t repeat_count, RE_Node* node) {
+    while (node) {
+        if (node->status & RE_STATUS_VISITED_REP)
+            return TRUE;
 
-    /* Guarantee that there's something to attach to. */
-    args->start = create_node(args->pattern, RE_OP_BRANCH, 0, 0, 0);
-    args->end = args->start;
+        node->status |= RE_STATUS_VISITED_REP;
 
-    /* The sequence should end with an opcode we don't understand. If it
-     * doesn't then the code is illegal.
-     */
-    while (args->code < args->end_code) {
-        /* The following code groups opcodes by format, not function. */
-        switch (args->code[0]) {
-        case RE_OP_ANY:
-        case RE_OP_ANY_ALL:
-        case RE_OP_ANY_ALL_REV:
-        case RE_OP_ANY_REV:
-        case RE_OP_ANY_U:
-        case RE_OP_ANY_U_REV:
-            /* A simple opcode with no trailing codewords and width of 1. */
-            status = build_ANY(args);
-            if (status != RE_ERROR_SUCCESS)
-                return status;
-            break;
-        case RE_OP_ATOMIC:
-            /* An atomic sequence. */
-            status = build_ATOMIC(args);
-            if (status != RE_ERROR_SUCCESS)
-                return status;
-            break;
-        case RE_OP_BOUNDARY:
-        case RE_OP_DEFAULT_BOUNDARY:
-        case RE_OP_DEFAULT_END_OF_WORD:
-        case RE_OP_DEFAULT_START_OF_WORD:
-        case RE_OP_END_OF_WORD:
-        case RE_OP_GRAPHEME_BOUNDARY:
-        case RE_OP_KEEP:
-        case RE_OP_SKIP:
-        case RE_OP_START_OF_WORD:
-            /* A word or grapheme boundary. */
-            status = build_BOUNDARY(args);
-            if (status != RE_ERROR_SUCCESS)
-                return status;
-            break;
+        switch (node->op) {
         case RE_OP_BRANCH:
-            /* A 2-way branch. */
-            status = build_BRANCH(args);
-            if (status != RE_ERROR_SUCCESS)
-                return status;
-            break;
-        case RE_OP_CALL_REF:
-            /* A group call ref. */
-            status = build_CALL_REF(args);
-            if (status != RE_ERROR_SUCCESS)
-                return status;
-            break;
-        case RE_OP_CHARACTER:
-        case RE_OP_CHARACTER_IGN:
-        case RE_OP_CHARACTER_IGN_REV:
-        case RE_OP_CHARACTER_REV:
-        case RE_OP_PROPERTY:
-        case RE_OP_PROPERTY_IGN:
-        case RE_OP_PROPERTY_IGN_REV:
-        case RE_OP_PROPERTY_REV:
-            /* A character literal or a property. */
-            status = build_CHARACTER_or_PROPERTY(args);
-            if (status != RE_ERROR_SUCCESS)
-                return status;
-            break;
-        case RE_OP_END_OF_LINE:
-        case RE_OP_END_OF_LINE_U:
-        case RE_OP_END_OF_STRING:
-        case RE_OP_END_OF_STRING_LINE:
-        case RE_OP_END_OF_STRING_LINE_U:
-        case RE_OP_SEARCH_ANCHOR:
-        case RE_OP_START_OF_LINE:
-        case RE_OP_START_OF_LINE_U:
-        case RE_OP_START_OF_STRING:
-            /* A simple opcode with no trailing codewords and width of 0. */
-            status = build_zerowidth(args);
-            if (status != RE_ERROR_SUCCESS)
-                return status;
+            if (!record_subpattern_repeats_and_fuzzy_sections(parent_node,
+              offset, repeat_count, node->next_1.node))
+                return FALSE;
+            node = node->nonstring.next_2.node;
             break;
-        case RE_OP_FAILURE:
-        case RE_OP_PRUNE:
-        case RE_OP_SUCCESS:
-            status = build_SUCCESS(args);
-            if (status != RE_ERROR_SUCCESS)
-                return status;
+        case RE_OP_END_FUZZY:
+            node = node->next_1.node;
             break;
+        case RE_OP_END_GREEDY_REPEAT:
+        case RE_OP_END_LAZY_REPEAT:
+            return TRUE;
         case RE_OP_FUZZY:
-            /* A fuzzy sequence. */
-            status = build_FUZZY(args);
-            if (status != RE_ERROR_SUCCESS)
-                return status;
+            /* Record the fuzzy index. */
+            if (!add_index(parent_node, offset, repeat_count +
+              node->values[0]))
+                return FALSE;
+            node = node->next_1.node;
             break;
         case RE_OP_GREEDY_REPEAT:
         case RE_OP_LAZY_REPEAT:
-            /* A repeated sequence. */
-            status = build_REPEAT(args);
-            if (status != RE_ERROR_SUCCESS)
-                return status;
-            break;
-        case RE_OP_GROUP:
-            /* A capture group. */
-            status = build_GROUP(args);
-            if (status != RE_ERROR_SUCCESS)
-                return status;
+            /* Record the repeat index. */
+            if (!add_index(parent_node, offset, node->values[0]))
+                return FALSE;
+            if (!record_subpattern_repeats_and_fuzzy_sections(parent_node,
+              offset, repeat_count, node->next_1.node))
+                return FALSE;
+            node = node->nonstring.next_2.node;
             break;
-        case RE_OP_GROUP_CALL:
-            /* A group call. */
-            status = build_GROUP_CALL(args);
-            if (status != RE_ERROR_SUCCESS)
-                return status;
+        case RE_OP_GREEDY_REPEAT_ONE:
+        case RE_OP_LAZY_REPEAT_ONE:
+            /* Record the repeat index. */
+            if (!add_index(parent_node, offset, node->values[0]))
+                return FALSE;
+            node = node->next_1.node;
             break;
         case RE_OP_GROUP_EXISTS:
-            /* A conditional sequence. */
-            status = build_GROUP_EXISTS(args);
-            if (status != RE_ERROR_SUCCESS)
-                return status;
-            break;
-        case RE_OP_LOOKAROUND:
-            /* A lookaround. */
-            status = build_LOOKAROUND(args);
-            if (status != RE_ERROR_SUCCESS)
-                return status;
-            break;
-        case RE_OP_RANGE:
-        case RE_OP_RANGE_IGN:
-        case RE_OP_RANGE_IGN_REV:
-        case RE_OP_RANGE_REV:
-            /* A range. */
-            status = build_RANGE(args);
-            if (status != RE_ERROR_SUCCESS)
-                return status;
-            break;
-        case RE_OP_REF_GROUP:
-        case RE_OP_REF_GROUP_FLD:
-        case RE_OP_REF_GROUP_FLD_REV:
-        case RE_OP_REF_GROUP_IGN:
-        case RE_OP_REF_GROUP_IGN_REV:
-        case RE_OP_REF_GROUP_REV:
-            /* A reference to a group. */
-            status = build_REF_GROUP(args);
-            if (status != RE_ERROR_SUCCESS)
-                return status;
-            break;
-        case RE_OP_SET_DIFF:
-        case RE_OP_SET_DIFF_IGN:
-        case RE_OP_SET_DIFF_IGN_REV:
-        case RE_OP_SET_DIFF_REV:
-        case RE_OP_SET_INTER:
-        case RE_OP_SET_INTER_IGN:
-        case RE_OP_SET_INTER_IGN_REV:
-        case RE_OP_SET_INTER_REV:
-        case RE_OP_SET_SYM_DIFF:
-        case RE_OP_SET_SYM_DIFF_IGN:
-        case RE_OP_SET_SYM_DIFF_IGN_REV:
-        case RE_OP_SET_SYM_DIFF_REV:
-        case RE_OP_SET_UNION:
-        case RE_OP_SET_UNION_IGN:
-        case RE_OP_SET_UNION_IGN_REV:
-        case RE_OP_SET_UNION_REV:
-            /* A set. */
-            status = build_SET(args);
-            if (status != RE_ERROR_SUCCESS)
-                return status;
-            break;
-        case RE_OP_STRING:
-        case RE_OP_STRING_FLD:
-        case RE_OP_STRING_FLD_REV:
-        case RE_OP_STRING_IGN:
-        case RE_OP_STRING_IGN_REV:
-        case RE_OP_STRING_REV:
-            /* A string literal. */
-            if (!build_STRING(args, FALSE))
+            if (!record_subpattern_repeats_and_fuzzy_sections(parent_node,
+              offset, repeat_count, node->next_1.node))
                 return FALSE;
-            break;
-        case RE_OP_STRING_SET:
-        case RE_OP_STRING_SET_FLD:
-        case RE_OP_STRING_SET_FLD_REV:
-        case RE_OP_STRING_SET_IGN:
-        case RE_OP_STRING_SET_IGN_REV:
-        case RE_OP_STRING_SET_REV:
-            /* A reference to a list. */
-            status = build_STRING_SET(args);
-            if (status != RE_ERROR_SUCCESS)
-                return status;
+            node = node->nonstring.next_2.node;
             break;
         default:
-            /* We've found an opcode which we don't recognise. We'll leave it
-             * for the caller.
-             */
-            return RE_ERROR_SUCCESS;
+            node = node->next_1.node;
+            break;
         }
     }
 
-    /* If we're here then we should be at the end of the code, otherwise we
-     * have an error.
-     */
-    return args->code == args->end_code;
+    return TRUE;
 }
 
-/* Compiles the regular expression code to 'nodes'.
+/* Marks nodes which are being used as used. */
+Py_LOCAL_INLINE(void) use_nodes(RE_Node* node) {
+    while (node && !(node->status & RE_STATUS_USED)) {
+        node->status |= RE_STATUS_USED;
+        if (!(node->status & RE_STATUS_STRING)) {
+            if (node->nonstring.next_2.node)
+                use_nodes(node->nonstring.next_2.node);
+        }
+        node = node->next_1.node;
+    }
+}
+
+/* Discards any unused nodes.
  *
- * Various details about the regular expression are discovered during
- * compilation and stored in the PatternObject.
+ * Optimising the nodes might result in some nodes no longer being used.
  */
-Py_LOCAL_INLINE(BOOL) compile_to_nodes(RE_CODE* code, RE_CODE* end_code,
-  PatternObject* pattern) {
-    RE_CompileArgs args;
-    int status;
+Py_LOCAL_INLINE(void) discard_unused_nodes(PatternObject* pattern) {
+    size_t i;
+    size_t new_count;
+
+    /* Mark the nodes which are being used. */
+    use_nodes(pattern->start_node);
+
+    for (i = 0; i < pattern->call_ref_info_capacity; i++)
+        use_nodes(pattern->call_ref_info[i].node);
+
+    new_count = 0;
+    for (i = 0; i < pattern->node_count; i++) {
+        RE_Node* node;
+
+        node = pattern->node_list[i];
+        if (node->status & RE_STATUS_USED)
+            pattern->node_list[new_count++] = node;
+        else {
+            re_dealloc(node->values);
+            if (node->status & RE_STATUS_STRING) {
+                re_dealloc(node->string.bad_character_offset);
+                re_dealloc(node->string.good_suffix_offset);
+            }
+            re_dealloc(node);
+        }
+    }
+
+    pattern->node_count = new_count;
+}
+
+/* Marks all the group which are named. Returns FALSE if there's an error. */
+Py_LOCAL_INLINE(BOOL) mark_named_groups(PatternObject* pattern) {
+    size_t i;
+
+    for (i = 0; i < pattern->public_group_count; i++) {
+        RE_GroupInfo* group_info;
+        PyObject* index;
+        int status;
+
+        group_info = &pattern->group_info[i];
+        index = Py_BuildValue("n", i + 1);
+        if (!index)
+            return FALSE;
+
+        status = PyDict_Contains(pattern->indexgroup, index);
+        Py_DECREF(index);
+        if (status < 0)
+            return FALSE;
+
+        group_info->has_name = status == 1;
+    }
+
+    return TRUE;
+}
+
+/* Gets the test node.
+ *
+ * The test node lets the matcher look ahead in the pattern, allowing it to
+ * avoid the cost of housekeeping, only to find that what follows doesn't match
+ * anyway.
+ */
+Py_LOCAL_INLINE(void) set_test_node(RE_NextNode* next) {
+    RE_Node* node = next->node;
+    RE_Node* test;
+
+    next->test = node;
+    next->match_next = node;
+    next->match_step = 0;
+
+    if (!node)
+        return;
+
+    test = node;
+    while (test->op == RE_OP_END_GROUP || test->op == RE_OP_START_GROUP)
+        test = test->next_1.node;
+
+    next->test = test;
+
+    if (test != node)
+        return;
+
+    switch (test->op) {
+    case RE_OP_ANY:
+    case RE_OP_ANY_ALL:
+    case RE_OP_ANY_ALL_REV:
+    case RE_OP_ANY_REV:
+    case RE_OP_ANY_U:
+    case RE_OP_ANY_U_REV:
+    case RE_OP_BOUNDARY:
+    case RE_OP_CHARACTER:
+    case RE_OP_CHARACTER_IGN:
+    case RE_OP_CHARACTER_IGN_REV:
+    case RE_OP_CHARACTER_REV:
+    case RE_OP_DEFAULT_BOUNDARY:
+    case RE_OP_DEFAULT_END_OF_WORD:
+    case RE_OP_DEFAULT_START_OF_WORD:
+    case RE_OP_END_OF_LINE:
+    case RE_OP_END_OF_LINE_U:
+    case RE_OP_END_OF_STRING:
+    case RE_OP_END_OF_STRING_LINE:
+    case RE_OP_END_OF_STRING_LINE_U:
+    case RE_OP_END_OF_WORD:
+    case RE_OP_GRAPHEME_BOUNDARY:
+    case RE_OP_PROPERTY:
+    case RE_OP_PROPERTY_IGN:
+    case RE_OP_PROPERTY_IGN_REV:
+    case RE_OP_PROPERTY_REV:
+    case RE_OP_RANGE:
+    case RE_OP_RANGE_IGN:
+    case RE_OP_RANGE_IGN_REV:
+    case RE_OP_RANGE_REV:
+    case RE_OP_SEARCH_ANCHOR:
+    case RE_OP_SET_DIFF:
+    case RE_OP_SET_DIFF_IGN:
+    case RE_OP_SET_DIFF_IGN_REV:
+    case RE_OP_SET_DIFF_REV:
+    case RE_OP_SET_INTER:
+    case RE_OP_SET_INTER_IGN:
+    case RE_OP_SET_INTER_IGN_REV:
+    case RE_OP_SET_INTER_REV:
+    case RE_OP_SET_SYM_DIFF:
+    case RE_OP_SET_SYM_DIFF_IGN:
+    case RE_OP_SET_SYM_DIFF_IGN_REV:
+    case RE_OP_SET_SYM_DIFF_REV:
+    case RE_OP_SET_UNION:
+    case RE_OP_SET_UNION_IGN:
+    case RE_OP_SET_UNION_IGN_REV:
+    case RE_OP_SET_UNION_REV:
+    case RE_OP_START_OF_LINE:
+    case RE_OP_START_OF_LINE_U:
+    case RE_OP_START_OF_STRING:
+    case RE_OP_START_OF_WORD:
+    case RE_OP_STRING:
+    case RE_OP_STRING_FLD:
+    case RE_OP_STRING_FLD_REV:
+    case RE_OP_STRING_IGN:
+    case RE_OP_STRING_IGN_REV:
+    case RE_OP_STRING_REV:
+        next->match_next = test->next_1.node;
+        next->match_step = test->step;
+        break;
+    case RE_OP_GREEDY_REPEAT_ONE:
+    case RE_OP_LAZY_REPEAT_ONE:
+        if (test->values[1] > 0)
+            next->test = test;
+        break;
+    }
+}
+
+/* Sets the test nodes. */
+Py_LOCAL_INLINE(void) set_test_nodes(PatternObject* pattern) {
+    RE_Node** node_list;
+    size_t i;
+
+    node_list = pattern->node_list;
+    for (i = 0; i < pattern->node_count; i++) {
+        RE_Node* node;
+
+        node = node_list[i];
+        set_test_node(&node->next_1);
+        if (!(node->status & RE_STATUS_STRING))
+            set_test_node(&node->nonstring.next_2);
+    }
+}
+
+/* Optimises the pattern. */
+Py_LOCAL_INLINE(BOOL) optimise_pattern(PatternObject* pattern) {
+    size_t i;
+
+    /* Building the nodes is made simpler by allowing branches to have a single
+     * exit. These need to be removed.
+     */
+    skip_one_way_branches(pattern);
+
+    /* Add position guards for repeat bodies containing a reference to a group
+     * or repeat tails followed at some point by a reference to a group.
+     */
+    add_repeat_guards(pattern, pattern->start_node);
+
+    /* Record the index of repeats and fuzzy sections within the body of atomic
+     * and lookaround nodes.
+     */
+    if (!record_subpattern_repeats_and_fuzzy_sections(NULL, 0,
+      pattern->repeat_count, pattern->start_node))
+        return FALSE;
+
+    for (i = 0; i < pattern->call_ref_info_count; i++) {
+        RE_Node* node;
+
+        node = pattern->call_ref_info[i].node;
+        if (!record_subpattern_repeats_and_fuzzy_sections(NULL, 0,
+          pattern->repeat_count, node))
+            return FALSE;
+    }
+
+    /* Discard any unused nodes. */
+    discard_unused_nodes(pattern);
+
+    /* Set the test nodes. */
+    set_test_nodes(pattern);
+
+    /* Mark all the group that are named. */
+    if (!mark_named_groups(pattern))
+        return FALSE;
+
+    return TRUE;
+}
+
+/* Creates a new pattern node. */
+Py_LOCAL_INLINE(RE_Node*) create_node(PatternObject* pattern, RE_UINT8 op,
+  RE_CODE flags, Py_ssize_t step, size_t value_count) {
+    RE_Node* node;
+
+    node = (RE_Node*)re_alloc(sizeof(*node));
+    if (!node)
+        return NULL;
+    memset(node, 0, sizeof(RE_Node));
+
+    node->value_count = value_count;
+    if (node->value_count > 0) {
+        node->values = (RE_CODE*)re_alloc(node->value_count * sizeof(RE_CODE));
+        if (!node->values)
+            goto error;
+    } else
+        node->values = NULL;
+
+    node->op = op;
+    node->match = (flags & RE_POSITIVE_OP) != 0;
+    node->status = (RE_STATUS_T)(flags << RE_STATUS_SHIFT);
+    node->step = step;
+
+    /* Ensure that there's enough storage to record the new node. */
+    if (pattern->node_count >= pattern->node_capacity) {
+        RE_Node** new_node_list;
+
+        pattern->node_capacity *= 2;
+        if (pattern->node_capacity == 0)
+            pattern->node_capacity = RE_INIT_NODE_LIST_SIZE;
+        new_node_list = (RE_Node**)re_realloc(pattern->node_list,
+          pattern->node_capacity * sizeof(RE_Node*));
+        if (!new_node_list)
+            goto error;
+        pattern->node_list = new_node_list;
+    }
+
+    /* Record the new node. */
+    pattern->node_list[pattern->node_count++] = node;
+
+    return node;
+
+error:
+    re_dealloc(node->values);
+    re_dealloc(node);
+    return NULL;
+}
+
+/* Adds a node as a next node for another node. */
+Py_LOCAL_INLINE(void) add_node(RE_Node* node_1, RE_Node* node_2) {
+    if (!node_1->next_1.node)
+        node_1->next_1.node = node_2;
+    else
+        node_1->nonstring.next_2.node = node_2;
+}
+
+/* Ensures that the entry for a group's details actually exists. */
+Py_LOCAL_INLINE(BOOL) ensure_group(PatternObject* pattern, size_t group) {
+    size_t old_capacity;
+    size_t new_capacity;
+    RE_GroupInfo* new_group_info;
+
+    if (group <= pattern->true_group_count)
+        /* We already have an entry for the group. */
+        return TRUE;
+
+    /* Increase the storage capacity to include the new entry if it's
+     * insufficient.
+     */
+    old_capacity = pattern->group_info_capacity;
+    new_capacity = pattern->group_info_capacity;
+    while (group > new_capacity)
+        new_capacity += RE_LIST_SIZE_INC;
+
+    if (new_capacity > old_capacity) {
+        new_group_info = (RE_GroupInfo*)re_realloc(pattern->group_info,
+          new_capacity * sizeof(RE_GroupInfo));
+        if (!new_group_info)
+            return FALSE;
+        memset(new_group_info + old_capacity, 0, (new_capacity - old_capacity)
+          * sizeof(RE_GroupInfo));
+
+        pattern->group_info = new_group_info;
+        pattern->group_info_capacity = new_capacity;
+    }
+
+    pattern->true_group_count = group;
+
+    return TRUE;
+}
+
+/* Records that there's a reference to a group. */
+Py_LOCAL_INLINE(BOOL) record_ref_group(PatternObject* pattern, size_t group) {
+    if (!ensure_group(pattern, group))
+        return FALSE;
+
+    pattern->group_info[group - 1].referenced = TRUE;
+
+    return TRUE;
+}
+
+/* Records that there's a new group. */
+Py_LOCAL_INLINE(BOOL) record_group(PatternObject* pattern, size_t group,
+  RE_Node* node) {
+    if (!ensure_group(pattern, group))
+        return FALSE;
+
+    if (group >= 1) {
+        RE_GroupInfo* info;
+
+        info = &pattern->group_info[group - 1];
+        info->end_index = (Py_ssize_t)pattern->true_group_count;
+        info->node = node;
+    }
+
+    return TRUE;
+}
+
+/* Records that a group has closed. */
+Py_LOCAL_INLINE(void) record_group_end(PatternObject* pattern, size_t group) {
+    if (group >= 1)
+        pattern->group_info[group - 1].end_index = ++pattern->group_end_index;
+}
+
+/* Ensures that the entry for a call_ref's details actually exists. */
+Py_LOCAL_INLINE(BOOL) ensure_call_ref(PatternObject* pattern, size_t call_ref)
+  {
+    size_t old_capacity;
+    size_t new_capacity;
+    RE_CallRefInfo* new_call_ref_info;
+
+    if (call_ref < pattern->call_ref_info_count)
+        /* We already have an entry for the call_ref. */
+        return TRUE;
+
+    /* Increase the storage capacity to include the new entry if it's
+     * insufficient.
+     */
+    old_capacity = pattern->call_ref_info_capacity;
+    new_capacity = pattern->call_ref_info_capacity;
+    while (call_ref >= new_capacity)
+        new_capacity += RE_LIST_SIZE_INC;
+
+    if (new_capacity > old_capacity) {
+        new_call_ref_info = (RE_CallRefInfo*)re_realloc(pattern->call_ref_info,
+          new_capacity * sizeof(RE_CallRefInfo));
+        if (!new_call_ref_info)
+            return FALSE;
+        memset(new_call_ref_info + old_capacity, 0, (new_capacity -
+          old_capacity) * sizeof(RE_CallRefInfo));
+
+        pattern->call_ref_info = new_call_ref_info;
+        pattern->call_ref_info_capacity = new_capacity;
+    }
+
+    pattern->call_ref_info_count = 1 + call_ref;
+
+    return TRUE;
+}
+
+/* Records that a call_ref is defined. */
+Py_LOCAL_INLINE(BOOL) record_call_ref_defined(PatternObject* pattern, size_t
+  call_ref, RE_Node* node) {
+    if (!ensure_call_ref(pattern, call_ref))
+        return FALSE;
+
+    pattern->call_ref_info[call_ref].defined = TRUE;
+    pattern->call_ref_info[call_ref].node = node;
+
+    return TRUE;
+}
+
+/* Records that a call_ref is used. */
+Py_LOCAL_INLINE(BOOL) record_call_ref_used(PatternObject* pattern, size_t
+  call_ref) {
+    if (!ensure_call_ref(pattern, call_ref))
+        return FALSE;
+
+    pattern->call_ref_info[call_ref].used = TRUE;
+
+    return TRUE;
+}
+
+/* Checks whether a node matches one and only one character. */
+Py_LOCAL_INLINE(BOOL) sequence_matches_one(RE_Node* node) {
+    while (node->op == RE_OP_BRANCH && !node->nonstring.next_2.node)
+        node = node->next_1.node;
+
+    if (node->next_1.node || (node->status & RE_STATUS_FUZZY))
+        return FALSE;
+
+    return node_matches_one_character(node);
+}
+
+/* Records a repeat. */
+Py_LOCAL_INLINE(BOOL) record_repeat(PatternObject* pattern, size_t index,
+  size_t repeat_depth) {
+    size_t old_capacity;
+    size_t new_capacity;
+
+    /* Increase the storage capacity to include the new entry if it's
+     * insufficient.
+     */
+    old_capacity = pattern->repeat_info_capacity;
+    new_capacity = pattern->repeat_info_capacity;
+    while (index >= new_capacity)
+        new_capacity += RE_LIST_SIZE_INC;
+
+    if (new_capacity > old_capacity) {
+        RE_RepeatInfo* new_repeat_info;
+
+        new_repeat_info = (RE_RepeatInfo*)re_realloc(pattern->repeat_info,
+          new_capacity * sizeof(RE_RepeatInfo));
+        if (!new_repeat_info)
+            return FALSE;
+        memset(new_repeat_info + old_capacity, 0, (new_capacity - old_capacity)
+          * sizeof(RE_RepeatInfo));
+
+        pattern->repeat_info = new_repeat_info;
+        pattern->repeat_info_capacity = new_capacity;
+    }
+
+    if (index >= pattern->repeat_count)
+        pattern->repeat_count = index + 1;
+
+    if (repeat_depth > 0)
+        pattern->repeat_info[index].status |= RE_STATUS_INNER;
+
+    return TRUE;
+}
+
+Py_LOCAL_INLINE(Py_ssize_t) get_step(RE_CODE op) {
+    switch (op) {
+    case RE_OP_ANY:
+    case RE_OP_ANY_ALL:
+    case RE_OP_ANY_U:
+    case RE_OP_CHARACTER:
+    case RE_OP_CHARACTER_IGN:
+    case RE_OP_PROPERTY:
+    case RE_OP_PROPERTY_IGN:
+    case RE_OP_RANGE:
+    case RE_OP_RANGE_IGN:
+    case RE_OP_SET_DIFF:
+    case RE_OP_SET_DIFF_IGN:
+    case RE_OP_SET_INTER:
+    case RE_OP_SET_INTER_IGN:
+    case RE_OP_SET_SYM_DIFF:
+    case RE_OP_SET_SYM_DIFF_IGN:
+    case RE_OP_SET_UNION:
+    case RE_OP_SET_UNION_IGN:
+    case RE_OP_STRING:
+    case RE_OP_STRING_FLD:
+    case RE_OP_STRING_IGN:
+        return 1;
+    case RE_OP_ANY_ALL_REV:
+    case RE_OP_ANY_REV:
+    case RE_OP_ANY_U_REV:
+    case RE_OP_CHARACTER_IGN_REV:
+    case RE_OP_CHARACTER_REV:
+    case RE_OP_PROPERTY_IGN_REV:
+    case RE_OP_PROPERTY_REV:
+    case RE_OP_RANGE_IGN_REV:
+    case RE_OP_RANGE_REV:
+    case RE_OP_SET_DIFF_IGN_REV:
+    case RE_OP_SET_DIFF_REV:
+    case RE_OP_SET_INTER_IGN_REV:
+    case RE_OP_SET_INTER_REV:
+    case RE_OP_SET_SYM_DIFF_IGN_REV:
+    case RE_OP_SET_SYM_DIFF_REV:
+    case RE_OP_SET_UNION_IGN_REV:
+    case RE_OP_SET_UNION_REV:
+    case RE_OP_STRING_FLD_REV:
+    case RE_OP_STRING_IGN_REV:
+    case RE_OP_STRING_REV:
+        return -1;
+    }
+
+    return 0;
+}
+
+Py_LOCAL_INLINE(int) build_sequence(RE_CompileArgs* args);
+
+/* Builds an ANY node. */
+Py_LOCAL_INLINE(int) build_ANY(RE_CompileArgs* args) {
+    RE_UINT8 op;
+    RE_CODE flags;
+    Py_ssize_t step;
+    RE_Node* node;
+
+    /* codes: opcode, flags. */
+    if (args->code + 1 > args->end_code)
+        return RE_ERROR_ILLEGAL;
+
+    op = (RE_UINT8)args->code[0];
+    flags = args->code[1];
+
+    step = get_step(op);
+
+    /* Create the node. */
+    node = create_node(args->pattern, op, flags, step, 0);
+    if (!node)
+        return RE_ERROR_MEMORY;
+
+    args->code += 2;
+
+    /* Append the node. */
+    add_node(args->end, node);
+    args->end = node;
+
+    ++args->min_width;
+
+    return RE_ERROR_SUCCESS;
+}
+
+/* Builds a FUZZY node. */
+Py_LOCAL_INLINE(int) build_FUZZY(RE_CompileArgs* args) {
+    RE_CODE flags;
+    RE_Node* start_node;
+    RE_Node* end_node;
+    RE_CODE index;
+    RE_CompileArgs subargs;
+    int status;
+
+    /* codes: opcode, flags, constraints, sequence, end. */
+    if (args->code + 13 > args->end_code)
+        return RE_ERROR_ILLEGAL;
+
+    flags = args->code[1];
+
+    /* Create nodes for the start and end of the fuzzy sequence. */
+    start_node = create_node(args->pattern, RE_OP_FUZZY, flags, 0, 9);
+    end_node = create_node(args->pattern, RE_OP_END_FUZZY, flags, 0, 5);
+    if (!start_node || !end_node)
+        return RE_ERROR_MEMORY;
+
+    index = (RE_CODE)args->pattern->fuzzy_count++;
+    start_node->values[0] = index;
+    end_node->values[0] = index;
+
+    /* The constraints consist of 4 pairs of limits and the cost equation. */
+    end_node->values[RE_FUZZY_VAL_MIN_DEL] = args->code[2]; /* Deletion minimum. */
+    end_node->values[RE_FUZZY_VAL_MIN_INS] = args->code[4]; /* Insertion minimum. */
+    end_node->values[RE_FUZZY_VAL_MIN_SUB] = args->code[6]; /* Substitution minimum. */
+    end_node->values[RE_FUZZY_VAL_MIN_ERR] = args->code[8]; /* Error minimum. */
+
+    start_node->values[RE_FUZZY_VAL_MAX_DEL] = args->code[3]; /* Deletion maximum. */
+    start_node->values[RE_FUZZY_VAL_MAX_INS] = args->code[5]; /* Insertion maximum. */
+    start_node->values[RE_FUZZY_VAL_MAX_SUB] = args->code[7]; /* Substitution maximum. */
+    start_node->values[RE_FUZZY_VAL_MAX_ERR] = args->code[9]; /* Error maximum. */
+
+    start_node->values[RE_FUZZY_VAL_DEL_COST] = args->code[10]; /* Deletion cost. */
+    start_node->values[RE_FUZZY_VAL_INS_COST] = args->code[11]; /* Insertion cost. */
+    start_node->values[RE_FUZZY_VAL_SUB_COST] = args->code[12]; /* Substitution cost. */
+    start_node->values[RE_FUZZY_VAL_MAX_COST] = args->code[13]; /* Total cost. */
+
+    args->code += 14;
+
+    subargs = *args;
+    subargs.has_captures = FALSE;
+    subargs.is_fuzzy = TRUE;
+    subargs.within_fuzzy = TRUE;
+
+    /* Compile the sequence and check that we've reached the end of the
+     * subpattern.
+     */
+    status = build_sequence(&subargs);
+    if (status != RE_ERROR_SUCCESS)
+        return status;
+
+    if (subargs.code[0] != RE_OP_END)
+        return RE_ERROR_ILLEGAL;
+
+    args->code = subargs.code;
+    args->min_width = subargs.min_width;
+    args->has_captures |= subargs.has_captures;
+
+    ++args->code;
+
+    /* Append the fuzzy sequence. */
+    add_node(args->end, start_node);
+    add_node(start_node, subargs.start);
+    add_node(subargs.end, end_node);
+    args->end = end_node;
+
+    args->is_fuzzy = TRUE;
+
+    return RE_ERROR_SUCCESS;
+}
+
+/* Builds an ATOMIC node. */
+Py_LOCAL_INLINE(int) build_ATOMIC(RE_CompileArgs* args) {
+    RE_Node* atomic_node;
+    RE_CompileArgs subargs;
+    int status;
+    RE_Node* end_node;
+
+    /* codes: opcode, sequence, end. */
+    if (args->code + 1 > args->end_code)
+        return RE_ERROR_ILLEGAL;
+
+    atomic_node = create_node(args->pattern, RE_OP_ATOMIC, 0, 0, 0);
+    if (!atomic_node)
+        return RE_ERROR_MEMORY;
+
+    ++args->code;
+
+    /* Compile the sequence and check that we've reached the end of it. */
+    subargs = *args;
+    subargs.min_width = 0;
+    status = build_sequence(&subargs);
+    if (status != RE_ERROR_SUCCESS)
+        return status;
+
+    if (subargs.code[0] != RE_OP_END)
+        return RE_ERROR_ILLEGAL;
+
+    args->code = subargs.code;
+    ++args->code;
+
+    /* Check the subpattern. */
+    args->min_width += subargs.min_width;
+    args->has_captures |= subargs.has_captures;
+    args->is_fuzzy |= subargs.is_fuzzy;
+
+    /* Create the node to terminate the subpattern. */
+    end_node = create_node(subargs.pattern, RE_OP_END_ATOMIC, 0, 0, 0);
+    if (!end_node)
+        return RE_ERROR_MEMORY;
+
+    /* Append the new sequence. */
+    add_node(args->end, atomic_node);
+    add_node(atomic_node, subargs.start);
+    add_node(subargs.end, end_node);
+    args->end = end_node;
+
+    return RE_ERROR_SUCCESS;
+}
+
+/* Builds a BOUNDARY node. */
+Py_LOCAL_INLINE(int) build_BOUNDARY(RE_CompileArgs* args) {
+    RE_UINT8 op;
+    RE_CODE flags;
+    RE_Node* node;
+
+    /* codes: opcode, flags. */
+    if (args->code + 1 > args->end_code)
+        return RE_ERROR_ILLEGAL;
+
+    op = (RE_UINT8)args->code[0];
+    flags = args->code[1];
+
+    args->code += 2;
+
+    /* Create the node. */
+    node = create_node(args->pattern, op, flags, 0, 0);
+    if (!node)
+        return RE_ERROR_MEMORY;
+
+    /* Append the node. */
+    add_node(args->end, node);
+    args->end = node;
+
+    return RE_ERROR_SUCCESS;
+}
+
+/* Builds a BRANCH node. */
+Py_LOCAL_INLINE(int) build_BRANCH(RE_CompileArgs* args) {
+    RE_Node* branch_node;
+    RE_Node* join_node;
+    Py_ssize_t smallest_min_width;
+    RE_CompileArgs subargs;
+    int status;
+
+    /* codes: opcode, branch, next, branch, end. */
+    if (args->code + 2 > args->end_code)
+        return RE_ERROR_ILLEGAL;
+
+    /* Create nodes for the start and end of the branch sequence. */
+    branch_node = create_node(args->pattern, RE_OP_BRANCH, 0, 0, 0);
+    join_node = create_node(args->pattern, RE_OP_BRANCH, 0, 0, 0);
+    if (!branch_node || !join_node)
+        return RE_ERROR_MEMORY;
+
+    /* Append the node. */
+    add_node(args->end, branch_node);
+    args->end = join_node;
+
+    smallest_min_width = PY_SSIZE_T_MAX;
+
+    subargs = *args;
+
+    /* A branch in the regular expression is compiled into a series of 2-way
+     * branches.
+     */
+    do {
+        RE_Node* next_branch_node;
+
+        /* Skip over the 'BRANCH' or 'NEXT' opcode. */
+        ++subargs.code;
+
+        /* Compile the sequence until the next 'BRANCH' or 'NEXT' opcode. */
+        subargs.min_width = 0;
+        subargs.has_captures = FALSE;
+        subargs.is_fuzzy = FALSE;
+        status = build_sequence(&subargs);
+        if (status != RE_ERROR_SUCCESS)
+            return status;
+
+        smallest_min_width = min_ssize_t(smallest_min_width,
+          subargs.min_width);
+
+        args->has_captures |= subargs.has_captures;
+        args->is_fuzzy |= subargs.is_fuzzy;
+
+        /* Append the sequence. */
+        add_node(branch_node, subargs.start);
+        add_node(subargs.end, join_node);
+
+        /* Create a start node for the next sequence and append it. */
+        next_branch_node = create_node(subargs.pattern, RE_OP_BRANCH, 0, 0, 0);
+        if (!next_branch_node)
+            return RE_ERROR_MEMORY;
+
+        add_node(branch_node, next_branch_node);
+        branch_node = next_branch_node;
+    } while (subargs.code < subargs.end_code && subargs.code[0] == RE_OP_NEXT);
+
+    /* We should have reached the end of the branch. */
+    if (subargs.code[0] != RE_OP_END)
+        return RE_ERROR_ILLEGAL;
+
+    args->code = subargs.code;
+
+    ++args->code;
+    args->min_width += smallest_min_width;
+
+    return RE_ERROR_SUCCESS;
+}
+
+/* Builds a CALL_REF node. */
+Py_LOCAL_INLINE(int) build_CALL_REF(RE_CompileArgs* args) {
+    RE_CODE call_ref;
+    RE_Node* start_node;
+    RE_Node* end_node;
+    RE_CompileArgs subargs;
+    int status;
+
+    /* codes: opcode, call_ref. */
+    if (args->code + 1 > args->end_code)
+        return RE_ERROR_ILLEGAL;
+
+    call_ref = args->code[1];
+
+    args->code += 2;
+
+    /* Create nodes for the start and end of the subpattern. */
+    start_node = create_node(args->pattern, RE_OP_CALL_REF, 0, 0, 1);
+    end_node = create_node(args->pattern, RE_OP_GROUP_RETURN, 0, 0, 0);
+    if (!start_node || !end_node)
+        return RE_ERROR_MEMORY;
+
+    start_node->values[0] = call_ref;
+
+    /* Compile the sequence and check that we've reached the end of the
+     * subpattern.
+     */
+    subargs = *args;
+    subargs.has_captures = FALSE;
+    subargs.is_fuzzy = FALSE;
+    status = build_sequence(&subargs);
+    if (status != RE_ERROR_SUCCESS)
+        return status;
+
+    if (subargs.code[0] != RE_OP_END)
+        return RE_ERROR_ILLEGAL;
+
+    args->code = subargs.code;
+    args->min_width = subargs.min_width;
+    args->has_captures |= subargs.has_captures;
+    args->is_fuzzy |= subargs.is_fuzzy;
+
+    ++args->code;
+
+    /* Record that we defined a call_ref. */
+    if (!record_call_ref_defined(args->pattern, call_ref, start_node))
+        return RE_ERROR_MEMORY;
+
+    /* Append the node. */
+    add_node(args->end, start_node);
+    add_node(start_node, subargs.start);
+    add_node(subargs.end, end_node);
+    args->end = end_node;
+
+    return RE_ERROR_SUCCESS;
+}
+
+/* Builds a CHARACTER or PROPERTY node. */
+Py_LOCAL_INLINE(int) build_CHARACTER_or_PROPERTY(RE_CompileArgs* args) {
+    RE_UINT8 op;
+    RE_CODE flags;
+    Py_ssize_t step;
+    RE_Node* node;
+
+    /* codes: opcode, flags, value. */
+    if (args->code + 2 > args->end_code)
+        return RE_ERROR_ILLEGAL;
+
+    op = (RE_UINT8)args->code[0];
+    flags = args->code[1];
+
+    step = get_step(op);
+
+    if (flags & RE_ZEROWIDTH_OP)
+        step = 0;
+
+    /* Create the node. */
+    node = create_node(args->pattern, op, flags, step, 1);
+    if (!node)
+        return RE_ERROR_MEMORY;
+
+    node->values[0] = args->code[2];
+
+    args->code += 3;
+
+    /* Append the node. */
+    add_node(args->end, node);
+    args->end = node;
+
+    if (step != 0)
+        ++args->min_width;
+
+    return RE_ERROR_SUCCESS;
+}
+
+/* Builds a GROUP node. */
+Py_LOCAL_INLINE(int) build_GROUP(RE_CompileArgs* args) {
+    RE_CODE private_group;
+    RE_CODE public_group;
+    RE_Node* start_node;
+    RE_Node* end_node;
+    RE_CompileArgs subargs;
+    int status;
+
+    /* codes: opcode, private_group, public_group. */
+    if (args->code + 2 > args->end_code)
+        return RE_ERROR_ILLEGAL;
+
+    private_group = args->code[1];
+    public_group = args->code[2];
+
+    args->code += 3;
+
+    /* Create nodes for the start and end of the capture group. */
+    start_node = create_node(args->pattern, args->forward ? RE_OP_START_GROUP :
+      RE_OP_END_GROUP, 0, 0, 3);
+    end_node = create_node(args->pattern, args->forward ? RE_OP_END_GROUP :
+      RE_OP_START_GROUP, 0, 0, 3);
+    if (!start_node || !end_node)
+        return RE_ERROR_MEMORY;
+
+    start_node->values[0] = private_group;
+    end_node->values[0] = private_group;
+    start_node->values[1] = public_group;
+    end_node->values[1] = public_group;
+
+    /* Signal that the capture should be saved when it's complete. */
+    start_node->values[2] = 0;
+    end_node->values[2] = 1;
+
+    /* Record that we have a new capture group. */
+    if (!record_group(args->pattern, private_group, start_node))
+        return RE_ERROR_MEMORY;
+
+    /* Compile the sequence and check that we've reached the end of the capture
+     * group.
+     */
+    subargs = *args;
+    subargs.has_captures = FALSE;
+    subargs.is_fuzzy = FALSE;
+    status = build_sequence(&subargs);
+    if (status != RE_ERROR_SUCCESS)
+        return status;
+
+    if (subargs.code[0] != RE_OP_END)
+        return RE_ERROR_ILLEGAL;
+
+    args->code = subargs.code;
+    args->min_width = subargs.min_width;
+    if (subargs.has_captures || subargs.visible_captures)
+        args->has_captures = TRUE;
+    args->is_fuzzy |= subargs.is_fuzzy;
+
+    ++args->code;
+
+    /* Record that the capture group has closed. */
+    record_group_end(args->pattern, private_group);
+
+    /* Append the capture group. */
+    add_node(args->end, start_node);
+    add_node(start_node, subargs.start);
+    add_node(subargs.end, end_node);
+    args->end = end_node;
+
+    return RE_ERROR_SUCCESS;
+}
+
+/* Builds a GROUP_CALL node. */
+Py_LOCAL_INLINE(int) build_GROUP_CALL(RE_CompileArgs* args) {
+    RE_CODE call_ref;
+    RE_Node* node;
+
+    /* codes: opcode, call_ref. */
+    if (args->code + 1 > args->end_code)
+        return RE_ERROR_ILLEGAL;
+
+    call_ref = args->code[1];
+
+    /* Create the node. */
+    node = create_node(args->pattern, RE_OP_GROUP_CALL, 0, 0, 1);
+    if (!node)
+        return RE_ERROR_MEMORY;
+
+    node->values[0] = call_ref;
+
+    args->code += 2;
+
+    /* Record that we used a call_ref. */
+    if (!record_call_ref_used(args->pattern, call_ref))
+        return RE_ERROR_MEMORY;
+
+    /* Append the node. */
+    add_node(args->end, node);
+    args->end = node;
+
+    return RE_ERROR_SUCCESS;
+}
+
+/* Builds a GROUP_EXISTS node. */
+Py_LOCAL_INLINE(int) build_GROUP_EXISTS(RE_CompileArgs* args) {
+    RE_CODE group;
+    RE_Node* start_node;
+    RE_Node* end_node;
+    RE_CompileArgs subargs;
+    int status;
+    Py_ssize_t min_width;
+
+    /* codes: opcode, sequence, next, sequence, end. */
+    if (args->code + 2 > args->end_code)
+        return RE_ERROR_ILLEGAL;
+
+    group = args->code[1];
+
+    args->code += 2;
+
+    /* Record that we have a reference to a group. If group is 0, then we have
+     * a DEFINE and not a true group.
+     */
+    if (group > 0 && !record_ref_group(args->pattern, group))
+        return RE_ERROR_MEMORY;
+
+    /* Create nodes for the start and end of the structure. */
+    start_node = create_node(args->pattern, RE_OP_GROUP_EXISTS, 0, 0, 1);
+    end_node = create_node(args->pattern, RE_OP_BRANCH, 0, 0, 0);
+    if (!start_node || !end_node)
+        return RE_ERROR_MEMORY;
+
+    start_node->values[0] = group;
+
+    subargs = *args;
+    subargs.min_width = 0;
+    subargs.has_captures = FALSE;
+    subargs.is_fuzzy = FALSE;
+    status = build_sequence(&subargs);
+    if (status != RE_ERROR_SUCCESS)
+        return status;
+
+    args->code = subargs.code;
+    args->has_captures |= subargs.has_captures;
+    args->is_fuzzy |= subargs.is_fuzzy;
+
+    min_width = subargs.min_width;
+
+    /* Append the start node. */
+    add_node(args->end, start_node);
+    add_node(start_node, subargs.start);
+
+    if (args->code[0] == RE_OP_NEXT) {
+        RE_Node* true_branch_end;
+
+        ++args->code;
+
+        true_branch_end = subargs.end;
+
+        subargs.code = args->code;
+        subargs.min_width = 0;
+        subargs.has_captures = FALSE;
+        subargs.is_fuzzy = FALSE;
+        status = build_sequence(&subargs);
+        if (status != RE_ERROR_SUCCESS)
+            return status;
+
+        args->code = subargs.code;
+        args->has_captures |= subargs.has_captures;
+        args->is_fuzzy |= subargs.is_fuzzy;
+
+        if (group == 0) {
+            /* Join the 2 branches end-to-end and bypass it. The sequence
+             * itself will never be matched as a whole, so it doesn't matter.
+             */
+            min_width = 0;
+
+            add_node(start_node, end_node);
+            add_node(true_branch_end, subargs.start);
+        } else {
+            min_width = min_ssize_t(min_width, subargs.min_width);
+
+            add_node(start_node, subargs.start);
+            add_node(true_branch_end, end_node);
+        }
+
+        add_node(subargs.end, end_node);
+    } else {
+        add_node(start_node, end_node);
+        add_node(subargs.end, end_node);
+
+        min_width = 0;
+    }
+
+    args->min_width += min_width;
+
+    if (args->code[0] != RE_OP_END)
+        return RE_ERROR_ILLEGAL;
+
+    ++args->code;
+
+    args->end = end_node;
+
+    return RE_ERROR_SUCCESS;
+}
+
+/* Builds a LOOKAROUND node. */
+Py_LOCAL_INLINE(int) build_LOOKAROUND(RE_CompileArgs* args) {
+    RE_CODE flags;
+    BOOL forward;
+    RE_Node* lookaround_node;
+    RE_CompileArgs subargs;
+    int status;
+    RE_Node* end_node;
+    RE_Node* next_node;
+
+    /* codes: opcode, flags, forward, sequence, end. */
+    if (args->code + 3 > args->end_code)
+        return RE_ERROR_ILLEGAL;
+
+    flags = args->code[1];
+    forward = (BOOL)args->code[2];
+
+    /* Create a node for the lookaround. */
+    lookaround_node = create_node(args->pattern, RE_OP_LOOKAROUND, flags, 0,
+      0);
+    if (!lookaround_node)
+        return RE_ERROR_MEMORY;
+
+    args->code += 3;
+
+    /* Compile the sequence and check that we've reached the end of the
+     * subpattern.
+     */
+    subargs = *args;
+    subargs.forward = forward;
+    status = build_sequence(&subargs);
+    if (status != RE_ERROR_SUCCESS)
+        return status;
+
+    if (subargs.code[0] != RE_OP_END)
+        return RE_ERROR_ILLEGAL;
+
+    args->code = subargs.code;
+    ++args->code;
+
+    /* Check the subpattern. */
+    args->has_captures |= subargs.has_captures;
+    args->is_fuzzy |= subargs.is_fuzzy;
+
+    /* Create the node to terminate the subpattern. */
+    end_node = create_node(args->pattern, RE_OP_END_LOOKAROUND, 0, 0, 0);
+    if (!end_node)
+        return RE_ERROR_MEMORY;
+
+    /* Make a continuation node. */
+    next_node = create_node(args->pattern, RE_OP_BRANCH, 0, 0, 0);
+    if (!next_node)
+        return RE_ERROR_MEMORY;
+
+    /* Append the new sequence. */
+    add_node(args->end, lookaround_node);
+    add_node(lookaround_node, subargs.start);
+    add_node(lookaround_node, next_node);
+    add_node(subargs.end, end_node);
+    add_node(end_node, next_node);
+
+    args->end = next_node;
+
+    return RE_ERROR_SUCCESS;
+}
+
+/* Builds a RANGE node. */
+Py_LOCAL_INLINE(int) build_RANGE(RE_CompileArgs* args) {
+    RE_UINT8 op;
+    RE_CODE flags;
+    Py_ssize_t step;
+    RE_Node* node;
+
+    /* codes: opcode, flags, lower, upper. */
+    if (args->code + 3 > args->end_code)
+        return RE_ERROR_ILLEGAL;
+
+    op = (RE_UINT8)args->code[0];
+    flags = args->code[1];
+
+    step = get_step(op);
+
+    if (flags & RE_ZEROWIDTH_OP)
+        step = 0;
+
+    /* Create the node. */
+    node = create_node(args->pattern, op, flags, step, 2);
+    if (!node)
+        return RE_ERROR_MEMORY;
+
+    node->values[0] = args->code[2];
+    node->values[1] = args->code[3];
+
+    args->code += 4;
+
+    /* Append the node. */
+    add_node(args->end, node);
+    args->end = node;
+
+    if (step != 0)
+        ++args->min_width;
+
+    return RE_ERROR_SUCCESS;
+}
+
+/* Builds a REF_GROUP node. */
+Py_LOCAL_INLINE(int) build_REF_GROUP(RE_CompileArgs* args) {
+    RE_CODE flags;
+    RE_CODE group;
+    RE_Node* node;
+
+    /* codes: opcode, flags, group. */
+    if (args->code + 2 > args->end_code)
+        return RE_ERROR_ILLEGAL;
+
+    flags = args->code[1];
+    group = args->code[2];
+    node = create_node(args->pattern, (RE_UINT8)args->code[0], flags, 0, 1);
+    if (!node)
+        return RE_ERROR_MEMORY;
+
+    node->values[0] = group;
+
+    args->code += 3;
+
+    /* Record that we have a reference to a group. */
+    if (!record_ref_group(args->pattern, group))
+        return RE_ERROR_MEMORY;
+
+    /* Append the reference. */
+    add_node(args->end, node);
+    args->end = node;
+
+    return RE_ERROR_SUCCESS;
+}
+
+/* Builds a REPEAT node. */
+Py_LOCAL_INLINE(int) build_REPEAT(RE_CompileArgs* args) {
+    BOOL greedy;
+    RE_CODE min_count;
+    RE_CODE max_count;
+    int status;
+
+    /* codes: opcode, min_count, max_count, sequence, end. */
+    if (args->code + 3 > args->end_code)
+        return RE_ERROR_ILLEGAL;
+
+    greedy = args->code[0] == RE_OP_GREEDY_REPEAT;
+    min_count = args->code[1];
+    max_count = args->code[2];
+    if (args->code[1] > args->code[2])
+        return RE_ERROR_ILLEGAL;
+
+    args->code += 3;
+
+    if (min_count == 1 && max_count == 1) {
+        /* Singly-repeated sequence. */
+        RE_CompileArgs subargs;
+
+        subargs = *args;
+        subargs.has_captures = FALSE;
+        subargs.is_fuzzy = FALSE;
+        status = build_sequence(&subargs);
+        if (status != RE_ERROR_SUCCESS)
+            return status;
+
+        if (subargs.code[0] != RE_OP_END)
+            return RE_ERROR_ILLEGAL;
+
+        args->code = subargs.code;
+        args->min_width = subargs.min_width;
+        args->has_captures |= subargs.has_captures;
+        args->is_fuzzy |= subargs.is_fuzzy;
+
+        ++args->code;
+
+        /* Append the sequence. */
+        add_node(args->end, subargs.start);
+        args->end = subargs.end;
+    } else {
+        size_t index;
+        RE_Node* repeat_node;
+        RE_CompileArgs subargs;
+
+        index = args->pattern->repeat_count;
+
+        /* Create the nodes for the repeat. */
+        repeat_node = create_node(args->pattern, greedy ? RE_OP_GREEDY_REPEAT :
+          RE_OP_LAZY_REPEAT, 0, args->forward ? 1 : -1, 4);
+        if (!repeat_node || !record_repeat(args->pattern, index,
+          args->repeat_depth))
+            return RE_ERROR_MEMORY;
+
+        repeat_node->values[0] = (RE_CODE)index;
+        repeat_node->values[1] = min_count;
+        repeat_node->values[2] = max_count;
+        repeat_node->values[3] = args->forward;
+
+        if (args->within_fuzzy)
+            args->pattern->repeat_info[index].status |= RE_STATUS_BODY;
+
+        /* Compile the 'body' and check that we've reached the end of it. */
+        subargs = *args;
+        subargs.min_width = 0;
+        subargs.visible_captures = TRUE;
+        subargs.has_captures = FALSE;
+        subargs.is_fuzzy = FALSE;
+        ++subargs.repeat_depth;
+        status = build_sequence(&subargs);
+        if (status != RE_ERROR_SUCCESS)
+            return status;
+
+        if (subargs.code[0] != RE_OP_END)
+            return RE_ERROR_ILLEGAL;
+
+        args->code = subargs.code;
+        args->min_width += (Py_ssize_t)min_count * subargs.min_width;
+        args->has_captures |= subargs.has_captures;
+        args->is_fuzzy |= subargs.is_fuzzy;
+
+        ++args->code;
+
+        /* Is it a repeat of something which will match a single character?
+         *
+         * If it's in a fuzzy section then it won't be optimised as a
+         * single-character repeat.
+         */
+        if (sequence_matches_one(subargs.start)) {
+            repeat_node->op = greedy ? RE_OP_GREEDY_REPEAT_ONE :
+              RE_OP_LAZY_REPEAT_ONE;
+
+            /* Append the new sequence. */
+            add_node(args->end, repeat_node);
+            repeat_node->nonstring.next_2.node = subargs.start;
+            args->end = repeat_node;
+        } else {
+            RE_Node* end_repeat_node;
+            RE_Node* end_node;
+
+            end_repeat_node = create_node(args->pattern, greedy ?
+              RE_OP_END_GREEDY_REPEAT : RE_OP_END_LAZY_REPEAT, 0, args->forward
+              ? 1 : -1, 4);
+            if (!end_repeat_node)
+                return RE_ERROR_MEMORY;
+
+            end_repeat_node->values[0] = repeat_node->values[0];
+            end_repeat_node->values[1] = repeat_node->values[1];
+            end_repeat_node->values[2] = repeat_node->values[2];
+            end_repeat_node->values[3] = args->forward;
+
+            end_node = create_node(args->pattern, RE_OP_BRANCH, 0, 0, 0);
+            if (!end_node)
+                return RE_ERROR_MEMORY;
+
+            /* Append the new sequence. */
+            add_node(args->end, repeat_node);
+            add_node(repeat_node, subargs.start);
+            add_node(repeat_node, end_node);
+            add_node(subargs.end, end_repeat_node);
+            add_node(end_repeat_node, subargs.start);
+            add_node(end_repeat_node, end_node);
+            args->end = end_node;
+        }
+    }
+
+    return RE_ERROR_SUCCESS;
+}
+
+/* Builds a STRING node. */
+Py_LOCAL_INLINE(int) build_STRING(RE_CompileArgs* args, BOOL is_charset) {
+    RE_CODE flags;
+    RE_CODE length;
+    RE_UINT8 op;
+    Py_ssize_t step;
+    RE_Node* node;
+    size_t i;
+
+    /* codes: opcode, flags, length, characters. */
+    flags = args->code[1];
+    length = args->code[2];
+    if (args->code + 3 + length > args->end_code)
+        return RE_ERROR_ILLEGAL;
+
+    op = (RE_UINT8)args->code[0];
+
+    step = get_step(op);
+
+    /* Create the node. */
+    node = create_node(args->pattern, op, flags, step * (Py_ssize_t)length,
+      length);
+    if (!node)
+        return RE_ERROR_MEMORY;
+    if (!is_charset)
+        node->status |= RE_STATUS_STRING;
+
+    for (i = 0; i < length; i++)
+        node->values[i] = args->code[3 + i];
+
+    args->code += 3 + length;
+
+    /* Append the node. */
+    add_node(args->end, node);
+    args->end = node;
+
+    /* Because of full case-folding, one character in the text could match
+     * multiple characters in the pattern.
+     */
+    if (op == RE_OP_STRING_FLD || op == RE_OP_STRING_FLD_REV)
+        args->min_width += possible_unfolded_length((Py_ssize_t)length);
+    else
+        args->min_width += (Py_ssize_t)length;
+
+    return RE_ERROR_SUCCESS;
+}
+
+/* Builds the bitmap of a SET node, recording which of the first few
+ * codepoints are in the set so that matching them doesn't need to walk the
+ * set's members. There's no bitmap if the set depends on the locale.
+ */
+Py_LOCAL_INLINE(int) build_SET_bitmap(PatternObject* pattern, RE_Node* node) {
+    RE_EncodingTable* encoding;
+    BOOL ignore_case;
+    RE_CODE* bitmap;
+    Py_UCS4 ch;
+
+    encoding = pattern->encoding;
+    if (encoding == &locale_encoding)
+        return RE_ERROR_SUCCESS;
+
+    switch (node->op) {
+    case RE_OP_SET_DIFF_IGN:
+    case RE_OP_SET_DIFF_IGN_REV:
+    case RE_OP_SET_INTER_IGN:
+    case RE_OP_SET_INTER_IGN_REV:
+    case RE_OP_SET_SYM_DIFF_IGN:
+    case RE_OP_SET_SYM_DIFF_IGN_REV:
+    case RE_OP_SET_UNION_IGN:
+    case RE_OP_SET_UNION_IGN_REV:
+        ignore_case = TRUE;
+        break;
+    default:
+        ignore_case = FALSE;
+        break;
+    }
+
+    bitmap = (RE_CODE*)re_alloc(RE_SET_BITMAP_SIZE * sizeof(RE_CODE));
+    if (!bitmap)
+        return RE_ERROR_MEMORY;
+
+    memset(bitmap, 0, RE_SET_BITMAP_SIZE * sizeof(RE_CODE));
+
+    /* The set doesn't have a bitmap yet, so this walks its members. */
+    for (ch = 0; ch < RE_SET_BITMAP_CHARS; ch++) {
+        BOOL in_set;
+
+        if (ignore_case)
+            in_set = matches_SET_IGN(encoding, NULL, node, ch);
+        else
+            in_set = matches_SET(encoding, NULL, node, ch);
+
+        if (in_set)
+            bitmap[ch >> 5] |= (RE_CODE)1 << (ch & 0x1F);
+    }
+
+    node->values = bitmap;
+    node->value_count = RE_SET_BITMAP_SIZE;
+
+    return RE_ERROR_SUCCESS;
+}
+
+/* Builds a SET node. */
+Py_LOCAL_INLINE(int) build_SET(RE_CompileArgs* args) {
+    RE_UINT8 op;
+    RE_CODE flags;
+    Py_ssize_t step;
+    RE_Node* node;
+    Py_ssize_t saved_min_width;
+    int status;
+
+    /* codes: opcode, flags, members. */
+    op = (RE_UINT8)args->code[0];
+    flags = args->code[1];
+
+    step = get_step(op);
+
+    if (flags & RE_ZEROWIDTH_OP)
+        step = 0;
+
+    node = create_node(args->pattern, op, flags, step, 0);
+    if (!node)
+        return RE_ERROR_MEMORY;
+
+    args->code += 2;
+
+    /* Append the node. */
+    add_node(args->end, node);
+    args->end = node;
+
+    saved_min_width = args->min_width;
+
+    /* Compile the character set. */
+    do {
+        switch (args->code[0]) {
+        case RE_OP_CHARACTER:
+        case RE_OP_PROPERTY:
+            status = build_CHARACTER_or_PROPERTY(args);
+            if (status != RE_ERROR_SUCCESS)
+                return status;
+            break;
+        case RE_OP_RANGE:
+            status = build_RANGE(args);
+            if (status != RE_ERROR_SUCCESS)
+                return status;
+            break;
+        case RE_OP_SET_DIFF:
+        case RE_OP_SET_INTER:
+        case RE_OP_SET_SYM_DIFF:
+        case RE_OP_SET_UNION:
+            status = build_SET(args);
+            if (status != RE_ERROR_SUCCESS)
+                return status;
+            break;
+        case RE_OP_STRING:
+            /* A set of characters. */
+            if (!build_STRING(args, TRUE))
+                return FALSE;
+            break;
+        default:
+            /* Illegal opcode for a character set. */
+            return RE_ERROR_ILLEGAL;
+        }
+    } while (args->code < args->end_code && args->code[0] != RE_OP_END);
+
+    /* Check that we've reached the end correctly. (The last opcode should be
+     * 'END'.)
+     */
+    if (args->code >= args->end_code || args->code[0] != RE_OP_END)
+        return RE_ERROR_ILLEGAL;
+
+    ++args->code;
+
+    /* At this point the set's members are in the main sequence. They need to
+     * be moved out-of-line.
+     */
+    node->nonstring.next_2.node = node->next_1.node;
+    node->next_1.node = NULL;
+    args->end = node;
+
+    args->min_width = saved_min_width;
+
+    if (step != 0)
+        ++args->min_width;
+
+    return RE_ERROR_SUCCESS;
+}
+
+/* Compares members of a string set for sorting. */
+static int trie_key_compare(const void* a, const void* b) {
+    const RE_TrieKey* key_a;
+    const RE_TrieKey* key_b;
+    Py_ssize_t length;
+    Py_ssize_t i;
+
+    key_a = (const RE_TrieKey*)a;
+    key_b = (const RE_TrieKey*)b;
+    length = min_ssize_t(key_a->length, key_b->length);
+
+    for (i = 0; i < length; i++) {
+        if (key_a->chars[i] != key_b->chars[i])
+            return key_a->chars[i] < key_b->chars[i] ? -1 : 1;
+    }
+
+    if (key_a->length != key_b->length)
+        return key_a->length < key_b->length ? -1 : 1;
+
+    return 0;
+}
+
+/* Builds the trie of a string set, forwards or reversed. */
+Py_LOCAL_INLINE(BOOL) build_string_trie(RE_StringTrie* trie, PyObject*
+  string_set, BOOL reverse) {
+    PyObject* members;
+    Py_ssize_t member_count;
+    Py_ssize_t key_count;
+    Py_ssize_t total_length;
+    Py_ssize_t i;
+    Py_UCS4* pool = NULL;
+    RE_TrieKey* keys = NULL;
+    Py_ssize_t* ranges = NULL;
+    Py_ssize_t node_count;
+    Py_ssize_t edge_count;
+    void* new_ptr;
+
+    members = PySequence_Fast(string_set, "string set should be iterable");
+    if (!members)
+        return FALSE;
+
+    member_count = PySequence_Fast_GET_SIZE(members);
+
+    /* Only strings can match the text. */
+    total_length = 0;
+    for (i = 0; i < member_count; i++) {
+        PyObject* member;
+
+        member = PySequence_Fast_GET_ITEM(members, i);
+        if (PyUnicode_Check(member) || PyBytes_Check(member))
+            total_length += PySequence_Length(member);
+    }
+
+    if (total_length >= (Py_ssize_t)0xFFFFFFFF) {
+        set_error(RE_ERROR_MEMORY, NULL);
+        goto error;
+    }
+
+    /* There's a node for each codepoint plus the root, and an edge to each
+     * node except the root.
+     */
+    pool = (Py_UCS4*)re_alloc((size_t)(total_length + 1) * sizeof(Py_UCS4));
+    keys = (RE_TrieKey*)re_alloc((size_t)(member_count + 1) *
+      sizeof(RE_TrieKey));
+    trie->nodes = (RE_TrieNode*)re_alloc((size_t)(total_length + 1) *
+      sizeof(RE_TrieNode));
+    trie->edges = (RE_TrieEdge*)re_alloc((size_t)(total_length + 1) *
+      sizeof(RE_TrieEdge));
+    ranges = (Py_ssize_t*)re_alloc((size_t)(total_length + 1) * 3 *
+      sizeof(Py_ssize_t));
+    if (!pool || !keys || !trie->nodes || !trie->edges || !ranges)
+        goto error;
+
+    /* Copy the codepoints of the members. */
+    key_count = 0;
+    total_length = 0;
+    for (i = 0; i < member_count; i++) {
+        PyObject* member;
+        RE_StringInfo str_info;
+        Py_UCS4 (*char_at)(void* text, Py_ssize_t pos);
+        RE_TrieKey* key;
+        Py_ssize_t j;
+
+        member = PySequence_Fast_GET_ITEM(members, i);
+        if (!PyUnicode_Check(member) && !PyBytes_Check(member))
+            continue;
+
+        if (!get_string(member, &str_info))
+            goto error;
+
+        switch (str_info.charsize) {
+        case 2:
+            char_at = bytes2_char_at;
+            break;
+        case 4:
+            char_at = bytes4_char_at;
+            break;
+        default:
+            char_at = bytes1_char_at;
+            break;
+        }
+
+        key = &keys[key_count++];
+        key->chars = pool + total_length;
+        key->length = str_info.length;
+        key->kinds = str_info.is_unicode ? RE_TRIE_UNICODE : RE_TRIE_BYTES;
+
+        for (j = 0; j < key->length; j++) {
+            Py_ssize_t pos;
+
+            pos = reverse ? key->length - 1 - j : j;
+            key->chars[j] = char_at(str_info.characters, pos);
+        }
+
+        total_length += key->length;
+
+        release_buffer(&str_info);
+    }
+
+    Py_DECREF(members);
+    members = NULL;
+
+    /* Sort the members so that those which share a prefix are together and
+     * any which ends at a node comes before those which continue past it.
+     */
+    qsort(keys, (size_t)key_count, sizeof(RE_TrieKey), trie_key_compare);
+
+    /* Build the nodes breadth-first so that the edges from each node are
+     * contiguous. The members which pass through a node are in a range of the
+     * sorted members.
+     */
+    ranges[0] = 0;
+    ranges[1] = key_count;
+    ranges[2] = 0;
+    node_count = 1;
+    edge_count = 0;
+
+    for (i = 0; i < node_count; i++) {
+        RE_TrieNode* node;
+        Py_ssize_t lo;
+        Py_ssize_t hi;
+        Py_ssize_t depth;
+
+        node = &trie->nodes[i];
+        lo = ranges[i * 3];
+        hi = ranges[i * 3 + 1];
+        depth = ranges[i * 3 + 2];
+
+        node->first_edge = (RE_UINT32)edge_count;
+        node->end_kinds = 0;
+        node->below_kinds = 0;
+
+        while (lo < hi && keys[lo].length == depth) {
+            node->end_kinds |= keys[lo].kinds;
+            ++lo;
+        }
+
+        while (lo < hi) {
+            Py_UCS4 ch;
+            Py_ssize_t next;
+
+            ch = keys[lo].chars[depth];
+            next = lo;
+            while (next < hi && keys[next].chars[depth] == ch) {
+                node->below_kinds |= keys[next].kinds;
+                ++next;
+            }
+
+            trie->edges[edge_count].ch = ch;
+            trie->edges[edge_count].target = (RE_UINT32)node_count;
+            ++edge_count;
+
+            ranges[node_count * 3] = lo;
+            ranges[node_count * 3 + 1] = next;
+            ranges[node_count * 3 + 2] = depth + 1;
+            ++node_count;
+
+            lo = next;
+        }
+
+        node->edge_count = (RE_UINT32)(edge_count - node->first_edge);
+    }
+
+    re_dealloc(ranges);
+    re_dealloc(keys);
+    re_dealloc(pool);
+
+    /* Members which share a prefix share nodes, so discard the spare space. */
+    new_ptr = PyMem_Realloc(trie->nodes, (size_t)node_count *
+      sizeof(RE_TrieNode));
+    if (new_ptr)
+        trie->nodes = (RE_TrieNode*)new_ptr;
+
+    new_ptr = PyMem_Realloc(trie->edges, (size_t)(edge_count + 1) *
+      sizeof(RE_TrieEdge));
+    if (new_ptr)
+        trie->edges = (RE_TrieEdge*)new_ptr;
+
+    return TRUE;
+
+error:
+    Py_XDECREF(members);
+    re_dealloc(ranges);
+    re_dealloc(keys);
+    re_dealloc(pool);
+    re_dealloc(trie->nodes);
+    re_dealloc(trie->edges);
+    trie->nodes = NULL;
+    trie->edges = NULL;
+
+    return FALSE;
+}
+
+/* Builds a STRING_SET node. */
+Py_LOCAL_INLINE(int) build_STRING_SET(RE_CompileArgs* args) {
+    RE_CODE index;
+    RE_CODE min_len;
+    RE_CODE max_len;
+    BOOL reverse;
+    RE_StringTrie* trie;
+    RE_Node* node;
+
+    /* codes: opcode, index, min_len, max_len. */
+    if (args->code + 3 > args->end_code)
+        return RE_ERROR_ILLEGAL;
+
+    index = args->code[1];
+    min_len = args->code[2];
+    max_len = args->code[3];
+
+    if (index >= args->pattern->named_lists_count)
+        return RE_ERROR_ILLEGAL;
+
+    /* Build the trie of the string set, if it hasn't already been built. */
+    switch (args->code[0]) {
+    case RE_OP_STRING_SET_FLD_REV:
+    case RE_OP_STRING_SET_IGN_REV:
+    case RE_OP_STRING_SET_REV:
+        reverse = TRUE;
+        break;
+    default:
+        reverse = FALSE;
+        break;
+    }
+
+    trie = &args->pattern->named_list_tries[reverse][index];
+    if (!trie->nodes) {
+        PyObject* string_set;
+
+        /* PyList_GET_ITEM borrows a reference. */
+        string_set = PyList_GET_ITEM(args->pattern->named_list_indexes, index);
+        if (!build_string_trie(trie, string_set, reverse))
+            return RE_ERROR_MEMORY;
+    }
+
+    /* Within a fuzzy section it's matched by walking the trie with an error
+     * budget.
+     */
+    node = create_node(args->pattern, (RE_UINT8)args->code[0],
+      args->within_fuzzy ? RE_FUZZY_OP : 0, 0, 3);
+    if (!node)
+        return RE_ERROR_MEMORY;
+
+    node->values[0] = index;
+    node->values[1] = min_len;
+    node->values[2] = max_len;
+
+    args->code += 4;
+
+    /* Append the reference. */
+    add_node(args->end, node);
+    args->end = node;
+
+    return RE_ERROR_SUCCESS;
+}
+
+/* Builds a SUCCESS node . */
+Py_LOCAL_INLINE(int) build_SUCCESS(RE_CompileArgs* args) {
+    RE_Node* node;
+    /* code: opcode. */
+
+    /* Create the node. */
+    node = create_node(args->pattern, args->code[0], 0, 0, 0);
+    if (!node)
+        return RE_ERROR_MEMORY;
+
+    ++args->code;
+
+    /* Append the node. */
+    add_node(args->end, node);
+    args->end = node;
+
+    return RE_ERROR_SUCCESS;
+}
+
+/* Builds a zero-width node. */
+Py_LOCAL_INLINE(int) build_zerowidth(RE_CompileArgs* args) {
+    RE_CODE flags;
+    RE_Node* node;
+
+    /* codes: opcode, flags. */
+    if (args->code + 1 > args->end_code)
+        return RE_ERROR_ILLEGAL;
+
+    flags = args->code[1];
+
+    /* Create the node. */
+    node = create_node(args->pattern, (RE_UINT8)args->code[0], flags, 0, 0);
+    if (!node)
+        return RE_ERROR_MEMORY;
+
+    args->code += 2;
+
+    /* Append the node. */
+    add_node(args->end, node);
+    args->end = node;
+
+    return RE_ERROR_SUCCESS;
+}
+
+/* Builds a sequence of nodes from regular expression code. */
+Py_LOCAL_INLINE(int) build_sequence(RE_CompileArgs* args) {
+    int status;
+
+    /* Guarantee that there's something to attach to. */
+    args->start = create_node(args->pattern, RE_OP_BRANCH, 0, 0, 0);
+    args->end = args->start;
+
+    /* The sequence should end with an opcode we don't understand. If it
+     * doesn't then the code is illegal.
+     */
+    while (args->code < args->end_code) {
+        /* The following code groups opcodes by format, not function. */
+        switch (args->code[0]) {
+        case RE_OP_ANY:
+        case RE_OP_ANY_ALL:
+        case RE_OP_ANY_ALL_REV:
+        case RE_OP_ANY_REV:
+        case RE_OP_ANY_U:
+        case RE_OP_ANY_U_REV:
+            /* A simple opcode with no trailing codewords and width of 1. */
+            status = build_ANY(args);
+            if (status != RE_ERROR_SUCCESS)
+                return status;
+            break;
+        case RE_OP_ATOMIC:
+            /* An atomic sequence. */
+            status = build_ATOMIC(args);
+            if (status != RE_ERROR_SUCCESS)
+                return status;
+            break;
+        case RE_OP_BOUNDARY:
+        case RE_OP_DEFAULT_BOUNDARY:
+        case RE_OP_DEFAULT_END_OF_WORD:
+        case RE_OP_DEFAULT_START_OF_WORD:
+        case RE_OP_END_OF_WORD:
+        case RE_OP_GRAPHEME_BOUNDARY:
+        case RE_OP_KEEP:
+        case RE_OP_SKIP:
+        case RE_OP_START_OF_WORD:
+            /* A word or grapheme boundary. */
+            status = build_BOUNDARY(args);
+            if (status != RE_ERROR_SUCCESS)
+                return status;
+            break;
+        case RE_OP_BRANCH:
+            /* A 2-way branch. */
+            status = build_BRANCH(args);
+            if (status != RE_ERROR_SUCCESS)
+                return status;
+            break;
+        case RE_OP_CALL_REF:
+            /* A group call ref. */
+            status = build_CALL_REF(args);
+            if (status != RE_ERROR_SUCCESS)
+                return status;
+            break;
+        case RE_OP_CHARACTER:
+        case RE_OP_CHARACTER_IGN:
+        case RE_OP_CHARACTER_IGN_REV:
+        case RE_OP_CHARACTER_REV:
+        case RE_OP_PROPERTY:
+        case RE_OP_PROPERTY_IGN:
+        case RE_OP_PROPERTY_IGN_REV:
+        case RE_OP_PROPERTY_REV:
+            /* A character literal or a property. */
+            status = build_CHARACTER_or_PROPERTY(args);
+            if (status != RE_ERROR_SUCCESS)
+                return status;
+            break;
+        case RE_OP_END_OF_LINE:
+        case RE_OP_END_OF_LINE_U:
+        case RE_OP_END_OF_STRING:
+        case RE_OP_END_OF_STRING_LINE:
+        case RE_OP_END_OF_STRING_LINE_U:
+        case RE_OP_SEARCH_ANCHOR:
+        case RE_OP_START_OF_LINE:
+        case RE_OP_START_OF_LINE_U:
+        case RE_OP_START_OF_STRING:
+            /* A simple opcode with no trailing codewords and width of 0. */
+            status = build_zerowidth(args);
+            if (status != RE_ERROR_SUCCESS)
+                return status;
+            break;
+        case RE_OP_FAILURE:
+        case RE_OP_PRUNE:
+        case RE_OP_SUCCESS:
+            status = build_SUCCESS(args);
+            if (status != RE_ERROR_SUCCESS)
+                return status;
+            break;
+        case RE_OP_FUZZY:
+            /* A fuzzy sequence. */
+            status = build_FUZZY(args);
+            if (status != RE_ERROR_SUCCESS)
+                return status;
+            break;
+        case RE_OP_GREEDY_REPEAT:
+        case RE_OP_LAZY_REPEAT:
+            /* A repeated sequence. */
+            status = build_REPEAT(args);
+            if (status != RE_ERROR_SUCCESS)
+                return status;
+            break;
+        case RE_OP_GROUP:
+            /* A capture group. */
+            status = build_GROUP(args);
+            if (status != RE_ERROR_SUCCESS)
+                return status;
+            break;
+        case RE_OP_GROUP_CALL:
+            /* A group call. */
+            status = build_GROUP_CALL(args);
+            if (status != RE_ERROR_SUCCESS)
+                return status;
+            break;
+        case RE_OP_GROUP_EXISTS:
+            /* A conditional sequence. */
+            status = build_GROUP_EXISTS(args);
+            if (status != RE_ERROR_SUCCESS)
+                return status;
+            break;
+        case RE_OP_LOOKAROUND:
+            /* A lookaround. */
+            status = build_LOOKAROUND(args);
+            if (status != RE_ERROR_SUCCESS)
+                return status;
+            break;
+        case RE_OP_RANGE:
+        case RE_OP_RANGE_IGN:
+        case RE_OP_RANGE_IGN_REV:
+        case RE_OP_RANGE_REV:
+            /* A range. */
+            status = build_RANGE(args);
+            if (status != RE_ERROR_SUCCESS)
+                return status;
+            break;
+        case RE_OP_REF_GROUP:
+        case RE_OP_REF_GROUP_FLD:
+        case RE_OP_REF_GROUP_FLD_REV:
+        case RE_OP_REF_GROUP_IGN:
+        case RE_OP_REF_GROUP_IGN_REV:
+        case RE_OP_REF_GROUP_REV:
+            /* A reference to a group. */
+            status = build_REF_GROUP(args);
+            if (status != RE_ERROR_SUCCESS)
+                return status;
+            break;
+        case RE_OP_SET_DIFF:
+        case RE_OP_SET_DIFF_IGN:
+        case RE_OP_SET_DIFF_IGN_REV:
+        case RE_OP_SET_DIFF_REV:
+        case RE_OP_SET_INTER:
+        case RE_OP_SET_INTER_IGN:
+        case RE_OP_SET_INTER_IGN_REV:
+        case RE_OP_SET_INTER_REV:
+        case RE_OP_SET_SYM_DIFF:
+        case RE_OP_SET_SYM_DIFF_IGN:
+        case RE_OP_SET_SYM_DIFF_IGN_REV:
+        case RE_OP_SET_SYM_DIFF_REV:
+        case RE_OP_SET_UNION:
+        case RE_OP_SET_UNION_IGN:
+        case RE_OP_SET_UNION_IGN_REV:
+        case RE_OP_SET_UNION_REV:
+            /* A set. */
+            status = build_SET(args);
+            if (status != RE_ERROR_SUCCESS)
+                return status;
+
+            status = build_SET_bitmap(args->pattern, args->end);
+            if (status != RE_ERROR_SUCCESS)
+                return status;
+            break;
+        case RE_OP_STRING:
+        case RE_OP_STRING_FLD:
+        case RE_OP_STRING_FLD_REV:
+        case RE_OP_STRING_IGN:
+        case RE_OP_STRING_IGN_REV:
+        case RE_OP_STRING_REV:
+            /* A string literal. */
+            if (!build_STRING(args, FALSE))
+                return FALSE;
+            break;
+        case RE_OP_STRING_SET:
+        case RE_OP_STRING_SET_FLD:
+        case RE_OP_STRING_SET_FLD_REV:
+        case RE_OP_STRING_SET_IGN:
+        case RE_OP_STRING_SET_IGN_REV:
+        case RE_OP_STRING_SET_REV:
+            /* A reference to a list. */
+            status = build_STRING_SET(args);
+            if (status != RE_ERROR_SUCCESS)
+                return status;
+            break;
+        default:
+            /* We've found an opcode which we don't recognise. We'll leave it
+             * for the caller.
+             */
+            return RE_ERROR_SUCCESS;
+        }
+    }
+
+    /* If we're here then we should be at the end of the code, otherwise we
+     * have an error.
+     */
+    return args->code == args->end_code;
+}
+
+/* Compiles the regular expression code to 'nodes'.
+ *
+ * Various details about the regular expression are discovered during
+ * compilation and stored in the PatternObject.
+ */
+Py_LOCAL_INLINE(BOOL) compile_to_nodes(RE_CODE* code, RE_CODE* end_code,
+  PatternObject* pattern) {
+    RE_CompileArgs args;
+    int status;
+
+    /* Compile a regex sequence and then check that we've reached the end
+     * correctly. (The last opcode should be 'SUCCESS'.)
+     *
+     * If successful, 'start' and 'end' will point to the start and end nodes
+     * of the compiled sequence.
+     */
+    args.code = code;
+    args.end_code = end_code;
+    args.pattern = pattern;
+    args.forward = (pattern->flags & RE_FLAG_REVERSE) == 0;
+    args.min_width = 0;
+    args.visible_captures = FALSE;
+    args.has_captures = FALSE;
+    args.repeat_depth = 0;
+    args.is_fuzzy = FALSE;
+    args.within_fuzzy = FALSE;
+    status = build_sequence(&args);
+    if (status == RE_ERROR_ILLEGAL)
+        set_error(RE_ERROR_ILLEGAL, NULL);
+
+    if (status != RE_ERROR_SUCCESS)
+        return FALSE;
+
+    pattern->min_width = args.min_width;
+    pattern->is_fuzzy = args.is_fuzzy;
+    pattern->do_search_start = TRUE;
+    pattern->start_node = args.start;
+
+    /* Optimise the pattern. */
+    if (!optimise_pattern(pattern))
+        return FALSE;
+
+    pattern->start_test = locate_test_start(pattern->start_node);
+
+    /* Get the call_ref for the entire pattern, if any. */
+    if (pattern->start_node->op == RE_OP_CALL_REF)
+        pattern->pattern_call_ref = (Py_ssize_t)pattern->start_node->values[0];
+    else
+        pattern->pattern_call_ref = -1;
+
+    return TRUE;
+}
+
+/* Gets the required characters for a regex.
+ *
+ * In the event of an error, it just pretends that there are no required
+ * characters.
+ */
+Py_LOCAL_INLINE(void) get_required_chars(PyObject* required_chars, RE_CODE**
+  req_chars, size_t* req_length) {
+    Py_ssize_t len;
+    RE_CODE* chars;
+    Py_ssize_t i;
+
+    *req_chars = NULL;
+    *req_length = 0;
+
+    len = PyTuple_GET_SIZE(required_chars);
+    if (len < 1 || PyErr_Occurred()) {
+        PyErr_Clear();
+        return;
+    }
+
+    chars = (RE_CODE*)re_alloc((size_t)len * sizeof(RE_CODE));
+    if (!chars)
+        goto error;
+
+    for (i = 0; i < len; i++) {
+        PyObject* o;
+        size_t value;
+
+        /* PyTuple_SET_ITEM borrows the reference. */
+        o = PyTuple_GET_ITEM(required_chars, i);
+
+        value = PyLong_AsUnsignedLong(o);
+        if ((Py_ssize_t)value == -1 && PyErr_Occurred())
+            goto error;
+
+        chars[i] = (RE_CODE)value;
+        if (chars[i] != value)
+            goto error;
+    }
+
+    *req_chars = chars;
+    *req_length = (size_t)len;
+
+    return;
+
+error:
+    PyErr_Clear();
+    re_dealloc(chars);
+}
+
+/* Makes a STRING node. */
+Py_LOCAL_INLINE(RE_Node*) make_STRING_node(PatternObject* pattern, RE_UINT8 op,
+  size_t length, RE_CODE* chars) {
+    Py_ssize_t step;
+    RE_Node* node;
+    size_t i;
+
+    step = get_step(op);
+
+    /* Create the node. */
+    node = create_node(pattern, op, 0, step * (Py_ssize_t)length, length);
+    if (!node)
+        return NULL;
+
+    node->status |= RE_STATUS_STRING;
+
+    for (i = 0; i < length; i++)
+        node->values[i] = chars[i];
+
+    return node;
+}
+
+/* Makes a list of nodes for required strings, linked by 'next_1'.
+ *
+ * In the event of an error, it just pretends that there are no required
+ * strings.
+ */
+Py_LOCAL_INLINE(RE_Node*) make_required_list(PatternObject* pattern,
+  PyObject* strings, Py_ssize_t max_count) {
+    RE_Node* first;
+    RE_Node* last;
+    Py_ssize_t count;
+    Py_ssize_t i;
+
+    first = NULL;
+    last = NULL;
+
+    if (!PyTuple_Check(strings))
+        return NULL;
+
+    count = PyTuple_GET_SIZE(strings);
+    if (count > max_count)
+        count = max_count;
+
+    for (i = 0; i < count; i++) {
+        PyObject* item;
+        Py_ssize_t req_flags;
+        RE_CODE* req_chars;
+        size_t req_length;
+        RE_UINT8 op;
+        RE_Node* node;
+
+        /* PyTuple_GET_ITEM borrows the reference. */
+        item = PyTuple_GET_ITEM(strings, i);
+        if (!PyTuple_Check(item) || PyTuple_GET_SIZE(item) != 2 ||
+          !PyTuple_Check(PyTuple_GET_ITEM(item, 1)))
+            goto error;
+
+        req_flags = PyLong_AsSsize_t(PyTuple_GET_ITEM(item, 0));
+        if (req_flags == -1 && PyErr_Occurred())
+            goto error;
+
+        /* Remove the FULLCASE flag if it's not a Unicode pattern. */
+        if (!(pattern->flags & RE_FLAG_UNICODE))
+            req_flags &= ~RE_FLAG_FULLCASE;
+
+        switch (req_flags) {
+        case 0:
+        case RE_FLAG_FULLCASE:
+            op = RE_OP_STRING;
+            break;
+        case RE_FLAG_IGNORECASE | RE_FLAG_FULLCASE:
+            op = RE_OP_STRING_FLD;
+            break;
+        case RE_FLAG_IGNORECASE:
+            op = RE_OP_STRING_IGN;
+            break;
+        default:
+            goto error;
+        }
+
+        get_required_chars(PyTuple_GET_ITEM(item, 1), &req_chars,
+          &req_length);
+        if (!req_chars)
+            goto error;
+
+        node = make_STRING_node(pattern, op, req_length, req_chars);
+        re_dealloc(req_chars);
+        if (!node)
+            goto error;
+
+        if (last)
+            last->next_1.node = node;
+        else
+            first = node;
+
+        last = node;
+    }
+
+    return first;
+
+error:
+    PyErr_Clear();
+    return NULL;
+}
+
+/* Gets the maximum number of errors permitted by the constraints of a fuzzy
+ * section.
+ */
+Py_LOCAL_INLINE(size_t) fuzzy_max_errors(RE_Node* node) {
+    size_t max_errors;
+    size_t by_type;
+    int fuzzy_type;
+
+    max_errors = node->values[RE_FUZZY_VAL_MAX_ERR];
+
+    /* The cost equation and the limits on the types of error also limit the
+     * number of errors.
+     */
+    by_type = 0;
+    for (fuzzy_type = 0; fuzzy_type < RE_FUZZY_COUNT; fuzzy_type++) {
+        size_t max_count;
+        size_t cost;
+
+        max_count = node->values[RE_FUZZY_VAL_MAX_BASE + fuzzy_type];
+        cost = node->values[RE_FUZZY_VAL_COST_BASE + fuzzy_type];
+        if (cost > 0 && node->values[RE_FUZZY_VAL_MAX_COST] / cost < max_count)
+            max_count = node->values[RE_FUZZY_VAL_MAX_COST] / cost;
+
+        if (max_count >= RE_UNLIMITED)
+            return RE_UNLIMITED;
+
+        by_type += max_count;
+    }
+
+    return by_type < max_errors ? by_type : max_errors;
+}
+
+/* Checks whether the best match of a fuzzy pattern can be found in a single
+ * pass by pruning on the cost. Atomic groups, lookarounds and the like can
+ * match differently when less is permitted, so they need a fresh pass each
+ * time.
+ */
+Py_LOCAL_INLINE(BOOL) can_find_best_in_single_pass(PatternObject* pattern) {
+    size_t i;
+
+    if (!pattern->is_fuzzy || !(pattern->flags & RE_FLAG_BESTMATCH) ||
+      (pattern->flags & RE_FLAG_POSIX))
+        return FALSE;
+
+    for (i = 0; i < pattern->node_count; i++) {
+        switch (pattern->node_list[i]->op) {
+        case RE_OP_ATOMIC:
+        case RE_OP_LOOKAROUND:
+        case RE_OP_PRUNE:
+        case RE_OP_SEARCH_ANCHOR:
+        case RE_OP_SKIP:
+            return FALSE;
+        }
+    }
+
+    return TRUE;
+}
+
+/* Makes the info for scanning for a fuzzy literal if the pattern is just a
+ * fuzzy section around a sequence of single characters or sets that's short
+ * enough for the bit-parallel scan.
+ *
+ * In the event of an error, it just pretends that the pattern isn't one.
+ */
+Py_LOCAL_INLINE(RE_FuzzyLiteral*) make_fuzzy_literal(PatternObject* pattern) {
+    RE_Node* fuzzy_node;
+    RE_Node* node;
+    size_t length;
+    size_t max_errors;
+    RE_FuzzyLiteral* literal;
+    Py_UCS4 ch;
+
+    fuzzy_node = pattern->start_node;
+    if (fuzzy_node->op != RE_OP_FUZZY || (pattern->flags & RE_FLAG_REVERSE))
+        return NULL;
+
+    /* Count the positions. */
+    length = 0;
+    for (node = fuzzy_node->next_1.node; node->op != RE_OP_END_FUZZY; node =
+      node->next_1.node) {
+        if (node->op == RE_OP_STRING || node->op == RE_OP_STRING_IGN)
+            length += node->value_count;
+        else if (node_matches_one_character(node))
+            ++length;
+        else
+            return NULL;
+    }
+
+    if (node->next_1.node->op != RE_OP_SUCCESS)
+        return NULL;
+
+    /* A literal that's too short would match almost anywhere. */
+    max_errors = fuzzy_max_errors(fuzzy_node);
+    if (length == 0 || length > sizeof(size_t) * 8 || max_errors >= length)
+        return NULL;
+
+    literal = (RE_FuzzyLiteral*)re_alloc(sizeof(RE_FuzzyLiteral));
+    if (!literal)
+        goto error;
+
+    literal->nodes = (RE_Node**)re_alloc(length * sizeof(RE_Node*));
+    literal->offsets = (Py_ssize_t*)re_alloc(length * sizeof(Py_ssize_t));
+    if (!literal->nodes || !literal->offsets) {
+        dealloc_fuzzy_literal(literal);
+        goto error;
+    }
+
+    literal->length = 0;
+    literal->max_errors = max_errors;
+
+    for (node = fuzzy_node->next_1.node; node->op != RE_OP_END_FUZZY; node =
+      node->next_1.node) {
+        if (node->op == RE_OP_STRING || node->op == RE_OP_STRING_IGN) {
+            size_t i;
+
+            for (i = 0; i < node->value_count; i++) {
+                literal->nodes[literal->length] = node;
+                literal->offsets[literal->length] = (Py_ssize_t)i;
+                ++literal->length;
+            }
+        } else {
+            literal->nodes[literal->length] = node;
+            literal->offsets[literal->length] = -1;
+            ++literal->length;
+        }
+    }
+
+    /* The positions that each Latin-1 character matches. */
+    for (ch = 0; ch < 256; ch++) {
+        size_t i;
+
+        literal->masks[ch] = 0;
+        for (i = 0; i < length; i++) {
+            if (fuzzy_literal_matches(pattern->encoding, pattern->locale_info,
+              literal->nodes[i], literal->offsets[i], ch))
+                literal->masks[ch] |= (size_t)1 << i;
+        }
+    }
+
+    return literal;
+
+error:
+    PyErr_Clear();
+    return NULL;
+}
+
+/* Makes the info for the alternative required strings.
+ *
+ * In the event of an error, it just pretends that there are no alternatives.
+ */
+Py_LOCAL_INLINE(RE_RequiredAlts*) make_required_alts(PatternObject* pattern,
+  PyObject* offset, PyObject* strings) {
+    Py_ssize_t alt_offset;
+    RE_Node* list;
+    RE_RequiredAlts* alts;
+    RE_Node* node;
+
+    alt_offset = PyLong_AsSsize_t(offset);
+    if (alt_offset == -1 && PyErr_Occurred()) {
+        PyErr_Clear();
+        return NULL;
+    }
+
+    list = make_required_list(pattern, strings, PY_SSIZE_T_MAX);
+    if (!list)
+        return NULL;
+
+    alts = (RE_RequiredAlts*)re_alloc(sizeof(RE_RequiredAlts));
+    if (!alts) {
+        PyErr_Clear();
+        return NULL;
+    }
+
+    memset(alts, 0, sizeof(RE_RequiredAlts));
+    alts->strings = list;
+    alts->offset = alt_offset;
+
+    /* Collect the possible first characters of the strings. */
+    for (node = list; node; node = node->next_1.node) {
+        Py_UCS4 cases[RE_MAX_CASES];
+        int case_count;
+        int i;
+
+        switch (node->op) {
+        case RE_OP_STRING:
+            cases[0] = node->values[0];
+            case_count = 1;
+            break;
+        case RE_OP_STRING_IGN:
+            case_count = pattern->encoding->all_cases(pattern->locale_info,
+              node->values[0], cases);
+            break;
+        default:
+            /* Full case-folding isn't supported by the search. */
+            re_dealloc(alts);
+            return NULL;
+        }
+
+        for (i = 0; i < case_count; i++) {
+            Py_UCS4 ch;
 
-    /* Compile a regex sequence and then check that we've reached the end
-     * correctly. (The last opcode should be 'SUCCESS'.)
-     *
-     * If successful, 'start' and 'end' will point to the start and end nodes
-     * of the compiled sequence.
-     */
-    args.code = code;
-    args.end_code = end_code;
-    args.pattern = pattern;
-    args.forward = (pattern->flags & RE_FLAG_REVERSE) == 0;
-    args.min_width = 0;
-    args.visible_captures = FALSE;
-    args.has_captures = FALSE;
-    args.repeat_depth = 0;
-    args.is_fuzzy = FALSE;
-    args.within_fuzzy = FALSE;
-    status = build_sequence(&args);
-    if (status == RE_ERROR_ILLEGAL)
-        set_error(RE_ERROR_ILLEGAL, NULL);
+            ch = cases[i];
 
-    if (status != RE_ERROR_SUCCESS)
-        return FALSE;
+            if (ch < RE_SET_BITMAP_CHARS)
+                alts->first_bitmap[ch >> 5] |= (RE_CODE)1 << (ch & 0x1F);
+            else
+                alts->wide_first = TRUE;
 
-    pattern->min_width = args.min_width;
-    pattern->is_fuzzy = args.is_fuzzy;
-    pattern->do_search_start = TRUE;
-    pattern->start_node = args.start;
+            /* Keep a list of them while there aren't too many. */
+            if (alts->first_count >= 0 && !any_case(ch, alts->first_count,
+              alts->firsts)) {
+                if (alts->first_count < RE_MAX_CASES)
+                    alts->firsts[alts->first_count++] = ch;
+                else
+                    alts->first_count = -1;
+            }
+        }
+    }
 
-    /* Optimise the pattern. */
-    if (!optimise_pattern(pattern))
-        return FALSE;
+    if (alts->first_count < 0)
+        alts->first_count = 0;
 
-    pattern->start_test = locate_test_start(pattern->start_node);
+    return alts;
+}
 
-    /* Get the call_ref for the entire pattern, if any. */
-    if (pattern->start_node->op == RE_OP_CALL_REF)
-        pattern->pattern_call_ref = (Py_ssize_t)pattern->start_node->values[0];
-    else
-        pattern->pattern_call_ref = -1;
+/* Gets the kind of instruction of the lazy DFA which tests with a node, or -1
+ * if the lazy DFA can't test with it.
+ */
+Py_LOCAL_INLINE(int) dfa_instr_kind(RE_UINT8 op) {
+    switch (op) {
+    case RE_OP_ANY:
+    case RE_OP_ANY_ALL:
+    case RE_OP_ANY_U:
+    case RE_OP_CHARACTER:
+    case RE_OP_CHARACTER_IGN:
+    case RE_OP_PROPERTY:
+    case RE_OP_PROPERTY_IGN:
+    case RE_OP_RANGE:
+    case RE_OP_RANGE_IGN:
+    case RE_OP_SET_DIFF:
+    case RE_OP_SET_DIFF_IGN:
+    case RE_OP_SET_INTER:
+    case RE_OP_SET_INTER_IGN:
+    case RE_OP_SET_SYM_DIFF:
+    case RE_OP_SET_SYM_DIFF_IGN:
+    case RE_OP_SET_UNION:
+    case RE_OP_SET_UNION_IGN:
+        return RE_DFA_TEST;
+    case RE_OP_BOUNDARY:
+    case RE_OP_DEFAULT_BOUNDARY:
+    case RE_OP_DEFAULT_END_OF_WORD:
+    case RE_OP_DEFAULT_START_OF_WORD:
+    case RE_OP_END_OF_LINE:
+    case RE_OP_END_OF_LINE_U:
+    case RE_OP_END_OF_STRING:
+    case RE_OP_END_OF_STRING_LINE:
+    case RE_OP_END_OF_STRING_LINE_U:
+    case RE_OP_END_OF_WORD:
+    case RE_OP_START_OF_LINE:
+    case RE_OP_START_OF_LINE_U:
+    case RE_OP_START_OF_STRING:
+    case RE_OP_START_OF_WORD:
+        return RE_DFA_ASSERT;
+    }
 
-    return TRUE;
+    return -1;
 }
 
-/* Gets the required characters for a regex.
+/* Gets the classes of characters which an assertion of the lazy DFA depends
+ * on.
+ */
+Py_LOCAL_INLINE(RE_UINT8) dfa_assertion_classes(RE_UINT8 op) {
+    switch (op) {
+    case RE_OP_BOUNDARY:
+    case RE_OP_END_OF_WORD:
+    case RE_OP_START_OF_WORD:
+        return RE_DFA_CLASS_NONE | RE_DFA_CLASS_WORD;
+    case RE_OP_END_OF_LINE:
+        return RE_DFA_CLASS_NONE | RE_DFA_CLASS_LINE_FEED |
+          RE_DFA_CLASS_SLICE_END;
+    case RE_OP_END_OF_LINE_U:
+    case RE_OP_START_OF_LINE_U:
+        return RE_DFA_CLASS_NONE | RE_DFA_CLASS_LINE_FEED |
+          RE_DFA_CLASS_CARRIAGE_RETURN | RE_DFA_CLASS_LINE_SEP;
+    case RE_OP_END_OF_STRING_LINE:
+    case RE_OP_END_OF_STRING_LINE_U:
+        return RE_DFA_CLASS_NONE | RE_DFA_CLASS_LINE_SEP;
+    case RE_OP_START_OF_LINE:
+        return RE_DFA_CLASS_NONE | RE_DFA_CLASS_LINE_FEED;
+    }
+
+    return RE_DFA_CLASS_NONE;
+}
+
+/* Makes a program for the lazy DFA.
  *
- * In the event of an error, it just pretends that there are no required
- * characters.
+ * The lazy DFA is only an optimisation, so if there's a problem then there's
+ * no program and the pattern is matched by the backtracking engine alone.
  */
-Py_LOCAL_INLINE(void) get_required_chars(PyObject* required_chars, RE_CODE**
-  req_chars, size_t* req_length) {
-    Py_ssize_t len;
-    RE_CODE* chars;
+Py_LOCAL_INLINE(RE_DFAProgram*) make_dfa_program(PatternObject* pattern,
+  PyObject* code_list) {
+    Py_ssize_t code_len;
+    RE_CODE* code;
+    RE_CODE* end_code;
+    RE_CODE* p;
+    RE_DFAProgram* program;
     Py_ssize_t i;
 
-    *req_chars = NULL;
-    *req_length = 0;
+    if (!PyList_Check(code_list))
+        return NULL;
 
-    len = PyTuple_GET_SIZE(required_chars);
-    if (len < 1 || PyErr_Occurred()) {
-        PyErr_Clear();
-        return;
-    }
+    code_len = PyList_GET_SIZE(code_list);
+    if (code_len < 2)
+        return NULL;
 
-    chars = (RE_CODE*)re_alloc((size_t)len * sizeof(RE_CODE));
-    if (!chars)
+    code = (RE_CODE*)re_alloc((size_t)code_len * sizeof(RE_CODE));
+    if (!code)
         goto error;
 
-    for (i = 0; i < len; i++) {
-        PyObject* o;
+    for (i = 0; i < code_len; i++) {
         size_t value;
 
-        /* PyTuple_SET_ITEM borrows the reference. */
-        o = PyTuple_GET_ITEM(required_chars, i);
-
-        value = PyLong_AsUnsignedLong(o);
+        /* PyList_GET_ITEM borrows a reference. */
+        value = PyLong_AsUnsignedLong(PyList_GET_ITEM(code_list, i));
         if ((Py_ssize_t)value == -1 && PyErr_Occurred())
             goto error;
 
-        chars[i] = (RE_CODE)value;
-        if (chars[i] != value)
+        code[i] = (RE_CODE)value;
+        if (code[i] != value)
             goto error;
     }
 
-    *req_chars = chars;
-    *req_length = (size_t)len;
+    end_code = code + code_len;
 
-    return;
+    program = (RE_DFAProgram*)re_alloc(sizeof(RE_DFAProgram));
+    if (!program)
+        goto error;
 
-error:
-    PyErr_Clear();
-    re_dealloc(chars);
-}
+    program->entry = (Py_ssize_t)code[0];
+    program->count = (Py_ssize_t)code[1];
+    program->assertion_count = 0;
+    program->classes = 0;
+    program->local = TRUE;
+    program->at_final_line_sep = FALSE;
+    program->instrs = (RE_DFAInstr*)re_alloc((size_t)program->count *
+      sizeof(RE_DFAInstr));
+    if (!program->instrs) {
+        re_dealloc(program);
+        goto error;
+    }
 
-/* Makes a STRING node. */
-Py_LOCAL_INLINE(RE_Node*) make_STRING_node(PatternObject* pattern, RE_UINT8 op,
-  size_t length, RE_CODE* chars) {
-    Py_ssize_t step;
-    RE_Node* node;
-    size_t i;
+    /* Each instruction is a split, a match, or a test followed by the index
+     * of the next instruction.
+     */
+    p = code + 2;
+    for (i = 0; i < program->count; i++) {
+        RE_DFAInstr* instr;
 
-    step = get_step(op);
+        instr = &program->instrs[i];
+        instr->node = NULL;
+        instr->next_1 = 0;
+        instr->next_2 = 0;
+        instr->context_bit = 0;
 
-    /* Create the node. */
-    node = create_node(pattern, op, 0, step * (Py_ssize_t)length, length);
-    if (!node)
-        return NULL;
+        if (p >= end_code)
+            goto illegal;
 
-    node->status |= RE_STATUS_STRING;
+        switch (p[0]) {
+        case RE_OP_BRANCH:
+            if (end_code - p < 3)
+                goto illegal;
 
-    for (i = 0; i < length; i++)
-        node->values[i] = chars[i];
+            instr->kind = RE_DFA_SPLIT;
+            instr->next_1 = (Py_ssize_t)p[1];
+            instr->next_2 = (Py_ssize_t)p[2];
+            p += 3;
+            break;
+        case RE_OP_SUCCESS:
+            instr->kind = RE_DFA_MATCH;
+            ++p;
+            break;
+        default:
+        {
+            RE_CompileArgs args;
+            RE_Node* node;
+            int kind;
+
+            args.code = p;
+            args.end_code = end_code;
+            args.pattern = pattern;
+            args.forward = TRUE;
+            args.min_width = 0;
+            args.repeat_depth = 0;
+            args.visible_captures = FALSE;
+            args.has_captures = FALSE;
+            args.is_fuzzy = FALSE;
+            args.within_fuzzy = FALSE;
+
+            /* The test should be a single node followed by 'NEXT'. */
+            if (build_sequence(&args) != RE_ERROR_SUCCESS)
+                goto illegal;
+
+            node = args.start->next_1.node;
+            if (!node || node != args.end || end_code - args.code < 2 ||
+              args.code[0] != RE_OP_NEXT)
+                goto illegal;
+
+            kind = dfa_instr_kind(node->op);
+            if (kind < 0)
+                goto illegal;
+
+            instr->kind = (RE_UINT8)kind;
+            instr->node = node;
+            instr->next_1 = (Py_ssize_t)args.code[1];
+            p = args.code + 2;
+
+            if (kind == RE_DFA_ASSERT) {
+                size_t a;
+
+                /* Assertions with the same op and sense have the same result,
+                 * so they share a bit in the context.
+                 */
+                for (a = 0; a < program->assertion_count; a++) {
+                    if (program->assertions[a]->op == node->op &&
+                      program->assertions[a]->match == node->match)
+                        break;
+                }
 
-    return node;
+                if (a >= program->assertion_count) {
+                    if (a >= RE_DFA_MAX_ASSERTIONS)
+                        goto illegal;
+
+                    program->assertions[a] = node;
+                    ++program->assertion_count;
+                }
+
+                instr->context_bit = (RE_UINT32)1 << a;
+                program->classes |= dfa_assertion_classes(node->op);
+
+                switch (node->op) {
+                case RE_OP_DEFAULT_BOUNDARY:
+                case RE_OP_DEFAULT_END_OF_WORD:
+                case RE_OP_DEFAULT_START_OF_WORD:
+                    program->local = FALSE;
+                    break;
+                case RE_OP_END_OF_STRING_LINE:
+                case RE_OP_END_OF_STRING_LINE_U:
+                    program->at_final_line_sep = TRUE;
+                    break;
+                }
+            }
+            break;
+        }
+        }
+
+        if (instr->next_1 >= program->count || instr->next_2 >=
+          program->count)
+            goto illegal;
+    }
+
+    if (p != end_code || program->entry >= program->count)
+        goto illegal;
+
+    re_dealloc(code);
+
+    return program;
+
+illegal:
+    re_dealloc(program->instrs);
+    re_dealloc(program);
+
+error:
+    re_dealloc(code);
+    PyErr_Clear();
+
+    return NULL;
 }
 
 /* Scans all of the characters in the current locale for their properties. */
@@ -23184,6 +27035,8 @@ static PyObject* re_compile(PyObject* self_, PyObject* args) {
     Py_ssize_t req_offset;
     PyObject* required_chars;
     Py_ssize_t req_flags;
+    PyObject* req_literals;
+    PyObject* dfa_code;
     size_t public_group_count;
     Py_ssize_t code_len;
     RE_CODE* code;
@@ -23196,9 +27049,10 @@ static PyObject* re_compile(PyObject* self_, PyObject* args) {
     BOOL ascii;
     BOOL ok;
 
-    if (!PyArg_ParseTuple(args, "OnOOOOOnOnn:re_compile", &pattern, &flags,
+    if (!PyArg_ParseTuple(args, "OnOOOOOnOnOOn:re_compile", &pattern, &flags,
       &code_list, &groupindex, &indexgroup, &named_lists, &named_list_indexes,
-      &req_offset, &required_chars, &req_flags, &public_group_count))
+      &req_offset, &required_chars, &req_flags, &req_literals, &dfa_code,
+      &public_group_count))
         return NULL;
 
     /* Read the regex code. */
@@ -23247,10 +27101,10 @@ static PyObject* re_compile(PyObject* self_, PyObject* args) {
     self->groupindex = groupindex;
     self->indexgroup = indexgroup;
     self->named_lists = named_lists;
-    self->named_lists_count = (size_t)PyDict_Size(named_lists);
-    self->partial_named_lists[0] = NULL;
-    self->partial_named_lists[1] = NULL;
     self->named_list_indexes = named_list_indexes;
+    self->named_lists_count = (size_t)PyList_GET_SIZE(named_list_indexes);
+    self->named_list_tries[0] = NULL;
+    self->named_list_tries[1] = NULL;
     self->node_capacity = 0;
     self->node_count = 0;
     self->node_list = NULL;
@@ -23261,12 +27115,21 @@ static PyObject* re_compile(PyObject* self_, PyObject* args) {
     self->call_ref_info = NULL;
     self->repeat_info_capacity = 0;
     self->repeat_info = NULL;
-    self->groups_storage = NULL;
-    self->repeats_storage = NULL;
+    self->state_pool_count = 0;
+    self->state_pool_hits = 0;
+    self->state_pool_misses = 0;
     self->fuzzy_count = 0;
     self->recursive = FALSE;
     self->req_offset = req_offset;
     self->req_string = NULL;
+    self->req_alts = NULL;
+    self->req_following = NULL;
+    for (i = 0; i < 2; i++) {
+        self->dfa_programs[i] = NULL;
+        self->dfa_storage[i] = NULL;
+    }
+    self->fuzzy_literal = NULL;
+    self->bestmatch_passes_avoided = 0;
     self->locale_info = NULL;
     Py_INCREF(self->pattern);
     Py_INCREF(self->groupindex);
@@ -23291,6 +27154,24 @@ static PyObject* re_compile(PyObject* self_, PyObject* args) {
     else if (ascii)
         self->encoding = &ascii_encoding;
 
+    /* The tries of the named lists are built as the nodes which use them are
+     * compiled.
+     */
+    for (i = 0; i < 2; i++) {
+        size_t size;
+
+        size = self->named_lists_count * sizeof(RE_StringTrie);
+        self->named_list_tries[i] = (RE_StringTrie*)re_alloc(size + 1);
+        if (!self->named_list_tries[i]) {
+            Py_DECREF(self);
+            re_dealloc(req_chars);
+            re_dealloc(code);
+            return NULL;
+        }
+
+        memset(self->named_list_tries[i], 0, size);
+    }
+
     /* Compile the regular expression code to nodes. */
     ok = compile_to_nodes(code, code + code_len, self);
 
@@ -23357,6 +27238,42 @@ static PyObject* re_compile(PyObject* self_, PyObject* args) {
         scan_locale_chars(self->locale_info);
     }
 
+    /* Make nodes for the other required strings, if there are any. */
+    if (PyTuple_Check(req_literals) && PyTuple_GET_SIZE(req_literals) == 3) {
+        self->req_alts = make_required_alts(self,
+          PyTuple_GET_ITEM(req_literals, 0), PyTuple_GET_ITEM(req_literals,
+          1));
+
+        /* The strings following the required string are looked for only if
+         * there's a required string.
+         */
+        if (self->req_string)
+            self->req_following = make_required_list(self,
+              PyTuple_GET_ITEM(req_literals, 2), RE_MAX_REQ_FOLLOWING);
+    }
+
+    /* Make the programs for the lazy DFA, if the pattern is suitable. It's
+     * used only if there are programs for both directions.
+     */
+    if (PyTuple_Check(dfa_code) && PyTuple_GET_SIZE(dfa_code) == 2) {
+        for (i = 0; i < 2; i++)
+            self->dfa_programs[i] = make_dfa_program(self,
+              PyTuple_GET_ITEM(dfa_code, i));
+
+        if (!self->dfa_programs[0] || !self->dfa_programs[1]) {
+            for (i = 0; i < 2; i++) {
+                dealloc_dfa_program(self->dfa_programs[i]);
+                self->dfa_programs[i] = NULL;
+            }
+        }
+    }
+
+    /* Make the info for scanning for a fuzzy literal, if the pattern is one.
+     */
+    self->fuzzy_literal = make_fuzzy_literal(self);
+
+    self->single_pass_best = can_find_best_in_single_pass(self);
+
     return (PyObject*)self;
 
 error:
@@ -23370,6 +27287,93 @@ static PyObject* get_code_size(PyObject* self, PyObject* unused) {
     return Py_BuildValue("n", sizeof(RE_CODE));
 }
 
+/* Sets the default maximum memory for matching. */
+static PyObject* set_max_memory(PyObject* self, PyObject* args) {
+    PyObject* max_memory;
+    Py_ssize_t limit;
+
+    if (!PyArg_ParseTuple(args, "O:set_max_memory", &max_memory))
+        return NULL;
+
+    if (!decode_size_limit(max_memory, "max_memory", -1, &limit))
+        return NULL;
+
+    default_max_memory = limit;
+
+    Py_INCREF(Py_None);
+    return Py_None;
+}
+
+/* Marks or unmarks a thread's matching as cancelled. */
+static PyObject* set_cancelled(PyObject* self_, PyObject* args) {
+    PyObject* thread_id;
+    int cancelled;
+    int status;
+
+    if (!PyArg_ParseTuple(args, "Oi:set_cancelled", &thread_id, &cancelled))
+        return NULL;
+
+    if (!cancelled_threads) {
+        cancelled_threads = PySet_New(NULL);
+        if (!cancelled_threads)
+            return NULL;
+    }
+
+    if (cancelled)
+        status = PySet_Add(cancelled_threads, thread_id);
+    else
+        status = PySet_Discard(cancelled_threads, thread_id);
+    if (status < 0)
+        return NULL;
+
+    Py_INCREF(Py_None);
+    return Py_None;
+}
+
+/* Moves a match from a chunk of a stream to its offset in the stream.
+ *
+ * The match keeps the chunk, but its string is detached and its positions are
+ * made relative to the start of the stream.
+ */
+static PyObject* offset_match(PyObject* self_, PyObject* args) {
+    MatchObject* match;
+    Py_ssize_t offset;
+    size_t g;
+
+    if (!PyArg_ParseTuple(args, "O!n:offset_match", &Match_Type, &match,
+      &offset))
+        return NULL;
+
+    Py_CLEAR(match->string);
+    Py_CLEAR(match->regs);
+
+    match->substring_offset += offset;
+    match->pos += offset;
+    match->endpos += offset;
+    match->match_start += offset;
+    match->match_end += offset;
+
+    for (g = 0; g < match->group_count; g++) {
+        RE_GroupData* group;
+        size_t c;
+
+        group = &match->groups[g];
+
+        if (group->span.start >= 0) {
+            group->span.start += offset;
+            group->span.end += offset;
+        }
+
+        for (c = 0; c < group->capture_count; c++) {
+            group->captures[c].start += offset;
+            group->captures[c].end += offset;
+        }
+    }
+
+    Py_INCREF(Py_None);
+    return Py_None;
+}
+
 /* Gets the property dict. */
 static PyObject* get_properties(PyObject* self_, PyObject* args) {
     Py_INCREF(property_dict);
@@ -23664,6 +27668,9 @@ static PyMethodDef _functions[] = {
     {"get_expand_on_folding", (PyCFunction)get_expand_on_folding, METH_NOARGS},
     {"has_property_value", (PyCFunction)has_property_value, METH_VARARGS},
     {"get_all_cases", (PyCFunction)get_all_cases, METH_VARARGS},
+    {"set_max_memory", (PyCFunction)set_max_memory, METH_VARARGS},
+    {"offset_match", (PyCFunction)offset_match, METH_VARARGS},
+    {"set_cancelled", (PyCFunction)set_cancelled, METH_VARARGS},
     {NULL, NULL}
 };
 
@@ -23845,6 +27852,9 @@ PyMODINIT_FUNC PyInit__regex(void) {
         return NULL;
 
     error_exception = NULL;
+    timeout_exception = NULL;
+    monotonic_clock = NULL;
+    memory_limit_exception = NULL;
 
     m = PyModule_Create(&remodule);
     if (!m)
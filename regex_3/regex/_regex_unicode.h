@@ -224,3 +224,11 @@ RE_UINT32 re_get_posix_xdigit(RE_UINT32 ch);
 int re_get_all_cases(RE_UINT32 ch, RE_UINT32* codepoints);
 RE_UINT32 re_get_simple_case_folding(RE_UINT32 ch);
 int re_get_full_case_folding(RE_UINT32 ch, RE_UINT32* codepoints);
+
+#define RE_LATIN1_WORD 0x1
+#define RE_LATIN1_ALNUM 0x2
+#define RE_LATIN1_ALPHA 0x4
+#define RE_LATIN1_SPACE 0x8
+
+extern RE_UINT8 re_latin1_gc[0x100];
+extern RE_UINT8 re_latin1_flags[0x100];
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+# This script measures how long it takes to compile a pattern which is a large
+# alternation of literals, such as one generated from a keyword file, and how
+# much memory is needed to do it.
+#
+# For each size it compiles an alternation of that many distinct random words,
+# reporting the time taken and the peak memory allocated, and then the time
+# taken to search some text with the compiled pattern. The memory is measured
+# in a separate compilation because tracing it slows the compilation down.
+#
+# It uses whichever regex module is importable, so run it with PYTHONPATH
+# pointing at a build to compare builds.
+#
+# This script is written in Python 3.
+
+import random
+import string
+import sys
+import time
+import tracemalloc
+
+import regex
+
+def make_words(count, rng):
+    words = set()
+    while len(words) < count:
+        length = rng.randint(3, 12)
+        words.add("".join(rng.choice(string.ascii_lowercase) for _ in
+          range(length)))
+
+    words = list(words)
+    rng.shuffle(words)
+
+    return words
+
+def make_text(words, length, rng):
+    text = []
+    for _ in range(length):
+        if rng.random() < 0.1:
+            text.append(rng.choice(words))
+        else:
+            text.append("".join(rng.choice(string.ascii_lowercase) for _ in
+              range(rng.randint(3, 12))))
+
+    return " ".join(text)
+
+def bench(count, rng):
+    words = make_words(count, rng)
+    pattern = r"\b(?:{})\b".format("|".join(words))
+    text = make_text(words, 10000, rng)
+
+    start = time.perf_counter()
+    compiled = regex.compile(pattern, cache_pattern=False)
+    compile_time = time.perf_counter() - start
+
+    # Tracing the memory slows the compilation, so it's compiled again.
+    regex.purge()
+    tracemalloc.start()
+    regex.compile(pattern, cache_pattern=False)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    found = len(compiled.findall(text))
+    search_time = time.perf_counter() - start
+
+    print("{:>7} literals: compile {:8.3f}s, peak {:8.1f} MiB, findall "
+      "{:8.3f}s ({} found)".format(count, compile_time, peak / 1024 / 1024,
+      search_time, found))
+
+def main(args):
+    sizes = [int(arg) for arg in args] or [1000, 10000, 100000]
+    rng = random.Random(0)
+
+    print("regex {} from {}".format(regex.__version__, regex.__file__))
+
+    for count in sizes:
+        bench(count, rng)
+
+if __name__ == "__main__":
+    main(sys.argv[1 : ])
@@ -2009,9 +2009,76 @@ RE_GetPropertyFunc re_get_property[] = {
 
     c_file.write("};\n")
 
+    generate_latin1_tables(h_file, c_file, info)
+
     h_file.close()
     c_file.close()
 
+def generate_latin1_tables(h_file, c_file, info):
+    """Generates flat tables of the commonest properties of the codepoints in
+    the Latin-1 range, so that they can be looked up without going through the
+    multi-stage tables.
+    """
+
+    gc_entries = properties["GC"].entries
+    alpha_entries = properties["Alpha"].entries
+    space_entries = properties["Space"].entries
+
+    gc_short = info["gc_short"]
+    word_mask = (info["gc_masks"]["M"] | (1 << gc_short["ND"]) | (1 <<
+      gc_short["PC"]))
+
+    flag_names = ["WORD", "ALNUM", "ALPHA", "SPACE"]
+
+    h_file.write("\n")
+
+    for i, name in enumerate(flag_names):
+        h_file.write("#define RE_LATIN1_{} 0x{:X}\n".format(name, 1 << i))
+
+    h_file.write("""
+extern RE_UINT8 re_latin1_gc[0x100];
+extern RE_UINT8 re_latin1_flags[0x100];
+""")
+
+    gc_items = []
+    flag_items = []
+    for ch in range(0x100):
+        gc = gc_entries[ch]
+        alpha = alpha_entries[ch] == 1
+
+        flags = 0
+        if alpha or (word_mask & (1 << gc)) != 0:
+            flags |= 0x1
+        if alpha or gc == gc_short["ND"]:
+            flags |= 0x2
+        if alpha:
+            flags |= 0x4
+        if space_entries[ch] == 1:
+            flags |= 0x8
+
+        gc_items.append("{},".format(gc))
+        flag_items.append("0x{:X},".format(flags))
+
+    columns = 16
+    for name, items in [("gc", gc_items), ("flags", flag_items)]:
+        width = max(len(i) for i in items)
+        items = [i.rjust(width) for i in items]
+
+        c_file.write("""
+/* Latin-1 {name}. */
+
+RE_UINT8 re_latin1_{name}[] = {{
+""".format(name=name))
+
+        for start in range(0, len(items), columns):
+            c_file.write("    {}\n".format(" ".join(items[start : start +
+              columns])))
+
+        c_file.write("""}};
+
+/* Latin-1 {name}: {bytesize} bytes. */
+""".format(name=name, bytesize=len(items)))
+
 # Build a dict for converting 8-tuples into bytes.
 bitflag_dict = {}
 for value in range(0x100):